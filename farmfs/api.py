@@ -1,12 +1,33 @@
+import os
+import uuid
 from flask import Flask, request, g, jsonify, url_for, Response
 from flask.typing import ResponseReturnValue
+from werkzeug.wsgi import wrap_file
 from farmfs import getvol, cwd
+from farmfs.apiserver import DEFAULT_SERVER_THREADS, ApiServer
+from farmfs.blobstore import (
+    BULK_CONTENT_TYPE,
+    BULK_FRAME,
+    BULK_MISSING,
+    CHUNKED,
+    PACKED,
+    BulkFrame,
+    bulk_frame_head,
+    decode_manifest,
+    read_bulk_frame_head,
+    valid_blob_id,
+)
+from farmfs.codec import SAMPLE_SIZE, CompressingReader, DecompressingReader, worth_compressing
 from farmfs.fs import Path
+from farmfs.util import Readable
 from docopt import docopt
-from typing import Optional
+from typing import IO, Dict, Iterator, List, Optional, Sequence, Tuple, cast
 
 from farmfs.volume import FarmFSVolume
 
+# Bytes read at a time when sending a blob the server can't hand to sendfile.
+DEFAULT_CHUNK_SIZE = int(os.environ.get("FARMFS_API_CHUNK_SIZE", str(1024 * 1024)))
+
 API_USAGE = """
     Farmfs API endpoint.
 
@@ -14,55 +35,214 @@ API_USAGE = """
       farmapi [options]
 
     Options:
-      --host=<host>  Host interface to bind to [default: 127.0.0.1].
-      --port=<port>  Port to run the Flask app on [default: 5000].
-      --root=<root>  Where the farmfs depot is located.
-      -h --help      Show this help message.
+      --host=<host>          Host interface to bind to [default: 127.0.0.1].
+      --port=<port>          Port to run the Flask app on [default: 5000].
+      --root=<root>          Where the farmfs depot is located.
+      --threads=<n>          Connections served at once [default: %d].
+      --chunk-size=<bytes>   Bytes read at a time when a blob can't be sent with sendfile.
+      --debug                Run Flask's debug server instead, one connection per request.
+      -h --help              Show this help message.
+    """ % DEFAULT_SERVER_THREADS
+
+class _FileRange:
+    """The next length bytes of fd, for a wsgi.file_wrapper. fileno lets a server sendfile them."""
+
+    def __init__(self, fd: IO[bytes], length: int):
+        self._fd = fd
+        self._remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        n = self._remaining if size < 0 else min(size, self._remaining)
+        data = self._fd.read(n)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self._fd.fileno()
+
+    def close(self) -> None:
+        self._fd.close()
+
+
+def _satisfiable(ranges: Sequence[Tuple[int, Optional[int]]], size: int) -> List[Tuple[int, int]]:
+    """Resolve parsed byte ranges against a size, as (start, stop) pairs, dropping any wholly past the end."""
+    resolved = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+
+def _multipart_ranges(fd: IO[bytes], ranges: List[Tuple[int, int]], size: int, chunk_size: int) -> Response:
+    """A multipart/byteranges response holding each range of fd."""
+    boundary = uuid.uuid4().hex
+    heads = [
+        (f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+        for start, stop in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def body() -> Iterator[bytes]:
+        with fd:
+            for i, (head, (start, stop)) in enumerate(zip(heads, ranges)):
+                yield (b"\r\n" if i else b"") + head
+                fd.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    data = fd.read(min(chunk_size, remaining))
+                    if not data:
+                        raise ValueError(f"Blob ended {remaining} bytes short of {size}")
+                    remaining -= len(data)
+                    yield data
+            yield tail
+    response = Response(body(), status=206, mimetype=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
+    response.content_length = sum(len(h) for h in heads) + 2 * (len(ranges) - 1) + sum(b - a for a, b in ranges) + len(tail)
+    return response
+
+
+def _encoded(fd: IO[bytes], codec: Optional[str], blob: str, gzip_ok: bool, chunk_size: int) -> Response:
     """
+    A blob whose bytes on disk aren't what the client is after: a compressed blob
+    sent as is to a client accepting gzip, or decompressed for one that doesn't,
+    or a plain one compressed as it is sent. Only the first has a known length.
+    """
+    def body(src: Readable[bytes]) -> Iterator[bytes]:
+        with fd:
+            while data := src.read(chunk_size):
+                yield data
+    if codec is not None and gzip_ok:
+        response = Response(wrap_file(request.environ, fd, chunk_size), content_type="application/octet-stream", direct_passthrough=True)
+        response.content_length = os.fstat(fd.fileno()).st_size
+    elif codec is not None:
+        response = Response(body(DecompressingReader(fd)), content_type="application/octet-stream", direct_passthrough=True)
+    else:
+        response = Response(body(CompressingReader(fd)), content_type="application/octet-stream", direct_passthrough=True)
+    if gzip_ok:
+        response.content_encoding = "gzip"
+        response.set_etag(blob, weak=True)
+    else:
+        response.set_etag(blob)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def _assembled(vol: FarmFSVolume, blob: str, chunk_size: int) -> Response:
+    """A chunked or packed blob with no plain copy, read out of its chunks or pack as it is sent."""
+    size = vol.bs.blob_size(blob)
+
+    def body() -> Iterator[bytes]:
+        with vol.bs.read_handle(blob) as src:
+            while data := src.read(chunk_size):
+                yield data
+    response = Response(body(), content_type="application/octet-stream", direct_passthrough=True)
+    response.content_length = size
+    response.set_etag(blob)
+    return response
+
 
 def get_app(args: dict[str, str]) -> Flask:
     app = Flask("farmfs")
+    # Opened once and shared by every request; the blobstore holds no per request state.
+    vol = getvol(Path(args.get("<root>") or args.get("--root") or cwd))
+    chunk_size = int(args.get("--chunk-size") or DEFAULT_CHUNK_SIZE)
 
     @app.before_request
     def get_volume() -> None:
-        g.vol = getvol(Path(args.get("<root>", cwd)))
+        g.vol = vol
 
     @app.route("/bs", methods=["POST"])
     def blob_create() -> ResponseReturnValue:
         """
         Create a new blob in the blobstore.
         blob is a required argument, which is the md5 checksum of the blob content.
+        The body may be sent with Content-Encoding: gzip.
+        The body is hashed as it is stored, and a body whose md5 isn't blob gets a 400.
         """
-        headers = {}
+        headers: Dict[str, str] = {}
         vol: FarmFSVolume = g.vol
         blob = request.args["blob"]
+        encoding = request.headers.get("Content-Encoding", "identity")
+        if encoding not in ("identity", "gzip"):
+            return jsonify({"error": f"unsupported Content-Encoding {encoding}"}), 415, headers
         try:
-            upload_fd = request.stream
+            upload_fd = request.stream if encoding == "identity" else DecompressingReader(request.stream)
             # HTTP doesn't give us retry capability on upload_fd
             with vol.bs.session() as sess:
-                duplicate = sess.import_via_fd(lambda: upload_fd, blob)
+                _, duplicate = sess.import_verified(lambda: upload_fd, blob)
             if duplicate:
                 status = 200
             else:
                 status = 201
             headers["Location"] = url_for("blob_get_head", blob=blob, _external=True)
             return jsonify({"duplicate": duplicate, "blob": blob}), status, headers
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400, headers
         except Exception as e:
             return jsonify({"error": str(e)}), 500, headers
 
     def blob_read(blob: str) -> ResponseReturnValue:
         """
-        Read a blob. <blob> is the md5 checksum of the content.
-        Returns 404 if not found.
+        Read a blob. <blob> is the md5 checksum of the content, and serves as its strong ETag.
+        Returns 304 if If-None-Match names the blob, 404 if not found.
+        A Range header gets a 206 with just those bytes, in a multipart/byteranges
+        body if there are several ranges, or a 416 if none of them are in the blob.
+        If-Range makes the Range conditional on the ETag still matching.
+
+        A client accepting gzip gets a compressed blob as it is stored, and a plain
+        one compressed if it looks worth it, with the ETag weakened to match.
+        A chunked blob without a plain copy is sent put back together, and a packed
+        one read out of its pack.
+        Ranges are only served from blobs sent as they are.
         """
         vol: FarmFSVolume = g.vol
+        if request.if_none_match.contains_weak(blob):
+            response = Response(status=304)
+            response.set_etag(blob)
+            return response
         try:
-            response = Response(
-                vol.bs.blob_chunks(blob, 4096), content_type="application/octet-stream"
-            )
+            path, codec = vol.bs.stored_blob(blob)
+            if codec in (CHUNKED, PACKED):
+                return _assembled(vol, blob, chunk_size)
+            fd = path.open("rb")
         except FileNotFoundError:
             return "", 404, {}
-        return response, 200, {}
+        gzip_ok = request.accept_encodings["gzip"] > 0
+        if codec is not None or (gzip_ok and request.range is None and worth_compressing(os.pread(fd.fileno(), SAMPLE_SIZE, 0))):
+            return _encoded(fd, codec, blob, gzip_ok, chunk_size)
+        size = os.fstat(fd.fileno()).st_size
+        ranges = None
+        if request.range is not None and request.range.units == "bytes":
+            if_range = request.if_range
+            if if_range.date is None and (if_range.etag is None or if_range.etag == blob):
+                ranges = _satisfiable(request.range.ranges, size)
+        if ranges == []:
+            fd.close()
+            return "", 416, {"Content-Range": f"bytes */{size}"}
+        if ranges is None:
+            # A server with a zero copy wsgi.file_wrapper sends the file itself; otherwise it is read chunk_size at a time.
+            response = Response(
+                wrap_file(request.environ, fd, chunk_size), content_type="application/octet-stream", direct_passthrough=True
+            )
+            response.content_length = size
+        elif len(ranges) == 1:
+            start, stop = ranges[0]
+            fd.seek(start)
+            response = Response(
+                wrap_file(request.environ, cast(IO[bytes], _FileRange(fd, stop - start)), chunk_size),
+                status=206, content_type="application/octet-stream", direct_passthrough=True,
+            )
+            response.content_length = stop - start
+            response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        else:
+            response = _multipart_ranges(fd, ranges, size, chunk_size)
+        response.set_etag(blob)
+        response.accept_ranges = "bytes"
+        return response
 
     # TODO: Update (not needed for immutable store? Maybe for fixing corruptions?)
 
@@ -114,6 +294,95 @@ def get_app(args: dict[str, str]) -> Flask:
         else:
             return "", 404
 
+    @app.route("/bs/exists", methods=["POST"])
+    def blob_exists_many() -> ResponseReturnValue:
+        """
+        Check which of a batch of blobs are in the blobstore.
+
+        Request JSON:
+          {"blobs": [...]}
+        Response JSON:
+          {"present": [...]}, the subset of blobs which are present.
+        """
+        vol = g.vol
+        payload = request.get_json(force=True, silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get("blobs"), list):
+            return jsonify({"error": "expected a JSON object with a blobs list"}), 400
+        present = vol.bs.exists_many(payload["blobs"])
+        return jsonify({"present": sorted(present)}), 200
+
+    @app.route("/bs/bulk-read", methods=["POST"])
+    def blob_read_many() -> ResponseReturnValue:
+        """
+        Read a batch of blobs in one response.
+
+        Request JSON:
+          {"blobs": [...]}
+        Response:
+          A frame for each blob, in the order asked for. See farmfs.blobstore.BULK_FRAME.
+        """
+        vol: FarmFSVolume = g.vol
+        payload = request.get_json(force=True, silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get("blobs"), list):
+            return jsonify({"error": "expected a JSON object with a blobs list"}), 400
+        blobs = payload["blobs"]
+        if not all(valid_blob_id(blob) for blob in blobs):
+            return jsonify({"error": "blobs must be md5 hexdigests"}), 400
+        sizes: List[Optional[int]] = []
+        for blob in blobs:
+            try:
+                sizes.append(vol.bs.blob_size(blob))
+            except FileNotFoundError:
+                sizes.append(None)
+
+        def body() -> Iterator[bytes]:
+            for blob, size in zip(blobs, sizes):
+                if size is None:
+                    yield bulk_frame_head(blob, BULK_MISSING)
+                    continue
+                yield bulk_frame_head(blob, size)
+                with vol.bs.read_handle(blob) as fd:
+                    frame = BulkFrame(fd, size)
+                    while data := frame.read(chunk_size):
+                        yield data
+        response = Response(body(), content_type=BULK_CONTENT_TYPE, direct_passthrough=True)
+        response.content_length = sum(BULK_FRAME.size + (size or 0) for size in sizes)
+        return response
+
+    @app.route("/bs/bulk", methods=["POST"])
+    def blob_create_many() -> ResponseReturnValue:
+        """
+        Create a batch of blobs from one body of frames. See farmfs.blobstore.BULK_FRAME.
+        Each frame is hashed as it is stored, and the batch stops with a 400 at the
+        first whose md5 isn't its blob, naming it.
+
+        Response JSON:
+          {"created": [...], "duplicate": [...]}
+        """
+        vol: FarmFSVolume = g.vol
+        created: List[str] = []
+        duplicate: List[str] = []
+        blob: Optional[str] = None
+        stream = request.stream
+        try:
+            with vol.bs.session() as sess:
+                while (head := read_bulk_frame_head(stream)) is not None:
+                    blob, length = head
+                    if length == BULK_MISSING:
+                        raise ValueError(f"No bytes sent for {blob}")
+                    frame = BulkFrame(stream, length)
+                    if sess.import_verified(lambda: frame, blob)[1]:
+                        duplicate.append(blob)
+                    else:
+                        created.append(blob)
+                    frame.skip()
+                    blob = None
+        except (ValueError, ConnectionError) as e:
+            return jsonify({"error": str(e), "blob": blob, "created": created}), 400
+        except Exception as e:
+            return jsonify({"error": str(e), "created": created}), 500
+        return jsonify({"created": created, "duplicate": duplicate}), 200
+
     @app.route("/bs/<blob>", methods=["HEAD", "GET", "DELETE"])
     def blob_get_head(blob):
         """Router on blob operations to different verbs"""
@@ -126,6 +395,32 @@ def get_app(args: dict[str, str]) -> Flask:
         else:
             return "", 405  # Method Not Allowed
 
+    @app.route("/bs/<blob>/chunks", methods=["GET", "PUT"])
+    def blob_manifest(blob: str) -> ResponseReturnValue:
+        """
+        GET the chunks a blob is stored as, 404 if it isn't chunked.
+        PUT stores a blob as chunks already in the blobstore: 201 if it is new,
+        200 if it was already present, 400 if the manifest is bad or names a missing chunk.
+
+        Manifest JSON:
+          {"chunks": [[<chunk>, <size>], ...]}
+        """
+        vol: FarmFSVolume = g.vol
+        if not valid_blob_id(blob):
+            return jsonify({"error": "blob must be an md5 hexdigest"}), 400
+        if request.method == "GET":
+            manifest = vol.bs.manifest(blob)
+            if manifest is None:
+                return jsonify({"error": f"{blob} is not chunked"}), 404
+            return jsonify({"chunks": manifest}), 200
+        try:
+            manifest = decode_manifest(request.get_data())
+            with vol.bs.session() as sess:
+                duplicate = sess.import_manifest(blob, manifest)
+        except (ValueError, FileNotFoundError) as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"duplicate": duplicate, "blob": blob}), 200 if duplicate else 201
+
     @app.route("/bs/<blob>/checksum", methods=["GET"])
     def blob_get_checksum(blob) -> ResponseReturnValue:
         vol = g.vol
@@ -138,4 +433,14 @@ def get_app(args: dict[str, str]) -> Flask:
 def api_main() -> None:
     args = docopt(API_USAGE)
     app = get_app(args)
-    app.run(debug=True, host=args["--host"], port=int(args["--port"]))
+    if args["--debug"]:
+        app.run(debug=True, host=args["--host"], port=int(args["--port"]))
+        return
+    server = ApiServer(args["--host"], int(args["--port"]), app, threads=int(args["--threads"]))
+    print(f"Serving farmapi on http://{args['--host']}:{server.server_port} with {args['--threads']} threads")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
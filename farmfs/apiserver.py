@@ -0,0 +1,219 @@
+"""A threaded WSGI server for serving farmapi in production.
+
+Flask's development server handles each connection on its own thread but
+closes it after one request, and copies every response through Python. This
+server keeps HTTP/1.1 connections alive, so the clients' connection pools
+(see farmfs.connpool) get reused, and hands file responses wrapped with
+wsgi.file_wrapper to os.sendfile, so blob bodies go from the page cache to the
+socket without being copied through userspace. A response of unknown length,
+like a blob compressed as it is sent, goes out with chunked transfer coding,
+so it doesn't cost the connection either.
+
+Each connection gets a thread, which an idle keep-alive connection holds
+until the client hangs up or keep_alive_timeout passes. Idle connections
+cost little, so the limit is on requests instead: at most threads are handled
+at once, and the rest wait their turn.
+"""
+import logging
+import os
+import socket
+import sys
+import threading
+from socketserver import ThreadingMixIn
+from typing import IO, Any, Dict, Optional, Set, cast
+from wsgiref.handlers import SimpleHandler
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from wsgiref.types import WSGIApplication
+from wsgiref.util import FileWrapper
+
+from werkzeug.serving import DechunkedInput
+from werkzeug.wsgi import LimitedStream
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVER_THREADS = 16
+# Seconds an idle keep-alive connection is held open.
+DEFAULT_KEEP_ALIVE_TIMEOUT = 60.0
+
+
+class _Handler(SimpleHandler):
+    """Runs one request, sending file responses with os.sendfile."""
+    http_version = "1.1"
+    os_environ: Dict[str, str] = {}  # Don't copy the server's environment into every request.
+    wsgi_file_wrapper = FileWrapper
+    # Set by BaseHandler, which typeshed doesn't declare.
+    environ: Dict[str, Any]
+    status: Optional[str]
+    headers: Any
+    headers_sent: bool
+    result: Any
+    bytes_sent: int
+
+    def __init__(self, request_handler: "_RequestHandler", stdin: Any, environ: Dict[str, Any]):
+        super().__init__(stdin, cast(IO[bytes], request_handler.wfile), sys.stderr, environ, multithread=True, multiprocess=False)
+        self.request_handler = request_handler
+        self.responded = False
+        self.chunked = False
+
+    def cleanup_headers(self) -> None:
+        super().cleanup_headers()
+        assert self.status is not None and self.headers is not None
+        bodiless = self.environ["REQUEST_METHOD"] == "HEAD" or self.status[:3] in ("204", "304")
+        if "Content-Length" not in self.headers and not bodiless:
+            if self.request_handler.request_version == "HTTP/1.1":
+                self.headers["Transfer-Encoding"] = "chunked"
+                self.chunked = True
+            else:
+                # Without a length the end of the body is the end of the connection.
+                self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers["Connection"] = "close"
+        self.responded = True
+
+    def write(self, data: bytes) -> None:
+        if not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if self.chunked:
+            if not data:
+                return  # An empty chunk would end the body.
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        self._write(data)
+        self._flush()
+
+    def finish_content(self) -> None:
+        super().finish_content()
+        if self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+
+    def handle_error(self) -> None:
+        # Whatever was sent of the response can't be trusted to be framed right.
+        self.request_handler.close_connection = True
+        super().handle_error()
+
+    def sendfile(self) -> bool:
+        assert self.result is not None and self.headers is not None
+        filelike = getattr(self.result, "filelike", None)
+        length = self.headers.get("Content-Length")
+        try:
+            fileno = filelike.fileno()  # type: ignore[union-attr]
+        except (AttributeError, OSError):
+            return False
+        if length is None or self.environ["REQUEST_METHOD"] == "HEAD":
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        out = self.request_handler.connection.fileno()
+        offset = os.lseek(fileno, 0, os.SEEK_CUR)
+        remaining = int(length)
+        while remaining > 0:
+            sent = os.sendfile(out, fileno, offset, remaining)
+            if sent == 0:
+                raise ConnectionError(f"File ended {remaining} bytes short of its Content-Length")
+            offset += sent
+            remaining -= sent
+        return True
+
+
+class _RequestHandler(WSGIRequestHandler):
+    """Serves requests off one connection until the client or the response closes it."""
+    protocol_version = "HTTP/1.1"
+    server: "ApiServer"
+
+    def setup(self) -> None:
+        super().setup()
+        self.connection.settimeout(self.server.keep_alive_timeout)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self) -> None:
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self) -> None:
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        environ = self.get_environ()
+        body: Any
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = DechunkedInput(cast(IO[bytes], self.rfile))
+            environ["wsgi.input_terminated"] = True
+        else:
+            body = LimitedStream(cast(IO[bytes], self.rfile), int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Expect", "").lower() == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        app = self.server.get_app()
+        assert app is not None
+        handler = _Handler(self, body, environ)
+        with self.server.slots:
+            handler.run(app)
+        if not handler.responded:
+            self.close_connection = True
+        if not self.close_connection:
+            # Skip whatever of the body the app didn't read, so the next request starts in the right place.
+            while body.read(1024 * 1024):
+                pass
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+class ApiServer(ThreadingMixIn, WSGIServer):
+    """A WSGIServer with a thread per connection, handling up to threads requests at once."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            app: WSGIApplication,
+            threads: int = DEFAULT_SERVER_THREADS,
+            keep_alive_timeout: float = DEFAULT_KEEP_ALIVE_TIMEOUT,
+    ):
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        self.keep_alive_timeout = keep_alive_timeout
+        self.slots = threading.BoundedSemaphore(threads)
+        self._lock = threading.Lock()
+        self._connections: Set[socket.socket] = set()
+        super().__init__((host, port), _RequestHandler)
+        self.set_app(app)
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        with self._lock:
+            self._connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request: Any) -> None:
+        with self._lock:
+            self._connections.discard(request)
+        super().shutdown_request(request)
+
+    def server_close(self) -> None:
+        """Stop listening, and hang up on idle keep-alive connections so their threads finish."""
+        super().server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -0,0 +1,319 @@
+"""
+An index of the blobs in a FileBlobstore.
+
+Without it, FileBlobstore.exists stats the blob's files, and fsck --missing,
+fetch, the link checker and gc ask about millions of blobs. Counting or
+paging through the blobs walks the fanout directories. The index answers all
+of these from memory.
+
+The index is two files in its directory. blobs.idx is a sorted array of the
+16 byte md5 digests of the blobs, memory mapped, with an optional Bloom filter
+after it which answers most questions about absent blobs without a search.
+blobs.log holds the changes since, a record appended for each blob imported
+or deleted by whichever process made the change. Once the log passes
+LOG_MAX records it is folded into a new blobs.idx and emptied. Writers
+append to the log under a shared flock, and whoever rewrites blobs.idx
+holds it exclusively. The log starts with a random generation, changed
+each time it is emptied, so readers know to load blobs.idx again.
+
+The index is built by walking the blobstore, and only used once built. A
+change made by hand, or by a farmfs without the index, isn't in the log,
+so the index should be built again after one.
+
+Index layout: INDEX_MAGIC, then as big endian 64 bit integers the blob count
+and the Bloom filter's size in bits, then its number of hashes as a byte,
+then the sorted digests, then the filter's bits.
+"""
+import bisect
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+import uuid
+from os import environ
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from farmfs.fs import Path, ensure_dir
+
+# Bits of Bloom filter per blob in the index; 10 bits and 7 hashes gives about 1% false
+# positives. 0 leaves the filter out, and every question is a binary search.
+DEFAULT_BLOOM_BITS = int(environ.get("FARMFS_BLOB_INDEX_BLOOM_BITS", "0"))
+# Log records kept before they are folded into the index.
+DEFAULT_LOG_MAX = int(environ.get("FARMFS_BLOB_INDEX_LOG_MAX", "65536"))
+
+INDEX_NAME = "blobs.idx"
+LOG_NAME = "blobs.log"
+INDEX_MAGIC = b"FARMBIDX"
+INDEX_HEADER = struct.Struct(">8sQQB")
+LOG_MAGIC = b"FARMBLOG"
+LOG_HEADER = struct.Struct(">8sQ")
+RECORD = struct.Struct(">c16s")
+DIGEST_SIZE = 16
+BLOOM_HASHES = 7
+
+_ADD = b"+"
+_DELETE = b"-"
+
+
+def _bloom_positions(digest: bytes, bits: int, hashes: int) -> Iterator[int]:
+    """The filter bits of digest. md5 digests are already uniform, so its halves are the hashes."""
+    h1 = int.from_bytes(digest[:8])
+    h2 = int.from_bytes(digest[8:]) | 1
+    return ((h1 + i * h2) % bits for i in range(hashes))
+
+
+def encode_index(digests: bytes, bloom_bits: int = DEFAULT_BLOOM_BITS) -> bytes:
+    """An index of the sorted, concatenated digests, with bloom_bits bits of filter per blob."""
+    count = len(digests) // DIGEST_SIZE
+    bits = count * bloom_bits
+    bits += -bits % 8
+    bloom = bytearray(bits // 8)
+    if bits:
+        for i in range(count):
+            for bit in _bloom_positions(digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE], bits, BLOOM_HASHES):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+    return INDEX_HEADER.pack(INDEX_MAGIC, count, bits, BLOOM_HASHES if bits else 0) + digests + bytes(bloom)
+
+
+class _Digests:
+    """The digests of a blobs.idx, as a sorted sequence which can be bisected."""
+
+    def __init__(self, data: bytes | mmap.mmap):
+        if len(data) < INDEX_HEADER.size:
+            raise ValueError("Blob index is truncated")
+        magic, count, bits, hashes = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or len(data) != INDEX_HEADER.size + count * DIGEST_SIZE + bits // 8:
+            raise ValueError("Not a blob index")
+        self._data = data
+        self._count = count
+        self._bits = bits
+        self._hashes = hashes
+        self._bloom = INDEX_HEADER.size + count * DIGEST_SIZE
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> bytes:
+        start = INDEX_HEADER.size + i * DIGEST_SIZE
+        return self._data[start:start + DIGEST_SIZE]
+
+    def __contains__(self, digest: bytes) -> bool:
+        if self._bits:
+            for bit in _bloom_positions(digest, self._bits, self._hashes):
+                if not self._data[self._bloom + (bit >> 3)] & (1 << (bit & 7)):
+                    return False
+        i = bisect.bisect_left(self, digest)
+        return i < self._count and self[i] == digest
+
+    def after(self, digest: Optional[bytes]) -> Iterator[bytes]:
+        """The digests after digest, or all of them."""
+        i = 0 if digest is None else bisect.bisect_right(self, digest)
+        return (self[j] for j in range(i, self._count))
+
+
+class BlobIndex:
+    """
+    The blob index in index_dir. Every method but build answers None while the
+    index isn't built. Safe to share between threads and processes.
+    """
+
+    def __init__(self, index_dir: Path, tmp_dir: Path, bloom_bits: int = DEFAULT_BLOOM_BITS, log_max: int = DEFAULT_LOG_MAX):
+        self.index_dir = index_dir
+        self.tmp_dir = tmp_dir
+        self.bloom_bits = bloom_bits
+        self.log_max = log_max
+        self.index_path = index_dir.join(INDEX_NAME)
+        self.log_path = index_dir.join(LOG_NAME)
+        self._lock = threading.RLock()
+        self._log_fd: Optional[int] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self._base: Optional[_Digests] = None
+        self._generation: Optional[int] = None
+        self._offset = 0
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._added: Set[bytes] = set()
+        self._added_sorted: List[bytes] = []
+        self._deleted: Set[bytes] = set()
+        self._count = 0
+
+    def _open_log(self) -> Optional[int]:
+        if self._log_fd is None:
+            try:
+                self._log_fd = os.open(self.log_path._path, os.O_RDWR | os.O_APPEND)
+            except FileNotFoundError:
+                return None
+        return self._log_fd
+
+    def _refresh(self) -> None:
+        """Catch up with the log, loading blobs.idx again if it has been emptied since."""
+        fd = self._open_log()
+        if fd is None:
+            return
+        st = os.fstat(fd)
+        if st.st_nlink == 0:
+            # Dropped, and perhaps built again, since it was opened.
+            os.close(fd)
+            self._log_fd = None
+            self._reset()
+            fd = self._open_log()
+            if fd is None:
+                return
+            st = os.fstat(fd)
+        size = st.st_size
+        # The mtime tells a log emptied and refilled to the same size from one left alone.
+        if self._base is not None and (size, st.st_mtime_ns) == self._stamp:
+            return
+        header = os.pread(fd, LOG_HEADER.size, 0)
+        if len(header) < LOG_HEADER.size:
+            self._reset()  # Being built.
+            return
+        magic, generation = LOG_HEADER.unpack(header)
+        if magic != LOG_MAGIC:
+            raise ValueError("Not a blob index log")
+        if self._base is None or generation != self._generation or size < self._offset:
+            self._reset()
+            try:
+                with self.index_path.open("rb") as fd_index:
+                    self._base = _Digests(mmap.mmap(fd_index.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                return
+            self._generation = generation
+            self._offset = LOG_HEADER.size
+            self._count = len(self._base)
+        records = os.pread(fd, size - self._offset, self._offset)
+        # A record still being appended is left for next time.
+        records = records[:len(records) - len(records) % RECORD.size]
+        for op, digest in RECORD.iter_unpack(records):
+            self._apply(op, digest)
+        self._offset += len(records)
+        self._stamp = (size, st.st_mtime_ns) if self._offset == size else None
+
+    def _present(self, digest: bytes) -> bool:
+        assert self._base is not None
+        if digest in self._added:
+            return True
+        if digest in self._deleted:
+            return False
+        return digest in self._base
+
+    def _apply(self, op: bytes, digest: bytes) -> None:
+        """Replay a log record. Replaying one already in blobs.idx changes nothing."""
+        assert self._base is not None
+        present = self._present(digest)
+        in_base = digest in self._base
+        if op == _ADD:
+            self._deleted.discard(digest)
+            if not in_base and digest not in self._added:
+                self._added.add(digest)
+                bisect.insort(self._added_sorted, digest)
+            self._count += not present
+        else:
+            if digest in self._added:
+                self._added.remove(digest)
+                del self._added_sorted[bisect.bisect_left(self._added_sorted, digest)]
+            if in_base:
+                self._deleted.add(digest)
+            self._count -= present
+
+    def built(self) -> bool:
+        with self._lock:
+            self._refresh()
+            return self._base is not None
+
+    def exists(self, blob: str) -> Optional[bool]:
+        with self._lock:
+            self._refresh()
+            if self._base is None:
+                return None
+            return self._present(bytes.fromhex(blob))
+
+    def count(self) -> Optional[int]:
+        with self._lock:
+            self._refresh()
+            return None if self._base is None else self._count
+
+    def blobs(self, start_after: Optional[str] = None) -> Optional[Iterator[str]]:
+        """The blobs in sorted order, only those after start_after if given, as they were when called."""
+        with self._lock:
+            self._refresh()
+            if self._base is None:
+                return None
+            start = None if start_after is None else bytes.fromhex(start_after)
+            i = 0 if start is None else bisect.bisect_right(self._added_sorted, start)
+            added = self._added_sorted[i:]
+            deleted = set(self._deleted)
+            base = self._base.after(start)
+        digests = heapq.merge((digest for digest in base if digest not in deleted), added)
+        return (digest.hex() for digest in digests)
+
+    def record(self, blob: str, present: bool) -> None:
+        """Log that blob was imported, or deleted, folding the log into the index once it is long enough."""
+        with self._lock:
+            fd = self._open_log()
+            if fd is None:
+                return
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                os.write(fd, RECORD.pack(_ADD if present else _DELETE, bytes.fromhex(blob)))
+                size = os.fstat(fd).st_size
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            if (size - LOG_HEADER.size) // RECORD.size >= self.log_max:
+                self.compact()
+
+    def _write(self, fd: int, digests: bytes) -> None:
+        """With the log locked, replace blobs.idx with digests and empty the log."""
+        with self.index_path.safeopen("wb", lambda _: self.tmp_dir) as dst:
+            dst.write(encode_index(digests, self.bloom_bits))
+        os.ftruncate(fd, 0)
+        os.write(fd, LOG_HEADER.pack(LOG_MAGIC, uuid.uuid4().int & 0xFFFFFFFFFFFFFFFF))
+
+    def compact(self) -> None:
+        """Fold the log into blobs.idx."""
+        with self._lock:
+            fd = self._open_log()
+            if fd is None:
+                return
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                blobs = self.blobs()
+                if blobs is None or self._offset == LOG_HEADER.size:
+                    return
+                self._write(fd, b"".join(bytes.fromhex(blob) for blob in blobs))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._refresh()
+
+    def build(self, blobs: Iterable[str]) -> int:
+        """
+        Build the index of blobs, in sorted order, like a walk of the blobstore.
+        Imports and deletes by other processes wait until it is done. Returns the count.
+        """
+        with self._lock:
+            ensure_dir(self.index_dir)
+            os.close(os.open(self.log_path._path, os.O_WRONLY | os.O_CREAT, 0o644))
+            fd = self._open_log()
+            assert fd is not None
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                digests = b"".join(bytes.fromhex(blob) for blob in blobs)
+                self._write(fd, digests)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._refresh()
+            return len(digests) // DIGEST_SIZE
+
+    def drop(self) -> None:
+        """Remove the index, so the blobstore is asked directly again."""
+        with self._lock:
+            self.log_path.unlink()
+            self.index_path.unlink()
+            if self._log_fd is not None:
+                os.close(self._log_fd)
+                self._log_fd = None
+            self._reset()
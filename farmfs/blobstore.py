@@ -1,9 +1,13 @@
 from farmfs.fs import (
+    _BLOCKSIZE,
+    DIR,
     Path,
+    WalkItem,
     ensure_link,
     ensure_readonly,
     ensure_immutable_readable,
     ensure_dir,
+    fastcopy,
     ftype_selector,
     FILE,
     is_readonly,
@@ -12,23 +16,59 @@ from farmfs.fs import (
     walk_from,
     walk_path,
 )
+import heapq
 import http.client
+import io
+import stat
+import struct
+import tempfile
+from hashlib import md5
 from http.client import HTTPResponse
+import itertools
 import json
 import logging
+import os
+from os import environ, pwrite
 from contextlib import contextmanager
 from collections.abc import Callable
 from os.path import sep
 import re
-from typing import ContextManager, IO, Generator, Iterator, List, Optional, Tuple
+from typing import ContextManager, IO, Dict, cast, Generator, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 from urllib.parse import urlparse
-from s3lib import Connection as s3conn, ConnectionLifecycleError, LIST_BUCKET_KEY
+from xml.etree import ElementTree
+from s3lib import Connection as s3conn, ConnectionLifecycleError, LIST_BUCKET_KEY, PreconditionFailed, S3ByteStream
+from farmfs.codec import (
+    CODECS,
+    SUFFIXES,
+    CompressingReader,
+    PeekReader,
+    check_codec,
+    decompressed,
+    DecompressingReader,
+    gzip_size,
+    record_gzip_size,
+    worth_compressing,
+)
+from farmfs.chunking import DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_THRESHOLD, ChunkedReader, Manifest, chunks
+from farmfs.connpool import ConnectionPool, socket_idle
+from farmfs.blobindex import BlobIndex
+from farmfs.s3request import s3_call, s3_head
+from farmfs.packfile import DEFAULT_PACK_SIZE, DEFAULT_PACK_THRESHOLD, Packs
 from farmfs.util import (
+    concat,
+    consume,
     copyfileobj,
+    ffilter,
     fmap,
     HandleThunk,
+    partial,
+    pfmaplazy,
+    pfmaplazyordered,
     pipeline,
+    process_executor,
     Readable,
+    retry,
+    uniq_sorted,
     withHandles2,
 )
 
@@ -36,6 +76,60 @@ logger = logging.getLogger(__name__)
 
 _sep_replace_ = re.compile(sep)
 
+# Number of threads FileBlobstore uses to list the checksum fanout.
+# 1 walks serially; higher values help on latency bound storage like NFS.
+DEFAULT_LIST_WORKERS = int(environ.get("FARMFS_LIST_WORKERS", "1"))
+
+# How FileBlobstore.blob_checksums hashes blobs. Threads are enough when the disk is
+# the bottleneck; processes keep hashing on every core when md5 is.
+CHECKSUM_ENGINES = ["threads", "processes"]
+DEFAULT_CHECKSUM_ENGINE = environ.get("FARMFS_CHECKSUM_ENGINE", "threads")
+DEFAULT_CHECKSUM_WORKERS = int(environ.get("FARMFS_CHECKSUM_WORKERS", "8"))
+# Blobs handed to a hashing process at once, so small blobs don't pay a round trip each.
+CHECKSUM_BATCH = 16
+
+# S3 blobs of at least FARMFS_S3_MULTIPART_THRESHOLD bytes are uploaded with multipart
+# upload and downloaded with range requests, in parts of FARMFS_S3_PART_SIZE bytes,
+# FARMFS_S3_PART_WORKERS at a time. S3 allows at most 10000 parts of at least 5MiB.
+DEFAULT_S3_MULTIPART_THRESHOLD = int(environ.get("FARMFS_S3_MULTIPART_THRESHOLD", str(64 * 1024 * 1024)))
+DEFAULT_S3_PART_SIZE = int(environ.get("FARMFS_S3_PART_SIZE", str(16 * 1024 * 1024)))
+DEFAULT_S3_PART_WORKERS = int(environ.get("FARMFS_S3_PART_WORKERS", "4"))
+S3_MAX_PARTS = 10000
+
+# FileBlobstore compresses blobs it imports by copy with FARMFS_FILE_CODEC, one of
+# farmfs.codec.CODECS, if set. Linking a compressed blob into a tree decompresses it again.
+DEFAULT_FILE_CODEC = environ.get("FARMFS_FILE_CODEC") or None
+# HttpBlobstore asks farmapi for blobs compressed, and compresses what it uploads,
+# with FARMFS_HTTP_CODEC if set.
+DEFAULT_HTTP_CODEC = environ.get("FARMFS_HTTP_CODEC") or None
+# S3Blobstore stores blobs compressed with FARMFS_S3_CODEC if set, naming the codec in
+# the object's S3_CODEC_HEADER metadata. Their ETags are the md5 of the compressed bytes.
+DEFAULT_S3_CODEC = environ.get("FARMFS_S3_CODEC") or None
+S3_CODEC_HEADER = "x-amz-meta-farmfs-codec"
+
+# A blob split into chunks (see farmfs.chunking) is stored as a manifest listing them,
+# with MANIFEST_SUFFIX in a FileBlobstore and marked with the CHUNKED codec on S3. The
+# chunks are blobs in their own right. A FileBlobstore keeps a plain copy beside the
+# manifest while links need one.
+CHUNKED = "chunked"
+MANIFEST_SUFFIX = ".chunks"
+# A small blob moved into a pack (see farmfs.packfile) is stored with the PACKED codec.
+PACKED = "packed"
+
+# Most blobs checked by one exists_many request to a remote blobstore.
+EXISTS_BATCH = 1000
+
+# farmapi's bulk endpoints move FARMFS_BULK_BATCH blobs per request. Only blobs of at most
+# FARMFS_BULK_MAX_BLOB_SIZE bytes are uploaded in bulk; larger ones are worth a request each.
+DEFAULT_BULK_BATCH = int(environ.get("FARMFS_BULK_BATCH", "256"))
+DEFAULT_BULK_MAX_BLOB_SIZE = int(environ.get("FARMFS_BULK_MAX_BLOB_SIZE", str(1024 * 1024)))
+# A bulk body is a run of frames: the blob's 32 character id, its length as a big
+# endian signed 64 bit integer, then that many bytes. BULK_MISSING, with no bytes
+# following, stands for a blob the server doesn't have.
+BULK_FRAME = struct.Struct(">32sq")
+BULK_MISSING = -1
+BULK_CONTENT_TYPE = "application/x-farmfs-frames"
+
 
 def _remove_sep_(path: str) -> str:
     return _sep_replace_.subn("", path)[0]
@@ -86,6 +180,16 @@ def old_reverser(num_segs=3) -> ReverserFunction:
 reverser = fast_reverser
 
 
+def _checksum_batch(job: Tuple[str, Optional[Tuple[str, str]], List[str], int, bool]) -> List[Tuple[str, str]]:
+    """
+    Hash blobs of the blobstore at root in a worker process, returning (blob, checksum) pairs.
+    pack_dirs is the blobstore's pack and temporary directories, if it has packs.
+    """
+    root, pack_dirs, blobs, read_size, use_mmap = job
+    packs = None if pack_dirs is None else Packs(Path(pack_dirs[0]), Path(pack_dirs[1]))
+    return [(blob, _stored_checksum(Path(root), packs, blob, read_size, use_mmap)) for blob in blobs]
+
+
 def _checksum_to_path(checksum: str, num_segs=3, seg_len=3) -> str:
     segs = [
         checksum[i: i + seg_len]
@@ -102,6 +206,153 @@ class Blobstore:
 
 class LifecycleError(Exception):
     pass
+
+
+class BlobRejected(Exception):
+    """
+    A remote blobstore refused a blob, like one whose bytes don't match its
+    checksum. Sending the same bytes again won't help, so it isn't retried.
+    blob is None when the blobstore didn't say which blob it refused.
+    """
+
+    def __init__(self, blob: Optional[str], reason: str):
+        super().__init__(f"{blob or 'upload'} rejected: {reason}")
+        self.blob = blob
+
+
+def part_ranges(size: int, part_size: int) -> List[Tuple[int, int]]:
+    """Split size bytes into (offset, length) parts of part_size, the last one shorter."""
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def _preallocate(fileno: int, size: int) -> None:
+    """Reserve size bytes for a file about to be written out of order, or at least extend it."""
+    try:
+        os.posix_fallocate(fileno, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fileno, size)
+
+
+def _codec_path(path: Path, codec: str) -> Path:
+    """Where a blob stored at path is kept when compressed with codec."""
+    return Path(str(path) + SUFFIXES[codec])
+
+
+def _manifest_path(path: Path) -> Path:
+    """Where the manifest of a chunked blob whose plain path is path is kept."""
+    return Path(str(path) + MANIFEST_SUFFIX)
+
+
+def _stored_blob(path: Path) -> Tuple[Path, Optional[str]]:
+    """
+    The file holding the blob whose plain path is path, and the codec it is compressed
+    with, CHUNKED for a manifest, or None if it is plain.
+    """
+    if path.exists():
+        return path, None
+    for codec in CODECS:
+        stored = _codec_path(path, codec)
+        if stored.exists():
+            return stored, codec
+    manifest = _manifest_path(path)
+    if manifest.exists():
+        return manifest, CHUNKED
+    raise FileNotFoundError(f"No blob at {path}")
+
+
+def _present(path: Path) -> bool:
+    """Whether the blob whose plain path is path is stored in any form."""
+    return path.exists() or any(_codec_path(path, codec).exists() for codec in CODECS) or _manifest_path(path).exists()
+
+
+def _locate(root: Path, packs: Optional[Packs], blob: str) -> Tuple[Path, Optional[str]]:
+    """Like _stored_blob, for a blob of the blobstore at root, looking in packs when it has no file."""
+    try:
+        return _stored_blob(Path(_checksum_to_path(blob), root))
+    except FileNotFoundError:
+        found = None if packs is None else packs.find(blob)
+        if found is None:
+            raise
+        return found[0].path, PACKED
+
+
+def _read_manifest(path: Path) -> Manifest:
+    with path.open("rb") as fd:
+        return decode_manifest(fd.read())
+
+
+def _read_manifest_stream(stream: ContextManager[Readable[bytes]]) -> Manifest:
+    """Read a manifest from a response stream, closing it after."""
+    with stream as src:
+        return decode_manifest(b"".join(iter(lambda: src.read(_BLOCKSIZE), b"")))
+
+
+def _open_blob(root: Path, packs: Optional[Packs], blob: str) -> ContextManager[Readable[bytes]]:
+    """A read handle to a blob in the blobstore at root with packs, however it is stored."""
+    stored, codec = _locate(root, packs, blob)
+    if codec is None:
+        return stored.open("rb")
+    if codec == PACKED:
+        assert packs is not None
+        return packs.open(blob)
+    if codec == CHUNKED:
+        return ChunkedReader(_read_manifest(stored), partial(_open_blob, root, packs))
+    return decompressed(stored.open("rb"))
+
+
+def _stored_size(path: Path, codec: Optional[str]) -> int:
+    """The uncompressed size of the blob stored at path."""
+    if codec is None:
+        return path.stat().st_size
+    if codec == CHUNKED:
+        return sum(size for _, size in _read_manifest(path))
+    with path.open("rb") as fd:
+        size = gzip_size(fd.read(64))
+    if size is not None:
+        return size
+    with decompressed(path.open("rb")) as src:
+        return sum(len(data) for data in iter(lambda: src.read(_BLOCKSIZE), b""))
+
+
+class _HashingReader:
+    """Reads src, keeping the md5 of everything read."""
+
+    def __init__(self, src: Readable[bytes]):
+        self._src = src
+        self._digest = md5()
+
+    def read(self, n: int = -1, /) -> bytes:
+        data = self._src.read(n)
+        self._digest.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+def _stream_checksum(src: Readable[bytes], read_size: int = _BLOCKSIZE) -> str:
+    digest = md5()
+    while data := src.read(read_size):
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _stored_checksum(
+        root: Path, packs: Optional[Packs], blob: str, read_size: int = _BLOCKSIZE, use_mmap: bool = False) -> str:
+    """The checksum of a blob in the blobstore at root with packs, however it is stored."""
+    stored, codec = _locate(root, packs, blob)
+    if codec is None:
+        return stored.checksum(read_size, use_mmap)
+    with _open_blob(root, packs, blob) as src:
+        return _stream_checksum(src, read_size)
+
+
+def _record(index: Optional[BlobIndex], blob: str, present: bool = True) -> None:
+    """Log an import, or a delete, in index if there is one."""
+    if index is not None:
+        index.record(blob, present)
+
+
 class FileBlobstoreSession:
     """
     A wrapper around file handles providing
@@ -111,10 +362,20 @@ class FileBlobstoreSession:
     resource managemnent errors.
     """
 
-    def __init__(self, root: Path, tmp_dir: Path):
+    def __init__(
+            self,
+            root: Path,
+            tmp_dir: Path,
+            codec: Optional[str] = None,
+            packs: Optional[Packs] = None,
+            index: Optional[BlobIndex] = None,
+    ):
         self._root = root
         self._fd: Optional[IO[bytes]] = None
         self._tmp_dir = tmp_dir
+        self._codec = check_codec(codec)
+        self._packs = packs
+        self._index = index
 
     def __enter__(self) -> 'FileBlobstoreSession':
         if self._fd is not None:
@@ -143,8 +404,15 @@ class FileBlobstoreSession:
 
     def read_handle(self, blob: str) -> ContextManager[Readable[bytes]]:
         """Returns a read handle to the blob's contents."""
-        path = self._key(blob)
-        return self._tracked(path.open("rb"))
+        path, codec = _locate(self._root, self._packs, blob)
+        if codec == CHUNKED:
+            # Each chunk is tracked as it is read.
+            return ChunkedReader(_read_manifest(path), self.read_handle)
+        if codec == PACKED:
+            assert self._packs is not None
+            return self._tracked(cast(IO[bytes], self._packs.open(blob)))
+        handle = self._tracked(path.open("rb"))
+        return handle if codec is None else decompressed(handle)
 
     def _write_handle(self, dst_path: Path) -> HandleThunk[IO[bytes]]:
         def _write_handle_thunk() -> ContextManager[IO[bytes]]:
@@ -158,26 +426,199 @@ class FileBlobstoreSession:
         getSrcHandle is a function which returns a read handle to copy from.
         blob is the blob's id.
         While file is first copied to local temporary storage, then moved to
-        the blobstore idepotently.
+        the blobstore idepotently. A plain copy of a file goes through fastcopy,
+        so it can share the source's extents or stay in the kernel.
         """
         dst_path = self._key(blob)
-        duplicate = dst_path.exists()
+        duplicate = self.exists(blob)
         if force or not duplicate:
             parent = dst_path.parent()
             assert parent is not None, "blob path cannot be root"
             ensure_dir(parent)
-            withHandles2(getSrcHandle, self._write_handle(dst_path), copyfileobj)
-            ensure_readonly(dst_path)
+            if force or self._codec is None:
+                # A forced import repairs a blob, so it is written plain, where a link would look for it.
+                withHandles2(getSrcHandle, self._write_handle(dst_path), fastcopy)
+                ensure_readonly(dst_path)
+            else:
+                ensure_readonly(self._import_compressed(getSrcHandle, dst_path, self._codec))
+            _record(self._index, blob)
         # TODO do we want to return duplicate or "we imported"?
         return duplicate
 
+    def _import_compressed(self, getSrcHandle: HandleThunk[Readable[bytes]], dst_path: Path, codec: str) -> Path:
+        """Copy the blob in compressed with codec, unless a sample says it won't compress. Returns where it went."""
+        with getSrcHandle() as src:
+            peeked = PeekReader(src)
+            if not worth_compressing(peeked.head):
+                with self._write_handle(dst_path)() as dst:
+                    copyfileobj(peeked, dst)
+                return dst_path
+            stored = _codec_path(dst_path, codec)
+            with self._write_handle(stored)() as dst:
+                compressing = CompressingReader(peeked)
+                copyfileobj(compressing, dst)
+                dst.flush()
+                record_gzip_size(dst.fileno(), compressing.size)
+            return stored
+
+    def import_verified(self, getSrcHandle: HandleThunk[Readable[bytes]], blob: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        Imports what getSrcHandle reads, hashing it as it is copied into the temporary
+        directory, so the source is read once. The copy is only moved into the
+        blobstore if its md5 is blob, and ValueError is raised otherwise. Without a
+        blob, the md5 names it. Returns the blob and whether it was already present.
+        """
+        if blob is not None and self.exists(blob):
+            return blob, True
+        with getSrcHandle() as src, tempfile.NamedTemporaryFile(dir=self._tmp_dir._path) as tmp:
+            hashing = _HashingReader(src)
+            codec = None
+            if self._codec is None:
+                copyfileobj(hashing, tmp)
+            else:
+                peeked = PeekReader(hashing)
+                if worth_compressing(peeked.head):
+                    codec = self._codec
+                    compressing = CompressingReader(peeked)
+                    copyfileobj(compressing, tmp)
+                    tmp.flush()
+                    record_gzip_size(tmp.fileno(), compressing.size)
+                else:
+                    copyfileobj(peeked, tmp)
+            csum = hashing.hexdigest()
+            if blob is not None and csum != blob:
+                raise ValueError(f"Imported {blob} has checksum {csum}")
+            if self.exists(csum):
+                return csum, True
+            dst_path = self._key(csum)
+            parent = dst_path.parent()
+            assert parent is not None, "blob path cannot be root"
+            ensure_dir(parent)
+            if codec is not None:
+                dst_path = _codec_path(dst_path, codec)
+            tmp.flush()
+            Path(tmp.name).rename(dst_path)
+        ensure_readonly(dst_path)
+        _record(self._index, csum)
+        return csum, False
+
+    def exists(self, blob: str) -> bool:
+        indexed = None if self._index is None else self._index.exists(blob)
+        if indexed is not None:
+            return indexed
+        return _present(self._key(blob)) or (self._packs is not None and self._packs.find(blob) is not None)
+
+    def import_manifest(self, blob: str, manifest: Manifest) -> bool:
+        """
+        Stores blob as the chunks listed by manifest, which must already be present.
+        Returns True if the blob was already present.
+        """
+        if self.exists(blob):
+            return True
+        for chunk, _ in manifest:
+            if not self.exists(chunk):
+                raise FileNotFoundError(f"Chunk {chunk} of {blob} is missing")
+        path = _manifest_path(self._key(blob))
+        parent = path.parent()
+        assert parent is not None, "blob path cannot be root"
+        ensure_dir(parent)
+        with path.safeopen("wb", lambda _: self._tmp_dir) as dst:
+            dst.write(encode_manifest(manifest))
+        ensure_readonly(path)
+        _record(self._index, blob)
+        return False
+
+    def import_chunks(self, blob: str, manifest: Manifest, read_chunk: Callable[[str], bytes], workers: int) -> bool:
+        """
+        Imports a chunked blob, fetching the chunks it is missing with read_chunk,
+        workers at a time. Each chunk is checked before it is stored, and the
+        manifest is only stored once they all are. Returns True if the blob was
+        already present.
+        """
+        if self.exists(blob):
+            return True
+        sizes = dict(manifest)
+
+        def import_chunk(chunk: str) -> None:
+            data = read_chunk(chunk)
+            if len(data) != sizes[chunk] or md5(data).hexdigest() != chunk:
+                raise ValueError(f"Chunk {chunk} of {blob} doesn't match its manifest")
+            # The chunks are written concurrently, each needing a handle of its own.
+            with FileBlobstoreSession(self._root, self._tmp_dir, self._codec, self._packs, self._index) as sess:
+                sess.import_via_fd(lambda: io.BytesIO(data), chunk)
+        missing = [chunk for chunk in sizes if not self.exists(chunk)]
+        consume(pfmaplazy(import_chunk, workers)(missing))
+        return self.import_manifest(blob, manifest)
+
+    def import_via_parts(
+            self,
+            blob: str,
+            size: int,
+            read_part: Callable[[int, int], bytes],
+            part_size: int,
+            workers: int,
+    ) -> bool:
+        """
+        Imports a blob fetched in parts, read_part(offset, length) returning those
+        bytes of it. Parts are fetched workers at a time and written into a
+        preallocated temporary file, which is only moved into the blobstore once
+        its md5 matches blob. Returns whether the blob was already present.
+        """
+        dst_path = self._key(blob)
+        if self.exists(blob):
+            return True
+        parent = dst_path.parent()
+        assert parent is not None, "blob path cannot be root"
+        ensure_dir(parent)
+        with dst_path.safeopen("wb", lambda _: self._tmp_dir) as dst:
+            fileno = dst.fileno()
+            _preallocate(fileno, size)
+
+            def write_part(part: Tuple[int, int]) -> None:
+                offset, length = part
+                data = read_part(offset, length)
+                if len(data) != length:
+                    raise ValueError(f"Part at {offset} of {blob} was {len(data)} bytes, expected {length}")
+                pwrite(fileno, data, offset)
+            consume(pfmaplazy(write_part, workers)(part_ranges(size, part_size)))
+            csum = Path(dst.name).checksum()
+            if csum != blob:
+                raise ValueError(f"Downloaded {blob} has checksum {csum}")
+        ensure_readonly(dst_path)
+        _record(self._index, blob)
+        return False
+
 
 class FileBlobstore:
-    def __init__(self, root: Path, tmp_dir: Path, num_segs=3):
+    def __init__(
+            self,
+            root: Path,
+            tmp_dir: Path,
+            num_segs=3,
+            list_workers: Optional[int] = None,
+            codec: Optional[str] = None,
+            chunk_threshold: Optional[int] = None,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            pack_dir: Optional[Path] = None,
+            pack_size: int = DEFAULT_PACK_SIZE,
+            index_dir: Optional[Path] = None,
+    ):
         self.root = root
         self.tmp_dir = tmp_dir
         self.reverser = reverser(num_segs)
         self.tmp_dir = tmp_dir
+        self.list_workers = DEFAULT_LIST_WORKERS if list_workers is None else list_workers
+        if self.list_workers < 1:
+            raise ValueError("list_workers must be at least 1")
+        self.codec = check_codec(codec or DEFAULT_FILE_CODEC)
+        # Blobs of at least chunk_threshold bytes imported by link are also stored as chunks.
+        self.chunk_threshold = chunk_threshold or DEFAULT_CHUNK_THRESHOLD
+        self.chunk_size = chunk_size
+        # Small blobs can be moved into packs in pack_dir, if there is one.
+        self.packs = None if pack_dir is None else Packs(pack_dir, tmp_dir)
+        self.pack_size = pack_size
+        # Once built, the index in index_dir answers exists, count and blobs.
+        self.index = None if index_dir is None else BlobIndex(index_dir, tmp_dir)
 
     def _blob_id_to_name(self, blob: str) -> str:
         """Return string name of link relative to root"""
@@ -189,30 +630,289 @@ class FileBlobstore:
         """Return absolute Path to a blob given a blob id."""
         return Path(self._blob_id_to_name(blob), self.root)
 
+    def stored_blob(self, blob: str) -> Tuple[Path, Optional[str]]:
+        """
+        The file holding a blob, and the codec it is compressed with, CHUNKED for a
+        manifest, PACKED for a pack, or None if it is stored plain. A plain copy beside
+        a manifest or in a pack wins. Raises FileNotFoundError if the blob isn't present.
+        """
+        return _locate(self.root, self.packs, blob)
+
+    def stored_size(self, blob: str) -> int:
+        """The bytes the blob takes up on disk, as it is stored."""
+        path, codec = self.stored_blob(blob)
+        if codec == PACKED:
+            return self.blob_size(blob)
+        return path.stat().st_size
+
+    def manifest(self, blob: str) -> Optional[Manifest]:
+        """The chunks blob is stored as, or None if it isn't chunked."""
+        try:
+            return _read_manifest(_manifest_path(self.blob_path(blob)))
+        except FileNotFoundError:
+            return None
+
+    def chunked_blobs(self) -> Iterator[str]:
+        """The blobs with manifests, in sorted order."""
+        def is_manifest(item: WalkItem) -> bool:
+            path, type_ = item
+            return type_ == FILE and str(path).endswith(MANIFEST_SUFFIX)
+
+        def blob_id(path: Path) -> str:
+            return self.reverser(str(path).removesuffix(MANIFEST_SUFFIX))
+        return pipeline(ffilter(is_manifest), fmap(walk_path), fmap(blob_id))(self.walk())
+
+    def chunk(self, blob: str) -> Manifest:
+        """
+        Split blob into chunk_size chunks, storing each as a blob, and keep a manifest
+        of them beside it. Returns the manifest.
+        """
+        manifest = self.manifest(blob)
+        if manifest is not None:
+            return manifest
+        manifest = []
+        with self.read_handle(blob) as src, self.session() as sess:
+            for data in chunks(src, self.chunk_size):
+                chunk = md5(data).hexdigest()
+                if chunk == blob:
+                    # One chunk is the whole blob, and a manifest of it would name itself.
+                    return [(blob, len(data))]
+                sess.import_via_fd(lambda: io.BytesIO(data), chunk)
+                manifest.append((chunk, len(data)))
+        path = _manifest_path(self.blob_path(blob))
+        with path.safeopen("wb", lambda _: self.tmp_dir) as dst:
+            dst.write(encode_manifest(manifest))
+        ensure_readonly(path)
+        return manifest
+
+    def evict(self, blob: str) -> int:
+        """
+        Drop the plain copy of a chunked blob, which can be rebuilt from its chunks.
+        Returns the bytes freed. Links to the blob break until it is materialised.
+        """
+        path = self.blob_path(blob)
+        if not _manifest_path(path).exists() or not path.exists():
+            return 0
+        size = path.stat().st_size
+        path.unlink()
+        return size
+
+    def blob_size(self, blob: str) -> int:
+        """The size of the blob's contents, uncompressed."""
+        path, codec = self.stored_blob(blob)
+        if codec == PACKED:
+            assert self.packs is not None
+            found = self.packs.find(blob)
+            if found is None:
+                raise FileNotFoundError(f"{blob} was removed from its pack")
+            return found[2]
+        return _stored_size(path, codec)
+
+    def materialise(self, blob: str) -> Path:
+        """
+        Returns blob_path(blob), first decompressing the blob there if it is stored
+        compressed, putting its chunks back together if it is chunked, or copying it
+        out of its pack, so links to it can be followed. The plain copy is checked
+        against the blob id before it goes in place. A compressed copy is then
+        dropped; a manifest or pack entry is kept.
+        """
+        path = self.blob_path(blob)
+        try:
+            stored, codec = self.stored_blob(blob)
+        except FileNotFoundError:
+            return path
+        if codec is None:
+            return path
+        parent = path.parent()
+        assert parent is not None, "blob path cannot be root"
+        ensure_dir(parent)  # A packed blob's directory may have gone with its file.
+        with path.safeopen("wb", lambda _: self.tmp_dir) as dst:
+            with _open_blob(self.root, self.packs, blob) as src:
+                copyfileobj(src, dst)
+            dst.flush()
+            csum = Path(dst.name).checksum()
+            if csum != blob:
+                raise ValueError(f"Stored blob {blob} has checksum {csum}")
+        ensure_readonly(path)
+        if codec not in (CHUNKED, PACKED):
+            stored.unlink()
+        return path
+
     def exists(self, blob: str) -> bool:
-        blob_path = self.blob_path(blob)
-        return blob_path.exists()
+        indexed = None if self.index is None else self.index.exists(blob)
+        if indexed is not None:
+            return indexed
+        return _present(self.blob_path(blob)) or (self.packs is not None and self.packs.find(blob) is not None)
+
+    def count(self) -> int:
+        """The number of blobs, from the index if it is built."""
+        indexed = None if self.index is None else self.index.count()
+        if indexed is not None:
+            return indexed
+        return sum(1 for _ in self.blobs())
+
+    def build_index(self) -> int:
+        """Build the blob index from a walk of the blobstore. Returns the blobs indexed."""
+        if self.index is None:
+            raise ValueError("Blobstore has no index directory")
+        return self.index.build(self._listed_blobs())
+
+    def exists_many(self, blobs: Iterable[str]) -> Set[str]:
+        """The blobs which are present, checked list_workers at a time."""
+        def check(blob: str) -> Tuple[str, bool]:
+            return blob, self.exists(blob)
+        return {blob for blob, present in pfmaplazyordered(check, self.list_workers)(blobs) if present}
 
     def delete_blob(self, blob: str) -> None:
-        """Takes a blob, and removes it from the blobstore"""
+        """Takes a blob, and removes it from the blobstore, repacking its pack if most of that is now dead."""
         blob_path = self.blob_path(blob)
-        blob_path.unlink(clean=self.root)
+        for codec in CODECS:
+            _codec_path(blob_path, codec).unlink()
+        _manifest_path(blob_path).unlink()
+        parent = blob_path.parent()
+        # A packed blob's directory may have gone with its file already.
+        blob_path.unlink(clean=self.root if parent is not None and parent.exists() else None)
+        if self.packs is not None:
+            self.packs.delete(blob)
+        _record(self.index, blob, False)
+
+    def pack(self, blobs: Iterable[str], threshold: Optional[int] = None) -> List[str]:
+        """
+        Move those of blobs stored plain in files of under threshold bytes into packs of
+        about pack_size bytes, removing the files. Returns the blobs packed. Links to a
+        packed blob break until it is materialised, so only blobs nothing links to
+        should be packed.
+        """
+        if self.packs is None:
+            raise ValueError("This blobstore has no pack directory")
+        packs = self.packs
+        threshold = DEFAULT_PACK_THRESHOLD if threshold is None else threshold
+        packed: List[str] = []
+        batch: List[Tuple[str, bytes]] = []
+        batch_size = 0
+
+        def flush() -> None:
+            packs.write(batch)
+            # Packed before the files go, so the blobs are always somewhere.
+            for blob, _ in batch:
+                self.blob_path(blob).unlink(clean=self.root)
+            packed.extend(blob for blob, _ in batch)
+            batch.clear()
+        for blob in blobs:
+            path = self.blob_path(blob)
+            try:
+                if path.stat().st_size >= threshold:
+                    continue
+                data = path.content("rb")
+            except FileNotFoundError:
+                continue  # Stored compressed, chunked or packed already.
+            assert isinstance(data, bytes)
+            batch.append((blob, data))
+            batch_size += len(data)
+            if batch_size >= self.pack_size:
+                flush()
+                batch_size = 0
+        if batch:
+            flush()
+        return packed
 
     def import_via_link(self, tree_path: Path, blob: str) -> bool:
-        """Adds a file to a blobstore via a hard link."""
+        """
+        Adds a file to a blobstore via a hard link.
+        Safe to race with another import of the same blob: only one link wins,
+        and the loser reports a duplicate. A new blob of at least chunk_threshold
+        bytes is chunked as well.
+        """
         blob_path = self.blob_path(blob)
-        duplicate = blob_path.exists()
-        if not duplicate:
-            ensure_link(blob_path, tree_path)
-            ensure_readonly(blob_path)
-        return duplicate
+        if blob_path.exists():
+            return True
+        parent = blob_path.parent()
+        assert parent is not None
+        ensure_dir(parent)
+        try:
+            blob_path.link(tree_path)
+        except FileExistsError:
+            if blob_path.exists():
+                return True
+            ensure_link(blob_path, tree_path)  # Replace a dangling entry.
+        ensure_readonly(blob_path)
+        compressed = [_codec_path(blob_path, codec) for codec in CODECS if _codec_path(blob_path, codec).exists()]
+        for stored in compressed:
+            # The tree's copy is now the blob, so the compressed one can go.
+            stored.unlink()
+        if compressed or _manifest_path(blob_path).exists() or (self.packs is not None and self.packs.find(blob) is not None):
+            return True
+        _record(self.index, blob)
+        if self.chunk_threshold is not None and blob_path.stat().st_size >= self.chunk_threshold:
+            self.chunk(blob)
+        return False
+
+    def import_via_copy(self, tree_path: Path, blob: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        Adds a file to the blobstore by copying it, for when it can't be hard linked,
+        such as from another device. The file is hashed as it is copied, so it is
+        read once, and only stored if its md5 is blob, when that is given. The copy
+        is plain, so the tree can link to it. Returns the blob, and whether it was
+        already present. A new blob of at least chunk_threshold bytes is chunked as well.
+        """
+        plain = FileBlobstoreSession(self.root, self.tmp_dir, None, self.packs, self.index)
+        with plain as sess:
+            blob, duplicate = sess.import_verified(lambda: tree_path.open("rb"), blob)
+        if duplicate:
+            return blob, True
+        if self.chunk_threshold is not None and self.blob_path(blob).stat().st_size >= self.chunk_threshold:
+            self.chunk(blob)
+        return blob, False
 
     def session(self) -> FileBlobstoreSession:
         """
         Return a session context manager. FileBlobstore has no connection to
         manage, so the session is the blobstore itself wrapped in a nullcontext.
         """
-        return FileBlobstoreSession(self.root, self.tmp_dir)
+        return FileBlobstoreSession(self.root, self.tmp_dir, self.codec, self.packs, self.index)
+
+    def walk(self, start_after: Optional[str] = None) -> Iterator[WalkItem]:
+        """Walk the blobstore directory tree in the same sorted order as walk(root).
+
+        start_after -- if given, begin at the path of this blob (inclusive), as walk_from() does.
+
+        With list_workers > 1 the top level fanout directories are walked
+        concurrently and merged back into sorted order.
+        """
+        start = None if start_after is None else self.blob_path(start_after)
+        if self.list_workers > 1:
+            return self._parallel_walk(start)
+        elif start is None:
+            return walk(self.root)
+        else:
+            return walk_from(self.root, start)
+
+    def _parallel_walk(self, start: Optional[Path]) -> Iterator[WalkItem]:
+        root = self.root
+        seek_name: Optional[str] = None
+        if start is None or start == root:
+            yield (root, root.ftype())
+        else:
+            seek_name = [c for c in start.relative_to(root).split(sep) if c][0]
+
+        def partitions() -> Iterator[Tuple[Path, Optional[Path]]]:
+            """Top level subtrees to walk, paired with where to start within them."""
+            for top in root.dir_list():
+                name = top.name()
+                if seek_name is None or name > seek_name:
+                    yield (top, None)
+                elif name == seek_name and top.ftype() is DIR:
+                    yield (top, start)
+
+        def walk_partition(partition: Tuple[Path, Optional[Path]]) -> List[WalkItem]:
+            top, seek = partition
+            if seek is None:
+                return list(walk(top))
+            else:
+                return list(walk_from(top, seek))
+
+        walk_partitions = pfmaplazyordered(walk_partition, workers=self.list_workers)
+        yield from concat(walk_partitions(partitions()))
 
     def blobs(self, start_after: Optional[str] = None, max_items: Optional[int] = None) -> Iterator[str]:
         """Iterator across all blobs in sorted order.
@@ -222,20 +922,33 @@ class FileBlobstore:
                        the right directory subtree via walk_from() then skips
                        the start_after blob itself if present.
         max_items   -- if given, return at most this many blobs.
+
+        Once the index is built, the blobs are read from it instead.
         """
-        import itertools
+        indexed = None if self.index is None else self.index.blobs(start_after)
+        if indexed is not None:
+            return indexed if max_items is None else itertools.islice(indexed, max_items)
+        return self._listed_blobs(start_after, max_items)
+
+    def _listed_blobs(self, start_after: Optional[str] = None, max_items: Optional[int] = None) -> Iterator[str]:
+        """The blobs, found by walking the blobstore."""
         keep_files = ftype_selector([FILE])
 
-        if start_after is not None:
-            walker = walk_from(self.root, self.blob_path(start_after))
-        else:
-            walker = walk(self.root)
+        def blob_id(path: Path) -> str:
+            name = str(path)
+            for suffix in [*SUFFIXES.values(), MANIFEST_SUFFIX]:
+                name = name.removesuffix(suffix)
+            return self.reverser(name)
 
-        blobs: Iterator[str] = pipeline(
+        # A blob caught part way through materialise is briefly in both forms, side by side.
+        files: Iterator[str] = pipeline(
             keep_files,
             fmap(walk_path),
-            fmap(self.reverser),
-        )(walker)
+            fmap(blob_id),
+        )(self.walk(start_after))
+        if self.packs is not None:
+            files = heapq.merge(files, self.packs.blobs(start_after))
+        blobs = uniq_sorted(files)
 
         if start_after is not None:
             # walk_from is inclusive; skip the start_after blob itself.
@@ -250,40 +963,78 @@ class FileBlobstore:
         File object is configured to speak bytes.
         """
         # TODO could return a function which returns a handle to make idempotency easier.
-        path = self.blob_path(blob)
-        fd = path.open("rb")
-        return fd
+        path, codec = self.stored_blob(blob)
+        if codec is None:
+            return path.open("rb")
+        return cast(IO[bytes], _open_blob(self.root, self.packs, blob))
 
     def blob_chunks(self, blob: str, size: int) -> Generator[bytes, None, None]:
         """
         Returns a generator which returns the blob's content chunked by size.
         """
-        path = self.blob_path(blob)
-        return path.read_chunks(size)
+        path, codec = self.stored_blob(blob)
+        if codec is None:
+            return path.read_chunks(size)
+
+        def stored_chunks() -> Generator[bytes, None, None]:
+            with _open_blob(self.root, self.packs, blob) as src:
+                while data := src.read(size):
+                    yield data
+        return stored_chunks()
+
+    def blob_checksum(self, blob: str, read_size: int = _BLOCKSIZE, use_mmap: bool = False) -> str:
+        """Returns the checksum of the blob's contents, however it is stored."""
+        return _stored_checksum(self.root, self.packs, blob, read_size, use_mmap)
+
+    def blob_checksums(
+            self,
+            blobs: Iterable[str],
+            workers: Optional[int] = None,
+            engine: Optional[str] = None,
+            read_size: int = _BLOCKSIZE,
+            use_mmap: bool = False,
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Hash blobs concurrently, yielding (blob, checksum) pairs in completion order.
 
-    def blob_checksum(self, blob: str) -> str:
-        """Returns the blob's checksum."""
-        path = self.blob_path(blob)
-        csum = path.checksum()
-        return csum
+        workers   -- threads or processes hashing at once.
+        engine    -- "threads", or "processes" to hash on more cores than the GIL allows.
+        read_size -- bytes read per call; larger reads cut syscalls on big blobs.
+        use_mmap  -- hash blobs through a memory map rather than reads.
+        """
+        workers = DEFAULT_CHECKSUM_WORKERS if workers is None else workers
+        engine = engine or DEFAULT_CHECKSUM_ENGINE
+        if engine == "threads":
+            def blob_calc_checksum(blob: str) -> Tuple[str, str]:
+                return blob, self.blob_checksum(blob, read_size, use_mmap)
+            return pfmaplazy(blob_calc_checksum, workers=workers)(blobs)
+        elif engine == "processes":
+            pack_dirs = None if self.packs is None else (self.packs.pack_dir._path, self.packs.tmp_dir._path)
+
+            def batch_job(batch: Tuple[str, ...]) -> Tuple[str, Optional[Tuple[str, str]], List[str], int, bool]:
+                return self.root._path, pack_dirs, list(batch), read_size, use_mmap
+            jobs = fmap(batch_job)(itertools.batched(blobs, CHECKSUM_BATCH))
+            return concat(pfmaplazy(_checksum_batch, workers=workers, executor=process_executor)(jobs))
+        else:
+            raise ValueError("Unknown checksum engine %s, expected one of %s" % (engine, CHECKSUM_ENGINES))
 
     def verify_blob_permissions(self, blob: str) -> bool:
         """
         Returns True when the blob has correct permissions: read-only and readable by the current user.
         Returns False when the blob is writable or unreadable by the current user.
         """
-        path = self.blob_path(blob)
+        path, _ = self.stored_blob(blob)
         return is_readonly(path) and is_user_readable(path)
 
     def blob_permission_issue(self, blob: str) -> str:
         """Returns a human-readable description of the permission problem for a blob."""
-        path = self.blob_path(blob)
+        path, _ = self.stored_blob(blob)
         if not is_user_readable(path):
             return "unreadable blob:"
         return "writable blob:"
 
     def fix_blob_permissions(self, blob: str) -> None:
-        path = self.blob_path(blob)
+        path, _ = self.stored_blob(blob)
         ensure_immutable_readable(path)
 
 
@@ -299,6 +1050,84 @@ def _s3_putter(bucket: str, key: str) -> Callable[[Readable[bytes], s3conn], boo
     return s3_put
 
 
+def _xml_text(payload: bytes, tag: str) -> str:
+    for elem in ElementTree.fromstring(payload).iter():
+        if elem.tag.rsplit("}", 1)[-1] == tag and elem.text is not None:
+            return elem.text
+    raise ValueError(f"S3 response has no {tag}: {payload[:200]!r}")
+
+
+def _s3_exists(conn: s3conn, bucket: str, key: str) -> bool:
+    return s3_head(conn, bucket, key) is not None
+
+
+def _s3_multipart_put(
+        pool: ConnectionPool[s3conn],
+        bucket: str,
+        key: str,
+        fileno: int,
+        size: int,
+        part_size: int,
+        workers: int,
+        headers: Optional[dict] = None,
+) -> bool:
+    """
+    Upload size bytes of fileno to (bucket, key) with a multipart upload, sending
+    workers parts at a time, each retried on its own. S3 checks each part against
+    its Content-MD5, and the ETag S3 gives the result is checked against the parts.
+    headers are stored with the object. Returns True if the object already existed,
+    False if it was uploaded.
+    """
+    with pool.lease() as conn:
+        if _s3_exists(conn, bucket, key):
+            return True
+        _, _, payload = s3_call(conn, "POST", key, bucket, {"uploads": None}, headers or {})
+    upload_id = _xml_text(payload, "UploadId")
+    try:
+        def put_part(part: Tuple[int, Tuple[int, int]]) -> Tuple[int, bytes]:
+            number, (offset, length) = part
+            data = os.pread(fileno, length, offset)
+            digest = md5(data).digest()
+
+            def attempt() -> None:
+                with pool.lease() as conn:
+                    s3_call(conn, "PUT", key, bucket, {"partNumber": str(number), "uploadId": upload_id},
+                            {"content-length": str(len(data))}, data, md5_hint=digest)
+            retry(attempt, is_s3_exception)
+            return number, digest
+        digests = sorted(pfmaplazy(put_part, workers)(enumerate(part_ranges(size, part_size), 1)))
+        parts = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>\"{digest.hex()}\"</ETag></Part>" for number, digest in digests)
+        with pool.lease() as conn:
+            status, _, payload = s3_call(
+                conn, "POST", key, bucket, {"uploadId": upload_id}, {"If-None-Match": "*"},
+                f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode())
+        if status == 412:
+            return True  # Another upload finished first.
+        etag = _xml_text(payload, "ETag").strip('"')
+        expected = "%s-%d" % (md5(b"".join(digest for _, digest in digests)).hexdigest(), len(digests))
+        if etag != expected:
+            raise ValueError(f"Multipart upload of {key} has etag {etag}, expected {expected}")
+        return False
+    except BaseException:
+        try:
+            with pool.lease() as conn:
+                s3_call(conn, "DELETE", key, bucket, {"uploadId": upload_id}, {})
+        except Exception as e:
+            logger.debug("Aborting multipart upload of %s raised %s: %.200s", key, type(e).__name__, e)
+        raise
+
+
+def _regular_file(src: Readable[bytes]) -> Optional[Tuple[int, int]]:
+    """The fileno and size of src if it is a regular file, which parts can be read from at any offset."""
+    try:
+        fileno = getattr(src, "fileno")()
+        st = os.fstat(fileno)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    return (fileno, st.st_size) if stat.S_ISREG(st.st_mode) else None
+
+
 def _s3_parse_url(s3_url: str) -> Tuple[str, str]:
     pattern = r"^s3://(?P<bucket_name>[^/]+)/(?P<prefix>.+)$"
     match = re.match(pattern, s3_url)
@@ -325,41 +1154,93 @@ def is_s3_exception(e: Exception) -> bool:
     )
 
 
+def _s3_pool(
+        access_id: str,
+        secret: bytes,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        use_ssl: bool = True,
+) -> ConnectionPool[s3conn]:
+    def connect() -> s3conn:
+        return s3conn(access_id, secret, host=host, port=port, conn_timeout=60, use_ssl=use_ssl).__enter__()
+
+    def close(conn: s3conn) -> None:
+        conn.__exit__(None, None, None)
+
+    def healthy(conn: s3conn) -> bool:
+        return conn.is_ready() and socket_idle(None if conn.conn is None else conn.conn.sock)
+    return ConnectionPool(connect, close, healthy)
+
+
 class S3BlobstoreSession:
     """
-    A wrapper around an S3 connection providing
-    blobstore semantics and using s3lib.Connection connection management.
+    A wrapper around an S3 connection providing blobstore semantics.
+    The connection is leased from the blobstore's pool on entry and returned on exit.
     """
-    def __init__(self, access_id: str, secret: bytes, bucket: str, prefix: str):
-        self._access_id = access_id
-        self._secret = secret
+    def __init__(
+            self,
+            pool: ConnectionPool[s3conn],
+            bucket: str,
+            prefix: str,
+            multipart_threshold: int = DEFAULT_S3_MULTIPART_THRESHOLD,
+            part_size: int = DEFAULT_S3_PART_SIZE,
+            part_workers: int = DEFAULT_S3_PART_WORKERS,
+            codec: Optional[str] = None,
+    ):
+        self._pool = pool
         self._bucket = bucket
         self._prefix = prefix
-        self._conn: s3conn = s3conn(self._access_id, self._secret, conn_timeout=60)
+        self._codec = check_codec(codec)
+        self._multipart_threshold = multipart_threshold
+        self._part_size = part_size
+        self._part_workers = part_workers
+        self._conn: Optional[s3conn] = None
         self._handle_outstanding = False
 
     def __enter__(self) -> 'S3BlobstoreSession':
         if self._handle_outstanding:
             raise LifecycleError("Entering session with open handle")
-        self._conn.__enter__()
+        self._conn = self._pool.acquire()
         return self
 
-    def __exit__(self, *_) -> None:
+    def __exit__(self, exc_type, *_) -> None:
+        conn, self._conn = self._conn, None
         if self._handle_outstanding:
+            if conn is not None:
+                self._pool.release(conn, reuse=False)
             raise LifecycleError("Exiting session with open handle")
-        self._conn.__exit__(*_)
+        if conn is not None:
+            # A failed session may have left the connection mid request.
+            self._pool.release(conn, reuse=exc_type is None)
 
     def _key(self, blob: str) -> str:
         return self._prefix + "/" + blob
 
+    def _open_conn(self) -> s3conn:
+        if self._conn is None:
+            raise RuntimeError("S3BlobstoreSession: session is not open")
+        return self._conn
+
     def read_handle(self, blob: str) -> ContextManager[Readable[bytes]]:
+        stream, headers = self._get(blob)
+        codec = headers.get(S3_CODEC_HEADER)
+        if codec is None:
+            return stream
+        if codec == CHUNKED:
+            # The chunks are read one after another, each with a request of its own.
+            return ChunkedReader(_read_manifest_stream(stream), self.read_handle)
+        return decompressed(stream)
+
+    def _get(self, blob: str) -> Tuple[S3ByteStream, dict]:
+        conn = self._open_conn()
         if self._handle_outstanding:
             raise LifecycleError("S3BlobstoreSession: previous read handle must be closed before calling read_handle again")
         try:
-            stream, headers = self._conn.get_object2(self._bucket, self._key(blob))
+            stream, headers = conn.get_object2(self._bucket, self._key(blob))
         except ConnectionLifecycleError as e:
             raise LifecycleError(str(e)) from e
         assert stream is not None, f"get_object2 returned no stream for blob {blob}"
+        headers = {k.lower(): v for k, v in headers.items()}
         logger.debug("s3 read_handle blob=%s content_length=%s", blob, headers.get("content-length"))
         self._handle_outstanding = True
         _existing_on_close = stream._on_close
@@ -370,23 +1251,144 @@ class S3BlobstoreSession:
                 _existing_on_close()
 
         stream._on_close = _on_close
-        return stream
+        return stream, headers
 
     def _clear_handle(self) -> None:
         self._handle_outstanding = False
 
+    def _part_size_for(self, size: int) -> int:
+        return max(self._part_size, -(-size // S3_MAX_PARTS))
+
     def import_via_fd(self, getSrcHandle: HandleThunk[Readable[bytes]], blob: str, force: bool = False) -> bool:
+        """
+        Uploads the blob read from getSrcHandle. A source which is a regular file of
+        at least multipart_threshold bytes is uploaded in parts, part_workers at a time.
+        With a codec, a blob which looks worth it is uploaded compressed.
+        Returns True if the blob was already present.
+        """
+        conn = self._open_conn()
         key = self._key(blob)
-        ioFn = _s3_putter(self._bucket, key)
         with getSrcHandle() as src:
-            return ioFn(src, self._conn)
+            regular = _regular_file(src)
+            body: Readable[bytes] = src
+            if self._codec is not None:
+                peeked = PeekReader(src)
+                if worth_compressing(peeked.head):
+                    return self._import_compressed(peeked, key, self._codec)
+                body = peeked
+            if regular is not None and regular[1] >= self._multipart_threshold:
+                fileno, size = regular
+                return _s3_multipart_put(
+                    self._pool, self._bucket, key, fileno, size, self._part_size_for(size), self._part_workers)
+            if body is not src:
+                body = io.BytesIO(body.read())
+            ioFn = _s3_putter(self._bucket, key)
+            return ioFn(body, conn)
+
+    def _import_compressed(self, src: Readable[bytes], key: str, codec: str) -> bool:
+        """Compress src into a temporary file, and upload that, marked with codec."""
+        headers = {S3_CODEC_HEADER: codec}
+        with tempfile.TemporaryFile() as tmp:
+            compressing = CompressingReader(src)
+            copyfileobj(compressing, tmp)
+            tmp.flush()
+            record_gzip_size(tmp.fileno(), compressing.size)
+            size = os.fstat(tmp.fileno()).st_size
+            if size >= self._multipart_threshold:
+                return _s3_multipart_put(
+                    self._pool, self._bucket, key, tmp.fileno(), size, self._part_size_for(size), self._part_workers, headers)
+            tmp.seek(0)
+            try:
+                self._open_conn().put_object(self._bucket, key, tmp, headers=headers, if_none_match=True)
+            except PreconditionFailed:
+                return True
+        return False
+
+    def import_manifest(self, blob: str, manifest: Manifest) -> bool:
+        """
+        Stores blob as the chunks listed by manifest, which must already be uploaded.
+        Returns True if the blob was already present.
+        """
+        try:
+            self._open_conn().put_object(
+                self._bucket, self._key(blob), encode_manifest(manifest), headers={S3_CODEC_HEADER: CHUNKED}, if_none_match=True)
+        except PreconditionFailed:
+            return True
+        return False
+
+    def _read_chunk(self, chunk: str) -> bytes:
+        """Fetch a whole chunk on a pooled connection, retrying transient errors."""
+        def attempt() -> bytes:
+            with self._pool.lease() as conn:
+                stream, headers = conn.get_object2(self._bucket, self._key(chunk))
+                assert stream is not None, f"get_object2 returned no stream for chunk {chunk}"
+                codec = {k.lower(): v for k, v in headers.items()}.get(S3_CODEC_HEADER)
+                with stream:
+                    src: Readable[bytes] = stream if codec is None else DecompressingReader(stream)
+                    return b"".join(iter(lambda: src.read(_BLOCKSIZE), b""))
+        return retry(attempt, is_s3_exception)
+
+    def export_to(self, dst: FileBlobstoreSession, blob: str) -> bool:
+        """
+        Downloads the blob into dst. A blob of at least multipart_threshold bytes is
+        fetched with range requests, part_workers at a time, and checked before it
+        is moved into place. A chunked blob is fetched as whichever chunks dst is
+        missing, part_workers at a time. Returns True if dst already had it.
+        """
+        if dst.exists(blob):
+            return True
+        stream, headers = self._get(blob)
+        if headers.get(S3_CODEC_HEADER) == CHUNKED:
+            manifest = _read_manifest_stream(stream)
+            return dst.import_chunks(blob, manifest, self._read_chunk, self._part_workers)
+        if headers.get(S3_CODEC_HEADER) is not None:
+            # Parts of a compressed object can't be written where they go, so it comes down in one stream.
+            return dst.import_via_fd(lambda: decompressed(stream), blob)
+        size = int(headers.get("content-length", 0))
+        if size < self._multipart_threshold:
+            return dst.import_via_fd(lambda: stream, blob)
+        with stream:
+            pass
+        # The unread body is still on the socket, so hang up; the next request reconnects.
+        http_conn = self._open_conn().conn
+        if http_conn is not None:
+            http_conn.close()
+        key = self._key(blob)
+
+        def read_part(offset: int, length: int) -> bytes:
+            def attempt() -> bytes:
+                with self._pool.lease() as conn:
+                    part, _ = conn.get_object2(self._bucket, key, byte_range=(offset, offset + length - 1))
+                    assert part is not None, f"get_object2 returned no stream for part of {blob}"
+                    with part:
+                        # Read until the stream reports its end, leaving the connection reusable.
+                        return b"".join(iter(lambda: part.read(length), b""))
+            return retry(attempt, is_s3_exception)
+        return dst.import_via_parts(blob, size, read_part, self._part_size_for(size), self._part_workers)
 
 
 class S3Blobstore:
-    def __init__(self, s3_url: str, access_id: str, secret: bytes):
+    def __init__(
+            self,
+            s3_url: str,
+            access_id: str,
+            secret: bytes,
+            host: Optional[str] = None,
+            port: Optional[int] = None,
+            use_ssl: bool = True,
+            multipart_threshold: int = DEFAULT_S3_MULTIPART_THRESHOLD,
+            part_size: int = DEFAULT_S3_PART_SIZE,
+            part_workers: int = DEFAULT_S3_PART_WORKERS,
+            codec: Optional[str] = None,
+    ):
         self.bucket, self.prefix = _s3_parse_url(s3_url)
         self.access_id = access_id
         self.secret = secret
+        self.pool = _s3_pool(access_id, secret, host, port, use_ssl)
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_workers = part_workers
+        self.codec = check_codec(codec or DEFAULT_S3_CODEC)
 
     def _key(self, csum: str) -> str:
         """
@@ -396,10 +1398,19 @@ class S3Blobstore:
 
     def session(self) -> 'S3BlobstoreSession':
         """
-        Return a session context manager over a single S3 connection.
-        The connection is established on entry and closed on exit.
+        Return a session context manager over a single S3 connection,
+        leased from the pool on entry and returned on exit.
         """
-        return S3BlobstoreSession(self.access_id, self.secret, self.bucket, self.prefix)
+        return S3BlobstoreSession(
+            self.pool, self.bucket, self.prefix, self.multipart_threshold, self.part_size, self.part_workers, self.codec)
+
+    def blob_codec(self, blob: str) -> Optional[str]:
+        """The codec blob is stored compressed with, or None if it is stored plain."""
+        with self.pool.lease() as conn:
+            headers = s3_head(conn, self.bucket, self._key(blob))
+        if headers is None:
+            raise FileNotFoundError(f"{blob} is not in the blobstore")
+        return headers.get(S3_CODEC_HEADER)
 
     def blobs(self, start_after: Optional[str] = None, max_items: Optional[int] = None) -> Generator[str, None, None]:
         """Iterator across all blobs in sorted order.
@@ -413,7 +1424,7 @@ class S3Blobstore:
         if start_after is not None:
             s3_start_after = self.prefix + "/" + start_after
 
-        with s3conn(self.access_id, self.secret) as s3:
+        with self.pool.lease() as s3:
             key_iter = s3.list_bucket(self.bucket, prefix=self.prefix + "/", start=s3_start_after, batch_size=max_items)
             count = 0
             for key in key_iter:
@@ -423,13 +1434,35 @@ class S3Blobstore:
                 if max_items is not None and count >= max_items:
                     break
 
+    def exists_many(self, blobs: Iterable[str]) -> Set[str]:
+        """
+        The blobs which are present. S3 has no batch HEAD, so this lists the key
+        ranges the blobs fall in instead: each page of EXISTS_BATCH keys answers
+        for every blob it spans, and listing skips ahead to the next blob past it.
+        A dense set costs about one request per EXISTS_BATCH blobs in the
+        blobstore, a sparse one about one request per blob.
+        """
+        wanted = sorted(set(blobs))
+        present: Set[str] = set()
+        i = 0
+        while i < len(wanted):
+            # Start just before wanted[i]; a key which is a prefix of it sorts first.
+            page = list(self.blobs(start_after=wanted[i][:-1], max_items=EXISTS_BATCH))
+            listed = set(page)
+            end = page[-1] if len(page) == EXISTS_BATCH else None
+            while i < len(wanted) and (end is None or wanted[i] <= end):
+                if wanted[i] in listed:
+                    present.add(wanted[i])
+                i += 1
+        return present
+
     # TODO dict is rather open ended.
     def blob_stats(self) -> Callable[[], Generator[dict, None, None]]:
         # TODO why do we need this? Not portable.
         """Iterator across all blobs, retaining the listing information"""
 
         def blob_iterator() -> Generator[dict, None, None]:
-            with s3conn(self.access_id, self.secret) as s3:
+            with self.pool.lease() as s3:
                 key_iter = s3.list_bucket2(self.bucket, prefix=self.prefix + "/")
                 for head in key_iter:
                     blob = head[LIST_BUCKET_KEY][len(self.prefix) + 1:]
@@ -440,7 +1473,7 @@ class S3Blobstore:
 
     def url(self, blob: str) -> str:
         key = self.prefix + "/" + blob
-        with s3conn(self.access_id, self.secret) as s3:
+        with self.pool.lease() as s3:
             return s3.get_object_url(self.bucket, key)
 
 
@@ -449,39 +1482,223 @@ def _parse_http_url(http_url: str) -> tuple[Optional[str], Optional[int]]:
     return parsed_url.hostname, parsed_url.port
 
 
+def _http_pool(host: Optional[str], port: Optional[int], conn_timeout: float) -> ConnectionPool[http.client.HTTPConnection]:
+    def connect() -> http.client.HTTPConnection:
+        # Connects on the first request, and reconnects if the server closed the connection.
+        return http.client.HTTPConnection(host, port, timeout=conn_timeout)  # type: ignore[arg-type]
+
+    def close(conn: http.client.HTTPConnection) -> None:
+        conn.close()
+
+    def healthy(conn: http.client.HTTPConnection) -> bool:
+        return socket_idle(conn.sock)
+    return ConnectionPool(connect, close, healthy)
+
+
+# Times a read handle reconnects to resume a blob after its connection drops.
+HTTP_RESUME_TRIES = 3
+_DROPPED = (http.client.IncompleteRead, ConnectionError, TimeoutError)
+
+
+class _HttpBlobHandle:
+    """
+    The body of a blob GET. If the connection drops part way through the body,
+    the read resumes where it stopped with a Range request made on a fresh
+    connection. If-Range, naming the blob's ETag, keeps the bytes from the same blob.
+    """
+
+    def __init__(self, session: "HttpBlobstoreSession", blob: str, resp: HTTPResponse):
+        self._session = session
+        self._blob = blob
+        self._resp = resp
+        self._length = resp.length
+        etag = resp.getheader("ETag")
+        # A weak ETag, given to a compressed body, can't be resumed with a Range.
+        self._etag = None if etag is None or etag.startswith("W/") else etag
+        self._received = 0
+        self._resumes = 0
+
+    def __enter__(self) -> "_HttpBlobHandle":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def read(self, n: int = -1, /) -> bytes:
+        partial = b""
+        while True:
+            try:
+                data = self._resp.read() if n < 0 else self._resp.read(n)
+            except _DROPPED as e:
+                if isinstance(e, http.client.IncompleteRead):
+                    partial += e.partial
+                    self._received += len(e.partial)
+                self._resume(e)
+                continue
+            if not data and n != 0 and self._length is not None and self._received < self._length:
+                self._resume(http.client.IncompleteRead(partial, self._length - self._received))
+                continue
+            self._received += len(data)
+            return partial + data
+
+    def _resume(self, error: Exception) -> None:
+        if self._etag is None or self._length is None or self._resumes >= HTTP_RESUME_TRIES:
+            raise error
+        self._resumes += 1
+        logger.debug("Resuming %s at %d after %s", self._blob, self._received, type(error).__name__)
+        self._resp.close()
+        self._resp = self._session._resume(self._blob, self._received, self._etag)
+
+    def close(self) -> None:
+        self._session._clear_handle()
+        if not self._resp.isclosed():
+            self._session._unread = True
+        self._resp.close()
+
+
+def _read_upto(src: Readable[bytes], n: int) -> bytes:
+    """n bytes of src, or fewer if it ends first."""
+    buf = b""
+    while len(buf) < n:
+        data = src.read(n - len(buf))
+        if not data:
+            break
+        buf += data
+    return buf
+
+
+_BLOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def valid_blob_id(blob: object) -> bool:
+    """Whether blob is an md5 hexdigest, the only ids a bulk frame carries."""
+    return isinstance(blob, str) and _BLOB_ID.fullmatch(blob) is not None
+
+
+def encode_manifest(manifest: Manifest) -> bytes:
+    return json.dumps({"chunks": manifest}).encode()
+
+
+def decode_manifest(data: bytes) -> Manifest:
+    """Parse a manifest, raising ValueError if it isn't one."""
+    try:
+        entries = json.loads(data)["chunks"]
+        manifest = [(str(chunk), int(size)) for chunk, size in entries]
+    except (TypeError, KeyError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Bad manifest: {e}") from e
+    for chunk, size in manifest:
+        if not valid_blob_id(chunk) or size < 0:
+            raise ValueError(f"Bad manifest entry {chunk} {size}")
+    return manifest
+
+
+def bulk_frame_head(blob: str, length: int) -> bytes:
+    if not valid_blob_id(blob):
+        raise ValueError(f"Not a blob id: {blob!r}")
+    return BULK_FRAME.pack(blob.encode("ascii"), length)
+
+
+def read_bulk_frame_head(src: Readable[bytes]) -> Optional[Tuple[str, int]]:
+    """The blob and length heading the next frame of a bulk stream, or None if the stream is over."""
+    head = _read_upto(src, BULK_FRAME.size)
+    if not head:
+        return None
+    if len(head) < BULK_FRAME.size:
+        raise ConnectionError(f"Bulk stream ended {len(head)} bytes into a frame header")
+    raw, length = BULK_FRAME.unpack(head)
+    blob = raw.decode("ascii", errors="replace")
+    if not valid_blob_id(blob) or length < BULK_MISSING:
+        raise ValueError(f"Bad bulk frame header for {blob!r} of {length} bytes")
+    return blob, length
+
+
+class BulkFrame:
+    """
+    The length bytes of one blob in a bulk stream. Reads stop at the end of the
+    frame, and raise ConnectionError if the stream ends before it does.
+    Closing leaves the stream open; skip() moves it on to the next frame.
+    """
+
+    def __init__(self, src: Readable[bytes], length: int):
+        self._src = src
+        self.remaining = length
+
+    def __enter__(self) -> "BulkFrame":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+    def read(self, n: int = -1, /) -> bytes:
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        if n == 0:
+            return b""
+        data = self._src.read(n)
+        if not data:
+            raise ConnectionError(f"Bulk stream ended with {self.remaining} bytes of a frame unread")
+        self.remaining -= len(data)
+        return data
+
+    def skip(self) -> None:
+        while self.read(_BLOCKSIZE):
+            pass
+
+
+def _upload_error(status: int, payload: bytes, blob: Optional[str]) -> Exception:
+    """The error for a failed upload. A 4xx refuses what was sent, the rest may pass on a retry."""
+    if not 400 <= status < 500:
+        return RuntimeError(f"blobstore returned status code: {status}")
+    try:
+        error = json.loads(payload)
+        reason = error["error"]
+        blob = error.get("blob", blob)
+    except (ValueError, KeyError, TypeError):
+        reason = payload.decode("utf-8", "replace")
+    return BlobRejected(blob, f"status code {status}: {reason}")
+
+
 class HttpBlobstoreSession:
     """
-    A session over a single HTTP connection. Use via HttpBlobstore.session().
+    A session over a single HTTP connection, leased from the blobstore's pool.
+    Use via HttpBlobstore.session().
 
     Only one read handle may be outstanding at a time — the underlying
     HTTP/1.1 connection is strictly sequential.
     """
-    def __init__(self, host: Optional[str], port: Optional[int], conn_timeout: float):
-        self._host = host
-        self._port = port
-        self._conn_timeout = conn_timeout
+    def __init__(self, pool: ConnectionPool[http.client.HTTPConnection], codec: Optional[str] = None):
+        self._pool = pool
+        self._codec = check_codec(codec)
         self._conn: Optional[http.client.HTTPConnection] = None
         self._handle_outstanding = False
+        # A read handle closed before its body was read leaves the rest on the connection.
+        self._unread = False
 
     def __enter__(self) -> 'HttpBlobstoreSession':
         if self._handle_outstanding:
             raise LifecycleError("Entering session with open handle")
-        self._conn = http.client.HTTPConnection(
-            self._host, self._port, timeout=self._conn_timeout  # type: ignore[arg-type]
-        )
-        self._conn.connect()
+        self._conn = self._pool.acquire()
+        self._unread = False
         return self
 
-    def __exit__(self, *_) -> None:
+    def __exit__(self, exc_type, *_) -> None:
+        conn, self._conn = self._conn, None
         if self._handle_outstanding:
+            if conn is not None:
+                self._pool.release(conn, reuse=False)
             raise LifecycleError("Exiting session with open handle")
-        if self._conn is not None:
-            self._conn.close()
-            self._conn = None
-
-    def _request(self, method: str, path: str, body: Optional[str | Readable[bytes]] = None) -> HTTPResponse:
+        if conn is not None:
+            self._pool.release(conn, reuse=exc_type is None and not self._unread)
+
+    def _request(
+            self,
+            method: str,
+            path: str,
+            body: Optional[str | bytes | Readable[bytes] | Iterable[bytes]] = None,
+            headers: Optional[Dict[str, str]] = None,
+    ) -> HTTPResponse:
         assert self._conn is not None
-        self._conn.request(method, path, body=body)
+        self._conn.request(method, path, body=body, headers=headers or {})
         return self._conn.getresponse()
 
     def _clear_handle(self) -> None:
@@ -494,19 +1711,24 @@ class HttpBlobstoreSession:
             raise LifecycleError(
                 "HttpBlobstoreSession: previous read handle must be closed before calling read_handle again"
             )
-        resp = self._request("GET", "/bs/" + blob)
+        resp = self._request("GET", "/bs/" + blob, headers={"Accept-Encoding": self._codec} if self._codec else None)
         if resp.status != http.client.OK:
             raise RuntimeError(f"blobstore returned status code: {resp.status}")
         self._handle_outstanding = True
-        _orig_close = resp.close
-        # TODO: replace close-patching with an _HttpHandleWrapper class (like _S3HandleWrapper)
-        # for consistency and to avoid monkey-patching HTTPResponse.
-
-        def _close_and_clear() -> None:
-            self._clear_handle()
-            _orig_close()
+        handle = _HttpBlobHandle(self, blob, resp)
+        if resp.getheader("Content-Encoding", "identity") == "identity":
+            return handle
+        return DecompressingReader(handle)
 
-        resp.close = _close_and_clear  # type: ignore[method-assign]
+    def _resume(self, blob: str, offset: int, etag: str) -> HTTPResponse:
+        """Reconnect and request the rest of blob from offset, or raise if it can't be resumed."""
+        assert self._conn is not None
+        self._conn.close()
+        self._conn.request("GET", "/bs/" + blob, headers={"Range": f"bytes={offset}-", "If-Range": etag})
+        resp = self._conn.getresponse()
+        if resp.status != http.client.PARTIAL_CONTENT:
+            resp.close()
+            raise RuntimeError(f"blobstore answered resuming {blob} at {offset} with status code: {resp.status}")
         return resp
 
     def import_via_fd(self, getSrcHandle: HandleThunk[Readable[bytes]], blob: str, force: bool = False) -> bool:
@@ -517,38 +1739,135 @@ class HttpBlobstoreSession:
             raise LifecycleError(
                 "HttpBlobstoreSession: previous read handle must be closed before calling import_via_fd"
             )
-        with (
-            getSrcHandle() as src,
-            self._request("POST", f"/bs?blob={blob}", body=src) as resp,
-        ):
-            if resp.status == http.client.CREATED:
-                dup = False
-            elif resp.status == http.client.OK:
-                dup = True
-            else:
-                raise RuntimeError(f"blobstore returned status code: {resp.status}")
+        with getSrcHandle() as src:
+            body: Readable[bytes] = src
+            headers = {}
+            if self._codec is not None:
+                peeked = PeekReader(src)
+                body = peeked
+                if worth_compressing(peeked.head):
+                    body = CompressingReader(peeked)
+                    headers["Content-Encoding"] = self._codec
+            with self._request("POST", f"/bs?blob={blob}", body, headers) as resp:
+                payload = resp.read()  # Drain the body, so the connection can be reused.
+                if resp.status == http.client.CREATED:
+                    dup = False
+                elif resp.status == http.client.OK:
+                    dup = True
+                else:
+                    raise _upload_error(resp.status, payload, blob)
         return dup
 
+    def read_many(self, blobs: Sequence[str]) -> Generator[Tuple[str, Optional[BulkFrame]], None, None]:
+        """
+        Fetch blobs in one POST /bs/bulk-read, yielding each blob with a reader
+        over its bytes, or None if the server doesn't have it, in the order asked.
+        A reader is good until the next blob is yielded; whatever of it wasn't read is skipped.
+        """
+        if self._conn is None:
+            raise RuntimeError("HttpBlobstoreSession: session is not open")
+        if self._handle_outstanding:
+            raise LifecycleError(
+                "HttpBlobstoreSession: previous read handle must be closed before calling read_many"
+            )
+        resp = self._request("POST", "/bs/bulk-read", json.dumps({"blobs": list(blobs)}),
+                             {"Content-Type": "application/json"})
+        if resp.status != http.client.OK:
+            resp.read()
+            raise RuntimeError(f"blobstore returned status code: {resp.status}")
+        self._handle_outstanding = True
+        try:
+            for expected in blobs:
+                head = read_bulk_frame_head(resp)
+                if head is None or head[0] != expected:
+                    raise ValueError(f"Bulk read of {expected} answered with {head}")
+                blob, length = head
+                if length == BULK_MISSING:
+                    yield blob, None
+                    continue
+                frame = BulkFrame(resp, length)
+                yield blob, frame
+                frame.skip()
+            resp.read()
+        finally:
+            self._handle_outstanding = False
+            if not resp.isclosed():
+                self._unread = True
+            resp.close()
+
+    def import_many(self, items: Sequence[Tuple[str, int, HandleThunk[Readable[bytes]]]]) -> Dict[str, bool]:
+        """
+        Upload (blob, size, getSrcHandle) items in one POST /bs/bulk.
+        Returns whether each blob was already present, like import_via_fd.
+        """
+        if self._conn is None:
+            raise RuntimeError("HttpBlobstoreSession: session is not open")
+        if self._handle_outstanding:
+            raise LifecycleError(
+                "HttpBlobstoreSession: previous read handle must be closed before calling import_many"
+            )
+
+        def frames() -> Iterator[bytes]:
+            for blob, size, getSrcHandle in items:
+                yield bulk_frame_head(blob, size)
+                sent = 0
+                with getSrcHandle() as src:
+                    while sent < size and (data := src.read(min(_BLOCKSIZE, size - sent))):
+                        sent += len(data)
+                        yield data
+                if sent != size:
+                    # The body's length was promised up front, so the request can only be abandoned.
+                    raise ValueError(f"{blob} ended {size - sent} bytes short of its announced size")
+        length = sum(BULK_FRAME.size + size for _, size, _ in items)
+        headers = {"Content-Type": BULK_CONTENT_TYPE, "Content-Length": str(length)}
+        with self._request("POST", "/bs/bulk", frames(), headers) as resp:
+            payload = resp.read()
+            if resp.status != http.client.OK:
+                raise _upload_error(resp.status, payload, None)
+        duplicates = set(json.loads(payload)["duplicate"])
+        return {blob: blob in duplicates for blob, _, _ in items}
+
+    def import_manifest(self, blob: str, manifest: Manifest) -> bool:
+        """
+        Stores blob as the chunks listed by manifest with PUT /bs/<blob>/chunks.
+        The chunks must already be uploaded. Returns True if the blob was already present.
+        """
+        if self._conn is None:
+            raise RuntimeError("HttpBlobstoreSession: session is not open")
+        if self._handle_outstanding:
+            raise LifecycleError(
+                "HttpBlobstoreSession: previous read handle must be closed before calling import_manifest"
+            )
+        with self._request("PUT", f"/bs/{blob}/chunks", encode_manifest(manifest), {"Content-Type": "application/json"}) as resp:
+            payload = resp.read()
+            if resp.status == http.client.CREATED:
+                return False
+            if resp.status == http.client.OK:
+                return True
+            raise _upload_error(resp.status, payload, blob)
+
 
 class HttpBlobstore:
-    def __init__(self, endpoint, conn_timeout):
+    def __init__(self, endpoint, conn_timeout, codec: Optional[str] = None):
         self.host, self.port = _parse_http_url(endpoint)
         self.conn_timeout = conn_timeout
+        self.pool = _http_pool(self.host, self.port, conn_timeout)
+        self.codec = check_codec(codec or DEFAULT_HTTP_CODEC)
 
-    def _request(self, method: str, path: str, body: Optional[str | Readable[bytes]] = None) -> HTTPResponse:
-        conn = http.client.HTTPConnection(
-            self.host, self.port, timeout=self.conn_timeout
-        )
-        conn.request(method, path, body=body)
-        resp = conn.getresponse()
-        return resp
+    @contextmanager
+    def _request(self, method: str, path: str, body: Optional[str | Readable[bytes]] = None) -> Generator[HTTPResponse, None, None]:
+        """Make a request on a pooled connection. The response must be read in full before the block exits."""
+        with self.pool.lease() as conn:
+            conn.request(method, path, body=body)
+            with conn.getresponse() as resp:
+                yield resp
 
     def session(self) -> 'HttpBlobstoreSession':
         """
-        Return a session context manager over a single HTTP connection.
-        The connection is established on entry and closed on exit.
+        Return a session context manager over a single HTTP connection,
+        leased from the pool on entry and returned on exit.
         """
-        return HttpBlobstoreSession(self.host, self.port, self.conn_timeout)
+        return HttpBlobstoreSession(self.pool, self.codec)
 
     def blobs(self, start_after: Optional[str] = None, max_items: Optional[int] = None) -> Iterator[str]:
         """Iterator across all blobs, fetching pages until exhausted.
@@ -577,6 +1896,17 @@ class HttpBlobstore:
                 break
         return iter(result)
 
+    def exists_many(self, blobs: Iterable[str]) -> Set[str]:
+        """The blobs which are present, asked about EXISTS_BATCH at a time."""
+        present: Set[str] = set()
+        for batch in itertools.batched(blobs, EXISTS_BATCH):
+            with self._request("POST", "/bs/exists", json.dumps({"blobs": batch})) as resp:
+                if resp.status != http.client.OK:
+                    raise RuntimeError(f"blobstore returned status code: {resp.status}")
+                payload = json.loads(resp.read())
+            present.update(payload["present"])
+        return present
+
     def blob_checksum(self, blob: str) -> str:
         with self._request("GET", f"/bs/{blob}/checksum") as resp:
             if resp.status != http.client.OK:
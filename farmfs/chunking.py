@@ -0,0 +1,147 @@
+"""
+Content-defined chunking.
+
+A large file which changes a little at a time, like a VM image or a database
+dump, would otherwise be stored whole again every time it is frozen. Split
+into chunks whose boundaries depend only on the bytes around them, an edit
+only changes the chunks it touches, and the rest are shared with the file's
+earlier versions. Each chunk is stored as a blob of its own, and a manifest
+lists them in order.
+
+Rolling a hash over the data a byte at a time in Python runs at a few MB/s,
+so boundaries are found in two steps which each run at C speed. Each byte is
+mapped to a bit by a fixed table, and bytes.find looks for the few bytes whose
+bits match a short pattern. Those candidates become boundaries when the crc32
+of the WINDOW bytes before them has its low bits clear, enough of them that
+boundaries fall the average chunk size apart. Chunks are kept between a quarter
+and four times that. Runs of a single byte, like zeroed space, have no
+candidates, so they are cut at the largest chunk size.
+
+The table and the pattern decide where every boundary falls; changing them
+would stop new chunks lining up with the ones already stored.
+"""
+import zlib
+from hashlib import md5
+from os import environ
+from typing import Callable, ContextManager, Iterator, List, Optional, Sequence, Tuple
+
+from farmfs.util import Readable
+
+# Files of at least FARMFS_CHUNK_THRESHOLD bytes are chunked when frozen, if it is set.
+DEFAULT_CHUNK_THRESHOLD = int(environ.get("FARMFS_CHUNK_THRESHOLD", "0")) or None
+# The average chunk size, rounded down to a power of two.
+DEFAULT_CHUNK_SIZE = int(environ.get("FARMFS_CHUNK_SIZE", str(1024 * 1024)))
+MIN_CHUNK_SIZE = 64
+
+READ_SIZE = 64 * 1024
+
+# (chunk, size) pairs, in the order the chunks make up the blob.
+Manifest = List[Tuple[str, int]]
+
+# Bytes hashed to decide whether a candidate is a boundary.
+WINDOW = 48
+
+_BITS = bytes.maketrans(bytes(range(256)), bytes(b"01"[md5(bytes([b])).digest()[0] & 1] for b in range(256)))
+_PATTERN = b"10011101"
+
+
+def chunk_bounds(size: int) -> Tuple[int, int, int]:
+    """The crc32 mask, and the smallest and largest chunk sizes, for chunks averaging size bytes."""
+    if size < MIN_CHUNK_SIZE:
+        raise ValueError(f"Chunk size {size} is under {MIN_CHUNK_SIZE} bytes")
+    average_bits = min(size.bit_length() - 1, 32)
+    mask = (1 << (average_bits - len(_PATTERN))) - 1
+    return mask, (1 << average_bits) // 4, (1 << average_bits) * 4
+
+
+def _boundary(buf: bytearray, min_size: int, max_size: int, mask: int) -> int:
+    """Where the first chunk of buf ends."""
+    end = min(len(buf), max_size)
+    pos = max(min_size, WINDOW)
+    # Translated a piece at a time, since most chunks end well short of max_size.
+    while pos <= end:
+        stop = min(end, pos + min_size)
+        bits = buf[pos - len(_PATTERN):stop].translate(_BITS)
+        start = 0
+        while (found := bits.find(_PATTERN, start)) >= 0:
+            cut = pos + found
+            if not zlib.crc32(buf[cut - WINDOW:cut]) & mask:
+                return cut
+            start = found + 1
+        pos = stop + 1
+    return end
+
+
+def chunks(src: Readable[bytes], size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """Split what src reads into content-defined chunks averaging size bytes."""
+    mask, min_size, max_size = chunk_bounds(size)
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = src.read(max_size - len(buf))
+            if data:
+                buf += data
+            else:
+                eof = True
+        if not buf:
+            return
+        cut = len(buf) if len(buf) <= min_size else _boundary(buf, min_size, max_size, mask)
+        yield bytes(buf[:cut])
+        del buf[:cut]
+
+
+class ChunkedReader:
+    """
+    Reads the chunks of a manifest one after another, opening each with open_chunk
+    when it is reached. Raises ValueError if a chunk isn't the size the manifest says.
+    """
+
+    def __init__(self, manifest: Sequence[Tuple[str, int]], open_chunk: Callable[[str], ContextManager[Readable[bytes]]]):
+        self._chunks = iter(manifest)
+        self._open_chunk = open_chunk
+        self._handle: Optional[ContextManager[Readable[bytes]]] = None
+        self._src: Optional[Readable[bytes]] = None
+        self._chunk = ""
+        self._remaining = 0
+        self.closed = False
+
+    def __enter__(self) -> "ChunkedReader":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _close_chunk(self) -> None:
+        handle, self._handle, self._src = self._handle, None, None
+        if handle is not None:
+            handle.__exit__(None, None, None)
+
+    def close(self) -> None:
+        self._close_chunk()
+        self.closed = True
+
+    def read(self, n: int = -1, /) -> bytes:
+        out: List[bytes] = []
+        got = 0
+        while n < 0 or got < n:
+            if self._src is None:
+                entry = next(self._chunks, None)
+                if entry is None:
+                    break
+                self._chunk, self._remaining = entry
+                self._handle = self._open_chunk(self._chunk)
+                self._src = self._handle.__enter__()
+            # Always a sized read: some streams never report the end of a read(-1).
+            data = self._src.read(READ_SIZE if n < 0 else min(READ_SIZE, n - got))
+            if not data:
+                if self._remaining != 0:
+                    raise ValueError(f"Chunk {self._chunk} ended {self._remaining} bytes short")
+                self._close_chunk()
+                continue
+            self._remaining -= len(data)
+            if self._remaining < 0:
+                raise ValueError(f"Chunk {self._chunk} is longer than its manifest says")
+            out.append(data)
+            got += len(data)
+        return b"".join(out)
@@ -0,0 +1,221 @@
+"""
+Blob compression.
+
+Blobs are named by the md5 of their uncompressed bytes, whether they are
+stored or sent compressed, so compression is invisible above the blobstores.
+A compressed blob carries a codec marker naming how it was compressed: a
+suffix on the file in a FileBlobstore, object metadata on S3, and
+Content-Encoding over farmapi.
+
+gzip is the only codec. Its output is a standard gzip member, with the
+uncompressed size written into the header's extra field when it is known, so
+a stored blob's size can be read without decompressing it.
+
+Compression is opt-in, and even then a blob is only compressed when its first
+bytes suggest it is worth it: media which is already compressed (JPEG, PNG,
+video, archives and the like) is recognised by its magic number and a sample
+of anything else has to shrink by a tenth.
+"""
+import os
+import struct
+import zlib
+from os import environ
+from contextlib import contextmanager
+from typing import ContextManager, Generator, Optional
+
+from farmfs.util import Readable
+
+CODECS = ["gzip"]
+# The suffix marking a blob file stored compressed with each codec.
+SUFFIXES = {"gzip": ".gz"}
+DEFAULT_CODEC_LEVEL = int(environ.get("FARMFS_CODEC_LEVEL", "6"))
+
+# Bytes of a blob sampled to decide whether to compress it, and how small a sample must compress to.
+SAMPLE_SIZE = 64 * 1024
+MAX_RATIO = 0.9
+READ_SIZE = 64 * 1024
+
+# Magic numbers of formats which are already compressed, as (offset, bytes).
+_COMPRESSED_MAGIC = [
+    (0, b"\xff\xd8\xff"),  # JPEG
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (0, b"GIF8"),
+    (0, b"PK\x03\x04"),  # zip, and the office, jar and epub formats built on it
+    (0, b"\x1f\x8b"),  # gzip
+    (0, b"BZh"),
+    (0, b"\xfd7zXZ\x00"),
+    (0, b"(\xb5/\xfd"),  # zstd
+    (0, b"7z\xbc\xaf\x27\x1c"),
+    (0, b"Rar!\x1a\x07"),
+    (0, b"\x04\x22\x4d\x18"),  # lz4
+    (4, b"ftyp"),  # mp4, mov, heic, avif
+    (0, b"\x1a\x45\xdf\xa3"),  # mkv, webm
+    (0, b"ID3"),  # mp3
+    (0, b"\xff\xfb"),  # mp3 without tags
+    (0, b"OggS"),
+    (0, b"fLaC"),
+    (8, b"WEBP"),
+    (8, b"AVI "),
+]
+
+# The gzip header written: magic, deflate, FEXTRA, no mtime, no extra flags, unknown
+# OS, then an extra field holding one "FS" subfield with the uncompressed size.
+_GZIP_HEADER = struct.Struct("<2sBBIBBH2sHQ")
+_SIZE_OFFSET = _GZIP_HEADER.size - 8
+
+
+def check_codec(codec: Optional[str]) -> Optional[str]:
+    if codec is not None and codec not in CODECS:
+        raise ValueError("Unknown codec %s, expected one of %s" % (codec, CODECS))
+    return codec
+
+
+def looks_compressed(head: bytes) -> bool:
+    """Whether head, the first bytes of a blob, starts a format which is already compressed."""
+    return any(head[offset:offset + len(magic)] == magic for offset, magic in _COMPRESSED_MAGIC)
+
+
+def worth_compressing(head: bytes, level: int = DEFAULT_CODEC_LEVEL) -> bool:
+    """Whether a blob starting with head (up to SAMPLE_SIZE bytes of it) should be compressed."""
+    sample = head[:SAMPLE_SIZE]
+    if not sample or looks_compressed(sample):
+        return False
+    return len(zlib.compress(sample, level)) <= len(sample) * MAX_RATIO
+
+
+def gzip_size(head: bytes) -> Optional[int]:
+    """The uncompressed size recorded in a gzip header written here, or None if it has none."""
+    if len(head) < _GZIP_HEADER.size:
+        return None
+    magic, method, flags, _, _, _, xlen, subfield, sublen, size = _GZIP_HEADER.unpack_from(head)
+    if magic != b"\x1f\x8b" or not flags & 0x04 or xlen != 12 or subfield != b"FS" or sublen != 8:
+        return None
+    return size
+
+
+def record_gzip_size(fileno: int, size: int) -> None:
+    """Record the uncompressed size in the header of a gzip file written with an unknown size."""
+    os.pwrite(fileno, struct.pack("<Q", size), _SIZE_OFFSET)
+
+
+class GzipEncoder:
+    """Compresses a stream of chunks into one gzip member."""
+
+    def __init__(self, level: int = DEFAULT_CODEC_LEVEL, size: int = 0):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._header: Optional[bytes] = _GZIP_HEADER.pack(b"\x1f\x8b", 8, 0x04, 0, 0, 255, 12, b"FS", 8, size)
+        self._crc = 0
+        self.size = 0
+
+    def _start(self) -> bytes:
+        header, self._header = self._header, None
+        return header or b""
+
+    def compress(self, data: bytes) -> bytes:
+        self._crc = zlib.crc32(data, self._crc)
+        self.size += len(data)
+        return self._start() + self._z.compress(data)
+
+    def flush(self) -> bytes:
+        return self._start() + self._z.flush() + struct.pack("<II", self._crc, self.size & 0xFFFFFFFF)
+
+
+class PeekReader:
+    """A reader which has already read head from src, and replays it before the rest of src."""
+
+    def __init__(self, src: Readable[bytes], size: int = SAMPLE_SIZE):
+        self._src = src
+        self.head = b""
+        while len(self.head) < size:
+            data = src.read(size - len(self.head))
+            if not data:
+                break
+            self.head += data
+        self._pos = 0
+
+    def read(self, n: int = -1, /) -> bytes:
+        if self._pos < len(self.head):
+            end = len(self.head) if n < 0 else min(len(self.head), self._pos + n)
+            data = self.head[self._pos:end]
+            self._pos = end
+            if n < 0:
+                data += self._src.read()
+            return data
+        return self._src.read(n)
+
+
+class CompressingReader:
+    """Reads src gzip compressed."""
+
+    def __init__(self, src: Readable[bytes], level: int = DEFAULT_CODEC_LEVEL, size: int = 0):
+        self._src = src
+        self._encoder = GzipEncoder(level, size)
+        self._buf = b""
+        self._done = False
+
+    @property
+    def size(self) -> int:
+        """Bytes of src compressed so far."""
+        return self._encoder.size
+
+    def read(self, n: int = -1, /) -> bytes:
+        while not self._done and (n < 0 or len(self._buf) < n):
+            data = self._src.read(READ_SIZE)
+            if data:
+                self._buf += self._encoder.compress(data)
+            else:
+                self._buf += self._encoder.flush()
+                self._done = True
+        if n < 0:
+            n = len(self._buf)
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+
+class DecompressingReader:
+    """
+    Reads gzip compressed src uncompressed. Raises ValueError if src ends before
+    the compressed stream does, or if the stream's checksum doesn't match.
+    """
+
+    def __init__(self, src: Readable[bytes]):
+        self._src = src
+        self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def __enter__(self) -> "DecompressingReader":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        close = getattr(self._src, "close", None)
+        if close is not None:
+            close()
+
+    def read(self, n: int = -1, /) -> bytes:
+        if n == 0:
+            return b""
+        out = b""
+        while n < 0 or len(out) < n:
+            if self._z.unconsumed_tail:
+                chunk = self._z.unconsumed_tail
+            elif self._z.eof:
+                break
+            else:
+                chunk = self._src.read(READ_SIZE)
+                if not chunk:
+                    raise ValueError("Compressed blob ended early")
+            out += self._z.decompress(chunk, 0 if n < 0 else n - len(out))
+            if self._z.eof:
+                # Read src to its end, so a response body is seen through and its connection can be reused.
+                while self._src.read(READ_SIZE):
+                    pass
+        return out
+
+
+@contextmanager
+def decompressed(handle: ContextManager[Readable[bytes]]) -> Generator[DecompressingReader, None, None]:
+    """A handle reading what handle reads, uncompressed."""
+    with handle as src:
+        yield DecompressingReader(src)
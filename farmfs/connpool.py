@@ -0,0 +1,215 @@
+"""Thread-safe pools of keep-alive connections for the remote blobstores.
+
+Setting up a connection, and for S3 a TLS session on top of it, can take
+longer than sending a small blob over it. S3Blobstore and HttpBlobstore each
+keep a ConnectionPool, and their sessions, listings and one-off requests lease
+connections from it instead of opening their own.
+
+The most recently returned connection is leased first, keeping hot connections
+warm, and connections left idle for max_idle seconds are closed. A connection is
+checked before it is leased again; one the server has closed, or which still has
+unread response data, is replaced. A lease which raises discards its connection,
+since whatever went wrong may have left it in a bad state.
+"""
+import select
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from os import environ
+from types import TracebackType
+from typing import Callable, Deque, Generator, Optional, Tuple, Type, TypedDict
+
+# Most connections a pool holds, leased and idle, and how long an idle one is kept.
+DEFAULT_POOL_SIZE = int(environ.get("FARMFS_POOL_SIZE", "32"))
+DEFAULT_POOL_IDLE_SECONDS = float(environ.get("FARMFS_POOL_IDLE_SECONDS", "60"))
+# How long a lease waits for a connection when the pool is full.
+DEFAULT_POOL_WAIT_SECONDS = 60.0
+
+
+class PoolStats(TypedDict):
+    total: int
+    available: int
+    in_use: int
+    max_size: int
+    created: int
+    reused: int
+    evicted: int
+    discarded: int
+
+
+def socket_idle(sock: Optional[socket.socket]) -> bool:
+    """
+    Whether an idle keep-alive socket is fit to send a request on. It shouldn't
+    be readable: that means the server closed it, or sent data nobody read.
+    A socket which isn't connected is fine, it is connected on the next request.
+    """
+    if sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class ConnectionPool[C]:
+    """
+    Up to max_size connections made by connect, reused until closed by close.
+    healthy checks an idle connection before it is leased or taken back.
+    """
+
+    def __init__(
+            self,
+            connect: Callable[[], C],
+            close: Callable[[C], None],
+            healthy: Callable[[C], bool],
+            max_size: Optional[int] = None,
+            max_idle: Optional[float] = None,
+            wait_timeout: float = DEFAULT_POOL_WAIT_SECONDS,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = DEFAULT_POOL_SIZE if max_size is None else max_size
+        if self.max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_idle = DEFAULT_POOL_IDLE_SECONDS if max_idle is None else max_idle
+        self.wait_timeout = wait_timeout
+        self._connect = connect
+        self._close = close
+        self._healthy = healthy
+        self._clock = clock
+        self._cond = threading.Condition()
+        # Idle connections and when they were returned, most recently returned on the right.
+        self._idle: Deque[Tuple[C, float]] = deque()
+        self._total = 0
+        self._in_use = 0
+        self._created = 0
+        self._reused = 0
+        self._evicted = 0
+        self._discarded = 0
+        self._closed = False
+
+    def __enter__(self) -> "ConnectionPool[C]":
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc: Optional[BaseException],
+                 tb: Optional[TracebackType]) -> None:
+        self.close()
+
+    def _drop(self, conn: C) -> None:
+        """Close a connection the pool no longer counts. Called with the lock held."""
+        self._total -= 1
+        try:
+            self._close(conn)
+        except Exception:
+            pass  # It is being thrown away regardless.
+
+    def _evict_idle(self) -> None:
+        now = self._clock()
+        while self._idle and now - self._idle[0][1] >= self.max_idle:
+            conn, _ = self._idle.popleft()
+            self._evicted += 1
+            self._drop(conn)
+
+    def acquire(self) -> C:
+        """Lease a connection, waiting up to wait_timeout if all max_size are in use. Prefer lease()."""
+        deadline = self._clock() + self.wait_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Cannot lease from a closed ConnectionPool")
+                self._evict_idle()
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if self._healthy(conn):
+                        self._in_use += 1
+                        self._reused += 1
+                        return conn
+                    self._discarded += 1
+                    self._drop(conn)
+                if self._total < self.max_size:
+                    self._total += 1
+                    self._in_use += 1
+                    break
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No connection available within {self.wait_timeout}s ({self._in_use} of {self.max_size} in use)")
+                self._cond.wait(remaining)
+        try:
+            conn = self._connect()
+        except BaseException:
+            with self._cond:
+                self._total -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+        return conn
+
+    def release(self, conn: C, reuse: bool = True) -> None:
+        """Return a leased connection. It is closed instead of kept if reuse is False or it isn't healthy."""
+        with self._cond:
+            self._in_use -= 1
+            if self._closed:
+                self._drop(conn)
+            elif not reuse or not self._healthy(conn):
+                self._discarded += 1
+                self._drop(conn)
+            elif self._total > self.max_size:
+                self._drop(conn)  # Left over from a reservation which has ended.
+            else:
+                self._idle.append((conn, self._clock()))
+            self._cond.notify()
+
+    @contextmanager
+    def lease(self) -> Generator[C, None, None]:
+        """Lease a connection for the duration of a with block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, reuse=False)
+            raise
+        self.release(conn)
+
+    @contextmanager
+    def reserved(self, count: int) -> Generator[None, None, None]:
+        """
+        Raise max_size by count for the duration of a with block, for a caller
+        which holds up to count connections at once, on top of everyone else's.
+        """
+        with self._cond:
+            self.max_size += count
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.max_size -= count
+
+    def stats(self) -> PoolStats:
+        with self._cond:
+            return PoolStats(
+                total=self._total,
+                available=len(self._idle),
+                in_use=self._in_use,
+                max_size=self.max_size,
+                created=self._created,
+                reused=self._reused,
+                evicted=self._evicted,
+                discarded=self._discarded,
+            )
+
+    def close(self) -> None:
+        """Close the idle connections. Leased ones are closed as they come back."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._drop(conn)
+            self._cond.notify_all()
@@ -50,7 +50,8 @@ Usage:
   farmd volume add [options] <name> <root>
   farmd volume remove <name> [options]
   farmd volume list [options]
-  farmd job add fsck [options] <vol> --every=<e> [--missing] [--keydb] [--blob-permissions] [--checksums] [--schedule=<s>] [--name=<n>]
+  farmd job add fsck [options] <vol> --every=<e> [--missing] [--keydb] [--blob-permissions] [--checksums [--scrub] [--rate=<size>]]
+                     [--schedule=<s>] [--name=<n>]
   farmd job add fetch [options] <vol> --every=<e> [--schedule=<s>] [--name=<n>] [<remote>] [<snap>]
   farmd job add upload [options] <vol> --every=<e> --remote=<r> [--schedule=<s>] [--name=<n>]
   farmd job add gc [options] <vol> --every=<e> [--schedule=<s>] [--name=<n>]
@@ -73,6 +74,8 @@ Options:
   --keydb               Check keydb integrity (fsck only).
   --blob-permissions    Check blob file permissions (fsck only).
   --checksums           Verify blob checksums (fsck only).
+  --scrub               Verify checksums a share at a time, resuming where the last run stopped (fsck only).
+  --rate=<size>         Bytes per second a scrub may read, e.g. 50M (fsck only).
   --color               Force ANSI colour output even when not a tty (e.g. for less -R).
   --no-color            Disable ANSI colour output (overrides --color and NO_COLOR env).
   -h --help             Show help.
@@ -544,8 +547,11 @@ def cmd_job_add_fsck(jr: JobRunner, args: dict) -> int:
         ("--keydb", "--keydb"),
         ("--blob-permissions", "--blob-permissions"),
         ("--checksums", "--checksums"),
+        ("--scrub", "--scrub"),
     ]
     flags = [flag for flag, key in flag_map if args.get(key)]
+    if args.get("--rate"):
+        flags.append(f"--rate={args['--rate']}")
     raw: Dict[str, Any] = {"type": "fsck", "flags": flags}
     job_id = _resolve_job_id(vol_name, args.get("--name"), raw)
     job = JobConfig(
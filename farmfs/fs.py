@@ -1,4 +1,4 @@
-from collections.abc import Callable, Iterable
+from collections.abc import Buffer, Callable, Iterable
 from os import mkdir, stat_result
 from os import listdir
 from os import link
@@ -8,15 +8,20 @@ from os import readlink
 from os import rmdir
 from os import stat
 from os import chmod
+from os import utime
 from os import access, R_OK
 from os import rename
 from os import lstat
+from os import scandir, DirEntry
+from os import environ
+from os import fstat
 from errno import ENOENT as FileDoesNotExist
 from errno import EEXIST as FileExists
 from errno import EISDIR as DirectoryExists
 from errno import EINVAL as InvalidArgument
 from errno import EPERM as NotPermitted
 from errno import EISDIR as IsADirectory
+from errno import EBADF, ENOSYS, ENOTTY, EOPNOTSUPP, EXDEV
 from hashlib import md5
 from os.path import exists
 from os.path import isabs
@@ -24,12 +29,15 @@ from os.path import isdir
 from os.path import isfile, islink, sep
 from os.path import normpath
 from os.path import split
+import io
+import mmap
+import os
 import pathlib
 import stat as statc
 from os.path import splitext
 from fnmatch import fnmatchcase
 from functools import total_ordering
-from typing import IO, Any, Generator, List, Literal, Protocol, Optional, Tuple, Union, overload
+from typing import IO, Any, Dict, Generator, List, Literal, NamedTuple, Protocol, Optional, Tuple, Union, overload
 from farmfs.util import (
     ingest,
     uncurry,
@@ -123,7 +131,7 @@ def ftype_selector(keep_types: List[str]
 # Until this is fixed, we have to define our own protocl which matches the public API
 # of hash objects.
 class HashLike(Protocol):
-    def update(self, data: bytes) -> None: ...
+    def update(self, data: Buffer) -> None: ...
     def digest(self) -> bytes: ...
     def hexdigest(self) -> str: ...
 
@@ -147,6 +155,106 @@ def canonicalPath(path: str) -> str:
     return norm
 
 
+def _entry_name(entry: DirEntry) -> str:
+    return entry.name
+
+
+# How fastcopy moves bytes between files, fastest first. Each falls back to the next
+# where the kernel or filesystem doesn't support it; FARMFS_COPY_METHODS narrows the list.
+# reflink shares the source's extents (btrfs, xfs), copy_file_range copies within the
+# kernel, or on the server for NFS, and sendfile copies within the kernel too.
+COPY_METHODS = ["reflink", "copy_file_range", "sendfile", "buffered"]
+DEFAULT_COPY_METHODS = environ.get("FARMFS_COPY_METHODS", ",".join(COPY_METHODS)).split(",")
+# The ioctl cloning a whole file's extents into another, from linux/fs.h.
+FICLONE = 0x40049409
+# Errors meaning a copy method can't be used on these files, rather than that the copy failed.
+_UNSUPPORTED = {EXDEV, InvalidArgument, ENOSYS, EOPNOTSUPP, ENOTTY, EBADF}
+_COPY_CHUNK = 1 << 30
+
+
+def _reflink(src_fd: int, dst_fd: int) -> None:
+    import fcntl
+    # Only a whole file can be cloned, into an empty one.
+    if os.lseek(src_fd, 0, os.SEEK_CUR) != 0 or fstat(dst_fd).st_size != 0:
+        raise OSError(InvalidArgument, "reflink needs a whole file")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    size = fstat(src_fd).st_size
+    os.lseek(src_fd, size, os.SEEK_SET)
+    os.lseek(dst_fd, size, os.SEEK_SET)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int) -> None:
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is None:
+        raise OSError(ENOSYS, "copy_file_range is not available")
+    # Without offsets, both files' positions advance as it goes, so a fallback picks up where it stopped.
+    while copy_file_range(src_fd, dst_fd, _COPY_CHUNK):
+        pass
+
+
+def _sendfile(src_fd: int, dst_fd: int) -> None:
+    offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+    try:
+        while sent := os.sendfile(dst_fd, src_fd, offset, _COPY_CHUNK):
+            offset += sent
+    finally:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+
+
+_FAST_COPIES: Dict[str, Callable[[int, int], None]] = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+}
+
+
+def _file_fds(src: Any, dst: Any) -> Optional[Tuple[int, int]]:
+    """The descriptors of src and dst, if src is a regular file and neither has data buffered."""
+    if "b" not in getattr(src, "mode", "b") or "b" not in getattr(dst, "mode", "b"):
+        return None  # Text files' positions aren't byte offsets.
+    try:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        if not statc.S_ISREG(fstat(src_fd).st_mode):
+            return None
+        dst.flush()
+        if src.tell() != os.lseek(src_fd, 0, os.SEEK_CUR) or dst.tell() != os.lseek(dst_fd, 0, os.SEEK_CUR):
+            return None  # Read ahead, or behind, of the descriptor.
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+    return src_fd, dst_fd
+
+
+def fastcopy(src: Any, dst: Any, methods: Optional[List[str]] = None) -> str:
+    """
+    Copy the rest of src to dst, trying each of methods (by default DEFAULT_COPY_METHODS)
+    in turn until one works. Anything other than a pair of files is copied through
+    buffers. Returns the method which finished the copy.
+    """
+    methods = DEFAULT_COPY_METHODS if methods is None else methods
+    for method in methods:
+        if method not in COPY_METHODS:
+            raise ValueError("Unknown copy method %s, expected one of %s" % (method, COPY_METHODS))
+    fds = _file_fds(src, dst) if any(method in _FAST_COPIES for method in methods) else None
+    if fds is not None:
+        try:
+            for method in methods:
+                copy = _FAST_COPIES.get(method)
+                if copy is None:
+                    break
+                try:
+                    copy(*fds)
+                    return method
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED:
+                        raise
+        finally:
+            # Bring the file objects up to where their descriptors got to.
+            src.seek(os.lseek(fds[0], 0, os.SEEK_CUR))
+            dst.seek(os.lseek(fds[1], 0, os.SEEK_CUR))
+    copyfileobj(src, dst)
+    return "buffered"
+
+
 @total_ordering
 class Path:
 
@@ -355,7 +463,7 @@ class Path:
         else:
             mode += "b"  # http clients use bytes.
         with safeopen(self._path, mode, useDir=tmpfn) as dst_fd:
-            copyfileobj(src_fd, dst_fd)
+            fastcopy(src_fd, dst_fd)
 
     # TODO this behavior is the opposite of what one would expect.
     def copy_file(self, dst: "Path", tmpdir: Optional["Path"] = None) -> None:
@@ -365,8 +473,8 @@ class Path:
         Raises IsADirectoryError and FileDoesNotExist on namespace errors.
         The file will either be fully copied, or will not be created.
         This is achieved via temp files and atomic swap.
-        This API works for large files, as data is read in chunks and sent
-        to the destination.
+        The data is copied by fastcopy, so on a filesystem with reflinks the
+        copy shares the original's extents.
         """
         if tmpdir is None:
             tmpfn = sameDir
@@ -375,7 +483,7 @@ class Path:
         assert isinstance(dst, Path)
         with open(self._path, "rb") as src_fd:
             with safeopen(dst._path, "wb", useDir=tmpfn) as dst_fd:
-                copyfileobj(src_fd, dst_fd)
+                fastcopy(src_fd, dst_fd)
 
     def unlink(self, clean: Optional["Path"] = None) -> None:
         try:
@@ -418,14 +526,22 @@ class Path:
     def isfile(self) -> bool:
         return isfile(self._path)
 
-    def checksum(self) -> str:
+    def checksum(self, read_size: int = _BLOCKSIZE, use_mmap: bool = False) -> str:
         """
         If self path is a file or a symlink to a file, compute a checksum returned as a string.
         If self points to a missing file or a broken symlink, raises FileDoesNotExist.
         If self points to a directory or a symlink facing directory, raises IsADirectory.
+        The file is hashed read_size bytes at a time. With use_mmap it is mapped into
+        memory and hashed in read_size slices, saving a copy per read.
         """
         with self.open("rb") as fd:
-            hash = reducefileobj(_hash_buff, fd, _md5(), _BLOCKSIZE)
+            if use_mmap and fstat(fd.fileno()).st_size > 0:
+                hash = _md5()
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    for offset in range(0, len(view), read_size):
+                        hash.update(view[offset:offset + read_size])
+            else:
+                hash = reducefileobj(_hash_buff, fd, _md5(), read_size)
         digest = str(hash.hexdigest())
         return digest
 
@@ -465,6 +581,15 @@ class Path:
         paths = [Path(n, self, fast=True) for n in names]
         return paths
 
+    def dir_entries(self) -> List[Tuple["Path", DirEntry]]:
+        """
+        Like dir_list, but pairs each child with the DirEntry from scandir,
+        so callers can use the entry's cached type information.
+        """
+        with scandir(self._path) as it:
+            entries = sorted(it, key=_entry_name)
+        return [(Path(e.name, self, fast=True), e) for e in entries]
+
     def glob(self, pattern: str) -> List["Path"]:
         """Return all paths under self matching the given glob pattern (supports **)."""
         return [Path(str(p)) for p in pathlib.Path(self._path).glob(pattern)]
@@ -528,6 +653,11 @@ class Path:
     def chmod(self, mode: int) -> None:
         return chmod(self._path, mode)
 
+    def utime_from(self, src: "Path") -> None:
+        """Set the access and modification times of self to those of src."""
+        st = src.stat()
+        utime(self._path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
     def readable(self) -> bool:
         """Returns True if the current process can read the file."""
         return access(self._path, R_OK)
@@ -717,10 +847,110 @@ SkipFunction = Callable[[Path], bool]
 # TODO str could be a literal ROOT
 WalkItem = Tuple[Path, str]
 
+
+# A walk engine lists the sorted children of a directory along with a per-child
+# hint, and resolves a child's ftype from that hint. The hint lets an engine carry
+# type information gathered while listing (e.g. a DirEntry) to the point where the
+# walk needs it, which is only after the skip function has accepted the child.
+class WalkEngine(NamedTuple):
+    name: str
+    children: Callable[[Path], List[Tuple[Path, Any]]]
+    ftype: Callable[[Path, Any], str]
+
+
+def _listdir_children(directory: Path) -> List[Tuple[Path, None]]:
+    return [(child, None) for child in directory.dir_list()]
+
+
+def _listdir_ftype(path: Path, hint: None) -> str:
+    return path.ftype()
+
+
+def _scandir_children(directory: Path) -> List[Tuple[Path, DirEntry]]:
+    return directory.dir_entries()
+
+
+def _scandir_ftype(path: Path, entry: DirEntry) -> str:
+    """
+    Resolve ftype from a DirEntry. On filesystems which report d_type these
+    checks are answered from the directory listing without a stat call.
+    """
+    if entry.is_symlink():
+        return LINK
+    elif entry.is_file(follow_symlinks=False):
+        return FILE
+    elif entry.is_dir(follow_symlinks=False):
+        return DIR
+    else:
+        raise ValueError("%s is not in %s" % (path, TYPES))
+
+
+WALK_ENGINES: Dict[str, WalkEngine] = {
+    "listdir": WalkEngine("listdir", _listdir_children, _listdir_ftype),
+    "scandir": WalkEngine("scandir", _scandir_children, _scandir_ftype),
+}
+
+_walk_engine: WalkEngine = WALK_ENGINES[environ.get("FARMFS_WALK_ENGINE", "scandir")]
+
+
+def set_walk_engine(name: str) -> None:
+    """
+    Select the default engine used by walk and walk_from.
+    The initial engine can be chosen with the FARMFS_WALK_ENGINE environment variable.
+    """
+    global _walk_engine
+    if name not in WALK_ENGINES:
+        raise ValueError("Unknown walk engine %s, expected one of %s" % (name, sorted(WALK_ENGINES)))
+    _walk_engine = WALK_ENGINES[name]
+
+
+def get_walk_engine() -> str:
+    return _walk_engine.name
+
+
+def _select_engine(name: Optional[str]) -> WalkEngine:
+    if name is None:
+        return _walk_engine
+    if name not in WALK_ENGINES:
+        raise ValueError("Unknown walk engine %s, expected one of %s" % (name, sorted(WALK_ENGINES)))
+    return WALK_ENGINES[name]
+
+
+def _walk_children(
+        engine: WalkEngine,
+        directory: Path,
+        skip: SkipFunction,
+        prune: Optional[SkipFunction] = None,
+) -> Generator[WalkItem, None, None]:
+    """
+    Depth first walk of everything beneath directory, in sorted order.
+    Uses an explicit stack of listings rather than nested generators, so the
+    cost of yielding an item does not grow with its depth.
+    prune is asked about each directory once the consumer asks for the next
+    item, so the consumer can decide not to descend into what it was just given.
+    """
+    stack = [iter(engine.children(directory))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        child, hint = entry
+        if skip(child):
+            continue
+        t = engine.ftype(child, hint)
+        yield (child, t)
+        if t is DIR and not (prune and prune(child)):
+            stack.append(iter(engine.children(child)))
+
+
 def walk(
         *roots: Path,
-        skip: Optional[SkipFunction] = None
+        skip: Optional[SkipFunction] = None,
+        engine: Optional[str] = None,
+        prune: Optional[SkipFunction] = None,
 ) -> Generator[WalkItem, None, None]:
+    walker = _select_engine(engine)
     if skip is None:
         skip = lambda p: False
     for root in sorted(roots):
@@ -728,12 +958,13 @@ def walk(
             continue
         t = root.ftype()
         yield (root, t)
-        if t is DIR:
-            yield from walk(*root.dir_list(), skip=skip)
+        if t is DIR and not (prune and prune(root)):
+            yield from _walk_children(walker, root, skip, prune)
 
 def walk_from(
         root: Path,
         start: Path,
+        engine: Optional[str] = None,
 ) -> Generator[WalkItem, None, None]:
     """Like walk(root), but begins at 'start' (inclusive) instead of the root.
 
@@ -751,26 +982,33 @@ def walk_from(
     walk_from(root, start) for start not in walk(root) returns the suffix of
     walk(root) starting at the first item that sorts >= start.
     """
+    walker = _select_engine(engine)
+    no_skip: SkipFunction = lambda p: False
     # Decompose start into path components relative to root, e.g.
     # root=/a/bs, start=/a/bs/3ab/cd1/rest -> ["3ab", "cd1", "rest"]
     rel = start.relative_to(root)
     seek = [c for c in rel.split(sep) if c]
 
+    def _walk_subtree(child: Path, t: str) -> Generator[WalkItem, None, None]:
+        yield (child, t)
+        if t is DIR:
+            yield from _walk_children(walker, child, no_skip)
+
     def _walk_from(directory: Path, depth: int) -> Generator[WalkItem, None, None]:
-        children = directory.dir_list()  # already sorted
+        children = walker.children(directory)  # already sorted
         if depth >= len(seek):
             # Past all seek components — yield everything under this dir normally.
-            # walk(child) yields child itself then its subtree.
-            for child in children:
-                yield from walk(child)
+            # Each child is yielded followed by its subtree.
+            for child, hint in children:
+                yield from _walk_subtree(child, walker.ftype(child, hint))
             return
 
         target_name = seek[depth]
-        for child in children:
+        for child, hint in children:
             child_name = child.name()
             if child_name < target_name:
                 continue  # entire subtree sorts before start — skip
-            t = child.ftype()
+            t = walker.ftype(child, hint)
             if child_name == target_name:
                 if depth == len(seek) - 1:
                     # This is the start item itself — yield it and its subtree.
@@ -784,7 +1022,7 @@ def walk_from(
                         yield from _walk_from(child, depth + 1)
             else:
                 # Past the seek boundary — yield this child and its full subtree.
-                yield from walk(child)
+                yield from _walk_subtree(child, t)
 
     # Yield the start node itself, then use the seek path to pick up everything
     # from start onward (its own subtree first, then later siblings at each
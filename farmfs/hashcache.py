@@ -0,0 +1,184 @@
+"""Persistent stat keyed cache of file checksums.
+
+Files are identified by (device, inode, size, mtime_ns, ctime_ns). When a file
+still stats the same as when it was hashed, its checksum is served from the
+cache instead of rereading the file.
+
+Entries whose mtime is within RACY_NS of the moment they were recorded are not
+trusted: a write landing in the same timestamp tick as the hash would leave the
+stat unchanged. Such entries are rehashed, and rerecorded, on their next use.
+
+The cache also remembers directory digests (see farmfs.snapshot.MerkleBuilder)
+along with the names of each directory's subdirectories. Adding, removing or
+replacing an entry moves a directory's mtime, so a directory whose stat is
+unchanged, and whose subdirectories are all unchanged in turn, still has the
+recorded digest.
+"""
+import sqlite3
+import threading
+import time
+from os import stat_result
+from types import TracebackType
+from typing import List, Optional, Tuple, Type
+
+from farmfs.fs import Path
+
+RACY_NS = 2 * 1000 * 1000 * 1000
+COMMIT_INTERVAL = 1000
+
+StatKey = Tuple[int, int, int, int, int]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    csum TEXT NOT NULL,
+    recorded_ns INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino)
+)
+"""
+
+_DIR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    scope TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    subdirs TEXT NOT NULL,
+    recorded_ns INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino)
+)
+"""
+
+
+def stat_key(st: stat_result) -> StatKey:
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class HashCache:
+    """
+    SQLite backed checksum cache. Safe to share between threads.
+    Use as a context manager so pending entries are committed on exit.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute(_DIR_SCHEMA)
+        self._conn.commit()
+        self._pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self) -> "HashCache":
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc: Optional[BaseException],
+                 tb: Optional[TracebackType]) -> None:
+        self.close()
+
+    def lookup(self, st: stat_result) -> Optional[str]:
+        """Return the cached checksum for a file with stat st, or None if it must be rehashed."""
+        key = stat_key(st)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, ctime_ns, csum, recorded_ns FROM hashes WHERE dev = ? AND ino = ?",
+                key[0:2],
+            ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, ctime_ns, csum, recorded_ns = row
+        if (size, mtime_ns, ctime_ns) != key[2:]:
+            return None
+        if mtime_ns + RACY_NS > recorded_ns:
+            return None
+        return csum
+
+    def record(self, st: stat_result, csum: str) -> None:
+        """Remember that the file with stat st has checksum csum."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                stat_key(st) + (csum, time.time_ns()),
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+
+    def lookup_dir(self, st: stat_result, scope: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Return the cached (digest, subdirectory names) of a directory with stat st,
+        or None if it has changed. scope identifies what was excluded from the digest,
+        such as the volume's ignore patterns. The subdirectories must be checked too.
+        """
+        key = stat_key(st)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, ctime_ns, scope, digest, subdirs, recorded_ns FROM dirs WHERE dev = ? AND ino = ?",
+                key[0:2],
+            ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, ctime_ns, row_scope, digest, subdirs, recorded_ns = row
+        if (size, mtime_ns, ctime_ns) != key[2:] or row_scope != scope:
+            return None
+        if mtime_ns + RACY_NS > recorded_ns:
+            return None
+        return (digest, subdirs.split("\0") if subdirs else [])
+
+    def record_dir(self, st: stat_result, scope: str, digest: str, subdirs: List[str]) -> None:
+        """Remember that the directory with stat st has digest and holds the directories subdirs."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                stat_key(st) + (scope, digest, "\0".join(subdirs), time.time_ns()),
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+
+    def checksum(self, path: Path) -> str:
+        """
+        Like Path.checksum, but served from the cache when path is unchanged.
+        The file is only recorded if it stats the same before and after hashing.
+        """
+        before = path.stat()
+        csum = self.lookup(before)
+        with self._lock:
+            if csum is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if csum is not None:
+            return csum
+        csum = path.checksum()
+        after = path.stat()
+        if stat_key(before) == stat_key(after):
+            self.record(after, csum)
+        return csum
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM hashes")
+            self._conn.execute("DELETE FROM dirs")
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -1,5 +1,5 @@
 from collections.abc import Callable
-from typing import Any, Generic, Iterator, List, Optional, Protocol, Tuple, TypeVar, runtime_checkable
+from typing import IO, Any, Generic, Iterator, List, Optional, Protocol, Tuple, TypeVar, runtime_checkable
 from farmfs.blobstore import FileBlobstore
 from farmfs.fs import Path, ensure_symlink
 from hashlib import md5
@@ -133,6 +133,18 @@ class BlobKeyDB:
             data, _ = self._readparts_file(key_path)
             return data
 
+    def read_handle(self, key: str) -> IO[bytes]:
+        """
+        Open the value of a key for streaming reads. Close the handle when done.
+        Raises FileNotFoundError if the key is absent or the symlink is dangling.
+        """
+        key_path = self.keypath(key)
+        if self._is_blob(key_path):
+            return key_path.open("rb")
+        else:
+            data, _ = self._readparts_file(key_path)
+            return BytesIO(data)
+
     def write(self, key: str, value: bytes, overwrite: bool) -> None:
         """
         Write raw bytes as a blob-backed key.
@@ -148,7 +160,7 @@ class BlobKeyDB:
         value_hash = checksum(value)
         with self.bs.session() as sess:
             sess.import_via_fd(lambda: BytesIO(value), value_hash)
-        blob_path = self.bs.blob_path(value_hash)
+        blob_path = self.bs.materialise(value_hash)
         ensure_symlink(key_path, blob_path)
 
     def checksum(self, key: str) -> str:
@@ -0,0 +1,265 @@
+"""
+Packfiles for small blobs.
+
+A FileBlobstore keeps each blob in a file of its own, so a volume of millions
+of tiny blobs (thumbnails, sidecars) spends most of its listing, fsck and
+backup time, and its inodes, on per file overhead. Packing moves small blobs
+into a few large files instead.
+
+A pack is two files in the pack directory: pack-<name>.pack, the blobs' bytes
+one after another, and pack-<name>.idx, a sorted table of where each blob is.
+Both are written once and never changed in place. The index is written last,
+so a pack without one is an interrupted write and is ignored. Deleting a blob
+rewrites its pack's index without it; once most of a pack's bytes are dead,
+the rest are copied into a new pack and the old one is removed.
+
+Index layout: INDEX_MAGIC, the entry count as a big endian 64 bit integer,
+then an ENTRY per blob, sorted by digest: its 16 byte md5 digest, and the
+offset and length of its bytes in the pack.
+"""
+import bisect
+import heapq
+import os
+import struct
+import threading
+import uuid
+from os import environ
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from farmfs.fs import Path, ensure_dir, ensure_readonly
+from farmfs.util import uniq_sorted
+
+# farmdbg blob pack packs blobs smaller than FARMFS_PACK_THRESHOLD bytes,
+# into packs of about FARMFS_PACK_SIZE bytes each.
+DEFAULT_PACK_THRESHOLD = int(environ.get("FARMFS_PACK_THRESHOLD", "4096"))
+DEFAULT_PACK_SIZE = int(environ.get("FARMFS_PACK_SIZE", str(64 * 1024 * 1024)))
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"FARMPIDX"
+INDEX_HEADER = struct.Struct(">8sQ")
+ENTRY = struct.Struct(">16sQQ")
+
+# A pack is rewritten once less than this fraction of its bytes belong to live blobs.
+MIN_LIVE = 0.5
+
+
+class PackIndex:
+    """The sorted table of one pack's blobs."""
+
+    def __init__(self, data: bytes):
+        if len(data) < INDEX_HEADER.size:
+            raise ValueError("Pack index is truncated")
+        magic, count = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or len(data) != INDEX_HEADER.size + count * ENTRY.size:
+            raise ValueError("Not a pack index")
+        self._data = data
+        self._count = count
+
+    @staticmethod
+    def encode(entries: Iterable[Tuple[str, int, int]]) -> bytes:
+        """An index of (blob, offset, length) entries, in any order."""
+        records = sorted(ENTRY.pack(bytes.fromhex(blob), offset, length) for blob, offset, length in entries)
+        return INDEX_HEADER.pack(INDEX_MAGIC, len(records)) + b"".join(records)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> bytes:
+        """The digest of the i'th entry, so the index can be bisected."""
+        start = INDEX_HEADER.size + i * ENTRY.size
+        return self._data[start:start + 16]
+
+    def find(self, blob: str) -> Optional[Tuple[int, int]]:
+        """The offset and length of blob in the pack, or None if it isn't there."""
+        digest = bytes.fromhex(blob)
+        i = bisect.bisect_left(self, digest)
+        if i == self._count or self[i] != digest:
+            return None
+        _, offset, length = ENTRY.unpack_from(self._data, INDEX_HEADER.size + i * ENTRY.size)
+        return offset, length
+
+    def entries(self, start_after: Optional[str] = None) -> Iterator[Tuple[str, int, int]]:
+        """The (blob, offset, length) entries in sorted order, only those after start_after if given."""
+        i = 0 if start_after is None else bisect.bisect_right(self, bytes.fromhex(start_after))
+        for digest, offset, length in ENTRY.iter_unpack(self._data[INDEX_HEADER.size + i * ENTRY.size:]):
+            yield digest.hex(), offset, length
+
+
+class Pack:
+    def __init__(self, pack_dir: Path, name: str, index: PackIndex):
+        self.name = name
+        self.path = pack_dir.join(name + PACK_SUFFIX)
+        self.index_path = pack_dir.join(name + INDEX_SUFFIX)
+        self.index = index
+
+    def live_bytes(self) -> int:
+        return sum(length for _, _, length in self.index.entries())
+
+
+class PackedReader:
+    """Reads length bytes of a pack from offset."""
+
+    def __init__(self, path: Path, offset: int, length: int):
+        self._fd = os.open(path._path, os.O_RDONLY)
+        self._offset = offset
+        self._remaining = length
+        self.closed = False
+
+    def __enter__(self) -> "PackedReader":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self._fd)
+            self.closed = True
+
+    def read(self, n: int = -1, /) -> bytes:
+        if n < 0 or n > self._remaining:
+            n = self._remaining
+        data = os.pread(self._fd, n, self._offset)
+        if len(data) != n:
+            raise ValueError(f"Pack ended {n - len(data)} bytes short")
+        self._offset += n
+        self._remaining -= n
+        return data
+
+
+class Packs:
+    """
+    The packs in pack_dir. Their indexes are loaded when first needed, and again
+    whenever the directory changes. Safe to share between threads.
+    """
+
+    def __init__(self, pack_dir: Path, tmp_dir: Path):
+        self.pack_dir = pack_dir
+        self.tmp_dir = tmp_dir
+        self._lock = threading.Lock()
+        self._stamp: Optional[int] = None
+        self._packs: Dict[Tuple[str, int], Pack] = {}
+
+    def _load(self) -> List[Pack]:
+        try:
+            stamp = self.pack_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if stamp != self._stamp:
+                packs: Dict[Tuple[str, int], Pack] = {}
+                for index_path in self.pack_dir.dir_list():
+                    name = index_path.name()
+                    if not name.endswith(INDEX_SUFFIX):
+                        continue
+                    try:
+                        # A rewritten index is a new file, so its inode tells it from the one cached.
+                        key = (name, index_path.stat().st_ino)
+                        pack = self._packs.get(key)
+                        if pack is None:
+                            with index_path.open("rb") as fd:
+                                pack = Pack(self.pack_dir, name.removesuffix(INDEX_SUFFIX), PackIndex(fd.read()))
+                    except FileNotFoundError:
+                        continue  # Removed by a repack since it was listed.
+                    packs[key] = pack
+                self._packs, self._stamp = packs, stamp
+            return list(self._packs.values())
+
+    def _forget(self) -> None:
+        with self._lock:
+            self._stamp = None
+
+    def find(self, blob: str) -> Optional[Tuple[Pack, int, int]]:
+        """The pack holding blob, and the offset and length of it there, or None if it isn't packed."""
+        for pack in self._load():
+            found = pack.index.find(blob)
+            if found is not None:
+                return pack, *found
+        return None
+
+    def open(self, blob: str) -> PackedReader:
+        """A reader of a packed blob. Raises FileNotFoundError if it isn't packed."""
+        found = self.find(blob)
+        if found is None:
+            raise FileNotFoundError(f"{blob} is not packed")
+        pack, offset, length = found
+        return PackedReader(pack.path, offset, length)
+
+    def blobs(self, start_after: Optional[str] = None) -> Iterator[str]:
+        """The packed blobs in sorted order, only those after start_after if given."""
+        def blob_ids(pack: Pack) -> Iterator[str]:
+            return (blob for blob, _, _ in pack.index.entries(start_after))
+        return uniq_sorted(heapq.merge(*(blob_ids(pack) for pack in self._load())))
+
+    def count(self) -> int:
+        """Packed blobs, counting a blob in two packs twice."""
+        return sum(len(pack.index) for pack in self._load())
+
+    def write(self, blobs: Iterable[Tuple[str, bytes]]) -> Optional[Pack]:
+        """Write a pack of (blob, data) pairs. Returns it, or None if there were no blobs."""
+        ensure_dir(self.pack_dir)
+        name = "pack-" + uuid.uuid4().hex
+        pack_path = self.pack_dir.join(name + PACK_SUFFIX)
+        entries: List[Tuple[str, int, int]] = []
+        with pack_path.safeopen("wb", lambda _: self.tmp_dir) as dst:
+            offset = 0
+            for blob, data in blobs:
+                dst.write(data)
+                entries.append((blob, offset, len(data)))
+                offset += len(data)
+        if not entries:
+            pack_path.unlink()
+            return None
+        ensure_readonly(pack_path)
+        index = PackIndex.encode(entries)
+        index_path = self.pack_dir.join(name + INDEX_SUFFIX)
+        with index_path.safeopen("wb", lambda _: self.tmp_dir) as dst:
+            dst.write(index)
+        ensure_readonly(index_path)
+        self._forget()
+        return Pack(self.pack_dir, name, PackIndex(index))
+
+    def delete(self, blob: str) -> bool:
+        """
+        Drop blob from every pack holding it, rewriting a pack whose live bytes fall
+        below MIN_LIVE of its size. Returns whether it was packed.
+        """
+        packed = False
+        for pack in self._load():
+            if pack.index.find(blob) is None:
+                continue
+            packed = True
+            entries = [entry for entry in pack.index.entries() if entry[0] != blob]
+            live = sum(length for _, _, length in entries)
+            if live < pack.path.stat().st_size * MIN_LIVE:
+                self._rewrite(pack, entries)
+            else:
+                with pack.index_path.safeopen("wb", lambda _: self.tmp_dir) as dst:
+                    dst.write(PackIndex.encode(entries))
+                ensure_readonly(pack.index_path)
+        self._forget()
+        return packed
+
+    def _rewrite(self, pack: Pack, entries: List[Tuple[str, int, int]]) -> None:
+        """Copy entries of pack into a new pack, and remove the old one."""
+        with pack.path.open("rb") as src:
+            def data() -> Iterator[Tuple[str, bytes]]:
+                for blob, offset, length in entries:
+                    yield blob, os.pread(src.fileno(), length, offset)
+            self.write(data())
+        # The old index goes first, so its blobs are never missing from both packs.
+        pack.index_path.unlink()
+        pack.path.unlink()
+
+    def repack(self) -> int:
+        """Rewrite the packs holding dead bytes. Returns the bytes freed."""
+        freed = 0
+        for pack in self._load():
+            size = pack.path.stat().st_size
+            live = pack.live_bytes()
+            if live < size:
+                self._rewrite(pack, list(pack.index.entries()))
+                freed += size - live
+        self._forget()
+        return freed
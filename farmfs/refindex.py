@@ -0,0 +1,135 @@
+"""Persistent index of how many references each blob has.
+
+A blob's count is the number of links to it in the working tree plus the number
+of links to it in every snapshot. freeze, thaw, snapshot writes and deletes, and
+tree patches (snap restore, pull) keep the counts up to date as they go, so gc
+can find the blobs which lost their last reference without rereading the tree
+and every snapshot.
+
+Counts are raised before a reference is created and lowered after one is
+removed. A crash in between leaves a count too high, which only keeps a blob
+around until the next reconcile; it never makes a referenced blob look unused.
+Links made or removed behind farmfs's back are not counted, so the index is
+rebuilt from scratch by reconcile(), and gc checks its candidates against the
+working tree before deleting them.
+
+An index only starts out exact on a new volume. On an existing volume it must be
+built by reconcile() before gc may trust it; built() says whether it has been.
+"""
+import sqlite3
+import threading
+from typing import Iterable, List
+
+from farmfs.fs import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    csum TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+)
+"""
+
+_UNUSED_INDEX = "CREATE INDEX IF NOT EXISTS {table}_unused ON {table} (csum) WHERE count <= 0"
+
+_MISMATCHES = """
+SELECT new.csum, old.count, new.count FROM refs_new AS new
+LEFT JOIN refs AS old ON old.csum = new.csum
+WHERE (old.count IS NULL AND new.count != 0) OR old.count != new.count
+UNION ALL
+SELECT old.csum, old.count, NULL FROM refs AS old
+WHERE old.csum NOT IN (SELECT csum FROM refs_new)
+"""
+
+_ADJUST = """
+INSERT INTO {table} VALUES (?, ?)
+ON CONFLICT (csum) DO UPDATE SET count = count + excluded.count
+"""
+
+# The most mismatches reconcile() describes.
+MAX_MISMATCHES = 20
+
+
+class RefIndex:
+    """SQLite backed blob reference counts. Safe to share between threads."""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA.format(table="refs"))
+        self._conn.execute(_UNUSED_INDEX.format(table="refs"))
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+    def built(self) -> bool:
+        """Whether the counts cover every reference, rather than only those made since the index appeared."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def mark_built(self) -> None:
+        """Declare the counts complete, as they are for a new, empty volume."""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', '1')")
+
+    def adjust(self, csums: Iterable[str], delta: int) -> None:
+        """Add delta to the count of each blob in csums, once per occurrence."""
+        with self._lock, self._conn:
+            self._conn.executemany(_ADJUST.format(table="refs"), ((csum, delta) for csum in csums))
+
+    def count(self, csum: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT count FROM refs WHERE csum = ?", (csum,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def unused(self) -> List[str]:
+        """The blobs whose counts have dropped to zero, in sorted order."""
+        with self._lock:
+            rows = self._conn.execute("SELECT csum FROM refs WHERE count <= 0 ORDER BY csum").fetchall()
+        return [csum for (csum,) in rows]
+
+    def forget(self, csums: Iterable[str]) -> None:
+        """Drop blobs which are no longer in the blobstore."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM refs WHERE csum = ?", ((csum,) for csum in csums))
+
+    def reconcile(self, referenced: Iterable[str], blobs: Iterable[str], fix: bool) -> List[str]:
+        """
+        Recount from scratch: referenced is every reference in the tree and snapshots,
+        blobs every blob in the blobstore. Returns a description of each count the index
+        has wrong. With fix, the index is replaced by the recount in one transaction.
+        The recount is built on disk, so memory stays bounded.
+        """
+        with self._lock:
+            conn = self._conn
+            conn.execute("DROP TABLE IF EXISTS refs_new")
+            conn.execute(_SCHEMA.format(table="refs_new"))
+            conn.executemany("INSERT OR IGNORE INTO refs_new VALUES (?, 0)", ((csum,) for csum in blobs))
+            conn.executemany(_ADJUST.format(table="refs_new"), ((csum, 1) for csum in referenced))
+            rows = conn.execute(_MISMATCHES + " ORDER BY 1 LIMIT ?", (MAX_MISMATCHES,)).fetchall()
+            mismatches = []
+            for csum, old, new in rows:
+                if new is None:
+                    mismatches.append(f"{csum}: counted {old}, but the blob is gone")
+                else:
+                    mismatches.append(f"{csum}: counted {old or 0}, referenced {new}")
+            if len(rows) == MAX_MISMATCHES:
+                (total,) = conn.execute("SELECT COUNT(*) FROM (" + _MISMATCHES + ")").fetchone()
+                if total > MAX_MISMATCHES:
+                    mismatches.append(f"... ({total} wrong counts total)")
+            if fix:
+                conn.execute("DROP TABLE refs")
+                conn.execute("ALTER TABLE refs_new RENAME TO refs")
+                conn.execute(_UNUSED_INDEX.format(table="refs"))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', '1')")
+            else:
+                conn.execute("DROP TABLE refs_new")
+            conn.commit()
+        return mismatches
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
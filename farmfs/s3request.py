@@ -0,0 +1,76 @@
+"""
+Adapters over s3lib for the S3 requests farmfs makes outside its plain calls.
+
+Ranged GETs use get_object2(byte_range=), HEADs use head_object and PUTs which
+set headers, like the codec marker, use put_object(headers=, if_none_match=),
+since put_object2 takes no headers. s3lib has no multipart upload API though,
+so those requests are made with Connection._s3_request, the signed request
+path s3lib's own calls are built on, and the response is marked consumed by
+clearing Connection._outstanding_response. Both are private to s3lib and may
+change in any release, so they are only used with the s3lib versions they were
+written against, S3LIB_SUPPORTED, the same range pyproject.toml pins. With any
+other s3lib the first such request raises UnsupportedS3Lib rather than
+misbehaving.
+"""
+import inspect
+import re
+from functools import cache
+from importlib.metadata import PackageNotFoundError, version
+from typing import Dict, Optional, Tuple
+
+from s3lib import Connection as s3conn
+from s3lib.utils import raise_http_resp_error
+
+# s3lib versions, from the first up to but not including the second, whose private request path this uses.
+S3LIB_SUPPORTED = ((2, 3), (3, 0))
+
+
+class UnsupportedS3Lib(Exception):
+    """The installed s3lib isn't one whose private request path farmfs knows. Not worth retrying."""
+
+
+def _version(raw: str) -> Tuple[int, ...]:
+    return tuple(int(part) for part in re.findall(r"\d+", raw)[:2])
+
+
+@cache
+def check_s3lib() -> None:
+    """Raise UnsupportedS3Lib unless the installed s3lib is in S3LIB_SUPPORTED and has the calls used here."""
+    try:
+        installed = version("s3lib")
+    except PackageNotFoundError:
+        installed = "unknown"
+    request = getattr(s3conn, "_s3_request", None)
+    low, high = S3LIB_SUPPORTED
+    if not low <= _version(installed) < high or request is None or "md5_hint" not in inspect.signature(request).parameters:
+        raise UnsupportedS3Lib(
+            "Multipart S3 requests need s3lib >=%s,<%s, found %s" % (
+                ".".join(map(str, low)), ".".join(map(str, high)), installed))
+
+
+def s3_call(conn: s3conn, method: str, key: str, bucket: str, args: dict, headers: dict,
+            body: bytes = b"", md5_hint: Optional[bytes] = None) -> Tuple[int, dict, bytes]:
+    """
+    Make a signed request, returning its status, lower cased headers and body.
+    404 and 412 are returned, other errors raised. The response is read in
+    full, leaving the connection ready for the next request.
+    """
+    check_s3lib()
+    resp = conn._s3_request(method, bucket, key, args, headers, body, md5_hint=md5_hint)
+    if resp.status >= 300 and resp.status not in (404, 412):
+        raise_http_resp_error(resp)
+    payload = resp.read()
+    conn._outstanding_response = None
+    return resp.status, {k.lower(): v for k, v in resp.getheaders()}, payload
+
+
+def s3_head(conn: s3conn, bucket: str, key: str) -> Optional[Dict[str, str]]:
+    """The lower cased headers of key, or None if there is no such key."""
+    try:
+        headers = conn.head_object(bucket, key)
+    except ValueError as e:
+        # head_object raises every failed response as a ValueError whose message starts with the status.
+        if str(e).startswith("S3 request failed with:\n404 "):
+            return None
+        raise
+    return {k.lower(): v for k, v in dict(headers).items()}
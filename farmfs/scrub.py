@@ -0,0 +1,219 @@
+"""Resumable, rate limited checksum verification.
+
+A full fsck --checksums rereads every blob and starts over if it is stopped.
+A scrub remembers when each blob was last verified, in .farmfs/scrub.db, so it
+can be stopped at any point and pick up where it left off. Each run verifies:
+
+1. Blobs which have never been verified. They are found by listing the
+   blobstore from a cursor, the point the listing had safely reached when the
+   last run stopped. Once the listing reaches the end the cursor wraps around,
+   so the next run looks for new blobs from the start.
+2. Blobs last verified before a cutoff, those verified longest ago first.
+
+Progress is committed at least every COMMIT_INTERVAL_NS, so a scrub killed
+outright loses little work. Reads are paced to a bytes per second budget,
+leaving disk bandwidth for everything else.
+
+Corrupt blobs are not recorded as verified, so every scrub reports them again
+until they are repaired.
+"""
+import sqlite3
+import threading
+import time
+from collections import deque
+from types import TracebackType
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+from farmfs.blobstore import FileBlobstore
+from farmfs.fs import Path
+from farmfs.util import RateLimit
+
+COMMIT_INTERVAL_NS = 1000 * 1000 * 1000
+# Overdue blobs read from the index at a time.
+OVERDUE_BATCH = 1000
+DAY_NS = 24 * 60 * 60 * 1000 * 1000 * 1000
+DEFAULT_SCRUB_MAX_AGE_DAYS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verified (
+    csum TEXT PRIMARY KEY,
+    verified_ns INTEGER NOT NULL
+)
+"""
+
+_OVERDUE_INDEX = "CREATE INDEX IF NOT EXISTS verified_age ON verified (verified_ns, csum)"
+
+
+class ScrubIndex:
+    """
+    SQLite backed record of when each blob was last verified, and where the listing cursor is.
+    Use as a context manager so pending progress is committed on exit.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute(_OVERDUE_INDEX)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        self._committed_ns = time.monotonic_ns()
+
+    def __enter__(self) -> "ScrubIndex":
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc: Optional[BaseException],
+                 tb: Optional[TracebackType]) -> None:
+        self.close()
+
+    def _maybe_commit(self) -> None:
+        now = time.monotonic_ns()
+        if now - self._committed_ns >= COMMIT_INTERVAL_NS:
+            self._conn.commit()
+            self._committed_ns = now
+
+    def cursor(self) -> Optional[str]:
+        """The blob the listing of unverified blobs resumes after, or None to start from the beginning."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'cursor'").fetchone()
+        return None if row is None else row[0]
+
+    def set_cursor(self, cursor: Optional[str]) -> None:
+        with self._lock:
+            if cursor is None:
+                self._conn.execute("DELETE FROM meta WHERE key = 'cursor'")
+            else:
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('cursor', ?)", (cursor,))
+            self._maybe_commit()
+
+    def verified_at(self, csum: str) -> Optional[int]:
+        """When csum was last verified, in ns since the epoch, or None if it never was."""
+        with self._lock:
+            row = self._conn.execute("SELECT verified_ns FROM verified WHERE csum = ?", (csum,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, csum: str, verified_ns: int) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO verified VALUES (?, ?)", (csum, verified_ns))
+            self._maybe_commit()
+
+    def forget(self, csum: str) -> None:
+        """Drop a blob which is no longer in the blobstore."""
+        with self._lock:
+            self._conn.execute("DELETE FROM verified WHERE csum = ?", (csum,))
+            self._maybe_commit()
+
+    def overdue(self, cutoff_ns: int) -> Iterator[str]:
+        """
+        Blobs last verified before cutoff_ns, longest ago first.
+        Pages through the index, so blobs may be re-recorded while this is consumed.
+        """
+        after: Tuple[int, str] = (-1, "")
+        while True:
+            with self._lock:
+                rows: List[Tuple[str, int]] = self._conn.execute(
+                    "SELECT csum, verified_ns FROM verified WHERE verified_ns < ? AND (verified_ns, csum) > (?, ?)"
+                    " ORDER BY verified_ns, csum LIMIT ?",
+                    (cutoff_ns, after[0], after[1], OVERDUE_BATCH),
+                ).fetchall()
+            for csum, verified_ns in rows:
+                yield csum
+            if len(rows) < OVERDUE_BATCH:
+                return
+            after = (rows[-1][1], rows[-1][0])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+class _ListingCursor:
+    """
+    Tracks how far the listing of unverified blobs has safely got. Blobs finish
+    hashing out of order, so the cursor only moves past a blob once it and every
+    unverified blob listed before it are done.
+    """
+
+    def __init__(self, index: ScrubIndex):
+        self.index = index
+        self.listed = index.cursor()
+        self.exhausted = False
+        # Unverified blobs in flight, each with the listing position before it.
+        self.pending: Deque[Tuple[str, Optional[str]]] = deque()
+        self.done: Dict[str, bool] = {}
+
+    def unverified(self, blobs: Iterable[str]) -> Iterator[str]:
+        for blob in blobs:
+            before = self.listed
+            self.listed = blob
+            if self.index.verified_at(blob) is None:
+                self.pending.append((blob, before))
+                self.done[blob] = False
+                yield blob
+            elif not self.pending:
+                self.index.set_cursor(blob)
+        self.exhausted = True
+        self._save()
+
+    def finished(self, blob: str) -> None:
+        if blob not in self.done:
+            return
+        self.done[blob] = True
+        while self.pending and self.done[self.pending[0][0]]:
+            del self.done[self.pending.popleft()[0]]
+        self._save()
+
+    def _save(self) -> None:
+        if self.pending:
+            self.index.set_cursor(self.pending[0][1])
+        elif self.exhausted:
+            self.index.set_cursor(None)
+        else:
+            self.index.set_cursor(self.listed)
+
+
+def scrub(
+        bs: FileBlobstore,
+        index: ScrubIndex,
+        blob_checksums: Callable[[Iterable[str]], Iterator[Tuple[str, str]]],
+        max_age_ns: int,
+        rate: Optional[int] = None,
+        now_ns: Callable[[], int] = time.time_ns,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Verify never verified blobs, then those last verified more than max_age_ns ago,
+    hashing them with blob_checksums. Yields (blob, checksum) pairs as they are
+    verified; a pair which differs is a corrupt blob. rate caps reads in bytes
+    per second. Progress is recorded before each pair is yielded.
+    """
+    cutoff_ns = now_ns() - max_age_ns
+    cursor = _ListingCursor(index)
+    limit = None if rate is None else RateLimit(rate)
+
+    def candidates() -> Iterator[str]:
+        yield from cursor.unverified(bs.blobs(start_after=cursor.listed))
+        yield from index.overdue(cutoff_ns)
+
+    def paced(blobs: Iterable[str]) -> Iterator[str]:
+        for blob in blobs:
+            try:
+                size = bs.stored_size(blob)
+            except FileNotFoundError:
+                index.forget(blob)  # Collected since it was last verified.
+                cursor.finished(blob)
+                continue
+            if limit is not None:
+                limit.acquire(size)
+            yield blob
+
+    for blob, csum in blob_checksums(paced(candidates())):
+        if blob == csum:
+            index.record(blob, now_ns())
+        cursor.finished(blob)
+        yield blob, csum
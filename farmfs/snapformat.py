@@ -0,0 +1,335 @@
+"""
+Binary snapshot encoding.
+
+A binary snapshot is a fixed header followed by a stream of records, which may
+be compressed as a whole:
+
+    header:  MAGIC (8 bytes) | version (1 byte) | codec (1 byte)
+    record:  tag (1 byte) | shared (varint) | suffix length (varint) | suffix
+             | digest (16 bytes, links and directories with digests)
+    end:     tag 0
+
+Records are in path order. Each path is stored as the number of leading bytes
+it shares with the previous path, followed by the UTF-8 bytes that differ.
+Checksums and directory digests are stored as raw md5 digests rather than hex
+strings. Directory digests are only stored in binary snapshots; older farmfs
+releases build snapshot items from JSON dicts and reject keys they don't know.
+
+Snapshots are decoded one record at a time from an open handle, so reading a
+snapshot takes constant memory regardless of its size.
+"""
+import zlib
+from io import BytesIO
+from json import loads
+from os import environ
+from types import ModuleType
+from typing import IO, Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional
+
+from farmfs.fs import DIR, LINK
+from farmfs.keydb import BlobKeyDB, keydb_encoder
+from farmfs.snapshot import SnapshotItem, add_dir_digests
+from farmfs.util import egest
+
+zstandard: Optional[ModuleType]
+try:
+    import zstandard as _zstandard
+    zstandard = _zstandard
+except ImportError:  # zstd is optional, install farmfs[zstd] for it.
+    zstandard = None
+
+MAGIC = b"FARMSNAP"
+VERSION = 1
+HEADER_LEN = len(MAGIC) + 2
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+
+TAG_END = 0
+TAG_DIR = 1
+TAG_LINK = 2
+TAG_DIGEST_DIR = 3
+
+DIGEST_LEN = 16
+READ_SIZE = 64 * 1024
+
+# Format used for newly written snapshots: "json", or "binary-<codec>".
+# JSON stays the default so older farmfs releases can still read our snapshots.
+SNAP_FORMATS = ["json"] + ["binary-" + codec for codec in CODECS]
+DEFAULT_SNAP_FORMAT = environ.get("FARMFS_SNAP_FORMAT", "json")
+
+
+def is_binary(head: bytes) -> bool:
+    """True if head, the first bytes of a stored value, starts a binary snapshot."""
+    return head[:len(MAGIC)] == MAGIC
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _compressor(codec: int) -> Callable[[bytes], bytes]:
+    """Returns a function which compresses successive chunks; call it with b"" to flush."""
+    if codec == CODEC_NONE:
+        return lambda chunk: chunk
+    if codec == CODEC_ZLIB:
+        z = zlib.compressobj(9)
+        return lambda chunk: z.compress(chunk) if chunk else z.flush()
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd snapshots need the zstandard package")
+        zc = zstandard.ZstdCompressor(level=10).compressobj()
+        return lambda chunk: zc.compress(chunk) if chunk else zc.flush()
+    raise ValueError("Unknown snapshot codec %d" % codec)
+
+
+def _decompressed(chunks: Iterator[bytes], codec: int) -> Iterator[bytes]:
+    """Decompress a stream of chunks, raising ValueError if the stream is damaged."""
+    if codec == CODEC_NONE:
+        yield from chunks
+        return
+    if codec == CODEC_ZLIB:
+        d: Any = zlib.decompressobj()
+        errors: tuple = (zlib.error,)
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd snapshots need the zstandard package")
+        d = zstandard.ZstdDecompressor().decompressobj()
+        errors = (zstandard.ZstdError,)
+    else:
+        raise ValueError("Unknown snapshot codec %d" % codec)
+    try:
+        for chunk in chunks:
+            yield d.decompress(chunk)
+    except errors as e:
+        raise ValueError("Snapshot failed to decompress: %s" % e) from e
+    eof: bool = getattr(d, "eof", True)
+    unused: bytes = getattr(d, "unused_data", b"")
+    if not eof or unused:
+        raise ValueError("Snapshot compressed stream is truncated or has trailing data")
+
+
+def _raw_digest(hex_digest: str) -> bytes:
+    digest = bytes.fromhex(hex_digest)
+    if len(digest) != DIGEST_LEN:
+        raise ValueError("Checksum %s is not an md5 digest" % hex_digest)
+    return digest
+
+
+def encode_items(items: Iterable[Dict[str, Any]], codec: int = CODEC_ZLIB) -> Iterator[bytes]:
+    """Encode snapshot dicts, in path order, as a stream of binary snapshot chunks."""
+    compress = _compressor(codec)
+    yield MAGIC + bytes([VERSION, codec])
+    prev = b""
+    buf = bytearray()
+    for item in items:
+        path = egest(item["path"])
+        shared = 0
+        limit = min(len(prev), len(path))
+        while shared < limit and prev[shared] == path[shared]:
+            shared += 1
+        if item["type"] == LINK:
+            buf.append(TAG_LINK)
+            digest = _raw_digest(item["csum"])
+        elif item["type"] == DIR and "digest" in item:
+            buf.append(TAG_DIGEST_DIR)
+            digest = _raw_digest(item["digest"])
+        elif item["type"] == DIR:
+            buf.append(TAG_DIR)
+            digest = b""
+        else:
+            raise ValueError("Unexpected snapshot item type %s" % item["type"])
+        buf += _varint(shared)
+        buf += _varint(len(path) - shared)
+        buf += path[shared:]
+        buf += digest
+        prev = path
+        if len(buf) >= READ_SIZE:
+            yield compress(bytes(buf))
+            buf.clear()
+    buf.append(TAG_END)
+    yield compress(bytes(buf))
+    yield compress(b"")
+
+
+def encode(items: Iterable[Dict[str, Any]], codec: int = CODEC_ZLIB) -> bytes:
+    return b"".join(encode_items(items, codec))
+
+
+class _Reader:
+    """Exact reads over a stream of byte chunks."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buf = b""
+        self._pos = 0
+
+    def _fill(self, n: int) -> None:
+        parts = [self._buf[self._pos:]]
+        have = len(parts[0])
+        while have < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                raise ValueError("Snapshot ended unexpectedly")
+            parts.append(chunk)
+            have += len(chunk)
+        self._buf = b"".join(parts)
+        self._pos = 0
+
+    def read(self, n: int) -> bytes:
+        if self._pos + n > len(self._buf):
+            self._fill(n)
+        out = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return out
+
+    def byte(self) -> int:
+        if self._pos >= len(self._buf):
+            self._fill(1)
+        b = self._buf[self._pos]
+        self._pos += 1
+        return b
+
+    def varint(self) -> int:
+        n = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def at_end(self) -> bool:
+        if self._pos < len(self._buf):
+            return False
+        for chunk in self._chunks:
+            if chunk:
+                self._buf = chunk
+                self._pos = 0
+                return False
+        return True
+
+
+def decode_items(fd: IO[bytes]) -> Generator[SnapshotItem, None, None]:
+    """
+    Decode a binary snapshot from fd one item at a time.
+    Raises ValueError if the data is not a well formed binary snapshot.
+    """
+    header = fd.read(HEADER_LEN)
+    if len(header) < HEADER_LEN or not is_binary(header):
+        raise ValueError("Not a binary snapshot")
+    version, codec = header[len(MAGIC)], header[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError("Unsupported binary snapshot version %d" % version)
+    raw_chunks: Iterator[bytes] = iter(lambda: fd.read(READ_SIZE), b"")
+    reader = _Reader(_decompressed(raw_chunks, codec))
+    prev = b""
+    while True:
+        tag = reader.byte()
+        if tag == TAG_END:
+            break
+        shared = reader.varint()
+        if shared > len(prev):
+            raise ValueError("Snapshot path prefix is longer than the previous path")
+        path = prev[:shared] + reader.read(reader.varint())
+        try:
+            path_str = path.decode("utf-8")
+        except UnicodeDecodeError as e:
+            raise ValueError("Snapshot path is not UTF-8: %r" % path) from e
+        if tag == TAG_LINK:
+            yield SnapshotItem(path_str, LINK, reader.read(DIGEST_LEN).hex())
+        elif tag == TAG_DIR:
+            yield SnapshotItem(path_str, DIR)
+        elif tag == TAG_DIGEST_DIR:
+            yield SnapshotItem(path_str, DIR, digest=reader.read(DIGEST_LEN).hex())
+        else:
+            raise ValueError("Unexpected snapshot record tag %d" % tag)
+        prev = path
+    if not reader.at_end():
+        raise ValueError("Unexpected data after the end of the snapshot")
+
+
+def decode(data: bytes) -> List[SnapshotItem]:
+    return list(decode_items(BytesIO(data)))
+
+
+def stale_digests(items: List[SnapshotItem]) -> List[str]:
+    """The paths of the directories whose stored digest doesn't match their contents."""
+    expected = add_dir_digests([item.get_dict() for item in items])
+    return [item.pathStr() for item, want in zip(items, expected)
+            if item.digest() is not None and item.digest() != want.get("digest")]
+
+
+class SnapshotKeyDB:
+    """
+    Snapshot serialisation layer wrapping BlobKeyDB.
+    Reads both JSON and binary snapshots. Writes in the configured format.
+    Binary snapshots read back as a lazy stream of SnapshotItems, JSON snapshots as a list.
+    """
+
+    def __init__(self, db: BlobKeyDB, snap_format: Optional[str] = None):
+        snap_format = snap_format or DEFAULT_SNAP_FORMAT
+        if snap_format not in SNAP_FORMATS:
+            raise ValueError("Unknown snapshot format %s, expected one of %s" % (snap_format, SNAP_FORMATS))
+        self.db = db
+        self.snap_format = snap_format
+
+    def _is_binary_key(self, key: str) -> bool:
+        with self.db.read_handle(key) as fd:
+            return is_binary(fd.read(len(MAGIC)))
+
+    def read(self, key: str) -> Any:
+        """
+        Read a snapshot's items.
+        Raises FileNotFoundError if key is absent.
+        """
+        if self._is_binary_key(key):
+            return self._stream(key)
+        return loads(self.db.read(key))
+
+    def _stream(self, key: str) -> Generator[SnapshotItem, None, None]:
+        with self.db.read_handle(key) as fd:
+            yield from decode_items(fd)
+
+    def write(self, key: str, value: Any, overwrite: bool) -> None:
+        if self.snap_format == "json":
+            # Older releases build items from these dicts and reject keys they don't know.
+            value = [{k: v for k, v in item.items() if k != "digest"} for item in value]
+            value_bytes = egest(keydb_encoder.encode(value))
+        else:
+            codec = CODECS[self.snap_format[len("binary-"):]]
+            # Directory digests are recomputed on every write, so they can't go stale.
+            value_bytes = encode(add_dir_digests([dict(item) for item in value]), codec)
+        self.db.write(key, value_bytes, overwrite)
+
+    def verify(self, key: str) -> bool:
+        return len(self.diagnose(key)) == 0
+
+    def diagnose(self, key: str) -> List[str]:
+        """
+        Binary snapshots must decode cleanly with current directory digests; JSON snapshots must be canonical.
+        Raises FileNotFoundError if key is absent.
+        """
+        if self._is_binary_key(key):
+            try:
+                items = list(self._stream(key))
+            except ValueError as e:
+                return [str(e)]
+            return ["directory digest of %s doesn't match its contents" % path for path in stale_digests(items)]
+        raw = self.db.read(key)
+        if egest(keydb_encoder.encode(loads(raw))) == raw:
+            return []
+        return ["stored JSON is not canonical (data intact, needs rewrite)"]
+
+    def list(self, pattern: str = "**") -> List[str]:
+        return self.db.list(pattern)
+
+    def delete(self, key: str) -> None:
+        self.db.delete(key)
@@ -1,17 +1,39 @@
 from collections.abc import Iterable
 from delnone import delnone
 from farmfs.blobstore import ReverserFunction
-from farmfs.fs import Path, LINK, DIR, FILE, SkipFunction, ingest, ROOT, walk
+from farmfs.fs import Path, LINK, DIR, FILE, SkipFunction, canonicalPath, ingest, walk
+from farmfs.hashcache import HashCache, stat_key
+from farmfs.util import egest
 from functools import total_ordering
+from hashlib import md5
+from os import stat_result
 from os.path import sep
-from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+from typing import Any, Dict, Generator, Generic, Iterator, List, Optional, Tuple, TypeVar, Union
+
+
+PathKey = Tuple[str, ...]
+
+
+def path_key(path: str) -> PathKey:
+    """
+    The segments of a snapshot path relative to the volume root, for comparison.
+    Tuples of segments order exactly like Path objects do, with the root () first
+    and every directory directly before its children.
+    """
+    canonical = canonicalPath(sep + path)
+    if canonical == sep:
+        return ()
+    return tuple(canonical[1:].split(sep))
 
 
 @total_ordering
 class SnapshotItem:
-    def __init__(self, path: Path | str, type: str, csum: str | None = None):
+    __slots__ = ("_path", "_type", "_csum", "_key", "_digest")
+
+    def __init__(self, path: Path | str, type: str, csum: str | None = None, digest: str | None = None):
         assert isinstance(type, str)
         assert type in [LINK, DIR], type
+        assert digest is None or type == DIR, "only directories have digests"
         if isinstance(path, Path):
             path = path._path  # TODO reaching into path.
         assert isinstance(path, str), path
@@ -29,6 +51,11 @@ class SnapshotItem:
         self._path = path
         self._type = ingest(type)
         self._csum = csum and ingest(csum)  # csum can be None.
+        self._key = path_key(path)
+        self._digest = digest and ingest(digest)  # Directory Merkle digest, when known.
+
+    def sort_key(self) -> PathKey:
+        return self._key
 
     # TODO create a path comparator. cmp has different semantics.
     def __cmp__(self, other: Any) -> int:
@@ -36,18 +63,22 @@ class SnapshotItem:
             return -1
         if not isinstance(other, SnapshotItem):
             return NotImplemented
-        self_path = Path(self._path, ROOT)
-        other_path = Path(other._path, ROOT)
-        return self_path.__cmp__(other_path)
+        return (self._key > other._key) - (self._key < other._key)
 
     def __eq__(self, other: Any) -> bool:
-        return self.__cmp__(other) == 0
+        if not isinstance(other, SnapshotItem):
+            return False
+        return self._key == other._key
 
     def __ne__(self, other: Any) -> bool:
-        return self.__cmp__(other) != 0
+        return not self.__eq__(other)
 
     def __lt__(self, other: Any) -> bool:
-        return self.__cmp__(other) < 0
+        if other is None:
+            return True
+        if not isinstance(other, SnapshotItem):
+            return NotImplemented
+        return self._key < other._key
 
     def get_tuple(self) -> Tuple[str, str, str | None]:
         return (self._path, self._type, self._csum)
@@ -75,6 +106,10 @@ class SnapshotItem:
         assert self._csum is not None
         return self._csum
 
+    def digest(self) -> Optional[str]:
+        """The Merkle digest of a directory's contents, or None if it isn't known."""
+        return self._digest
+
     def __str__(self):
         return "<%s %s %s>" % (self._type, self._path, self._csum)
 
@@ -82,62 +117,275 @@ class SnapshotItem:
         return root.join(self._path)
 
 
+T = TypeVar("T")
+
+
+class MerkleDir(Generic[T]):
+    __slots__ = ("key", "tag", "hasher", "subdirs", "digest")
+
+    def __init__(self, key: PathKey, tag: T):
+        self.key = key
+        self.tag = tag
+        self.hasher = md5()
+        self.subdirs: List[str] = []
+        self.digest: Optional[str] = None
+
+
+class MerkleBuilder(Generic[T]):
+    """
+    Computes directory digests from snapshot items arriving in path order.
+    A directory's digest is the md5 of its entries in order, each entry being
+    its type, name and either a link's checksum or a subdirectory's digest.
+    Two directories with the same digest hold identical trees, wherever they are.
+
+    Adding an item returns the directories it closed, with their digests set.
+    Each directory carries a caller supplied tag to tell them apart.
+    """
+
+    def __init__(self) -> None:
+        self._stack: List[MerkleDir[T]] = []
+
+    def _entry(self, key: PathKey, type_: str, ref: str) -> None:
+        if self._stack:
+            parent = self._stack[-1]
+            name = sep.join(key[len(parent.key):])
+            parent.hasher.update(egest(type_ + "\0" + name + "\0" + ref + "\0"))
+            if type_ == DIR:
+                parent.subdirs.append(name)
+
+    def _close(self, until: Optional[PathKey] = None) -> List[MerkleDir[T]]:
+        """Close the open directories which until is not inside of, or all of them."""
+        closed = []
+        while self._stack:
+            top = self._stack[-1]
+            if until is not None and until[:len(top.key)] == top.key:
+                break
+            self._stack.pop()
+            if top.digest is None:
+                top.digest = top.hasher.hexdigest()
+            self._entry(top.key, DIR, top.digest)
+            closed.append(top)
+        return closed
+
+    def add_dir(self, key: PathKey, tag: T) -> List[MerkleDir[T]]:
+        closed = self._close(key)
+        self._stack.append(MerkleDir(key, tag))
+        return closed
+
+    def add_link(self, key: PathKey, csum: str) -> List[MerkleDir[T]]:
+        closed = self._close(key)
+        self._entry(key, LINK, csum)
+        return closed
+
+    def prune(self, digest: str) -> None:
+        """The directory just added already has digest, its contents won't be added."""
+        self._stack[-1].digest = digest
+
+    def finish(self) -> List[MerkleDir[T]]:
+        return self._close()
+
+
+def add_dir_digests(items: List[Dict]) -> List[Dict]:
+    """Set the digest of every directory in items, which are snapshot dicts in path order."""
+    builder: MerkleBuilder[Dict] = MerkleBuilder()
+
+    def set_digests(closed: List[MerkleDir[Dict]]) -> None:
+        for d in closed:
+            d.tag["digest"] = d.digest
+
+    for item in items:
+        if item["type"] == DIR:
+            set_digests(builder.add_dir(path_key(item["path"]), item))
+        else:
+            set_digests(builder.add_link(path_key(item["path"]), item["csum"]))
+    set_digests(builder.finish())
+    return items
+
+
 class Snapshot:
     name: str
 
     def __init__(self, name: str):
         self.name = name
 
-    def __iter__(self) -> Generator[SnapshotItem, None, None]:
+    def __iter__(self) -> Iterator[SnapshotItem]:
         raise NotImplementedError()
 
 
 class TreeSnapshot(Snapshot):
-    def __init__(self, root: Path, is_ignored: SkipFunction, reverser: ReverserFunction):
+    """
+    The snapshot of a working tree.
+    Given a HashCache, directories whose digests were recorded and which have not
+    changed since come with their digest, so a diff can skip them with prune().
+    scope names the ignore rules the digests were computed under.
+    """
+
+    def __init__(self,
+                 root: Path,
+                 is_ignored: SkipFunction,
+                 reverser: ReverserFunction,
+                 cache: Optional[HashCache] = None,
+                 scope: str = ""):
         super().__init__("<tree>")
         assert isinstance(root, Path)
         self.root = root
         self.is_ignored = is_ignored
         self.reverser = reverser
-
-    def __iter__(self) -> Generator[SnapshotItem, None, None]:
-        root = self.root
-
-        def tree_snap_iterator() -> Generator[SnapshotItem, None, None]:
-            for path, type_ in walk(root, skip=self.is_ignored):
-                if type_ is LINK:
-                    # We put the link destination through the reverser.
-                    # We don't control the link, so its possible the value is
-                    # corrupt, like say wrong volume.
-                    # Or perhaps crafted to cause problems.
-                    # TODO we are doign str -> Path -> str pointlessly.
-                    ud_str = self.reverser(str(path.readlinkat()))
-                elif type_ is DIR:
-                    ud_str = None
-                elif type_ is FILE:
-                    continue
+        self.cache = cache
+        self.scope = scope
+
+    def __iter__(self) -> "TreeSnapshotIterator":
+        return TreeSnapshotIterator(self)
+
+
+# The directory, its stat before it was listed, and the digest the cache had for it.
+TreeDir = Tuple[Path, stat_result, Optional[str]]
+
+
+class TreeSnapshotIterator:
+    """
+    Iterator over a TreeSnapshot.
+    prune() skips the contents of the directory just returned, which must have a digest.
+    As directories are finished their digests are recorded in the snapshot's cache.
+    """
+
+    def __init__(self, snap: TreeSnapshot):
+        self._snap = snap
+        self._pruned = False
+        self._last: Optional[SnapshotItem] = None
+        self._checked: Dict[Path, Tuple[stat_result, Optional[str]]] = {}
+        self._builder: MerkleBuilder[TreeDir] = MerkleBuilder()
+        self._items = self._generate()
+
+    def __iter__(self) -> "TreeSnapshotIterator":
+        return self
+
+    def __next__(self) -> SnapshotItem:
+        # The walk asks whether to prune the last directory as it resumes, so
+        # the flag is only cleared once the next item is in hand.
+        item = next(self._items)
+        self._pruned = False
+        self._last = item
+        return item
+
+    def prune(self) -> None:
+        digest = self._last.digest() if self._last is not None else None
+        assert digest is not None, "only directories with digests can be pruned"
+        self._builder.prune(digest)
+        self._pruned = True
+
+    def _check(self, path: Path) -> Tuple[stat_result, Optional[str]]:
+        """Stat a directory, and find its digest if it and every directory beneath it are unchanged."""
+        checked = self._checked.pop(path, None)
+        if checked is not None:
+            return checked
+        cache = self._snap.cache
+        st = path.stat()
+        digest = None
+        if cache is not None:
+            hit = cache.lookup_dir(st, self._snap.scope)
+            if hit is not None:
+                digest, subdirs = hit
+                for name in subdirs:
+                    sub = path.join(name)
+                    sub_checked = self._check(sub)
+                    # Keep the result for when the walk gets to sub.
+                    self._checked[sub] = sub_checked
+                    if sub_checked[1] is None:
+                        digest = None
+                        break
+        return (st, digest)
+
+    def _record(self, closed: List[MerkleDir[TreeDir]]) -> None:
+        cache = self._snap.cache
+        if cache is None:
+            return
+        for d in closed:
+            path, before, cached = d.tag
+            assert d.digest is not None
+            if cached == d.digest:
+                continue
+            # Only record directories which didn't change while we listed them.
+            after = path.stat()
+            if stat_key(before) == stat_key(after):
+                cache.record_dir(after, self._snap.scope, d.digest, d.subdirs)
+
+    def _generate(self) -> Generator[SnapshotItem, None, None]:
+        snap = self._snap
+        root = snap.root
+        builder = self._builder
+        prune = lambda p: self._pruned
+        for path, type_ in walk(root, skip=snap.is_ignored, prune=prune):
+            if type_ is LINK:
+                # We put the link destination through the reverser.
+                # We don't control the link, so its possible the value is
+                # corrupt, like say wrong volume.
+                # Or perhaps crafted to cause problems.
+                # TODO we are doign str -> Path -> str pointlessly.
+                ud_str = snap.reverser(str(path.readlinkat()))
+                item = SnapshotItem(path.relative_to(root), type_, ud_str)
+                if snap.cache is not None:
+                    self._record(builder.add_link(item.sort_key(), ud_str))
+            elif type_ is DIR:
+                if snap.cache is not None:
+                    st, digest = self._check(path)
+                    item = SnapshotItem(path.relative_to(root), type_, digest=digest)
+                    self._record(builder.add_dir(item.sort_key(), (path, st, digest)))
                 else:
-                    raise ValueError(
-                        "Encounted unexpected type %s for path %s" % (type_, path)
-                    )
-                yield SnapshotItem(path.relative_to(root), type_, ud_str)
-
-        return tree_snap_iterator()
+                    item = SnapshotItem(path.relative_to(root), type_)
+            elif type_ is FILE:
+                continue
+            else:
+                raise ValueError(
+                    "Encounted unexpected type %s for path %s" % (type_, path)
+                )
+            yield item
+        self._record(builder.finish())
 
 
 # TODO this is a lame way of describing whats in the snaps.
 SnapItemTypes = Union[List, Dict, SnapshotItem]
 class KeySnapshot(Snapshot):
-    def __init__(self, data: Iterable[SnapItemTypes], name: str, reverser: ReverserFunction):
+    """
+    A snapshot over stored items.
+    When presorted, the items are trusted to already be in path order and are
+    streamed as they are read; an item out of order raises ValueError rather
+    than producing a wrong diff. Otherwise they are sorted on first iteration.
+    """
+
+    def __init__(self, data: Iterable[SnapItemTypes], name: str, reverser: ReverserFunction, presorted: bool = False):
         super().__init__(name)
         assert data is not None
         self.data = data
         self._reverser = reverser
         self._consumed = False
+        self.presorted = presorted
+
+    def sorted(self) -> "KeySnapshot":
+        """The same snapshot, sorted on iteration instead of trusting the stored order."""
+        return KeySnapshot(self.data, self.name, self._reverser)
 
     # TODO this is dangerous because __iter__ consumes the snapshot data!
     # you can't call __iter__ twice!
-    def __iter__(self):
+    def __iter__(self) -> Iterator[SnapshotItem]:
+        items = self.items()
+        if self.presorted:
+            return self._check_sorted(items)
+        return iter(sorted(items, key=SnapshotItem.sort_key))
+
+    def _check_sorted(self, items: Iterator[SnapshotItem]) -> Generator[SnapshotItem, None, None]:
+        prev = None
+        for item in items:
+            if prev is not None and item._key < prev._key:
+                raise ValueError(
+                    "Snapshot %s is out of order: %s follows %s. Run 'farmfs fsck --keydb --fix'."
+                    % (self.name, item.pathStr(), prev.pathStr())
+                )
+            prev = item
+            yield item
+
+    def items(self) -> Iterator[SnapshotItem]:
+        """The items in stored order, neither sorted nor checked."""
         def key_snap_iterator():
             if self._consumed:
                 raise ValueError("Snapshot data has already been consumed")
@@ -160,7 +408,7 @@ class KeySnapshot(Snapshot):
                     parsed = item
                 yield parsed
 
-        return iter(sorted(key_snap_iterator()))
+        return key_snap_iterator()
 
 
 class SnapDelta:
@@ -0,0 +1,363 @@
+"""Concurrent blob transfers between blobstores.
+
+A blobstore session holds a single connection and one open handle at a time,
+so copying blobs one after another over one pair of sessions leaves a high
+latency link like S3 idle most of the time. Transfer copies blobs on a pool of
+worker threads instead, each borrowing a session from a pool on either side.
+
+Sessions keep their connection leased from the blobstore's ConnectionPool
+(see farmfs.connpool) while they are pooled here, so a Transfer reserves room
+in that pool for its sessions, their S3 part workers and its own existence
+checks. More workers than FARMFS_POOL_SIZE don't leave any waiting on a
+connection.
+
+A copy which fails with a transient error (see is_s3_exception) is retried on
+fresh sessions; the sessions it was using are closed rather than returned to
+their pools, since their connections may be broken.
+
+The bytes being copied at once are bounded, so a run of large blobs doesn't
+start more transfers than the link can carry. Blob sizes are only known up
+front when the source is a FileBlobstore; otherwise only the worker count
+bounds a transfer.
+
+Between a FileBlobstore and an HttpBlobstore, blobs go in batches over farmapi's
+bulk endpoints instead, one request carrying up to bulk_batch blobs, so a run of
+small blobs isn't bound by a round trip each. Uploads only batch blobs of at
+most DEFAULT_BULK_MAX_BLOB_SIZE bytes; a larger blob is sent in a batch of its own.
+
+A chunked blob in a FileBlobstore (see farmfs.chunking) is sent as whichever of
+its chunks dst_bs lacks, followed by its manifest, so a large file which changed
+a little only sends the chunks that changed. Chunked blobs fetched from an
+HttpBlobstore arrive whole, as farmapi serves them.
+
+fetch_blobs puts a Transfer behind a check for which blobs are already present,
+for fetch, pull and fsck --missing --fix, which each want a set of blobs local.
+missing_blobs makes that check in batches with exists_many, which farmdbg upload
+also uses to find the blobs a remote blobstore lacks without listing all of it.
+"""
+import logging
+import queue
+import threading
+import time
+from contextlib import ExitStack, closing, contextmanager
+from itertools import batched
+from os import environ
+from types import TracebackType
+from typing import ContextManager, Generator, Iterable, Iterator, List, Optional, Tuple, Type
+
+from farmfs.blobstore import (
+    DEFAULT_BULK_BATCH,
+    DEFAULT_BULK_MAX_BLOB_SIZE,
+    EXISTS_BATCH,
+    FileBlobstore,
+    FileBlobstoreSession,
+    HttpBlobstore,
+    HttpBlobstoreSession,
+    S3Blobstore,
+    S3BlobstoreSession,
+    is_s3_exception,
+)
+from farmfs.chunking import Manifest
+from farmfs.util import Readable, concat, consume, partial, pfmaplazy, retry, retryFdIo2, uniq
+
+logger = logging.getLogger(__name__)
+
+AnyBlobstore = FileBlobstore | HttpBlobstore | S3Blobstore
+AnySession = FileBlobstoreSession | HttpBlobstoreSession | S3BlobstoreSession
+
+# Blobs copied at once, and the most bytes those copies may add up to.
+DEFAULT_TRANSFER_WORKERS = int(environ.get("FARMFS_TRANSFER_WORKERS", "8"))
+DEFAULT_MAX_IN_FLIGHT = int(environ.get("FARMFS_TRANSFER_MAX_IN_FLIGHT", str(256 * 1024 * 1024)))
+
+
+def _is_transient(e: Exception) -> bool:
+    """A missing source blob won't turn up on a retry."""
+    return is_s3_exception(e) and not isinstance(e, FileNotFoundError)
+
+
+class SessionPool:
+    """
+    Up to size sessions on one blobstore, opened as they are first needed and
+    reused after. Each session is used by one thread at a time.
+    """
+
+    def __init__(self, bs: AnyBlobstore, size: int):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.bs = bs
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: "queue.LifoQueue[AnySession]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.discarded = 0
+
+    def _open(self) -> AnySession:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        sess = self.bs.session()
+        sess.__enter__()
+        with self._lock:
+            self.opened += 1
+        return sess
+
+    def _discard(self, sess: AnySession, error: BaseException) -> None:
+        with self._lock:
+            self.discarded += 1
+        try:
+            # Exiting with the error tells a pooled connection not to be reused.
+            sess.__exit__(type(error), error, error.__traceback__)
+        except Exception as e:
+            logger.debug("Closing a failed session raised %s: %.200s", type(e).__name__, e)
+
+    @contextmanager
+    def session(self) -> Generator[AnySession, None, None]:
+        """Borrow a session. It is closed instead of returned if the caller raises."""
+        with self._slots:
+            sess = self._open()
+            try:
+                yield sess
+            except BaseException as e:
+                self._discard(sess, e)
+                raise
+            self._idle.put(sess)
+
+    def close(self) -> None:
+        while True:
+            try:
+                sess = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            sess.__exit__(None, None, None)
+
+
+class _InFlight:
+    """Bytes being copied, bounded by limit. One copy may always proceed, however large."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._bytes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self._bytes == 0 or self._bytes + size <= self.limit)
+            self._bytes += size
+
+    def release(self, size: int) -> None:
+        with self._cond:
+            self._bytes -= size
+            self._cond.notify_all()
+
+
+class TransferStats:
+    """Running totals of a transfer. Bytes are only counted for blobs with a local side."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.blobs = 0
+        self.bytes = 0
+
+    def add(self, size: Optional[int]) -> None:
+        with self._lock:
+            self.blobs += 1
+            self.bytes += size or 0
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return "%d blobs, %d bytes in %.1fs (%.1f blobs/s, %.2f MB/s)" % (
+            self.blobs, self.bytes, elapsed, self.blobs / elapsed, self.bytes / elapsed / (1024 * 1024))
+
+
+def _connections(bs: AnyBlobstore, workers: int) -> int:
+    """The most connections to bs a transfer with workers sessions on it holds at once."""
+    if isinstance(bs, S3Blobstore):
+        # Each session's connection, the parts it sends or fetches, and an existence check.
+        return workers * (1 + bs.part_workers) + 1
+    if isinstance(bs, HttpBlobstore):
+        return workers + 1
+    return 0
+
+
+def _local_size(bs: AnyBlobstore, blob: str) -> Optional[int]:
+    if isinstance(bs, FileBlobstore):
+        return bs.blob_size(blob)
+    return None
+
+
+class Transfer:
+    """
+    Copies blobs from src_bs to dst_bs with workers concurrent copies.
+    Use as a context manager so the pooled sessions are closed afterwards.
+    """
+
+    def __init__(
+            self,
+            src_bs: AnyBlobstore,
+            dst_bs: AnyBlobstore,
+            workers: Optional[int] = None,
+            max_in_flight: Optional[int] = None,
+            tries: int = 3,
+            bulk_batch: Optional[int] = None,
+    ):
+        self.src_bs = src_bs
+        self.dst_bs = dst_bs
+        self.workers = DEFAULT_TRANSFER_WORKERS if workers is None else workers
+        if self.workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.src_pool = SessionPool(src_bs, self.workers)
+        self.dst_pool = SessionPool(dst_bs, self.workers)
+        self._in_flight = _InFlight(DEFAULT_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight)
+        self.tries = tries
+        self.bulk_batch = DEFAULT_BULK_BATCH if bulk_batch is None else bulk_batch
+        if self.bulk_batch < 1:
+            raise ValueError("bulk_batch must be at least 1")
+        self.stats = TransferStats()
+        self._reservations = ExitStack()
+
+    def __enter__(self) -> "Transfer":
+        for bs in [self.src_bs, self.dst_bs]:
+            if isinstance(bs, (S3Blobstore, HttpBlobstore)):
+                self._reservations.enter_context(bs.pool.reserved(_connections(bs, self.workers)))
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc: Optional[BaseException],
+                 tb: Optional[TracebackType]) -> None:
+        self.src_pool.close()
+        self.dst_pool.close()
+        self._reservations.close()
+
+    def _copy(self, job: Tuple[str, Optional[int]]) -> str:
+        blob, size = job
+
+        def import_blob(src: AnySession, dst: AnySession) -> bool:
+            if isinstance(src, S3BlobstoreSession) and isinstance(dst, FileBlobstoreSession):
+                return src.export_to(dst, blob)  # Large blobs are fetched in parts.
+
+            def read_src() -> ContextManager[Readable[bytes]]:
+                return src.read_handle(blob)
+            return dst.import_via_fd(read_src, blob)
+        try:
+            retryFdIo2(self.src_pool.session, self.dst_pool.session, import_blob, _is_transient, self.tries)
+        finally:
+            self._in_flight.release(size or 0)
+        self.stats.add(size if size is not None else _local_size(self.dst_bs, blob))
+        return blob
+
+    def _fetch_batch(self, batch: Tuple[str, ...]) -> Tuple[str, ...]:
+        """Copy a batch of blobs from an HttpBlobstore with one bulk read."""
+        def fetch(src: AnySession, dst: AnySession) -> None:
+            assert isinstance(src, HttpBlobstoreSession) and isinstance(dst, FileBlobstoreSession)
+            # A retry only asks for what the failed attempt didn't get to.
+            wanted = [blob for blob in batch if not dst.exists(blob)]
+            with closing(src.read_many(wanted)) as frames:
+                for blob, frame in frames:
+                    if frame is None:
+                        raise FileNotFoundError(f"{blob} is not in the source blobstore")
+                    size = frame.remaining
+                    dst.import_via_fd(lambda: frame, blob)
+                    self.stats.add(size)
+        retryFdIo2(self.src_pool.session, self.dst_pool.session, fetch, _is_transient, self.tries)
+        return batch
+
+    def _send_batch(self, batch: List[Tuple[str, int]]) -> List[str]:
+        """Copy a batch of blobs to an HttpBlobstore with one bulk upload."""
+        def send(src: AnySession, dst: AnySession) -> None:
+            assert isinstance(src, FileBlobstoreSession) and isinstance(dst, HttpBlobstoreSession)
+            dst.import_many([(blob, size, partial(src.read_handle, blob)) for blob, size in batch])
+        total = sum(size for _, size in batch)
+        try:
+            retryFdIo2(self.src_pool.session, self.dst_pool.session, send, _is_transient, self.tries)
+        finally:
+            self._in_flight.release(total)
+        for _, size in batch:
+            self.stats.add(size)
+        return [blob for blob, _ in batch]
+
+    def _send_batches(self, blobs: Iterable[str]) -> Iterator[List[Tuple[str, int]]]:
+        """Group blobs for bulk upload, reserving each batch's bytes in flight."""
+        batch: List[Tuple[str, int]] = []
+        for blob in blobs:
+            size = _local_size(self.src_bs, blob)
+            assert size is not None
+            if size > DEFAULT_BULK_MAX_BLOB_SIZE:
+                self._in_flight.acquire(size)
+                yield [(blob, size)]
+                continue
+            batch.append((blob, size))
+            if len(batch) == self.bulk_batch:
+                self._in_flight.acquire(sum(size for _, size in batch))
+                yield batch
+                batch = []
+        if batch:
+            self._in_flight.acquire(sum(size for _, size in batch))
+            yield batch
+
+    def copy(self, blobs: Iterable[str]) -> Iterator[str]:
+        """Copy blobs, yielding each once it is in dst_bs. Blobs come out in completion order."""
+        if isinstance(self.src_bs, FileBlobstore):
+            return self._copy_chunked(self.src_bs, blobs)
+        return self._copy_blobs(blobs)
+
+    def _copy_chunked(self, src_bs: FileBlobstore, blobs: Iterable[str]) -> Iterator[str]:
+        """Copy the unchunked blobs, then each chunked blob's missing chunks and its manifest."""
+        chunked: List[Tuple[str, Manifest]] = []
+
+        def unchunked(blobs: Iterable[str]) -> Iterator[str]:
+            for blob in blobs:
+                manifest = src_bs.manifest(blob)
+                if manifest is None:
+                    yield blob
+                else:
+                    chunked.append((blob, manifest))
+        yield from self._copy_blobs(unchunked(blobs))
+        for blob, manifest in chunked:
+            consume(self._copy_blobs(missing_blobs(self.dst_bs, (chunk for chunk, _ in manifest))))
+
+            def import_manifest() -> bool:
+                with self.dst_pool.session() as dst:
+                    return dst.import_manifest(blob, manifest)
+            retry(import_manifest, _is_transient, self.tries)
+            self.stats.add(0)
+            yield blob
+
+    def _copy_blobs(self, blobs: Iterable[str]) -> Iterator[str]:
+        if isinstance(self.src_bs, HttpBlobstore) and isinstance(self.dst_bs, FileBlobstore):
+            return concat(pfmaplazy(self._fetch_batch, workers=self.workers)(batched(blobs, self.bulk_batch)))
+        if isinstance(self.src_bs, FileBlobstore) and isinstance(self.dst_bs, HttpBlobstore):
+            return concat(pfmaplazy(self._send_batch, workers=self.workers)(self._send_batches(blobs)))
+
+        def budgeted(blobs: Iterable[str]) -> Iterator[Tuple[str, Optional[int]]]:
+            for blob in blobs:
+                size = _local_size(self.src_bs, blob)
+                self._in_flight.acquire(size or 0)
+                yield blob, size
+        return pfmaplazy(self._copy, workers=self.workers)(budgeted(blobs))
+
+
+def missing_blobs(bs: AnyBlobstore, blobs: Iterable[str]) -> Iterator[str]:
+    """
+    The distinct blobs which bs doesn't have, in the order first seen.
+    They are checked EXISTS_BATCH at a time with exists_many, a single request for a remote blobstore.
+    """
+    for batch in batched(uniq(blobs), EXISTS_BATCH):
+        present = bs.exists_many(batch)
+        yield from (blob for blob in batch if blob not in present)
+
+
+def fetch_blobs(
+        dst_bs: FileBlobstore,
+        src_bs: AnyBlobstore,
+        blobs: Iterable[str],
+        workers: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Copy whichever of blobs dst_bs doesn't have from src_bs, workers at a time.
+    Yields the blobs copied, in completion order.
+    """
+    with Transfer(src_bs, dst_bs, workers) as xfer:
+        yield from xfer.copy(missing_blobs(dst_bs, blobs))
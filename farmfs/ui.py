@@ -25,18 +25,19 @@ from farmfs.util import (
     maybe,
     ordered_merge_diff,
     partial,
-    pfmaplazy,
+    pfmaplazyordered,
     pipeline,
-    Readable,
     SIDE,
     then,
     uncurry,
     zipFrom,
 )
 from farmfs.keydb import KeyDBLike
+from farmfs.hashcache import HashCache
+from farmfs import snapformat
 from farmfs.volume import (BlobOperation, FarmFSVolume, ImportResult, TreeDescription,
                            TreeOperation, VolumeChangeOperation, mkfs, tree_diff,
-                           tree_patcher, encode_snapshot)
+                           tree_patcher, tree_prefetcher, encode_snapshot)
 from farmfs.fs import (
     Path,
     WalkItem,
@@ -48,12 +49,16 @@ from farmfs.fs import (
     walk,
     ensure_symlink,
     walk_path,
+    _BLOCKSIZE,
 )
 from json import JSONEncoder
 from s3lib.ui import load_creds as load_s3_creds
+from contextlib import nullcontext
 import sys
 import tqdm as tqdmlib
-from farmfs.blobstore import FileBlobstore, S3Blobstore, HttpBlobstore
+from farmfs.blobstore import DEFAULT_CHECKSUM_WORKERS, BlobRejected, FileBlobstore, S3Blobstore, HttpBlobstore
+from farmfs.transfer import DEFAULT_TRANSFER_WORKERS, Transfer, TransferStats, fetch_blobs, missing_blobs
+from farmfs.scrub import DAY_NS, DEFAULT_SCRUB_MAX_AGE_DAYS, scrub
 from farmfs.progress import csum_pbar, diff_pbar, lazy_pbar, list_pbar, tree_pbar
 
 def noop(x: Any) -> None:
@@ -110,24 +115,40 @@ FarmFS
 
 Usage:
   farmfs mkfs [options] [--root <root>] [--data <data>]
-  farmfs (status|freeze|thaw) [options] [<path>...]
+  farmfs (status|freeze|thaw) [options] [--no-cache] [--workers=<n>] [<path>...]
   farmfs snap list [options]
-  farmfs snap (make|read|delete|restore|diff) [options] [--force] <snap>
-  farmfs fsck [options] [--remote=<remote>] [--missing --frozen-ignored --blob-permissions --checksums --keydb] [--fix]
+  farmfs snap (make|read|delete|restore|diff) [options] [--force] [--no-cache] <snap>
+  farmfs fsck [options] [--remote=<remote>] [--missing --frozen-ignored --blob-permissions --checksums --keydb --refcounts] [--fix]
+              [--workers=<n>] [--hasher=<engine>] [--read-size=<size>] [--mmap] [--scrub [--rate=<size>] [--max-age=<days>]]
   farmfs count [options]
   farmfs similarity [options] <dir_a> <dir_b>
-  farmfs gc [options] [--noop]
+  farmfs gc [options] [--noop] [--incremental]
   farmfs remote add [options] [--force] <remote> <root>
   farmfs remote remove [options] <remote>
   farmfs remote list [options] [<remote>]
-  farmfs pull [options] <remote> [<snap>]
-  farmfs pull-path [options] <src_path> <dest_path> [<snap>]
-  farmfs diff [options] <remote> [<snap>]
-  farmfs fetch [options] [--force] [<remote>] [<snap>]
+  farmfs pull [options] [--no-cache] [--workers=<n>] <remote> [<snap>]
+  farmfs pull-path [options] [--workers=<n>] <src_path> <dest_path> [<snap>]
+  farmfs diff [options] [--no-cache] <remote> [<snap>]
+  farmfs fetch [options] [--force] [--workers=<n>] [<remote>] [<snap>]
 
 
 Options:
-  --quiet  Disable progress bars.
+  --quiet             Disable progress bars.
+  --no-cache          Hash every file and walk every directory instead of trusting .farmfs/hashcache.db.
+  --workers=<n>       Freeze or thaw up to n files at once (default 1), hash n blobs at once in fsck (default 8),
+                      or copy n blobs at once in pull, fetch and fsck --missing --fix (default 8).
+  --incremental       Only collect blobs whose reference counts dropped to zero, see fsck --refcounts.
+  --hasher=<engine>   Hash blobs for fsck --checksums in "threads" or "processes".
+  --read-size=<size>  Bytes fsck --checksums reads at a time, with an optional K or M suffix.
+  --mmap              Hash blobs for fsck --checksums through mmap instead of reads.
+  --scrub             Make fsck --checksums resumable: verify blobs never verified, then any last verified
+                      more than --max-age days ago (default 30), picking up where the last scrub stopped.
+  --rate=<size>       Read at most size bytes per second while scrubbing, with an optional K, M or G suffix.
+
+Snapshots:
+  snap make writes JSON unless FARMFS_SNAP_FORMAT names a binary format (binary-zlib, binary-none or binary-zstd).
+  Only binary snapshots record directory digests, which let snap diff, snap restore, pull and diff skip unchanged
+  directories; diffs against a JSON snapshot walk every directory.
 
 """
 
@@ -210,6 +231,7 @@ stream_op_doer = fmap(op_doer)
 def fsck_fix_missing_blobs(
         vol: FarmFSVolume,
         remote: Optional[FarmFSVolume],
+        workers: Optional[int] = None,
 ) -> Callable[[Iterable[Tuple[str, Iterable[Tuple[Snapshot, SnapshotItem]]]]], Iterable[str]]:
     if remote is None:
         raise ValueError("No remote specified, cannot restore missing blobs")
@@ -219,13 +241,8 @@ def fsck_fix_missing_blobs(
         return csum
     select_csums = fmap(select_csum)
 
-    def download_missing_blob(csum: str) -> str:
-        getSrcHandleFn = lambda: remote.bs.read_handle(csum)
-        # TODO this is going to open / close the session for each blob.
-        with vol.bs.session() as bs_sess:
-            bs_sess.import_via_fd(getSrcHandleFn, csum)
-        return csum
-    download_missing_blobs = fmap(download_missing_blob)
+    def download_missing_blobs(csums: Iterable[str]) -> Iterator[str]:
+        return fetch_blobs(vol.bs, remote.bs, csums, workers)
 
     def printr(csum: str) -> str:
         print("\tRestored ", csum, "from remote")
@@ -369,16 +386,23 @@ def fsck_blob_source(vol: FarmFSVolume, cwd: Path) -> Iterator[str]:
     return vol.bs.blobs()
 
 
-def fsck_checksum_mismatches(vol: FarmFSVolume, cwd: Path) -> Callable[[Iterable[str]], Iterable[str]]:
-    """Look for checksum mismatches."""
+def fsck_checksum_mismatches(
+        vol: FarmFSVolume,
+        cwd: Path,
+        blob_checksums: Callable[[Iterable[str]], Iterator[Tuple[str, str]]],
+) -> Callable[[Iterable[str]], Iterable[str]]:
+    """Look for checksum mismatches, hashing blobs with blob_checksums."""
+    return pipeline(blob_checksums, fsck_corrupt_blobs())
+
+
+def fsck_corrupt_blobs() -> Callable[[Iterable[Tuple[str, str]]], Iterable[str]]:
+    """Report the corrupt blobs among (blob, checksum) pairs."""
     # TODO CORRUPTION checksum mismatch in blob <CSUM>, would be nice to know back references.
-    def blob_calc_checksum(blob: str) -> Tuple[str, str]:
-        return blob, vol.bs.blob_checksum(blob)
-    p_blob_calc_checksums = pfmaplazy(blob_calc_checksum)
     def blob_is_corrupt(blob: str, checksum: str) -> bool:
         """Return True if corrupt, False if correct."""
         return blob != checksum
     blob_is_curript_tuple = uncurry(blob_is_corrupt)
+
     def corrupt_printer(blob: str, csum: str) -> str:
         print(f"CORRUPTION checksum mismatch in blob {blob} got {csum}")
         return blob
@@ -386,7 +410,6 @@ def fsck_checksum_mismatches(vol: FarmFSVolume, cwd: Path) -> Callable[[Iterable
     corrupt_printer_tuples = fmap(corrupt_printer_tuple)
 
     checker = pipeline(
-        p_blob_calc_checksums,
         ffilter(blob_is_curript_tuple),
         corrupt_printer_tuples,
     )
@@ -401,7 +424,8 @@ def fsck_check_missing(
         remote: Optional[FarmFSVolume],
         quiet: bool,
         fix: bool,
-        cwd: Path
+        cwd: Path,
+        workers: Optional[int] = None,
 ) -> Tuple[Iterable[Any], int]:
     snap_count = len(vol.snapdb.list()) + 1  # +1 for the live tree; cheap key listing, no data read
 
@@ -426,7 +450,7 @@ def fsck_check_missing(
         fsck_missing_blobs(vol, cwd),
     )(snaps)
     if fix:
-        return fsck_fix_missing_blobs(vol, remote)(missing), 1
+        return fsck_fix_missing_blobs(vol, remote, workers)(missing), 1
     return missing, 1
 
 
@@ -469,11 +493,33 @@ def fsck_check_checksums(
         remote: Optional[FarmFSVolume],
         quiet: bool,
         fix: bool,
-        cwd: Path) -> Tuple[Iterable[Any], int]:
-    corrupt: Iterable[str] = pipeline(
-        csum_pbar(label="Checksums", quiet=quiet, leave=False),
-        fsck_checksum_mismatches(vol, cwd),
-    )(fsck_blob_source(vol, cwd))
+        cwd: Path,
+        blob_checksums: Callable[[Iterable[str]], Iterator[Tuple[str, str]]],
+        scrub_limits: Optional[Tuple[int, Optional[int]]] = None) -> Tuple[Iterable[Any], int]:
+    """
+    Verify every blob's checksum. With scrub_limits, a (max age in ns, bytes per second)
+    pair, only verify blobs which are new or overdue, resuming where the last scrub stopped.
+    """
+    corrupt: Iterable[str]
+    if scrub_limits is None:
+        corrupt = pipeline(
+            csum_pbar(label="Checksums", quiet=quiet, leave=False),
+            fsck_checksum_mismatches(vol, cwd, blob_checksums),
+        )(fsck_blob_source(vol, cwd))
+    else:
+        max_age_ns, rate = scrub_limits
+
+        def scrubbed() -> Iterator[Tuple[str, str]]:
+            with vol.scrub_index() as index:
+                yield from scrub(vol.bs, index, blob_checksums, max_age_ns, rate)
+
+        @uncurry
+        def scrubbed_blob(blob: str, csum: str) -> str:
+            return blob
+        corrupt = pipeline(
+            tree_pbar(label="Scrub", quiet=quiet, leave=False, postfix=scrubbed_blob),
+            fsck_corrupt_blobs(),
+        )(scrubbed())
     if fix:
         return fsck_fix_checksum_mismatches(vol, remote)(corrupt), 2
     return corrupt, 2
@@ -514,6 +560,21 @@ def fsck_check_keydb(vol: FarmFSVolume,
     def check_json(key: str) -> Callable[[bytes], Union[Any, Exception]]:
         """Return a check that decodes raw bytes and verifies canonical JSON encoding."""
         def _check(raw: bytes) -> Union[Any, Exception]:
+            if key.startswith("snaps" + sep) and snapformat.is_binary(raw):
+                # Binary snapshots have no JSON form; decoding them fully is the check.
+                try:
+                    items = snapformat.decode(raw)
+                except ValueError as e:
+                    return Exception(f"CORRUPT keydb key: {key} (invalid binary snapshot: {e})")
+                stale = snapformat.stale_digests(items)
+                decoded = [item.get_dict() for item in items]
+                if stale:
+                    if not fix:
+                        return Exception(f"CORRUPT keydb key: {key} (stale directory digests: {', '.join(stale[:3])})")
+                    # Writing recomputes the digests.
+                    vol.snapdb.keydb.write(key[len("snaps" + sep):], decoded, overwrite=True)
+                    tqdmlib.tqdm.write(f"FIXED keydb key: {key} (directory digests recomputed)")
+                return decoded
             try:
                 decoded = _loads(raw)
             except Exception as e:
@@ -555,11 +616,14 @@ def fsck_check_keydb(vol: FarmFSVolume,
                     snap_key = key[len(prefix):]
                     # decoder is cheap (wraps list); call twice because
                     # KeySnapshot is single-use (consumed by encoder/validator).
-                    re_encoded = factory.encoder(factory.decoder(decoded, snap_key))
+                    value = factory.decoder(decoded, snap_key)
+                    if isinstance(value, KeySnapshot):
+                        value = value.sorted()  # The stored order is under test, don't trust it.
+                    re_encoded = factory.encoder(value)
                     detail = factory.validate_value(snap_key, factory.decoder(re_encoded, snap_key))
                     if re_encoded != decoded or detail:
                         if fix:
-                            vol.keydb.write(key, re_encoded, overwrite=True)
+                            factory.keydb.write(snap_key, re_encoded, overwrite=True)
                             tqdmlib.tqdm.write(f"FIXED keydb key: {key} (rewritten via semantic encoder)")
                             return re_encoded
                         msgs = []
@@ -588,6 +652,30 @@ def fsck_check_keydb(vol: FarmFSVolume,
     return iter(errors), 16
 
 
+def fsck_check_refcounts(vol: FarmFSVolume,
+                         remote: Optional[FarmFSVolume],
+                         quiet: bool,
+                         fix: bool,
+                         cwd: Path) -> Tuple[Iterable[Any], int]:
+    """Recount every reference, and compare against the reference index."""
+    if not vol.refs.built() and not fix:
+        print("reference index has not been built, run 'farmfs fsck --refcounts --fix'")
+        return iter([vol.refs]), 32
+    def link_csum(item: SnapshotItem) -> str:
+        return item.csum()
+    def is_link(item: SnapshotItem) -> bool:
+        return item.is_link()
+    items_pbar: Callable[[Iterable[SnapshotItem]], Iterator[SnapshotItem]] = tree_pbar(
+        label="Reference counts", quiet=quiet, leave=False)
+    referenced = pipeline(items_pbar, ffilter(is_link), fmap(link_csum))(vol.items())
+    mismatches = vol.refs.reconcile(referenced, vol.bs.blobs(), fix)
+    for mismatch in mismatches:
+        print("wrong reference count", mismatch)
+    if fix and mismatches:
+        print("rebuilt reference index")
+    return iter(mismatches), 32
+
+
 def ui_main() -> Never:
     result = farmfs_ui(sys.argv[1:], cwd)
     exit(result)
@@ -600,6 +688,56 @@ def get_vol(args: Dict[str, Any], cwd: Path) -> FarmFSVolume:
     # TODO add a --root option to specify the volume root for all commands, in addition to cwd-based discovery.
     return getvol(cwd)
 
+def get_workers(args: Dict[str, Any], default: int = 1) -> int:
+    workers = int(args.get("--workers") or default)
+    if workers < 1:
+        raise ValueError("--workers must be at least 1")
+    return workers
+
+def parse_size(option: str, text: str) -> int:
+    """Parse a byte count with an optional K, M or G suffix."""
+    scale = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[-1:].upper(), 1)
+    digits = text[:-1] if scale > 1 else text
+    if not digits.isdigit() or int(digits) < 1:
+        raise ValueError(f"{option} must be a positive number of bytes, got {text}")
+    return int(digits) * scale
+
+def get_read_size(args: Dict[str, Any]) -> int:
+    text = args.get("--read-size")
+    return parse_size("--read-size", text) if text else _BLOCKSIZE
+
+def get_scrub_limits(args: Dict[str, Any]) -> Optional[Tuple[int, Optional[int]]]:
+    """The (max age in ns, bytes per second) of a --scrub, or None for a full check."""
+    if not args.get("--scrub"):
+        return None
+    days = int(args.get("--max-age") or DEFAULT_SCRUB_MAX_AGE_DAYS)
+    if days < 0:
+        raise ValueError("--max-age must not be negative")
+    rate = args.get("--rate")
+    return days * DAY_NS, parse_size("--rate", rate) if rate else None
+
+def get_blob_checksummer(args: Dict[str, Any], vol: FarmFSVolume) -> Callable[[Iterable[str]], Iterator[Tuple[str, str]]]:
+    """The hashing engine fsck --checksums uses, configured from the command line."""
+    workers = get_workers(args, DEFAULT_CHECKSUM_WORKERS)
+    engine = args.get("--hasher")
+    read_size = get_read_size(args)
+    use_mmap = bool(args.get("--mmap"))
+    def blob_checksums(blobs: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        return vol.bs.blob_checksums(blobs, workers, engine, read_size, use_mmap)
+    return blob_checksums
+
+def parallel_fmap[X, Y](func: Callable[[X], Y], workers: int) -> Callable[[Iterable[X]], Iterator[Y]]:
+    """Map func over a stream with a pool of workers, keeping the stream's order."""
+    if workers == 1:
+        return fmap(func)
+    return pfmaplazyordered(func, workers=workers)
+
+def get_hash_cache(args: Dict[str, Any], vol: FarmFSVolume) -> ContextManager[Optional[HashCache]]:
+    """Open the volume's hash cache, or nothing when --no-cache was given."""
+    if args.get("--no-cache"):
+        return nullcontext()
+    return vol.hash_cache()
+
 def cmd_fetch(args: Dict[str, Any], cwd: Path) -> int:
     vol = get_vol(args, cwd)
     quiet = is_quiet(args)
@@ -607,6 +745,7 @@ def cmd_fetch(args: Dict[str, Any], cwd: Path) -> int:
     remote_name = args["<remote>"]
     snap_name = args["<snap>"]
     force = bool(args["--force"])
+    workers = get_transfer_workers(args)
     remote_names: List[str] = [str(remote_name)] if remote_name else vol.remotedb.list()
 
     def snap_item_postfix(item: SnapshotItem) -> str:
@@ -635,13 +774,9 @@ def cmd_fetch(args: Dict[str, Any], cwd: Path) -> int:
         remote_snap = remote_vol.snapdb.read(sname)
         remote_items = list(remote_snap)
         pbar = tree_pbar(label=sname, quiet=quiet, leave=False, postfix=snap_item_postfix)
-        with vol.bs.session() as bs_sess:
-            for item in pbar(remote_items):
-                if item.is_link():
-                    csum = item.csum()
-                    if not vol.bs.exists(csum):
-                        bs_sess.import_via_fd(lambda: remote_vol.bs.read_handle(csum), csum)
-        vol.snapdb.write(local_name, KeySnapshot(remote_items, local_name, vol.bs.reverser), force)
+        links = (item.csum() for item in pbar(remote_items) if item.is_link())
+        consume(fetch_blobs(vol.bs, remote_vol.bs, links, workers))
+        vol.snapdb.write(local_name, KeySnapshot(remote_items, local_name, vol.bs.reverser, presorted=True), force)
         tqdmlib.tqdm.write("Fetched %s/%s as %s" % (rname, sname, local_name))
         return 0
 
@@ -672,7 +807,11 @@ def subtree_items(
 
     Identity case: src_root == snap_root and dst_root == local_root
     produces the original snapshot items unchanged.
+    Rebasing swaps one common prefix for another, so the items stay in path order.
     """
+    if src_root == snap_root and dst_root == local_root:
+        return list(snap)
+
     def under_src(item: SnapshotItem) -> bool:
         item_abs = Path(item._path, snap_root)
         return item_abs == src_root or src_root in item_abs.parents()
@@ -687,7 +826,8 @@ def subtree_items(
         new_path = dst_abs.relative_to(local_root)
         if not new_path or new_path == ".":
             new_path = "."
-        return SnapshotItem(new_path, item._type, item._csum)
+        # Digests cover a directory's contents, not its name, so they survive the move.
+        return SnapshotItem(new_path, item._type, item._csum, item._digest)
 
     return list(pipeline(ffilter(under_src), fmap(rebase))(iter(snap)))
 
@@ -749,29 +889,42 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
                 else:
                     print(s)
 
-            importer = fmap(vol.freeze)
             get_thawed = fmap(vol.thawed)
             print_list = fmap(printr)
-            pipeline(get_thawed, concat, importer, print_list, consume)(paths)
+            with get_hash_cache(args, vol) as cache:
+
+                def freezer(path: Path) -> ImportResult:
+                    return vol.freeze(path, cache)
+
+                importer = parallel_fmap(freezer, get_workers(args))
+                pipeline(get_thawed, concat, importer, print_list, consume)(paths)
         elif args["thaw"]:
 
             def thaw_printr(path: Path) -> None:
                 print("Exported %s" % rel_path(path))
 
-            exporter = fmap(vol.thaw)
             get_frozen = fmap(vol.frozen)
             thaw_print_list = fmap(thaw_printr)
-            pipeline(get_frozen, concat, exporter, thaw_print_list, consume)(paths)
+            with get_hash_cache(args, vol) as cache:
+
+                def thawer(path: Path) -> Path:
+                    return vol.thaw(path, cache)
+
+                exporter = parallel_fmap(thawer, get_workers(args))
+                pipeline(get_frozen, concat, exporter, thaw_print_list, consume)(paths)
         elif args["fsck"]:
             remote_name = args["--remote"]
             remote = vol.remotedb.read(remote_name) if remote_name else None
             fix = bool(args["--fix"])
+            blob_checksums = get_blob_checksummer(args, vol)
+            scrub_limits = get_scrub_limits(args)
             fsck_checks: List[Tuple[str, FsckCheck]] = [
-                ("missing", lambda: fsck_check_missing(vol, remote, quiet, fix, cwd)),
+                ("missing", lambda: fsck_check_missing(vol, remote, quiet, fix, cwd, get_transfer_workers(args))),
                 ("frozen-ignored", lambda: fsck_check_frozen_ignored(vol, remote, quiet, fix, cwd)),
                 ("blob-permissions", lambda: fsck_check_blob_permissions(vol, remote, quiet, fix, cwd)),
-                ("checksums", lambda: fsck_check_checksums(vol, remote, quiet, fix, cwd)),
+                ("checksums", lambda: fsck_check_checksums(vol, remote, quiet, fix, cwd, blob_checksums, scrub_limits)),
                 ("keydb", lambda: fsck_check_keydb(vol, remote, quiet, fix, cwd)),
+                ("refcounts", lambda: fsck_check_refcounts(vol, remote, quiet, fix, cwd)),
             ]
             selected: List[Tuple[str, FsckCheck]] = [
                 (name, check)
@@ -779,7 +932,8 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
                 if args.get(f"--{name}")
             ]
             if len(selected) == 0:
-                selected = fsck_checks
+                # The reference index is only checked on request, links removed by hand leave it counting high.
+                selected = [(name, check) for (name, check) in fsck_checks if name != "refcounts"]
             @uncurry
             def fsck_task_name(name: str, check: FsckCheck) -> str:
                 return name
@@ -813,10 +967,13 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
             if args.get("--noop"):
                 applyfn = fmap(noop)
             else:
-                applyfn = fmap(vol.bs.delete_blob)
+                applyfn = fmap(vol.remove_blob)
+            removed = [0, 0]  # blobs, bytes
             @fmap
             def remove_printr(blob: str) -> str:
                 print("Removing", blob)
+                removed[0] += 1
+                removed[1] += vol.bs.stored_size(blob)
                 return blob
             # Actually print and do the delete (if not noop).
             remove_pipe = pipeline(
@@ -824,7 +981,28 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
                 applyfn,
                 consume
             )
-            pipeline(remove_pipe)(sorted(vol.unused_blobs(vol.items())))
+            if args.get("--incremental"):
+                unused = vol.unused_blobs_incremental()
+            else:
+                unused = vol.unused_blobs(vol.items())
+            pipeline(remove_pipe)(unused)
+            if args.get("--noop"):
+                print("%d unused blobs, %d bytes reclaimable" % tuple(removed))
+            else:
+                print("Removed %d unused blobs, reclaimed %d bytes" % tuple(removed))
+            # Plain copies of chunked blobs nothing links to can be rebuilt from their chunks.
+            evicted = [0, 0]  # blobs, bytes
+            for blob in vol.evictable_blobs():
+                evicted[0] += 1
+                if args.get("--noop"):
+                    evicted[1] += vol.bs.blob_path(blob).stat().st_size
+                else:
+                    evicted[1] += vol.bs.evict(blob)
+            if evicted[0]:
+                if args.get("--noop"):
+                    print("%d chunked blobs with plain copies, %d bytes evictable" % tuple(evicted))
+                else:
+                    print("Evicted %d plain copies of chunked blobs, reclaimed %d bytes" % tuple(evicted))
         elif args["snap"]:
             snapdb = vol.snapdb
             if args["list"]:
@@ -836,14 +1014,16 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
                 if args["delete"]:
                     snapdb.delete(name)
                 elif args["make"]:
-                    snapdb.write(name, cast(KeySnapshot, vol.tree()), force)
+                    with get_hash_cache(args, vol) as cache:
+                        snapdb.write(name, cast(KeySnapshot, vol.tree(cache)), force)
                 else:
                     snap = snapdb.read(name)
                     if args["read"]:
                         for i in snap:
                             print(i)
                     elif args["restore"]:
-                        diff = tree_diff(vol.tree(), snap)
+                        with get_hash_cache(args, vol) as cache:
+                            diff = tree_diff(vol.tree(cache), snap)
                         pipeline(
                             stream_delta_printr,
                             tree_patcher(vol, vol),
@@ -852,7 +1032,8 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
                             consume,
                         )(diff)
                     elif args["diff"]:
-                        diff = tree_diff(vol.tree(), snap)
+                        with get_hash_cache(args, vol) as cache:
+                            diff = tree_diff(vol.tree(cache), snap)
                         pipeline(stream_delta_printr, consume)(diff)
         elif args["remote"]:
             if args["add"]:
@@ -885,11 +1066,12 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
                     return 1
             remote_items = subtree_items(remote_snap, src_root, remote_vol.root, dst_root, local_vol.root)
             local_items = subtree_items(local_vol.tree(), dst_root, local_vol.root, dst_root, local_vol.root)
-            scoped_remote = KeySnapshot(remote_items, remote_snap.name, remote_vol.bs.reverser)
-            scoped_local = KeySnapshot(local_items, "<local>", local_vol.bs.reverser)
+            scoped_remote = KeySnapshot(remote_items, remote_snap.name, remote_vol.bs.reverser, presorted=True)
+            scoped_local = KeySnapshot(local_items, "<local>", local_vol.bs.reverser, presorted=True)
             diff = tree_diff(scoped_local, scoped_remote)
             patcher = tree_patcher(local_vol, remote_vol)
             pipeline(
+                tree_prefetcher(local_vol, remote_vol, get_transfer_workers(args)),
                 stream_delta_printr,
                 patcher,
                 stream_op_printr,
@@ -902,16 +1084,14 @@ def farmfs_ui(argv: List[str], cwd: Path) -> int:
             remote_snap = (
                 remote_vol.snapdb.read(snap_name) if snap_name else remote_vol.tree()
             )
-            src_root = remote_vol.root
-            dst_root = vol.root
-            remote_items = subtree_items(remote_snap, src_root, remote_vol.root, dst_root, vol.root)
-            local_items = subtree_items(vol.tree(), dst_root, vol.root, dst_root, vol.root)
-            scoped_remote = KeySnapshot(remote_items, remote_snap.name, remote_vol.bs.reverser)
-            scoped_local = KeySnapshot(local_items, "<local>", vol.bs.reverser)
-            diff = tree_diff(scoped_local, scoped_remote)
+            # Whole volumes line up without rebasing, so the tree is diffed as it is
+            # walked, skipping directories whose digests match the snapshot's.
+            with get_hash_cache(args, vol) as cache:
+                diff = tree_diff(vol.tree(cache), remote_snap)
             if args["pull"]:
                 patcher = tree_patcher(vol, remote_vol)
                 pipeline(
+                    tree_prefetcher(vol, remote_vol, get_transfer_workers(args)),
                     stream_delta_printr,
                     patcher,
                     stream_op_printr,
@@ -943,7 +1123,7 @@ DBG_USAGE = """
       farmdbg key list [options] [<query>]
       farmdbg key path [options] <key>
       farmdbg walk (keys|userdata|root|snap <snapshot>) [options] [--json]
-      farmdbg checksum [options] <path>...
+      farmdbg checksum [options] [--no-cache] <path>...
       farmdbg fix link [options] [--remote=<remote>] <target> <file>
       farmdbg rewrite-links [options]
       farmdbg missing [options] <snap>...
@@ -951,19 +1131,37 @@ DBG_USAGE = """
       farmdbg blob read [options] [--output=<outfile>] <blob>...
       farmdbg blob type [options] <blob>...
       farmdbg blob reverse [options] <path>...
+      farmdbg blob pack [options] [--threshold=<bytes>]
+      farmdbg blob repack [options]
+      farmdbg blob index [options] [--drop]
+      farmdbg blob count [options]
       farmdbg (s3|api|file) list [options] <endpoint>
-      farmdbg (s3|api|file) upload (local|userdata|snap <snapshot>) [options] <endpoint>
-      farmdbg (s3|api|file) download userdata [options] <endpoint>
+      farmdbg (s3|api|file) upload (local|userdata|snap <snapshot>) [options] [--workers=<n>] <endpoint>
+      farmdbg (s3|api|file) download userdata [options] [--workers=<n>] <endpoint>
       farmdbg (s3|api|file) check [options] <endpoint>
       farmdbg (s3|api|file) read [options] [--output=<outfile>] <endpoint> <blob>...
       farmdbg (s3|api|file) diff [options] [--output=<outfile>] <endpoint>
       farmdbg redact pattern [options] [--noop] <pattern> <from>
 
     Options:
-      --quiet  Disable progress bars.
+      --quiet              Disable progress bars.
+      --no-cache           Hash every file instead of trusting the stat cache in .farmfs/hashcache.db.
+      --workers=<n>        Copy up to n blobs at once, each over its own connection (default 8).
+      --threshold=<bytes>  Pack blobs smaller than this (default 4096).
+      --drop               Remove the blob index instead of building it.
     """
 
 
+def get_transfer_workers(args: Dict[str, Any]) -> int:
+    return get_workers(args, DEFAULT_TRANSFER_WORKERS)
+
+
+def print_pool_stats(bs: FileBlobstore | HttpBlobstore | S3Blobstore) -> None:
+    if isinstance(bs, (HttpBlobstore, S3Blobstore)):
+        stats = bs.pool.stats()
+        print("Connections: {created} opened, {reused} reused, {evicted} idle evicted, {discarded} discarded".format(**stats))
+
+
 def get_remote_bs(args: dict[str, str], cwd: Path) -> FileBlobstore | HttpBlobstore | S3Blobstore:
     connStr = args["<endpoint>"]
     if args["s3"]:
@@ -995,16 +1193,12 @@ def copy_blobs(
         blobs: Iterable[str],
         src_bs: FileBlobstore | HttpBlobstore | S3Blobstore,
         dst_bs: FileBlobstore | HttpBlobstore | S3Blobstore,
-) -> int:
-    """Copy blobs from src_bs to dst_bs. Returns count of blobs copied."""
-    count = 0
-    with src_bs.session() as src_sess, dst_bs.session() as dst_sess:
-        for blob in blobs:
-            def get_src(b: str = blob) -> ContextManager[Readable[bytes]]:
-                return src_sess.read_handle(b)
-            dst_sess.import_via_fd(get_src, blob)
-            count += 1
-    return count
+        workers: Optional[int] = None,
+) -> TransferStats:
+    """Copy blobs from src_bs to dst_bs, up to workers at once. Returns the transfer's totals."""
+    with Transfer(src_bs, dst_bs, workers) as xfer:
+        consume(xfer.copy(blobs))
+    return xfer.stats
 
 
 def dbg_main():
@@ -1107,8 +1301,10 @@ def dbg_ui(argv: list[str], cwd: Path) -> int:
             printr(vol.keydb.list())
     elif args["checksum"]:
         paths = empty_default(map(lambda x: Path(x, cwd), args["<path>"]), [vol.root])
-        for p in paths:
-            print(p.checksum(), p.relative_to(cwd))
+        with get_hash_cache(args, vol) as cache:
+            for p in paths:
+                csum = cache.checksum(p) if cache is not None else p.checksum()
+                print(csum, p.relative_to(cwd))
     elif args["link"]:
         f = Path(args["<file>"], cwd)
         b = ingest(args["<target>"])
@@ -1123,7 +1319,7 @@ def dbg_ui(argv: list[str], cwd: Path) -> int:
                 bs_sess.import_via_fd(getSrcHandleFn, b)
         else:
             pass  # b exists, can we check its checksum?
-        ensure_symlink(f, vol.bs.blob_path(b))
+        ensure_symlink(f, vol.bs.materialise(b))
     elif args["rewrite-links"]:
         for item in vol.tree():
             if not item.is_link():
@@ -1213,37 +1409,63 @@ def dbg_ui(argv: list[str], cwd: Path) -> int:
         elif args["reverse"]:
             for path in args["<path>"]:
                 print(vol.bs.reverser(path))
+        elif args["pack"]:
+            threshold = args.get("--threshold")
+            packed = vol.pack_blobs(None if threshold is None else int(threshold))
+            print("Packed %d blobs" % len(packed))
+        elif args["repack"]:
+            assert vol.bs.packs is not None
+            print("Repacked, reclaimed %d bytes" % vol.bs.packs.repack())
+        elif args["index"]:
+            assert vol.bs.index is not None
+            if args["--drop"]:
+                vol.bs.index.drop()
+                print("Dropped the blob index")
+            else:
+                print("Indexed %d blobs" % vol.bs.build_index())
+        elif args["count"]:
+            print(vol.bs.count())
     elif args["s3"] or args["api"] or args["file"]:
         remote_bs = get_remote_bs(args, cwd)
 
         if args["list"]:
             consume(pipeline(fmap(print))(remote_bs.blobs()))
         elif args["upload"]:
-            if args["local"]:
-                local_blobs: Iterable[str] = snap_link_csums(vol.tree())
-            elif args["userdata"]:
-                local_blobs = vol.bs.blobs()
-            elif args["snap"]:
-                local_blobs = snap_link_csums(vol.snapdb.read(str(args["<snapshot>"])))
+            if args["userdata"]:
+                # Everything is being sent, so one listing of the remote is the cheapest comparison.
+                scan_pbar = diff_pbar(label="Scanning blobs", quiet=quiet)
+                to_upload: Iterable[str] = blobs_only_in_left(scan_pbar(ordered_merge_diff(vol.bs.blobs(), remote_bs.blobs())))
             else:
-                raise ValueError("Invalid upload source")
-            scan_pbar = diff_pbar(label="Scanning blobs", quiet=quiet)
+                if args["local"]:
+                    local_blobs = snap_link_csums(vol.tree())
+                elif args["snap"]:
+                    local_blobs = snap_link_csums(vol.snapdb.read(str(args["<snapshot>"])))
+                else:
+                    raise ValueError("Invalid upload source")
+                # Ask the remote about just these blobs, a batch per request.
+                to_upload = missing_blobs(remote_bs, csum_pbar(label="Scanning blobs", quiet=quiet)(local_blobs))
             xfer_pbar = lazy_pbar(csum_pbar(label="Uploading blobs", quiet=quiet))
-            n = copy_blobs(
-                xfer_pbar(blobs_only_in_left(scan_pbar(ordered_merge_diff(local_blobs, remote_bs.blobs())))),
-                vol.bs, remote_bs,
-            )
-            print(f"Successfully uploaded: {n} blobs")
+            try:
+                stats = copy_blobs(xfer_pbar(to_upload), vol.bs, remote_bs, get_transfer_workers(args))
+            except BlobRejected as e:
+                # Most likely a local blob is corrupt, see fsck --checksums.
+                print(f"Upload failed, {e}")
+                return exitcode | 8
+            print(f"Successfully uploaded: {stats.blobs} blobs")
+            print(f"Transferred {stats.summary()}")
+            print_pool_stats(remote_bs)
         elif args["download"]:
             if not args["userdata"]:
                 raise ValueError("Invalid download source")
             scan_pbar = diff_pbar(label="Scanning blobs", quiet=quiet)
             xfer_pbar = lazy_pbar(csum_pbar(label="Downloading blobs", quiet=quiet))
-            n = copy_blobs(
+            stats = copy_blobs(
                 xfer_pbar(blobs_only_in_left(scan_pbar(ordered_merge_diff(remote_bs.blobs(), vol.bs.blobs())))),
-                remote_bs, vol.bs,
+                remote_bs, vol.bs, get_transfer_workers(args),
             )
-            print(f"Successfully downloaded: {n} blobs")
+            print(f"Successfully downloaded: {stats.blobs} blobs")
+            print(f"Transferred {stats.summary()}")
+            print_pool_stats(remote_bs)
         elif args[
             "check"
         ]:  # TODO what are the check semantics for API? Weird to look at etag.
@@ -1251,8 +1473,20 @@ def dbg_ui(argv: list[str], cwd: Path) -> int:
                 assert isinstance(remote_bs, S3Blobstore)
                 def obj_etag(obj: dict) -> str:
                     return obj['ETag'][1:-1]  # Strip quotes from etag, which is how s3 returns it.
+                multipart = [0]
+                compressed = [0]
                 def keep_corrupt(obj: dict) -> bool:
-                    return obj_etag(obj) != obj['blob']
+                    if "-" in obj_etag(obj):
+                        # A multipart upload's etag isn't the md5 of the object; S3 checked each part instead.
+                        multipart[0] += 1
+                        return False
+                    if obj_etag(obj) == obj['blob']:
+                        return False
+                    if remote_bs.blob_codec(obj['blob']) is not None:
+                        # A compressed blob's etag is the md5 of its compressed bytes.
+                        compressed[0] += 1
+                        return False
+                    return True
                 def obj_printr(obj: dict) -> None:
                     print(obj["blob"], obj_etag(obj))
                 num_corrupt_blobs = pipeline(
@@ -1261,6 +1495,10 @@ def dbg_ui(argv: list[str], cwd: Path) -> int:
                     fmap(identify(obj_printr)),
                     count,
                 )(remote_bs.blob_stats()())  # TODO blob_stats is s3 only.
+                if multipart[0]:
+                    print(f"Skipped {multipart[0]} multipart blobs, whose etags are not checksums")
+                if compressed[0]:
+                    print(f"Skipped {compressed[0]} compressed or chunked blobs, whose etags are of their stored bytes")
             elif args["api"] or args["file"]:
                 assert isinstance(remote_bs, (HttpBlobstore, FileBlobstore))
                 def blob_csum_tuple(blob: str) -> Tuple[str, str]:
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 from functools import partial as functools_partial
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
 from collections.abc import Callable, Sequence
 import functools
+import heapq
 import logging
+import multiprocessing
 import os
+import tempfile
 from farmfs.pipeline import pipeline, then  # noqa: F401,E402 - re-exported for callers
 import sys
 import time
@@ -14,7 +18,7 @@ from typing import (Any, Concatenate, ContextManager, IO, Dict,
                     Iterable, Iterator, List, Literal, Optional, ParamSpec, Protocol,
                     Tuple, TypeVar, TypeVarTuple, cast, overload)
 
-from concurrent.futures import ThreadPoolExecutor, wait, Future, FIRST_COMPLETED
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait, Future, FIRST_COMPLETED
 from concurrent.futures.thread import _threads_queues
 
 # Configure module-level logger
@@ -258,11 +262,24 @@ def pfmap(func: Callable[..., X], workers: int = 8):
     parallel_mapped.__name__ = "pmapped_" + func.__name__
     return parallel_mapped
 
+def process_executor(max_workers: int) -> Executor:
+    """
+    A pool of worker processes, for CPU bound work the GIL would serialise.
+    Workers are spawned rather than forked, so they don't inherit the parent's
+    threads or locks; functions run in them must be importable and picklable.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
 def pfmaplazy(
     func: Callable[[X], Y],
     workers: int = 8,
     buffer_size: int = 16,
+    executor: Callable[[int], Executor] = ThreadPoolExecutor,
 ) -> Callable[[Iterable[X]], Iterator[Y]]:
+    """
+    Map func over a stream with a pool of workers, yielding results in completion order.
+    executor makes the pool from a worker count; pass process_executor to run func in processes.
+    """
     if workers < 1:
         raise ValueError("workers must be at least 1")
     if buffer_size < 1:
@@ -273,7 +290,7 @@ def pfmaplazy(
     @functools.wraps(func)
     def parallel_mapped_lazy(collection: Iterable[X]) -> Iterator[Y]:
         # NOTE: This yields results in completion order.
-        with ThreadPoolExecutor(max_workers=workers) as ex:
+        with executor(workers) as ex:
             in_flight: set[Future[Y]] = set()
 
             def drain_one() -> Iterator[Y]:
@@ -301,6 +318,45 @@ def pfmaplazy(
     parallel_mapped_lazy.__name__ = "pfmaplazy_" + getattr(func, "__name__", "fn")
     return parallel_mapped_lazy
 
+def pfmaplazyordered(
+    func: Callable[[X], Y],
+    workers: int = 8,
+    buffer_size: int = 16,
+) -> Callable[[Iterable[X]], Iterator[Y]]:
+    """
+    Like pfmaplazy, but yields results in input order rather than completion order.
+    At most workers + buffer_size items are in flight, so a slow item at the head
+    of the queue stalls the producer instead of growing the buffer without bound.
+    """
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    if buffer_size < 1:
+        raise ValueError("buffer_size must be at least 1")
+
+    max_in_flight = workers + buffer_size
+
+    @functools.wraps(func)
+    def parallel_mapped_ordered(collection: Iterable[X]) -> Iterator[Y]:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            in_flight: deque[Future[Y]] = deque()
+            try:
+                for item in collection:
+                    in_flight.append(ex.submit(func, item))
+                    if len(in_flight) >= max_in_flight:
+                        yield in_flight.popleft().result()
+
+                while in_flight:
+                    yield in_flight.popleft().result()
+
+            except BaseException:
+                for fut in in_flight:
+                    fut.cancel()
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    parallel_mapped_ordered.__name__ = "pfmaplazyordered_" + getattr(func, "__name__", "fn")
+    return parallel_mapped_ordered
+
 def ffilter(func: Callable[[X], bool]) -> Callable[[Iterable[X]], Iterator[X]]:
     def filtered(collection: Iterable[X]) -> Iterator[X]:
         return filter(func, collection)
@@ -418,6 +474,90 @@ def uniq(ls: Iterable[X]) -> Iterator[X]:
             yield i
 
 
+def uniq_sorted[C: Comparable](ls: Iterable[C]) -> Iterator[C]:
+    """Like uniq, but for sorted input, so only the last item is remembered."""
+    prev: Optional[C] = None
+    started = False
+    for i in ls:
+        if started and i == prev:
+            continue
+        started = True
+        prev = i
+        yield i
+
+
+SPILL_RUN_SIZE = 500000
+
+
+def spill_sorted(
+        items: Iterable[str],
+        run_size: int = SPILL_RUN_SIZE,
+        tmp_dir: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Sort and deduplicate a stream of strings in bounded memory.
+    Items are sorted in runs of up to run_size, which are spilled to temporary
+    files in tmp_dir and merged as they are read back. Items must not contain newlines.
+    """
+    runs: List[IO[str]] = []
+    try:
+        it = iter(items)
+        while True:
+            chunk = list(islice(it, run_size))
+            # Whether the input ran out goes by what was read, before duplicates are dropped.
+            exhausted = len(chunk) < run_size
+            run = sorted(set(chunk))
+            del chunk
+            if exhausted and len(runs) == 0:
+                # Everything fit in one run, no need to touch the disk.
+                yield from run
+                return
+            if len(run) > 0:
+                fd = tempfile.TemporaryFile("w+", encoding="utf-8", dir=tmp_dir)
+                runs.append(fd)
+                fd.writelines(item + "\n" for item in run)
+                fd.seek(0)
+            del run
+            if exhausted:
+                break
+        readers = [(line[:-1] for line in run_fd) for run_fd in runs]
+        yield from uniq_sorted(heapq.merge(*readers))
+    finally:
+        for run_fd in runs:
+            run_fd.close()
+
+
+class RateLimit:
+    """
+    Token bucket pacing work to rate units per second, with up to a second's worth of burst.
+    acquire() may overdraw the bucket, so one item larger than the budget still goes
+    through; the caller then waits for the debt to be paid off.
+    """
+
+    def __init__(
+            self,
+            rate: float,
+            clock: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], None] = time.sleep,
+    ):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = rate
+        self._last = clock()
+
+    def acquire(self, amount: int) -> None:
+        """Take amount from the bucket, sleeping until the bucket is no longer in debt."""
+        now = self._clock()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            self._sleep(-self._tokens / self.rate)
+
+
 def irange(start: int, increment: int) -> Iterator[int]:
     while True:
         yield start
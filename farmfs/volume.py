@@ -1,21 +1,34 @@
+import threading
 from collections.abc import Callable
 from errno import ENOENT as NoSuchFile
+from errno import EXDEV
 from farmfs.keydb import BlobKeyDB, JsonKeyDB
 from farmfs.keydb import KeyDBWindow
-from farmfs.keydb import KeyDBFactory
+from farmfs.keydb import KeyDBFactory, KeyDBLike
 from farmfs.blobstore import FileBlobstore, ReverserFunction
+from farmfs.chunking import Manifest
+from farmfs.hashcache import HashCache, stat_key
+from farmfs.refindex import RefIndex
+from farmfs.scrub import ScrubIndex
+from farmfs.transfer import fetch_blobs
+from farmfs.snapformat import SnapshotKeyDB
 from farmfs.util import (
     partial,
+    consume,
     ingest,
+    egest,
     fmap,
     pipeline,
     ffilter,
     concat,
     uncurry,
-    uniq,
     jaccard_similarity,
+    ensure_sorted,
+    ordered_merge_diff,
+    spill_sorted,
+    SPILL_RUN_SIZE,
 )
-from farmfs.fs import ensure_symlink, Path, ROOT
+from farmfs.fs import ensure_symlink, Path
 from farmfs.fs import (
     ensure_absent,
     ensure_dir,
@@ -27,10 +40,21 @@ from farmfs.fs import (
     walk,
     walk_path
 )
-from farmfs.snapshot import TreeSnapshot, KeySnapshot, SnapDelta, Snapshot, SnapshotItem, SnapItemTypes
-from itertools import chain
+from farmfs.snapshot import (
+    TreeSnapshot,
+    TreeSnapshotIterator,
+    KeySnapshot,
+    SnapDelta,
+    Snapshot,
+    SnapshotItem,
+    SnapItemTypes,
+    PathKey,
+    path_key,
+)
+from hashlib import md5
+from itertools import batched, chain
 from json import loads
-from typing import Dict, Generator, Iterator, List, Optional, Tuple, TypedDict
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, TypedDict
 
 
 def _metadata_path(root: Path) -> Path:
@@ -46,6 +70,14 @@ def _tmp_path(root: Path) -> Path:
     return _metadata_path(root).join("tmp")
 
 
+def _blob_index_path(root: Path) -> Path:
+    return _metadata_path(root).join("blobindex")
+
+
+def _packs_path(root: Path) -> Path:
+    return _metadata_path(root).join("packs")
+
+
 def _snaps_path(root: Path) -> Path:
     return _metadata_path(root).join("snaps")
 
@@ -54,6 +86,18 @@ def _locks_path(root: Path) -> Path:
     return _metadata_path(root).join("locks")
 
 
+def _hash_cache_path(root: Path) -> Path:
+    return _metadata_path(root).join("hashcache.db")
+
+
+def _refs_path(root: Path) -> Path:
+    return _metadata_path(root).join("refs.db")
+
+
+def _scrub_path(root: Path) -> Path:
+    return _metadata_path(root).join("scrub.db")
+
+
 def mkfs(root: Path, udd: Path):
     assert isinstance(root, Path)
     assert isinstance(udd, Path)
@@ -64,7 +108,9 @@ def mkfs(root: Path, udd: Path):
     _tmp_path(root).mkdir()
     _locks_path(root).mkdir()
     udd.mkdir()
-    bs = FileBlobstore(udd, _tmp_path(root))
+    bs = FileBlobstore(udd, _tmp_path(root), pack_dir=_packs_path(root), index_dir=_blob_index_path(root))
+    # With no blobs there are no links to count, so the reference index starts out exact.
+    refs_exact = next(iter(bs.blobs()), None) is None
     blob_db = BlobKeyDB(_keys_path(root), Path(_tmp_path(root)), bs)
     json_db = JsonKeyDB(blob_db)
     # Make sure root key is removed.
@@ -73,7 +119,9 @@ def mkfs(root: Path, udd: Path):
     json_db.write("udd", str(udd), True)
     # TODO should I overwrite?
     json_db.write("status", {}, True)
-    FarmFSVolume(root)
+    vol = FarmFSVolume(root)
+    if refs_exact:
+        vol.refs.mark_built()
 
 
 def encode_volume(vol: "FarmFSVolume") -> str:
@@ -85,13 +133,15 @@ def decode_volume(vol: str, key: str) -> "FarmFSVolume":
 
 
 def encode_snapshot(snap: Snapshot) -> List[Dict]:
+    # Snapshots iterate in path order, so what we store is presorted.
     snap_items = iter(snap)
     return list(map(lambda x: x.get_dict(), snap_items))
 
 
 def decode_snapshot(reverser: ReverserFunction):
     def decoder(data: List[SnapItemTypes], key: str) -> KeySnapshot:
-        return KeySnapshot(data, key, reverser)
+        # Snapshots are written in path order, see encode_snapshot.
+        return KeySnapshot(data, key, reverser, presorted=True)
     return decoder
 
 class ImportResult(TypedDict):
@@ -101,8 +151,8 @@ class ImportResult(TypedDict):
 
 def validate_snapshot(key: str, snap: KeySnapshot) -> List[str]:
     errors = []
-    items = list(snap)
-    sorted_items = sorted(items)
+    items = list(snap.items())
+    sorted_items = sorted(items, key=SnapshotItem.sort_key)
     if items != sorted_items:
         for i, (actual, expected) in enumerate(zip(items, sorted_items)):
             if actual != expected:
@@ -113,6 +163,50 @@ def validate_snapshot(key: str, snap: KeySnapshot) -> List[str]:
     return errors
 
 
+class RefCountedSnapDB(KeyDBFactory[KeySnapshot]):
+    """
+    Snapshot store which keeps the volume's reference index up to date.
+    A snapshot's links are counted before it is written and uncounted after it is
+    replaced or deleted.
+    """
+
+    def __init__(
+            self,
+            keydb: KeyDBLike,
+            encoder: Callable[[KeySnapshot], Any],
+            decoder: Callable[[Any, str], KeySnapshot],
+            validate: Callable[[str, KeySnapshot], List[str]],
+            refs: Callable[[], RefIndex],
+    ):
+        super().__init__(keydb, encoder, decoder, validate=validate)
+        self.refs = refs
+
+    def _links(self, key: str) -> List[str]:
+        """The checksums a stored snapshot links to, or nothing if there is no such snapshot."""
+        try:
+            snap = self.read(key)
+        except FileNotFoundError:
+            return []
+        return [item.csum() for item in snap.items() if item.is_link()]
+
+    def write(self, key: str, value: KeySnapshot, overwrite: bool) -> None:
+        encoded = self.encoder(value)
+        added = [item["csum"] for item in encoded if item["type"] == LINK]
+        replaced = self._links(key)
+        self.refs().adjust(added, 1)
+        try:
+            self.keydb.write(key, encoded, overwrite)
+        except BaseException:
+            self.refs().adjust(added, -1)
+            raise
+        self.refs().adjust(replaced, -1)
+
+    def delete(self, key: str) -> None:
+        removed = self._links(key)
+        self.keydb.delete(key)
+        self.refs().adjust(removed, -1)
+
+
 def validate_remote(key: str, vol: "FarmFSVolume") -> List[str]:
     errors = []
     root = str(vol.root)
@@ -128,20 +222,23 @@ class FarmFSVolume:
         self.mdd = _metadata_path(root)
         self.tmp_dir = Path(_tmp_path(root))  # TODO Hard coded while bs is known single volume.
         assert self.tmp_dir.isdir()
+        self._refs: Optional[RefIndex] = None
+        self._refs_lock = threading.Lock()
         # Bootstrap: read udd key (file-backed, no blobstore yet)
         keydb_bootstrap = BlobKeyDB(_keys_path(root), self.tmp_dir, blobstore=None)
         self.udd = Path(loads(keydb_bootstrap.read("udd")))
         assert self.udd.isdir()
-        self.bs = FileBlobstore(self.udd, self.tmp_dir)
+        self.bs = FileBlobstore(self.udd, self.tmp_dir, pack_dir=_packs_path(root), index_dir=_blob_index_path(root))
         snap_decoder = decode_snapshot(self.bs.reverser)
         self.blob_db: BlobKeyDB = BlobKeyDB(_keys_path(root), self.tmp_dir, self.bs)
         json_db = JsonKeyDB(self.blob_db)
         self.keydb: JsonKeyDB = json_db  # vol.keydb stays as the JSON layer for existing callers
-        self.snapdb: KeyDBFactory[KeySnapshot] = KeyDBFactory(
-            KeyDBWindow("snaps", json_db),
+        self.snapdb: KeyDBFactory[KeySnapshot] = RefCountedSnapDB(
+            KeyDBWindow("snaps", SnapshotKeyDB(self.blob_db)),
             encode_snapshot,
             snap_decoder,
             validate=validate_snapshot,
+            refs=lambda: self.refs,
         )
         self.remotedb: KeyDBFactory[FarmFSVolume] = KeyDBFactory(
             KeyDBWindow("remotes", json_db),
@@ -164,6 +261,8 @@ class FarmFSVolume:
             else:
                 raise e
         self.is_ignored = ignored_path_checker(ignored_patterns)
+        # Cached directory digests are only good under the same ignore rules.
+        self.ignore_scope = md5(egest("\n".join(ignored_patterns))).hexdigest()
 
     def thawed(self, path: Path) -> Iterator[Path]:
         """Yield set of files not backed by FarmFS under path"""
@@ -185,24 +284,123 @@ class FarmFSVolume:
         """
         assert isinstance(path, Path)
         assert self.root in path.parents()
-        ensure_symlink(path, self.bs.blob_path(blob))
+        self._counted(path, [blob], partial(ensure_symlink, path, self.bs.materialise(blob)))
+
+    def remove(self, path: Path) -> None:
+        """Remove path, and everything beneath it, from the tree."""
+        self._counted(path, [], partial(ensure_absent, path))
+
+    def mkdir(self, path: Path) -> None:
+        """Make path a directory, replacing a link or file that was there."""
+        if path.isdir():
+            return
+        self._counted(path, [], partial(ensure_dir, path))
 
-    def freeze(self, path: Path):
+    def _counted(self, path: Path, added: List[str], change: Callable[[], None]) -> None:
+        """
+        Apply change, which replaces whatever is at path, to the tree.
+        The reference index counts the blobs added before the change and drops the
+        ones it removes after, so a crash part way through only leaves counts too high.
+        """
+        removed = self.tree_links(path)
+        self.refs.adjust(added, 1)
+        change()
+        self.refs.adjust(removed, -1)
+
+    def tree_links(self, path: Path) -> List[str]:
+        """The blobs linked to at or beneath path in the tree, once per link."""
+        if not path.exists():
+            return []  # ensure_absent leaves dangling links alone, so they stay counted.
+        return list(self._link_csums(path))
+
+    def _link_csums(self, path: Path) -> Iterator[str]:
+        for link in self.frozen(path):
+            try:
+                yield self.bs.reverser(link.readlinkat())
+            except ValueError:
+                pass  # Not a link into our blobstore.
+
+    def evictable_blobs(self) -> List[str]:
+        """
+        The chunked blobs with a plain copy which neither the working tree nor the
+        keydb links to. Evicting those copies leaves just their chunks.
+        """
+        cached = [blob for blob in self.bs.chunked_blobs() if self.bs.blob_path(blob).exists()]
+        if not cached:
+            return []
+        linked = set(self._link_csums(self.root))
+        linked.update(self.blob_db.live_blobs())
+        return [blob for blob in cached if blob not in linked]
+
+    def pack_blobs(self, threshold: Optional[int] = None) -> List[str]:
+        """
+        Move the small blobs neither the working tree nor the keydb links to into packs.
+        Returns the blobs packed. See FileBlobstore.pack.
+        """
+        linked = set(self._link_csums(self.root))
+        linked.update(self.blob_db.live_blobs())
+        return self.bs.pack((blob for blob in self.bs.blobs() if blob not in linked), threshold)
+
+    def remove_blob(self, blob: str) -> None:
+        """Delete an unused blob from the blobstore and the reference index."""
+        self.bs.delete_blob(blob)
+        self.refs.forget([blob])
+
+    @property
+    def refs(self) -> RefIndex:
+        """The volume's blob reference counts, opened on first use."""
+        with self._refs_lock:
+            if self._refs is None:
+                self._refs = RefIndex(_refs_path(self.root))
+            return self._refs
+
+    def hash_cache(self) -> HashCache:
+        """Open the volume's persistent checksum cache."""
+        return HashCache(_hash_cache_path(self.root))
+
+    def scrub_index(self) -> ScrubIndex:
+        """Open the record of when each blob was last verified by a scrub."""
+        return ScrubIndex(_scrub_path(self.root))
+
+    def freeze(self, path: Path, cache: Optional[HashCache] = None):
         assert isinstance(path, Path)
         assert isinstance(self.udd, Path)
-        csum = path.checksum()
-        # TODO doesn't work on multi-volume blobstores.
-        # TODO we should rework so we try import_via_link then import_via_fd.
-        duplicate = self.bs.import_via_link(path, csum)
+        if path.stat().st_dev != self.udd.stat().st_dev:
+            # A hard link can't cross devices, so copy the file in, hashing it on the way.
+            before = path.stat()
+            known = None if cache is None else cache.lookup(before)
+            csum, duplicate = self.bs.import_via_copy(path, known)
+            if cache is not None and known is None and stat_key(path.stat()) == stat_key(before):
+                cache.record(before, csum)
+        else:
+            csum = path.checksum() if cache is None else cache.checksum(path)
+            # TODO doesn't work on multi-volume blobstores.
+            try:
+                duplicate = self.bs.import_via_link(path, csum)
+            except OSError as e:
+                if e.errno != EXDEV:
+                    raise
+                # The same device, but on another mount.
+                csum, duplicate = self.bs.import_via_copy(path, csum)
         # Note ensure_symlink is not atomic, which should be fine for volume.
         self.link(path, csum)
         return ImportResult(path=path, csum=csum, was_dup=duplicate)
 
-    def thaw(self, user_path: Path) -> Path:
+    def thaw(self, user_path: Path, cache: Optional[HashCache] = None) -> Path:
         assert isinstance(user_path, Path)
         csum_path = user_path.readlinkat()
         # TODO using bs.tmp_dir. When we allow alternate topology for bs, this will break.
         csum_path.copy_file(user_path, self.bs.tmp_dir)
+        try:
+            csum = self.bs.reverser(csum_path)
+        except ValueError:
+            return user_path  # Link didn't point into the blobstore, nothing to remember.
+        self.refs.adjust([csum], -1)
+        if cache is not None:
+            # Carry the blob's mtime over to the copy, so a later write to the
+            # file always moves its mtime and invalidates the cached checksum.
+            user_path.utime_from(csum_path)
+            cache.record(user_path.stat(), csum)
         return user_path
 
     def repair_link(self, path: Path) -> Optional[Path]:
@@ -212,7 +410,7 @@ class FarmFSVolume:
         if oldlink.isfile():
             return None
         csum = self.bs.reverser(oldlink)
-        newlink = self.bs.blob_path(csum)
+        newlink = self.bs.materialise(csum)
         if not newlink.isfile():
             raise ValueError("%s is missing, cannot relink" % newlink)
         else:
@@ -248,11 +446,13 @@ class FarmFSVolume:
         """Returns an iterator which lists all SnapshotItems from all local snaps + the working tree"""
         return pipeline(concat)(self.trees())
 
-    def tree(self) -> Snapshot:
+    def tree(self, cache: Optional[HashCache] = None) -> Snapshot:
         """
         Get a snap object which represents the tree of the volume.
+        With a cache, unchanged directories carry their digests so diffs can skip them.
         """
-        tree_snap = TreeSnapshot(self.root, self.is_ignored, reverser=self.bs.reverser)
+        tree_snap = TreeSnapshot(self.root, self.is_ignored, reverser=self.bs.reverser,
+                                 cache=cache, scope=self.ignore_scope)
         return tree_snap
 
     def userdata_csums(self) -> Generator[str, None, None]:
@@ -261,7 +461,7 @@ class FarmFSVolume:
         """
         # TODO this function is a duplicate of self.bs.blobs()
         # We populate counts with all hash paths from the userdata directory.
-        for path, type_ in walk(self.udd):
+        for path, type_ in self.bs.walk():
             assert isinstance(path, Path)
             if type_ == FILE:
                 yield self.bs.reverser(path)
@@ -270,25 +470,81 @@ class FarmFSVolume:
             else:
                 raise ValueError("%s is f invalid type %s" % (path, type_))
 
-    def unused_blobs(self, items: Iterator[SnapshotItem]) -> set[str]:
-        """Returns the set of blobs not referenced in items"""
+    def unused_blobs(self, items: Iterator[SnapshotItem], run_size: Optional[int] = None) -> Iterator[str]:
+        """
+        Yields the blobs not referenced in items or the keydb, in sorted order.
+        The chunks of a referenced chunked blob count as referenced too.
+        The references are sorted by spilling runs of run_size (SPILL_RUN_SIZE by
+        default) to disk, then merged against the sorted blobstore listing, so memory
+        stays bounded however many blobs there are.
+        """
+        if run_size is None:
+            run_size = SPILL_RUN_SIZE
         def is_link(item: SnapshotItem) -> bool:
             return item.is_link()
         select_links = ffilter(is_link)
         def csum(item: SnapshotItem) -> str:
             return item.csum()
         get_csums = fmap(csum)
-        referenced_hashes = set(pipeline(select_links, get_csums, uniq)(items))
-        keydb_hashes = set(self.blob_db.live_blobs())
-        udd_hashes = set(self.userdata_csums())
-        missing_data = referenced_hashes - udd_hashes
-        assert len(missing_data) == 0, "Missing %s\nReferenced %s\nExisting %s\n" % (
-            missing_data,
-            referenced_hashes,
-            udd_hashes,
-        )
-        orphaned_csums = udd_hashes - referenced_hashes - keydb_hashes
-        return orphaned_csums
+        tmp_dir = str(_tmp_path(self.root))
+        referenced_hashes = spill_sorted(self._with_chunks(pipeline(select_links, get_csums)(items)), run_size, tmp_dir)
+        udd_hashes = ensure_sorted(self.bs.blobs())
+        def unreferenced() -> Iterator[str]:
+            for side, blob in ordered_merge_diff(udd_hashes, referenced_hashes):
+                assert side != "right", "Missing %s, referenced but not in the blobstore" % blob
+                if side == "left":
+                    yield blob
+        keydb_hashes = spill_sorted(self._with_chunks(self.blob_db.live_blobs()), run_size, tmp_dir)
+        orphans = (blob for side, blob in ordered_merge_diff(unreferenced(), keydb_hashes) if side == "left")
+        # Spilling reads every source to the end before the first orphan comes out,
+        # so a missing blob stops gc before it deletes anything.
+        return spill_sorted(orphans, run_size, tmp_dir)
+
+    def _with_chunks(self, blobs: Iterable[str]) -> Iterator[str]:
+        """Yields blobs, each chunked one followed by its chunks the first time it comes up."""
+        chunked = set(self.bs.chunked_blobs())
+        for blob in blobs:
+            yield blob
+            if blob in chunked:
+                chunked.discard(blob)
+                manifest = self.bs.manifest(blob)
+                assert manifest is not None
+                yield from (chunk for chunk, _ in manifest)
+
+    def unused_blobs_incremental(self) -> Iterator[str]:
+        """
+        Yields the blobs the reference index counts as unused, in sorted order.
+        Only those candidates are checked: against the keydb, and against the working
+        tree, where links can appear without farmfs counting them. Snapshots aren't
+        reread, since every change to them is counted.
+        Chunks aren't counted, so those of an unused chunked blob are candidates too,
+        and a chunk stays while any chunked blob which stays has it in its manifest.
+        Raises ValueError if the index has not been built.
+        """
+        refs = self.refs
+        if not refs.built():
+            raise ValueError("The reference index has not been built. Run 'farmfs fsck --refcounts --fix'.")
+        candidates = refs.unused()
+        if len(candidates) == 0:
+            return iter([])
+        gone = [blob for blob in candidates if not self.bs.exists(blob)]
+        refs.forget(gone)
+        manifests: Dict[str, Manifest] = {}
+        for blob in self.bs.chunked_blobs():
+            manifest = self.bs.manifest(blob)
+            assert manifest is not None
+            manifests[blob] = manifest
+        candidate_set = set(candidates)
+        candidate_set.update(
+            chunk for blob in candidates if blob in manifests for chunk, _ in manifests[blob] if refs.count(chunk) <= 0)
+        keep = set(gone)
+        keep.update(blob for blob in self.blob_db.live_blobs() if blob in candidate_set)
+        keep.update(blob for blob in self._link_csums(self.root) if blob in candidate_set)
+        doomed = set(blob for blob in candidates if blob not in keep)
+        for blob, manifest in manifests.items():
+            if blob not in doomed:
+                keep.update(chunk for chunk, _ in manifest if chunk in candidate_set)
+        return iter(sorted(candidate_set - keep))
 
     def similarity(self, dir_a: Path, dir_b: Path) -> Tuple[int, int, int, float]:
         """
@@ -321,6 +577,28 @@ def tree_patcher(local_vol: FarmFSVolume, remote_vol: FarmFSVolume):
     return fmap(partial(tree_patch, local_vol, remote_vol))
 
 
+# Deltas read ahead of the tree ops, so the blobs they link to are fetched together.
+FETCH_BATCH = 1024
+
+
+def tree_prefetcher(
+        local_vol: FarmFSVolume,
+        remote_vol: FarmFSVolume,
+        workers: Optional[int] = None,
+) -> Callable[[Iterable[SnapDelta]], Iterator[SnapDelta]]:
+    """
+    Passes deltas through FETCH_BATCH at a time, first copying the blobs each batch
+    links to from remote_vol, workers at once. The blob ops tree_patch makes for
+    them then find the blobs already present, and the tree ops still apply in order.
+    """
+    def prefetched(deltas: Iterable[SnapDelta]) -> Iterator[SnapDelta]:
+        for batch in batched(deltas, FETCH_BATCH):
+            links = (delta.csum for delta in batch if delta.mode == SnapDelta.LINK and delta.csum is not None)
+            consume(fetch_blobs(local_vol.bs, remote_vol.bs, links, workers))
+            yield from batch
+    return prefetched
+
+
 def noop():
     pass
 
@@ -344,9 +622,9 @@ def tree_patch(
     csum = delta.csum
 
     if delta.mode == delta.REMOVED:
-        return (noop, partial(ensure_absent, path), ("Apply Removing %s", path))
+        return (noop, partial(local_vol.remove, path), ("Apply Removing %s", path))
     elif delta.mode == delta.DIR:
-        return (noop, partial(ensure_dir, path), ("Apply mkdir %s", path))
+        return (noop, partial(local_vol.mkdir, path), ("Apply mkdir %s", path))
     elif delta.mode == delta.LINK:
         assert csum is not None, "Excpected csum for link"
         _csum: str = csum
@@ -354,7 +632,7 @@ def tree_patch(
         def blob_op(csum: str = _csum) -> None:
             with local_vol.bs.session() as sess:
                 sess.import_via_fd(remote_read_handle_fn, csum)
-        tree_op = lambda: ensure_symlink(path, local_vol.bs.blob_path(csum))
+        tree_op = lambda: local_vol.link(path, csum)
         tree_desc = ("Apply mklink %s -> " + csum, path)
         return (blob_op, tree_op, tree_desc)
     else:
@@ -362,7 +640,7 @@ def tree_patch(
 
 
 def next_valid_snap_item(
-    item_iter: Generator[SnapshotItem, None, None], last_delta: Optional[SnapDelta]
+    item_iter: Iterator[SnapshotItem], last_delta: Optional[SnapDelta]
 ) -> Optional[SnapshotItem]:
     """
     Get the next valid snapshot item from the iterator.
@@ -376,18 +654,32 @@ def next_valid_snap_item(
         # If the last delta was not a removal, we can safely return the next item.
         return next(item_iter, None)
     # We last processed a REMOVE, lets comsume children if it was a dir.
-    removed_path = last_delta.path(ROOT)
+    return next_outside(item_iter, path_key(last_delta._pathStr))
+
+
+def next_outside(item_iter: Iterator[SnapshotItem], key: PathKey) -> Optional[SnapshotItem]:
+    """Get the next item from the iterator which isn't beneath key."""
+    depth = len(key)
     while True:
         next_item = next(item_iter, None)
         if next_item is None:
             return None
-        item_path = next_item.to_path(ROOT)
-        if removed_path in list(item_path.parents()):
+        if next_item.sort_key()[:depth] == key:
             continue
         else:
             return next_item
 
 
+def skip_subtree(item_iter: Iterator[SnapshotItem], item: SnapshotItem) -> Optional[SnapshotItem]:
+    """
+    Skip the contents of item, a directory with a digest which item_iter just returned.
+    Trees aren't walked beneath it at all.
+    """
+    if isinstance(item_iter, TreeSnapshotIterator):
+        item_iter.prune()
+    return next_outside(item_iter, item.sort_key())
+
+
 # TODO yields lots of SnapDelta. Maybe in wrong file?
 def _tree_diff(tree: Snapshot, snap: Snapshot) -> Generator[SnapDelta, None, None]:
     tree_parts = iter(tree)
@@ -397,19 +689,26 @@ def _tree_diff(tree: Snapshot, snap: Snapshot) -> Generator[SnapDelta, None, Non
     while t is not None or s is not None:
         if t is not None and s is not None:
             # We have components from both sides!
-            if t < s:
+            t_key = t.sort_key()
+            s_key = s.sort_key()
+            if t_key < s_key:
                 # The tree component is not present in the snap. Delete it.
                 sd = SnapDelta(t.pathStr(), SnapDelta.REMOVED)
                 t = next_valid_snap_item(tree_parts, sd)
                 yield sd
-            elif s < t:
+            elif s_key < t_key:
                 # The snap component is not part of the tree. Create it
                 yield SnapDelta(*s.get_tuple())
                 s = next(snap_parts, None)
-            elif t == s:
+            elif t_key == s_key:
                 if t.is_dir() and s.is_dir():
-                    t = next(tree_parts, None)
-                    s = next(snap_parts, None)
+                    if t.digest() is not None and t.digest() == s.digest():
+                        # The same digest means the same contents.
+                        t = skip_subtree(tree_parts, t)
+                        s = skip_subtree(snap_parts, s)
+                    else:
+                        t = next(tree_parts, None)
+                        s = next(snap_parts, None)
                 elif t.is_link() and s.is_link():
                     if t.csum() == s.csum():
                         t = next(tree_parts, None)
@@ -0,0 +1,129 @@
+from __future__ import print_function
+import io
+import itertools
+import os
+import random
+import threading
+import time
+from hashlib import md5
+from tabulate import tabulate
+import pytest
+from werkzeug.serving import make_server
+from farmfs.api import get_app
+from farmfs.apiserver import ApiServer
+from farmfs.blobstore import DEFAULT_BULK_BATCH, HttpBlobstore
+from farmfs.fs import Path
+from farmfs.volume import mkfs
+
+# FARMFS_PERF_API_BLOBS blobs of FARMFS_PERF_API_BLOB_SIZE bytes are served, each
+# client thread making FARMFS_PERF_API_REQUESTS requests.
+NUM_BLOBS = int(os.environ.get("FARMFS_PERF_API_BLOBS", "64"))
+BLOB_SIZE = int(os.environ.get("FARMFS_PERF_API_BLOB_SIZE", str(1024 * 1024)))
+REQUESTS = int(os.environ.get("FARMFS_PERF_API_REQUESTS", "50"))
+CLIENTS = [1, 8, 32]
+
+
+@pytest.fixture(scope="module")
+def volume(tmp_path_factory):
+    root = Path(str(tmp_path_factory.mktemp("api")))
+    mkfs(root, root.join(".farmfs").join("userdata"))
+    return root
+
+
+def serve(kind, app):
+    if kind == "dev":
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+    else:
+        server = ApiServer("127.0.0.1", 0, app, threads=max(CLIENTS))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def load(port, clients, op, blobs):
+    """Run clients threads each making REQUESTS op requests. Returns seconds taken and bytes moved."""
+    bs = HttpBlobstore("http://127.0.0.1:%d" % port, conn_timeout=60)
+    moved = [0] * clients
+
+    def client(i):
+        rng = random.Random(i)
+        with bs.session() as sess:
+            for n in range(REQUESTS):
+                if op == "GET":
+                    with sess.read_handle(rng.choice(blobs)) as fd:
+                        while chunk := fd.read(1024 * 1024):
+                            moved[i] += len(chunk)
+                else:
+                    payload = os.urandom(BLOB_SIZE)
+                    sess.import_via_fd(lambda: io.BytesIO(payload), md5(payload).hexdigest())
+                    moved[i] += len(payload)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, sum(moved)
+
+
+@pytest.mark.parametrize("op", ["GET", "POST"])
+def test_api_load(volume, op):
+    app = get_app({"<root>": volume})
+    blobs = []
+    with app.test_client() as client:
+        for _ in range(NUM_BLOBS):
+            payload = os.urandom(BLOB_SIZE)
+            blob = md5(payload).hexdigest()
+            client.post("/bs", data=payload, query_string={"blob": blob})
+            blobs.append(blob)
+    table = []
+    for kind in ["dev", "production"]:
+        server = serve(kind, app)
+        try:
+            for clients in CLIENTS:
+                elapsed, moved = load(server.server_port, clients, op, blobs)
+                requests = clients * REQUESTS
+                table.append((kind, clients, requests, elapsed, "%.0f" % (requests / elapsed), "%.1f" % (moved / elapsed / 2**20)))
+        finally:
+            server.shutdown()
+            server.server_close()
+    print()
+    print("%s of %d byte blobs" % (op, BLOB_SIZE))
+    print(tabulate(table, headers=["server", "clients", "requests", "time", "requests/s", "MB/s"]))
+
+
+@pytest.mark.parametrize("size", [1024, 64 * 1024])
+def test_api_bulk(volume, size):
+    app = get_app({"<root>": volume})
+    # The bulk uploads get payloads of their own, so they aren't all duplicates.
+    payloads, bulk_payloads = ([os.urandom(size) for _ in range(NUM_BLOBS * 16)] for _ in range(2))
+    blobs = [md5(p).hexdigest() for p in payloads]
+    server = serve("production", app)
+    try:
+        bs = HttpBlobstore("http://127.0.0.1:%d" % server.server_port, conn_timeout=60)
+        table = []
+        with bs.session() as sess:
+            start = time.perf_counter()
+            for blob, payload in zip(blobs, payloads):
+                sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+            table.append(("POST each", time.perf_counter() - start))
+            start = time.perf_counter()
+            for blob in blobs:
+                with sess.read_handle(blob) as fd:
+                    fd.read()
+            table.append(("GET each", time.perf_counter() - start))
+            start = time.perf_counter()
+            for batch in itertools.batched(bulk_payloads, DEFAULT_BULK_BATCH):
+                sess.import_many([(md5(p).hexdigest(), len(p), lambda p=p: io.BytesIO(p)) for p in batch])
+            table.append(("bulk POST", time.perf_counter() - start))
+            start = time.perf_counter()
+            for batch in itertools.batched(blobs, DEFAULT_BULK_BATCH):
+                for _, frame in sess.read_many(batch):
+                    frame.read()
+            table.append(("bulk read", time.perf_counter() - start))
+    finally:
+        server.shutdown()
+        server.server_close()
+    print()
+    print("%d blobs of %d bytes" % (len(blobs), size))
+    print(tabulate([(op, elapsed, "%.0f" % (len(blobs) / elapsed)) for op, elapsed in table], headers=["op", "time", "blobs/s"]))
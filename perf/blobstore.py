@@ -0,0 +1,82 @@
+from __future__ import print_function
+import os
+import time
+import timeit
+from contextlib import contextmanager
+from hashlib import md5
+from tabulate import tabulate
+import pytest
+import farmfs.fs as fs
+from farmfs.fs import Path
+from farmfs.blobstore import FileBlobstore
+from farmfs.util import consume
+
+# Building the store dominates the runtime of these cases; FARMFS_PERF_BLOBS
+# shrinks it for a quick run.
+NUM_BLOBS = int(os.environ.get("FARMFS_PERF_BLOBS", "1000000"))
+
+
+def build_store(root, num_blobs):
+    """Lay out num_blobs empty blobs in the checksum fanout without hashing content."""
+    for i in range(num_blobs):
+        csum = md5(str(i).encode()).hexdigest()
+        parent = os.path.join(root._path, csum[0:3], csum[3:6], csum[6:9])
+        os.makedirs(parent, exist_ok=True)
+        open(os.path.join(parent, csum[9:]), "w").close()
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    tmp = Path(str(tmp_path_factory.mktemp("blobstore")))
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    build_store(ud, NUM_BLOBS)
+    return ud, scratch
+
+
+@contextmanager
+def directory_latency(seconds):
+    """Delay every directory listing, approximating a remote filesystem like NFS."""
+    names = ("listdir", "scandir")
+    originals = {name: getattr(fs, name) for name in names}
+
+    def slow(fn):
+        def wrapped(*args, **kwargs):
+            time.sleep(seconds)
+            return fn(*args, **kwargs)
+        return wrapped
+
+    for name, fn in originals.items():
+        setattr(fs, name, slow(fn))
+    try:
+        yield
+    finally:
+        for name, fn in originals.items():
+            setattr(fs, name, fn)
+
+
+def compare_workers(ud, scratch, workers, number):
+    table = []
+    for w in workers:
+        bs = FileBlobstore(ud, scratch, list_workers=w)
+        time = timeit.timeit(lambda: consume(bs.blobs()), number=number)
+        table.append((w, time, NUM_BLOBS * number / time))
+    lowest = min(row[1] for row in table)
+    print()
+    print(tabulate(
+        [(w, t, "%.0f" % rate, "%.2f" % (t / lowest)) for (w, t, rate) in table],
+        headers=["list_workers", "time", "blobs/s", "scale"],
+    ))
+
+
+def test_blobs_local(store):
+    ud, scratch = store
+    compare_workers(ud, scratch, [1, 2, 4, 8, 16], number=1)
+
+
+def test_blobs_remote_latency(store):
+    ud, scratch = store
+    with directory_latency(0.0005):
+        compare_workers(ud, scratch, [1, 4, 16, 64], number=1)
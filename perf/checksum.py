@@ -0,0 +1,52 @@
+from __future__ import print_function
+import io
+import os
+import timeit
+from hashlib import md5
+from tabulate import tabulate
+import pytest
+from farmfs.fs import Path
+from farmfs.blobstore import FileBlobstore
+from farmfs.util import consume
+
+# FARMFS_PERF_CHECKSUM_MB sizes the synthetic blobstore; it should exceed the page
+# cache to measure the disk rather than memory bandwidth.
+TOTAL_MB = int(os.environ.get("FARMFS_PERF_CHECKSUM_MB", "512"))
+BLOB_SIZE = int(os.environ.get("FARMFS_PERF_CHECKSUM_BLOB_SIZE", str(4 * 1024 * 1024)))
+WORKERS = [1, 2, 4, 8, 16, 32]
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    tmp = Path(str(tmp_path_factory.mktemp("checksum")))
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(ud, scratch)
+    with bs.session() as sess:
+        for _ in range(TOTAL_MB * 1024 * 1024 // BLOB_SIZE):
+            payload = os.urandom(BLOB_SIZE)
+            sess.import_via_fd(lambda: io.BytesIO(payload), md5(payload).hexdigest())
+    return bs
+
+
+@pytest.mark.parametrize("read_size,use_mmap", [
+    (64 * 1024, False),
+    (1024 * 1024, False),
+    (8 * 1024 * 1024, False),
+    (1024 * 1024, True),
+])
+def test_blob_checksums(store, read_size, use_mmap):
+    blobs = list(store.blobs())
+    megabytes = len(blobs) * BLOB_SIZE / (1024 * 1024)
+    table = []
+    for engine in ["threads", "processes"]:
+        for workers in WORKERS:
+            if workers > (os.cpu_count() or 1) * 2:
+                continue
+            time = timeit.timeit(lambda: consume(store.blob_checksums(blobs, workers, engine, read_size, use_mmap)), number=1)
+            table.append((engine, workers, time, "%.0f" % (megabytes / time)))
+    print()
+    print("read size %d, mmap %s, %d blobs" % (read_size, use_mmap, len(blobs)))
+    print(tabulate(table, headers=["engine", "workers", "time", "MB/s"]))
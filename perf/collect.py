@@ -0,0 +1,33 @@
+from __future__ import print_function
+import os
+import timeit
+import tracemalloc
+from hashlib import md5
+from tabulate import tabulate
+from farmfs.util import spill_sorted
+
+# FARMFS_PERF_GC_REFS scales the reference stream up towards a real volume.
+NUM_REFS = int(os.environ.get("FARMFS_PERF_GC_REFS", "1000000"))
+
+
+def refs(n):
+    """n snapshot references to n // 2 distinct blobs, in no particular order."""
+    return (md5(str(i % (n // 2)).encode()).hexdigest() for i in range(n))
+
+
+def test_gc_reference_sort(tmp_path):
+    table = []
+    sorters = [("set", None)] + [("spill", run_size) for run_size in [100000, 500000]]
+    for name, run_size in sorters:
+        def run():
+            if run_size is None:
+                return sum(1 for _ in sorted(set(refs(NUM_REFS))))
+            return sum(1 for _ in spill_sorted(refs(NUM_REFS), run_size, str(tmp_path)))
+        tracemalloc.start()
+        assert run() == NUM_REFS // 2
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        time = timeit.timeit(run, number=1)
+        table.append((name, run_size, time, "%.1f" % (peak / 2**20)))
+    print()
+    print(tabulate(table, headers=["sort", "run size", "time", "peak MB"]))
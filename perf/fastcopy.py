@@ -0,0 +1,39 @@
+import os
+import timeit
+from tabulate import tabulate
+import pytest
+from farmfs.fs import COPY_METHODS, Path, fastcopy
+
+# FARMFS_PERF_COPY_MB sizes the file copied. Set FARMFS_PERF_COPY_DIR to copy onto
+# another filesystem, where reflinks can't be used.
+SIZE_MB = int(os.environ.get("FARMFS_PERF_COPY_MB", "256"))
+COPY_DIR = os.environ.get("FARMFS_PERF_COPY_DIR")
+
+
+@pytest.fixture(scope="module")
+def src(tmp_path_factory):
+    tmp = Path(str(tmp_path_factory.mktemp("copy")))
+    src = tmp.join("src")
+    with src.open("wb") as fd:
+        for _ in range(SIZE_MB):
+            fd.write(os.urandom(1024 * 1024))
+    return src
+
+
+def test_copy_methods(src, tmp_path):
+    dst_dir = Path(COPY_DIR) if COPY_DIR else Path(str(tmp_path))
+    dst = dst_dir.join("dst")
+    table = []
+    for method in COPY_METHODS:
+        used = []
+
+        def copy():
+            with src.open("rb") as s, dst.open("wb") as d:
+                used.append(fastcopy(s, d, [method]))
+        time = timeit.timeit(copy, number=1)
+        assert dst.checksum() == src.checksum()
+        dst.unlink()
+        table.append((method, used[0], time, "%.0f" % (SIZE_MB / time)))
+    print()
+    print("%d MB to %s" % (SIZE_MB, dst_dir))
+    print(tabulate(table, headers=["method", "used", "time", "MB/s"]))
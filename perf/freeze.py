@@ -0,0 +1,68 @@
+from __future__ import print_function
+import os
+import time
+from contextlib import contextmanager, redirect_stdout
+from io import StringIO
+from tabulate import tabulate
+from farmfs.fs import Path
+from farmfs.ui import farmfs_ui
+from farmfs.volume import mkfs
+
+
+def build_volume(root, num_files, size):
+    """A fresh volume holding num_files distinct files of size bytes."""
+    root.mkdir()
+    mkfs(root, root.join(".farmfs").join("userdata"))
+    for i in range(num_files):
+        d = root.join("d%02d" % (i % 16))
+        d.mkdir()
+        with d.join("f%05d" % i).open("wb") as fd:
+            fd.write(os.urandom(size))
+    return root
+
+
+@contextmanager
+def read_latency(seconds):
+    """Delay every file hash, approximating a seek on a spinning or remote disk."""
+    original = Path.checksum
+
+    def slow(self):
+        time.sleep(seconds)
+        return original(self)
+
+    Path.checksum = slow
+    try:
+        yield
+    finally:
+        Path.checksum = original
+
+
+def compare_workers(tmp, num_files, size, workers):
+    table = []
+    for w in workers:
+        vol = build_volume(tmp.join("w%d" % w), num_files, size)
+        start = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            r = farmfs_ui(["freeze", "--no-cache", "--workers", str(w)], vol)
+        elapsed = time.perf_counter() - start
+        assert r == 0
+        table.append((w, elapsed, num_files * size / elapsed / 2**20))
+    lowest = min(row[1] for row in table)
+    print()
+    print(tabulate(
+        [(w, t, "%.1f" % rate, "%.2f" % (t / lowest)) for (w, t, rate) in table],
+        headers=["workers", "time", "MB/s", "scale"],
+    ))
+
+
+def test_freeze_small_files(tmp_path):
+    compare_workers(Path(str(tmp_path)), num_files=4000, size=4096, workers=[1, 2, 4, 8])
+
+
+def test_freeze_large_files(tmp_path):
+    compare_workers(Path(str(tmp_path)), num_files=64, size=8 * 2**20, workers=[1, 2, 4, 8])
+
+
+def test_freeze_read_latency(tmp_path):
+    with read_latency(0.005):
+        compare_workers(Path(str(tmp_path)), num_files=1000, size=4096, workers=[1, 4, 16])
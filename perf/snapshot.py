@@ -0,0 +1,105 @@
+from __future__ import print_function
+import os
+import timeit
+import tracemalloc
+from hashlib import md5
+from io import BytesIO
+from json import loads
+from tabulate import tabulate
+from typing import cast
+from farmfs import getvol, snapformat
+from farmfs.fs import DIR, Path, ensure_symlink, walk
+from farmfs.hashcache import RACY_NS
+from farmfs.keydb import keydb_encoder
+from farmfs.snapshot import KeySnapshot
+from farmfs.util import egest
+from farmfs.volume import mkfs, tree_diff
+
+# FARMFS_PERF_SNAP_ITEMS scales the snapshots up towards a real volume.
+NUM_ITEMS = int(os.environ.get("FARMFS_PERF_SNAP_ITEMS", "200000"))
+
+
+def snap_data(num_items, width=20):
+    """Stored snapshot dicts, in path order, for num_items links under a width-way tree."""
+    items = [{"path": ".", "type": "dir"}]
+    for d in range(width):
+        items.append({"path": "d%02d" % d, "type": "dir"})
+        for i in range(d, num_items, width):
+            items.append({"path": "d%02d/f%08d" % (d, i), "type": "link", "csum": md5(str(i).encode()).hexdigest()})
+    return items
+
+
+def test_snap_diff():
+    left = snap_data(NUM_ITEMS)
+    right = snap_data(NUM_ITEMS)
+    right[-1] = dict(right[-1], csum="0" * 32)
+    table = []
+    for presorted in [False, True]:
+        def diff():
+            a = KeySnapshot(left, "left", None, presorted=presorted)
+            b = KeySnapshot(right, "right", None, presorted=presorted)
+            assert len(tree_diff(a, b)) == 1
+        time = timeit.timeit(diff, number=3) / 3
+        table.append((presorted, time, "%.0f" % (2 * len(left) / time)))
+    print()
+    print(tabulate(table, headers=["presorted", "time", "items/s"]))
+
+
+def test_snap_formats():
+    items = snap_data(NUM_ITEMS)
+    encoded = {"json": egest(keydb_encoder.encode(items))}
+    for codec in sorted(snapformat.CODECS):
+        if codec == "zstd" and snapformat.zstandard is None:
+            continue
+        encoded["binary-" + codec] = snapformat.encode(items, snapformat.CODECS[codec])
+
+    def read(name, data):
+        if name == "json":
+            return sum(1 for _ in KeySnapshot(loads(data), name, None, presorted=True))
+        return sum(1 for _ in KeySnapshot(snapformat.decode_items(BytesIO(data)), name, None, presorted=True))
+
+    table = []
+    for name, data in encoded.items():
+        tracemalloc.start()
+        assert read(name, data) == len(items)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        time = timeit.timeit(lambda: read(name, data), number=1)
+        table.append((name, len(data), "%.1f" % (len(encoded["json"]) / len(data)), time, peak))
+    print()
+    print(tabulate(table, headers=["format", "bytes", "ratio", "read time", "peak read memory"]))
+
+
+def test_tree_diff_digests(tmp_path, monkeypatch):
+    """Diff a volume with one changed link against its binary snapshot, with and without cached digests."""
+    monkeypatch.setattr("farmfs.snapformat.DEFAULT_SNAP_FORMAT", "binary-zlib")
+    root = Path(str(tmp_path)).join("vol")
+    root.mkdir()
+    mkfs(root, root.join(".farmfs").join("userdata"))
+    vol = getvol(root)
+    num_links = NUM_ITEMS // 10
+    for d in range(100):
+        root.join("d%02d" % d).mkdir()
+        for sub in range(10):
+            root.join("d%02d" % d).join("s%d" % sub).mkdir()
+    with vol.bs.session() as sess:
+        for i in range(num_links):
+            csum = md5(str(i).encode()).hexdigest()
+            sess.import_via_fd(lambda: BytesIO(str(i).encode()), csum)
+            ensure_symlink(root.join("d%02d/s%d/f%08d" % (i % 100, i // 100 % 10, i)), vol.bs.blob_path(csum))
+    for path, type_ in walk(root):
+        if type_ is DIR:
+            st = path.stat()
+            os.utime(path._path, ns=(st.st_atime_ns, st.st_mtime_ns - 10 * RACY_NS))
+    with vol.hash_cache() as cache:
+        vol.snapdb.write("snap", cast(KeySnapshot, vol.tree(cache)), overwrite=True)
+    ensure_symlink(root.join("d00/s0/f00000000"), vol.bs.blob_path(md5(b"1").hexdigest()))
+    table = []
+    for cached in [False, True]:
+        def diff():
+            with vol.hash_cache() as cache:
+                assert len(tree_diff(vol.tree(cache if cached else None), vol.snapdb.read("snap"))) == 1
+        time = timeit.timeit(diff, number=3) / 3
+        table.append((cached, num_links, time))
+    print()
+    print(tabulate(table, headers=["cached digests", "links", "time"]))
@@ -0,0 +1,87 @@
+from __future__ import print_function
+import os
+from hashlib import md5
+import timeit
+from contextlib import contextmanager
+from collections import Counter
+from tabulate import tabulate
+import farmfs.fs as fs
+from farmfs.fs import Path, walk, WALK_ENGINES
+from farmfs.util import consume
+
+
+def build_tree(root, depth, width, files):
+    """
+    Build a synthetic tree under root: each directory holds `files` files,
+    one symlink, and `width` subdirectories, down to `depth` levels.
+    """
+    for f in range(files):
+        with root.join("f%03d" % f).open("w") as fd:
+            fd.write(str(f))
+    root.join("link").symlink(root.join("f000"))
+    if depth == 0:
+        return
+    for d in range(width):
+        child = root.join("d%03d" % d)
+        child.mkdir()
+        build_tree(child, depth - 1, width, files)
+
+
+@contextmanager
+def counted_syscalls(counts):
+    """Count the directory and stat calls the walker makes through farmfs.fs."""
+    originals = {name: getattr(fs, name) for name in ("lstat", "listdir", "scandir")}
+
+    def counting(name, fn):
+        def wrapped(*args, **kwargs):
+            counts[name] += 1
+            return fn(*args, **kwargs)
+        return wrapped
+
+    for name, fn in originals.items():
+        setattr(fs, name, counting(name, fn))
+    try:
+        yield counts
+    finally:
+        for name, fn in originals.items():
+            setattr(fs, name, fn)
+
+
+def compare_engines(root, number):
+    table = []
+    for name in sorted(WALK_ENGINES):
+        counts = Counter()
+        with counted_syscalls(counts):
+            items = sum(1 for _ in walk(root, engine=name))
+        time = timeit.timeit(lambda: consume(walk(root, engine=name)), number=number)
+        table.append((name, items, counts["listdir"], counts["scandir"], counts["lstat"], time))
+    lowest = min(row[-1] for row in table)
+    print()
+    print(tabulate(
+        [row + ("%.2f" % (row[-1] / lowest),) for row in table],
+        headers=["engine", "items", "listdir", "scandir", "lstat", "time", "scale"],
+    ))
+
+
+def test_walk_deep(tmp_path):
+    root = Path(str(tmp_path))
+    build_tree(root, depth=6, width=3, files=4)
+    compare_engines(root, number=10)
+
+
+def test_walk_wide(tmp_path):
+    root = Path(str(tmp_path))
+    build_tree(root, depth=2, width=30, files=40)
+    compare_engines(root, number=10)
+
+
+def test_walk_userdata(tmp_path):
+    """Three level checksum fanout, like a FileBlobstore."""
+    root = Path(str(tmp_path))
+    for i in range(20000):
+        csum = md5(str(i).encode()).hexdigest()
+        blob = root.join(csum[0:3]).join(csum[3:6]).join(csum[6:9])
+        os.makedirs(blob._path, exist_ok=True)
+        with blob.join(csum[9:]).open("w") as fd:
+            fd.write(csum)
+    compare_engines(root, number=3)
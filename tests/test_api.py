@@ -1,5 +1,11 @@
+import gzip
+import io
+import os
+
 import pytest
+from farmfs import getvol
 from farmfs.api import get_app
+from farmfs.blobstore import BULK_MISSING, FileBlobstore, bulk_frame_head, read_bulk_frame_head
 from .conftest import build_checksum, build_blob
 
 
@@ -149,14 +155,13 @@ def test_api_blob_create_invalid_id(vol, client):
     assert {"duplicate": False, "blob": csuma} == response.json
 
 
-@pytest.mark.skip("Today the API doesn't validate checksums")
 def test_api_blob_create_corrupt_blob(vol, client):
-    # TODO the API should validate contents match blob id.
     csuma = build_checksum(b"a")
     response = client.post("/bs", data=b"b", query_string={"blob": csuma})
-    assert response.status_code == 201
-    assert response.headers["Location"] == f"http://localhost/bs/{csuma}"
-    assert {"duplicate": False, "blob": csuma} == response.json
+    assert response.status_code == 400
+    assert "checksum" in response.json["error"]
+    assert client.head(f"/bs/{csuma}").status_code == 404
+    assert client.head(f"/bs/{build_checksum(b'b')}").status_code == 404
 
 
 def test_api_blob_exists_missing(client, vol):
@@ -208,3 +213,182 @@ def test_api_blob_checksum(vol, client):
     response = client.get(f"/bs/{blob}/checksum")
     assert response.status_code == 200
     assert response.json == {"csum": csuma}
+
+
+def test_api_blob_exists_many(vol, client):
+    bloba = build_blob(vol, b"a")
+    blobb = build_blob(vol, b"b")
+    missing = build_checksum(b"missing")
+    response = client.post("/bs/exists", json={"blobs": [blobb, missing, bloba]})
+    assert response.status_code == 200
+    assert response.json["present"] == sorted([bloba, blobb])
+    assert client.post("/bs/exists", data=b"not json").status_code == 400
+
+
+def read_frames(body):
+    """The (blob, bytes or None) frames of a bulk body."""
+    stream = io.BytesIO(body)
+    frames = []
+    while (head := read_bulk_frame_head(stream)) is not None:
+        blob, length = head
+        frames.append((blob, None if length == BULK_MISSING else stream.read(length)))
+    return frames
+
+
+def test_api_blob_read_many(vol, client):
+    bloba = build_blob(vol, b"a")
+    blobb = build_blob(vol, b"bb")
+    missing = build_checksum(b"missing")
+    response = client.post("/bs/bulk-read", json={"blobs": [blobb, missing, bloba]})
+    assert response.status_code == 200
+    assert response.content_length == len(response.data)
+    assert read_frames(response.data) == [(blobb, b"bb"), (missing, None), (bloba, b"a")]
+    assert client.post("/bs/bulk-read", json={"blobs": []}).data == b""
+    assert client.post("/bs/bulk-read", data=b"not json").status_code == 400
+    assert client.post("/bs/bulk-read", json={"blobs": ["../../etc/passwd"]}).status_code == 400
+
+
+def test_api_blob_create_many(vol, client):
+    bloba = build_blob(vol, b"a")
+    blobx, bloby = build_checksum(b"x"), build_checksum(b"yy")
+    body = bulk_frame_head(blobx, 1) + b"x" + bulk_frame_head(bloba, 1) + b"a" + bulk_frame_head(bloby, 2) + b"yy"
+    response = client.post("/bs/bulk", data=body)
+    assert response.status_code == 200
+    assert response.json == {"created": [blobx, bloby], "duplicate": [bloba]}
+    assert client.get(f"/bs/{bloby}").data == b"yy"
+    # A body cut off part way through a blob keeps the blobs before it, and not the cut one.
+    blobz, blobw = build_checksum(b"z"), build_checksum(b"wwww")
+    response = client.post("/bs/bulk", data=bulk_frame_head(blobz, 1) + b"z" + bulk_frame_head(blobw, 4) + b"ww")
+    assert response.status_code == 400
+    assert response.json["created"] == [blobz]
+    assert client.head(f"/bs/{blobw}").status_code == 404
+    assert client.post("/bs/bulk", data=b"\xff" * 40).status_code == 400
+    # A frame whose bytes aren't its blob stops the batch.
+    response = client.post("/bs/bulk", data=bulk_frame_head(blobw, 1) + b"v")
+    assert response.status_code == 400
+    assert response.json["blob"] == blobw
+    assert client.head(f"/bs/{blobw}").status_code == 404
+
+
+def test_api_blob_read_headers(vol, client):
+    blob = build_blob(vol, b"0123456789")
+    response = client.get(f"/bs/{blob}")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{blob}"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Length"] == "10"
+    response = client.get(f"/bs/{blob}", headers={"If-None-Match": f'"{blob}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    response = client.get(f"/bs/{blob}", headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize("range_header,content_range,body", [
+    ("bytes=2-4", "bytes 2-4/10", b"234"),
+    ("bytes=7-", "bytes 7-9/10", b"789"),
+    ("bytes=-3", "bytes 7-9/10", b"789"),
+    ("bytes=8-100", "bytes 8-9/10", b"89"),
+])
+def test_api_blob_read_range(vol, client, range_header, content_range, body):
+    blob = build_blob(vol, b"0123456789")
+    response = client.get(f"/bs/{blob}", headers={"Range": range_header})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == content_range
+    assert response.headers["Content-Length"] == str(len(body))
+    assert response.data == body
+
+
+def test_api_blob_read_multiple_ranges(vol, client):
+    blob = build_blob(vol, b"0123456789")
+    response = client.get(f"/bs/{blob}", headers={"Range": "bytes=0-1,5-6,20-30"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    boundary = response.mimetype_params["boundary"].encode()
+    parts = response.data.split(b"--" + boundary)
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"Content-Range: bytes 0-1/10\r\n\r\n01\r\n")
+    assert parts[2].endswith(b"Content-Range: bytes 5-6/10\r\n\r\n56\r\n")
+    assert len(parts) == 4
+
+
+def test_api_blob_read_range_conditions(vol, client):
+    blob = build_blob(vol, b"0123456789")
+    response = client.get(f"/bs/{blob}", headers={"Range": "bytes=20-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+    # A stale If-Range gets the whole blob.
+    response = client.get(f"/bs/{blob}", headers={"Range": "bytes=2-4", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.data == b"0123456789"
+    response = client.get(f"/bs/{blob}", headers={"Range": "bytes=2-4", "If-Range": f'"{blob}"'})
+    assert response.data == b"234"
+
+
+_TEXT = b"".join(b"line %d of a compressible blob\n" % i for i in range(5000))
+
+
+def test_api_blob_read_gzip(vol, client):
+    text, noise = build_blob(vol, _TEXT), build_blob(vol, os.urandom(5000))
+    response = client.get(f"/bs/{text}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"] == f'W/"{text}"'
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.data) == _TEXT
+    response = client.get(f"/bs/{text}", headers={"If-None-Match": f'W/"{text}"'})
+    assert response.status_code == 304
+    # Without gzip, or for a blob which won't compress, the blob goes as it is.
+    response = client.get(f"/bs/{text}")
+    assert ("Content-Encoding" not in response.headers, response.data) == (True, _TEXT)
+    response = client.get(f"/bs/{noise}", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["ETag"] == f'"{noise}"'
+
+
+def test_api_blob_read_stored_gzip(vol, client):
+    bs = getvol(vol).bs
+    payload = _TEXT + b"stored compressed"
+    blob = build_checksum(payload)
+    with FileBlobstore(bs.root, bs.tmp_dir, codec="gzip").session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+    stored, _ = bs.stored_blob(blob)
+    response = client.get(f"/bs/{blob}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Length"] == str(stored.stat().st_size)
+    assert response.data == stored.content("rb")
+    response = client.get(f"/bs/{blob}")
+    assert response.data == payload
+    assert response.headers["ETag"] == f'"{blob}"'
+
+
+def test_api_blob_chunks(vol, client):
+    parts = [b"first chunk", b"second chunk"]
+    payload = b"".join(parts)
+    blob = build_checksum(payload)
+    body = {"chunks": [[build_checksum(p), len(p)] for p in parts]}
+    # The chunks have to be uploaded first.
+    assert client.put(f"/bs/{blob}/chunks", json=body).status_code == 400
+    for part in parts:
+        client.post(f"/bs?blob={build_checksum(part)}", data=part)
+    assert client.put(f"/bs/{blob}/chunks", data=b"not json").status_code == 400
+    assert client.put(f"/bs/{blob}/chunks", json=body).status_code == 201
+    assert client.put(f"/bs/{blob}/chunks", json=body).status_code == 200
+    assert client.get(f"/bs/{blob}/chunks").json == body
+    assert client.get(f"/bs/{build_checksum(parts[0])}/chunks").status_code == 404
+    assert client.get("/bs/nonsense/chunks").status_code == 400
+    # Without a plain copy the blob is sent put back together.
+    assert not getvol(vol).bs.blob_path(blob).exists()
+    response = client.get(f"/bs/{blob}")
+    assert response.data == payload
+    assert response.headers["Content-Length"] == str(len(payload))
+    assert response.headers["ETag"] == f'"{blob}"'
+
+
+def test_api_blob_create_gzip(vol, client):
+    blob = build_checksum(_TEXT)
+    response = client.post(f"/bs?blob={blob}", data=gzip.compress(_TEXT), headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 201
+    assert client.get(f"/bs/{blob}").data == _TEXT
+    response = client.post(f"/bs?blob={blob}", data=_TEXT, headers={"Content-Encoding": "br"})
+    assert response.status_code == 415
@@ -0,0 +1,115 @@
+import gzip
+import http.client
+import io
+import os
+import threading
+
+import pytest
+
+from farmfs.api import get_app
+from farmfs.apiserver import ApiServer
+from farmfs.blobstore import HttpBlobstore
+from .conftest import build_checksum
+
+
+@pytest.fixture
+def server(vol):
+    server = ApiServer("127.0.0.1", 0, get_app({"<root>": vol}), threads=4)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_api_server_round_trip(server, monkeypatch):
+    sent = []
+    real_sendfile = os.sendfile
+
+    def counting_sendfile(out, in_fd, offset, count):
+        n = real_sendfile(out, in_fd, offset, count)
+        sent.append(n)
+        return n
+    monkeypatch.setattr(os, "sendfile", counting_sendfile)
+    bs = HttpBlobstore(f"http://127.0.0.1:{server.server_port}", conn_timeout=5)
+    payloads = [b"", b"small", os.urandom(3 * 1024 * 1024 + 7)]
+    with bs.session() as sess:
+        for payload in payloads:
+            assert sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload)) is False
+        for payload in payloads:
+            with sess.read_handle(build_checksum(payload)) as fd:
+                assert fd.read() == payload
+    assert sum(sent) == sum(len(p) for p in payloads)
+    assert bs.exists_many(build_checksum(p) for p in payloads) == {build_checksum(p) for p in payloads}
+    # Every request went over the one keep-alive connection.
+    stats = bs.pool.stats()
+    assert (stats["created"], stats["discarded"]) == (1, 0)
+
+
+def test_api_server_skips_unread_body(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    # The blob route doesn't read a DELETE's body; it must not be taken for the next request.
+    conn.request("DELETE", "/bs/" + build_checksum(b"x"), body=b"GET / HTTP/1.1\r\n\r\n")
+    resp = conn.getresponse()
+    resp.read()
+    assert resp.status == 204
+    conn.request("GET", "/bs")
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert "blobs" in resp.read().decode()
+    missing = build_checksum(b"missing")
+    conn.request("GET", "/bs/" + missing)
+    resp = conn.getresponse()
+    resp.read()
+    assert resp.status == 404
+    conn.close()
+
+
+def test_api_server_honours_connection_close(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    conn.request("GET", "/bs", headers={"Connection": "close"})
+    resp = conn.getresponse()
+    resp.read()
+    assert resp.getheader("Connection") == "close"
+    conn.close()
+
+
+def test_api_server_bad_threads(vol):
+    with pytest.raises(ValueError):
+        ApiServer("127.0.0.1", 0, get_app({"<root>": vol}), threads=0)
+
+
+def test_api_server_sends_ranges(server):
+    payload = os.urandom(100000)
+    blob = build_checksum(payload)
+    bs = HttpBlobstore(f"http://127.0.0.1:{server.server_port}", conn_timeout=5)
+    with bs.session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    for range_header, body in [("bytes=1000-1999", payload[1000:2000]), ("bytes=-10", payload[-10:])]:
+        conn.request("GET", "/bs/" + blob, headers={"Range": range_header})
+        resp = conn.getresponse()
+        assert (resp.status, resp.read()) == (206, body)
+    conn.close()
+
+
+def test_api_server_chunked_response(server):
+    payload = b"".join(b"line %d of a compressible blob\n" % i for i in range(5000))
+    blob = build_checksum(payload)
+    bs = HttpBlobstore(f"http://127.0.0.1:{server.server_port}", conn_timeout=5)
+    with bs.session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    # Compressed as it is sent, so its length isn't known up front.
+    conn.request("GET", "/bs/" + blob, headers={"Accept-Encoding": "gzip"})
+    resp = conn.getresponse()
+    assert resp.getheader("Transfer-Encoding") == "chunked"
+    assert gzip.decompress(resp.read()) == payload
+    # The connection is still good for the next request.
+    conn.request("GET", "/bs/" + blob)
+    resp = conn.getresponse()
+    assert resp.read() == payload
+    assert resp.getheader("Connection") is None
+    conn.close()
@@ -0,0 +1,97 @@
+import io
+
+import pytest
+
+from farmfs.blobindex import BlobIndex, _Digests, encode_index
+from farmfs.blobstore import FileBlobstore
+from .conftest import build_checksum
+
+
+def _blobs(n):
+    return sorted(build_checksum(str(i).encode()) for i in range(n))
+
+
+def _index(tmp, **kwargs):
+    scratch = tmp.join("tmp")
+    if not scratch.exists():
+        scratch.mkdir()
+    return BlobIndex(tmp.join("index"), scratch, **kwargs)
+
+
+@pytest.mark.parametrize("bloom_bits", [0, 10])
+def test_digests(bloom_bits):
+    blobs = _blobs(200)
+    digests = _Digests(encode_index(b"".join(bytes.fromhex(b) for b in blobs), bloom_bits))
+    assert len(digests) == 200
+    assert all(bytes.fromhex(blob) in digests for blob in blobs)
+    assert bytes.fromhex(build_checksum(b"missing")) not in digests
+    assert [d.hex() for d in digests.after(bytes.fromhex(blobs[99]))] == blobs[100:]
+    with pytest.raises(ValueError):
+        _Digests(b"FARMBIDX")
+
+
+def test_blob_index(tmp):
+    index = _index(tmp, log_max=4)
+    blobs = _blobs(10)
+    assert index.exists(blobs[0]) is None
+    assert index.count() is None and index.blobs() is None
+    index.record(blobs[0], True)  # Not built, so not logged.
+    assert index.build(blobs[:5]) == 5
+    assert index.count() == 5
+    index.record(blobs[7], True)
+    index.record(blobs[2], False)
+    index.record(blobs[7], True)
+    assert index.exists(blobs[7]) and not index.exists(blobs[2])
+    assert index.count() == 5
+    assert list(index.blobs()) == [blobs[0], blobs[1], blobs[3], blobs[4], blobs[7]]
+    assert list(index.blobs(blobs[3])) == [blobs[4], blobs[7]]
+    # Another process sees the changes, and keeps seeing them once the log is folded into the index.
+    other = _index(tmp)
+    assert other.count() == 5 and other.exists(blobs[7])
+    index.record(blobs[8], True)
+    assert index.log_path.stat().st_size == 16
+    assert other.count() == 6
+    assert list(other.blobs()) == list(index.blobs())
+    other.record(blobs[8], False)
+    assert index.count() == 5 and not index.exists(blobs[8])
+    index.drop()
+    assert index.exists(blobs[0]) is None and other.exists(blobs[0]) is None
+
+
+def test_blobstore_index(tmp):
+    root = tmp.join("userdata")
+    root.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(root, scratch, index_dir=tmp.join("index"))
+    payloads = [b"a", b"b", b"c"]
+    with bs.session() as sess:
+        for payload in payloads[:2]:
+            sess.import_via_fd(lambda: io.BytesIO(payload), build_checksum(payload))
+    assert bs.count() == 2
+    assert bs.build_index() == 2
+    with bs.session() as sess:
+        sess.import_verified(lambda: io.BytesIO(b"c"))
+    bs.delete_blob(build_checksum(b"a"))
+    assert bs.count() == 2
+    assert list(bs.blobs()) == sorted([build_checksum(b"b"), build_checksum(b"c")])
+    assert list(bs.blobs()) == list(bs._listed_blobs())
+    assert list(bs.blobs(max_items=1)) == list(bs._listed_blobs(max_items=1))
+    assert bs.exists(build_checksum(b"c")) and not bs.exists(build_checksum(b"a"))
+
+
+def test_blobstore_index_import_chunks(tmp):
+    root = tmp.join("userdata")
+    root.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(root, scratch, index_dir=tmp.join("index"))
+    assert bs.build_index() == 0
+    chunks = {build_checksum(p): p for p in [b"one", b"two"]}
+    manifest = [(chunk, len(data)) for chunk, data in chunks.items()]
+    blob = build_checksum(b"onetwo")
+    with bs.session() as sess:
+        assert not sess.import_chunks(blob, manifest, chunks.__getitem__, 2)
+    assert bs.manifest(blob) == manifest
+    assert list(bs.blobs()) == list(bs._listed_blobs())
+    assert bs.exists_many(list(chunks) + [blob]) == set(chunks) | {blob}
@@ -1,15 +1,35 @@
+import base64
+import gzip
 import io
+import json
+import os
+import re
 import threading
+import time
 import uuid
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Set
+from urllib.parse import parse_qs, urlparse
 
 import pytest
 from werkzeug.serving import make_server
 
 from farmfs.api import get_app
-from farmfs.blobstore import FileBlobstore, HttpBlobstore, LifecycleError, S3Blobstore, fast_reverser, old_reverser
+from farmfs.blobstore import (
+    CHUNKED,
+    PACKED,
+    S3_CODEC_HEADER,
+    FileBlobstore,
+    HttpBlobstore,
+    LifecycleError,
+    S3Blobstore,
+    fast_reverser,
+    old_reverser,
+)
 from farmfs.fs import is_readonly
 from farmfs.volume import mkfs
-from .conftest import build_checksum
+from .conftest import build_checksum, build_file
 
 
 @pytest.mark.parametrize("reverser_builder", [old_reverser, fast_reverser])
@@ -56,6 +76,63 @@ def test_file_import_via_fd(tmp):
     assert bs.verify_blob_permissions(blob)
 
 
+def test_file_import_verified(tmp):
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(ud, scratch)
+    blob = build_checksum(b"foo")
+    with bs.session() as sess:
+        with pytest.raises(ValueError):
+            sess.import_verified(lambda: io.BytesIO(b"bar"), blob)
+        assert not sess.exists(blob) and not sess.exists(build_checksum(b"bar"))
+        assert sess.import_verified(lambda: io.BytesIO(b"foo"), blob) == (blob, False)
+        assert sess.import_verified(lambda: io.BytesIO(b"foo")) == (blob, True)
+        assert sess.import_verified(lambda: io.BytesIO(b"bar")) == (build_checksum(b"bar"), False)
+    assert bs.blob_path(blob).checksum() == blob
+    assert is_readonly(bs.blob_path(blob))
+    assert scratch.dir_list() == []
+    # Copying a file in leaves it plain, even for a blobstore which compresses.
+    zbs = FileBlobstore(tmp.join("zdata"), scratch, codec="gzip")
+    src = tmp.join("src")
+    with src.open("wb") as fd:
+        fd.write(_TEXT)
+    assert zbs.import_via_copy(src) == (build_checksum(_TEXT), False)
+    assert zbs.stored_blob(build_checksum(_TEXT)) == (zbs.blob_path(build_checksum(_TEXT)), None)
+    with zbs.session() as sess:
+        assert sess.import_verified(lambda: io.BytesIO(_TEXT * 2)) == (build_checksum(_TEXT * 2), False)
+    assert zbs.stored_blob(build_checksum(_TEXT * 2))[1] == "gzip"
+    assert zbs.blob_checksum(build_checksum(_TEXT * 2)) == build_checksum(_TEXT * 2)
+
+
+def test_file_import_via_link_race(tmp):
+    """Identical files imported at once produce one blob; every loser is flagged a duplicate."""
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(ud, scratch)
+    payload = "same"
+    blob = build_checksum(payload.encode())
+    files = [build_file(tmp, "f%d" % i, payload) for i in range(16)]
+    barrier = threading.Barrier(len(files))
+    results = []
+
+    def importer(f):
+        barrier.wait()
+        results.append(bs.import_via_link(f, blob))
+
+    threads = [threading.Thread(target=importer, args=(f,)) for f in files]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [False] + [True] * (len(files) - 1)
+    assert bs.blob_path(blob).checksum() == blob
+    assert is_readonly(bs.blob_path(blob))
+
+
 # ---------------------------------------------------------------------------
 # Lifecycle tests — parametrized across FileBlobstore and HttpBlobstore
 # ---------------------------------------------------------------------------
@@ -65,9 +142,9 @@ _BS_PORT = 5009
 
 
 class _MockServerThread(threading.Thread):
-    def __init__(self, app, port):
+    def __init__(self, app, port, threaded=False):
         super().__init__(daemon=True)
-        self.server = make_server("127.0.0.1", port, app)
+        self.server = make_server("127.0.0.1", port, app, threaded=threaded)
         app.app_context().push()
 
     def run(self):
@@ -160,3 +237,656 @@ def test_import_duplicate_is_flagged(bs_with_blob):
     with bs.session() as sess:
         result = sess.import_via_fd(lambda: io.BytesIO(_LIFECYCLE_PAYLOAD), blob)
     assert result is True
+
+
+@pytest.mark.parametrize("list_workers", [2, 8])
+def test_file_blobs_parallel_matches_serial(tmp, list_workers):
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    serial = FileBlobstore(ud, scratch, list_workers=1)
+    parallel = FileBlobstore(ud, scratch, list_workers=list_workers)
+    with serial.session() as sess:
+        for i in range(60):
+            payload = str(i).encode()
+            sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+    expected = list(serial.blobs())
+    assert len(expected) == 60
+    assert expected == sorted(expected)
+    assert list(parallel.walk()) == list(serial.walk())
+    assert list(parallel.blobs()) == expected
+    for i, blob in enumerate(expected):
+        assert list(parallel.blobs(start_after=blob)) == expected[i + 1:]
+        assert list(parallel.blobs(start_after=blob, max_items=3)) == expected[i + 1:i + 4]
+    # start_after need not be present in the store.
+    missing = "0" * 32
+    assert list(parallel.blobs(start_after=missing)) == list(serial.blobs(start_after=missing))
+    with pytest.raises(ValueError):
+        FileBlobstore(ud, scratch, list_workers=0)
+
+
+@pytest.mark.parametrize("engine,read_size,use_mmap", [
+    ("threads", 65536, False),
+    ("threads", 7, True),
+    ("processes", 1024 * 1024, False),
+    ("processes", 4096, True),
+])
+def test_file_blob_checksums(tmp, engine, read_size, use_mmap):
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(ud, scratch)
+    payloads = [b"", b"x"] + [str(i).encode() * 5000 for i in range(40)]
+    with bs.session() as sess:
+        for payload in payloads:
+            sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+    blobs = list(bs.blobs())
+    results = list(bs.blob_checksums(blobs, workers=3, engine=engine, read_size=read_size, use_mmap=use_mmap))
+    assert sorted(results) == [(blob, blob) for blob in blobs]
+    with pytest.raises(ValueError):
+        list(bs.blob_checksums(blobs, engine="gpu"))
+
+
+_TEXT = b"".join(b"line %d of a compressible blob\n" % i for i in range(5000))
+
+
+def test_file_compressed_blobs(tmp):
+    root = tmp.join("userdata")
+    root.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(root, scratch, codec="gzip")
+    noise = os.urandom(5000)
+    text, random = build_checksum(_TEXT), build_checksum(noise)
+    with bs.session() as sess:
+        assert sess.import_via_fd(lambda: io.BytesIO(_TEXT), text) is False
+        assert sess.import_via_fd(lambda: io.BytesIO(noise), random) is False
+        assert sess.import_via_fd(lambda: io.BytesIO(_TEXT), text) is True
+        with sess.read_handle(text) as fd:
+            assert fd.read() == _TEXT
+    # Only the blob worth compressing was.
+    stored, codec = bs.stored_blob(text)
+    assert (str(stored), codec) == (str(bs.blob_path(text)) + ".gz", "gzip")
+    assert gzip.decompress(stored.content("rb")) == _TEXT
+    assert is_readonly(stored)
+    assert bs.stored_blob(random) == (bs.blob_path(random), None)
+    assert list(bs.blobs()) == sorted([text, random])
+    assert bs.exists_many([text, random]) == {text, random}
+    assert bs.blob_size(text) == len(_TEXT)
+    assert bs.blob_checksum(text) == text
+    assert b"".join(bs.blob_chunks(text, 1000)) == _TEXT
+    with bs.read_handle(text) as fd:
+        assert fd.read() == _TEXT
+    # Materialising the blob leaves it plain, so links to it can be followed.
+    assert bs.materialise(text) == bs.blob_path(text)
+    assert bs.blob_path(text).content("rb") == _TEXT
+    assert is_readonly(bs.blob_path(text))
+    assert bs.stored_blob(text) == (bs.blob_path(text), None)
+    with bs.session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(_TEXT + b"more"), build_checksum(_TEXT + b"more"))
+    bs.delete_blob(build_checksum(_TEXT + b"more"))
+    assert not bs.exists(build_checksum(_TEXT + b"more"))
+    assert list(bs.blobs()) == sorted([text, random])
+
+
+def test_file_chunked_blobs(tmp):
+    root = tmp.join("userdata")
+    root.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(root, scratch, chunk_threshold=20000, chunk_size=1024)
+    payload = os.urandom(40000)
+    blob = build_checksum(payload)
+    small = build_file(tmp, "small", "small")
+    big = tmp.join("big")
+    with big.open("wb") as fd:
+        fd.write(payload)
+    # Freezing a file over the threshold chunks it, and leaves it linked in as the plain copy.
+    assert bs.import_via_link(small, build_checksum(b"small")) is False
+    assert bs.import_via_link(big, blob) is False
+    assert bs.manifest(build_checksum(b"small")) is None
+    manifest = bs.manifest(blob)
+    assert manifest is not None and len(manifest) > 5
+    assert sum(size for _, size in manifest) == len(payload)
+    assert list(bs.chunked_blobs()) == [blob]
+    chunk_ids = [chunk for chunk, _ in manifest]
+    assert set(bs.blobs()) == {blob, build_checksum(b"small"), *chunk_ids}
+    # Without the plain copy, reads put the chunks back together.
+    assert bs.evict(blob) == len(payload)
+    assert bs.evict(blob) == 0
+    assert bs.exists(blob) and blob in bs.blobs()
+    stored, codec = bs.stored_blob(blob)
+    assert (str(stored), codec) == (str(bs.blob_path(blob)) + ".chunks", CHUNKED)
+    assert is_readonly(stored)
+    assert bs.blob_size(blob) == len(payload)
+    assert bs.blob_checksum(blob) == blob
+    assert b"".join(bs.blob_chunks(blob, 1000)) == payload
+    with bs.read_handle(blob) as fd:
+        assert fd.read() == payload
+    with bs.session() as sess, sess.read_handle(blob) as fd:
+        assert b"".join(iter(lambda: fd.read(1000), b"")) == payload
+    # Materialising rebuilds the plain copy and keeps the manifest.
+    assert bs.materialise(blob).content("rb") == payload
+    assert bs.manifest(blob) == manifest
+    bs.delete_blob(blob)
+    assert not bs.exists(blob) and bs.manifest(blob) is None
+    assert list(bs.chunked_blobs()) == []
+    # A blob which is one chunk is left unchunked, since its manifest would only name itself.
+    zeros = tmp.join("zeros")
+    with zeros.open("wb") as fd:
+        fd.write(bytes(30000))
+    assert FileBlobstore(root, scratch, chunk_threshold=20000, chunk_size=8192).import_via_link(zeros, build_checksum(bytes(30000))) is False
+    assert bs.manifest(build_checksum(bytes(30000))) is None
+
+
+def test_file_import_manifest(tmp):
+    bs = _local_store(tmp, "local")
+    parts = [b"first chunk", b"second chunk"]
+    payload = b"".join(parts)
+    blob = build_checksum(payload)
+    manifest = [(build_checksum(p), len(p)) for p in parts]
+    with bs.session() as sess:
+        with pytest.raises(FileNotFoundError):
+            sess.import_manifest(blob, manifest)
+        for part in parts:
+            sess.import_via_fd(lambda p=part: io.BytesIO(p), build_checksum(part))
+        assert sess.import_manifest(blob, manifest) is False
+        assert sess.import_manifest(blob, manifest) is True
+    assert bs.blob_path(blob).exists() is False
+    with bs.read_handle(blob) as fd:
+        assert fd.read() == payload
+
+
+def test_file_packed_blobs(tmp):
+    root = tmp.join("userdata")
+    root.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(root, scratch, pack_dir=tmp.join("packs"), pack_size=300)
+    small = [str(i).encode() * 50 for i in range(10)]
+    large = b"large" * 1000
+    blobs = [build_checksum(p) for p in small + [large]]
+    with bs.session() as sess:
+        for payload in small + [large]:
+            sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+    assert sorted(bs.pack(blobs, threshold=1000)) == sorted(blobs[:-1])
+    assert bs.pack(blobs, threshold=1000) == []
+    # Split into packs of about pack_size bytes.
+    assert len([p for p in tmp.join("packs").dir_list() if p.name().endswith(".idx")]) == 2
+    assert not bs.blob_path(blobs[0]).exists()
+    assert bs.stored_blob(blobs[0])[1] == PACKED
+    assert list(bs.blobs()) == sorted(blobs)
+    assert list(bs.blobs(start_after=sorted(blobs)[4], max_items=3)) == sorted(blobs)[5:8]
+    assert bs.exists_many(blobs) == set(blobs)
+    for blob, payload in zip(blobs, small):
+        assert bs.blob_size(blob) == bs.stored_size(blob) == len(payload)
+        assert bs.blob_checksum(blob) == blob
+        assert b"".join(bs.blob_chunks(blob, 7)) == payload
+        with bs.read_handle(blob) as fd:
+            assert fd.read() == payload
+        with bs.session() as sess:
+            assert sess.import_via_fd(lambda: io.BytesIO(payload), blob) is True
+            with sess.read_handle(blob) as fd:
+                assert fd.read() == payload
+    assert dict(bs.blob_checksums(blobs, engine="processes", workers=2)) == {blob: blob for blob in blobs}
+    # Materialising copies the blob out for links, and leaves it packed too.
+    assert bs.materialise(blobs[0]).content("rb") == small[0]
+    assert bs.stored_blob(blobs[0]) == (bs.blob_path(blobs[0]), None)
+    assert list(bs.blobs()) == sorted(blobs)
+    for blob in blobs[:5]:
+        bs.delete_blob(blob)
+    assert not any(bs.exists(blob) for blob in blobs[:5])
+    assert list(bs.blobs()) == sorted(blobs[5:])
+    with bs.read_handle(blobs[5]) as fd:
+        assert fd.read() == small[5]
+
+
+def test_http_codec_round_trip(tmp):
+    server_root = tmp.join("api_server")
+    server_root.mkdir()
+    mkfs(server_root, server_root.join(".farmfs").join("userdata"))
+    app = get_app({"<root>": str(server_root)})
+    noise = os.urandom(5000)
+    with _MockServerThread(app, _BS_PORT):
+        bs = HttpBlobstore(f"http://127.0.0.1:{_BS_PORT}", conn_timeout=5, codec="gzip")
+        with bs.session() as sess:
+            for payload in [_TEXT, noise]:
+                assert sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload)) is False
+            for payload in [_TEXT, noise]:
+                with sess.read_handle(build_checksum(payload)) as fd:
+                    assert fd.read() == payload
+    # The server stores what it is sent plain, as its own codec says.
+    server_bs = FileBlobstore(server_root.join(".farmfs").join("userdata"), tmp)
+    assert server_bs.blob_path(build_checksum(_TEXT)).content("rb") == _TEXT
+
+
+def test_http_pool_sessions(tmp):
+    """Sessions and one-off requests lease their connections from the blobstore's pool."""
+    server_root = tmp.join("api_server")
+    server_root.mkdir()
+    mkfs(server_root, server_root.join(".farmfs").join("userdata"))
+    app = get_app({"<root>": str(server_root)})
+    blob = build_checksum(_LIFECYCLE_PAYLOAD)
+    with _MockServerThread(app, _BS_PORT):
+        bs = HttpBlobstore(f"http://127.0.0.1:{_BS_PORT}", conn_timeout=5)
+        with bs.session() as sess:
+            assert sess.import_via_fd(lambda: io.BytesIO(_LIFECYCLE_PAYLOAD), blob) is False
+        for _ in range(2):
+            with bs.session() as sess:
+                with sess.read_handle(blob) as fd:
+                    assert fd.read() == _LIFECYCLE_PAYLOAD
+        assert blob in list(bs.blobs())
+        assert bs.blob_checksum(blob) == blob
+        # The server closes each connection; the pooled one reconnects.
+        stats = bs.pool.stats()
+        assert (stats["created"], stats["reused"], stats["discarded"]) == (1, 4, 0)
+        # A read handle closed early leaves its connection unusable.
+        with bs.session() as sess:
+            with sess.read_handle(blob) as fd:
+                fd.read(1)
+        assert bs.pool.stats()["discarded"] == 1
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    """Answers checksum requests over HTTP/1.1 keep-alive, hanging up after any path ending in "hangup"."""
+    protocol_version = "HTTP/1.1"
+    connections: List[int] = []
+
+    def setup(self):
+        super().setup()
+        self.connections.append(1)
+
+    def do_GET(self):
+        blob = self.path.split("/")[2]
+        body = json.dumps({"csum": blob}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = blob == "hangup"
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_pool_keep_alive():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    _KeepAliveHandler.connections = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        bs = HttpBlobstore(f"http://127.0.0.1:{server.server_address[1]}", conn_timeout=5)
+        assert [bs.blob_checksum(str(i)) for i in range(3)] == ["0", "1", "2"]
+        assert len(_KeepAliveHandler.connections) == 1
+        # The health check notices the server hung up, and the pool replaces the connection.
+        assert bs.blob_checksum("hangup") == "hangup"
+        time.sleep(0.1)  # Let the hang up arrive.
+        assert bs.blob_checksum("4") == "4"
+        assert len(_KeepAliveHandler.connections) == 2
+        stats = bs.pool.stats()
+        assert (stats["created"], stats["discarded"], stats["total"]) == (2, 1, 1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    """
+    Just enough of S3 to exercise multipart uploads and ranged downloads.
+    Part numbers in fail_once get a 500 the first time they are sent.
+    """
+    protocol_version = "HTTP/1.1"
+    objects: Dict[str, bytes] = {}
+    metadata: Dict[str, Dict[str, str]] = {}
+    uploads: Dict[str, Dict[int, bytes]] = {}
+    upload_metadata: Dict[str, Dict[str, str]] = {}
+    fail_once: Set[int] = set()
+    ranges: List[str] = []
+    lists: List[str] = []
+
+    def _parse(self):
+        url = urlparse(self.path)
+        return url.path, parse_qs(url.query, keep_blank_values=True)
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _metadata(self):
+        return {k.lower(): v for k, v in self.headers.items() if k.lower().startswith("x-amz-meta-")}
+
+    def do_HEAD(self):
+        key, _ = self._parse()
+        if key not in self.objects:
+            return self._reply(404)
+        self.send_response(200)
+        for k, v in self.metadata.get(key, {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(self.objects[key])))
+        self.end_headers()
+
+    def _list(self, query):
+        def arg(name, default=""):
+            return query.get(name, [default])[0]
+        after = arg("continuation-token") or arg("start-after")
+        keys = sorted(k[1:] for k in self.objects if k[1:].startswith(arg("prefix")) and k[1:] > after)
+        page = keys[:int(arg("max-keys", "1000"))]
+        self.lists.append(after)
+        ns = "http://s3.amazonaws.com/doc/2006-03-01/"
+        body = "".join(f"<Contents><Key>{k}</Key></Contents>" for k in page)
+        if len(page) < len(keys):
+            body += f"<NextContinuationToken>{page[-1]}</NextContinuationToken>"
+        self._reply(200, f'<ListBucketResult xmlns="{ns}">{body}</ListBucketResult>'.encode())
+
+    def do_GET(self):
+        key, query = self._parse()
+        if "list-type" in query:
+            return self._list(query)
+        data = self.objects[key]
+        byte_range = self.headers.get("Range")
+        if byte_range is None:
+            return self._reply(200, data, {"ETag": '"%s"' % md5(data).hexdigest(), **self.metadata.get(key, {})})
+        self.ranges.append(byte_range)
+        start, end = (int(n) for n in byte_range[len("bytes="):].split("-"))
+        self._reply(206, data[start:end + 1], {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+
+    def do_PUT(self):
+        key, query = self._parse()
+        data = self._body()
+        digest = md5(data).digest()
+        if "partNumber" in query:
+            number = int(query["partNumber"][0])
+            if number in self.fail_once:
+                self.fail_once.discard(number)
+                return self._reply(500, b"<Error>InternalError</Error>")
+            assert base64.b64decode(self.headers["Content-MD5"]) == digest
+            self.uploads[query["uploadId"][0]][number] = data
+        elif self.headers.get("If-None-Match") == "*" and key in self.objects:
+            return self._reply(412)
+        else:
+            self.objects[key] = data
+            self.metadata[key] = self._metadata()
+        self._reply(200, headers={"ETag": '"%s"' % digest.hex()})
+
+    def do_POST(self):
+        key, query = self._parse()
+        body = self._body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {}
+            self.upload_metadata[upload_id] = self._metadata()
+            return self._reply(200, b"<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>"
+                               % upload_id.encode())
+        parts = self.uploads.pop(query["uploadId"][0])
+        self.metadata[key] = self.upload_metadata.pop(query["uploadId"][0])
+        numbers = [int(n) for n in re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)]
+        assert numbers == sorted(parts)
+        self.objects[key] = b"".join(parts[n] for n in numbers)
+        etag = "%s-%d" % (md5(b"".join(md5(parts[n]).digest() for n in numbers)).hexdigest(), len(numbers))
+        self._reply(200, b"<CompleteMultipartUploadResult><ETag>&quot;%s&quot;</ETag></CompleteMultipartUploadResult>"
+                    % etag.encode())
+
+    def do_DELETE(self):
+        _, query = self._parse()
+        self.uploads.pop(query["uploadId"][0], None)
+        self._reply(204)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def s3_server():
+    _S3Handler.objects, _S3Handler.uploads, _S3Handler.fail_once = {}, {}, set()
+    _S3Handler.metadata, _S3Handler.upload_metadata = {}, {}
+    _S3Handler.ranges, _S3Handler.lists = [], []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _S3Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _parts_store(port):
+    return S3Blobstore("s3://bucket/prefix", "id", b"secret", host="127.0.0.1", port=port, use_ssl=False,
+                       multipart_threshold=1000, part_size=300, part_workers=3)
+
+
+def _local_store(tmp, name):
+    root = tmp.join(name)
+    root.mkdir()
+    scratch = tmp.join(name + "_tmp")
+    scratch.mkdir()
+    return FileBlobstore(root, scratch)
+
+
+def test_s3_multipart_round_trip(tmp, s3_server, monkeypatch):
+    monkeypatch.setattr("farmfs.util.time.sleep", lambda _: None)
+    _S3Handler.fail_once = {2}
+    payload = bytes(range(256)) * 10
+    blob = build_checksum(payload)
+    small = b"small"
+    local = _local_store(tmp, "local")
+    with local.session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+        sess.import_via_fd(lambda: io.BytesIO(small), build_checksum(small))
+    s3 = _parts_store(s3_server)
+    with s3.session() as s3sess, local.session() as sess:
+        assert s3sess.import_via_fd(lambda: sess.read_handle(blob), blob) is False
+        assert s3sess.import_via_fd(lambda: sess.read_handle(blob), blob) is True
+        assert s3sess.import_via_fd(lambda: sess.read_handle(build_checksum(small)), build_checksum(small)) is False
+    # 2560 bytes in parts of 300, the second of which was retried.
+    assert _S3Handler.objects["/prefix/" + blob] == payload
+    assert _S3Handler.uploads == {}
+    # Downloads of large blobs are ranged, and checked before they land.
+    other = _local_store(tmp, "other")
+    with s3.session() as s3sess, other.session() as sess:
+        assert s3sess.export_to(sess, blob) is False
+        assert s3sess.export_to(sess, build_checksum(small)) is False
+        assert s3sess.export_to(sess, blob) is True
+    assert other.blob_path(blob).content("rb") == payload
+    assert is_readonly(other.blob_path(blob))
+    assert other.blob_path(build_checksum(small)).content("rb") == small
+    assert len(_S3Handler.ranges) == 9
+
+
+def test_s3_compressed_round_trip(tmp, s3_server):
+    # Hex digits compress to about half, so this one is still uploaded in parts.
+    large = os.urandom(4000).hex().encode()
+    noise = os.urandom(2000)
+    payloads = [_TEXT, large, noise]
+    local = _local_store(tmp, "local")
+    with local.session() as sess:
+        for payload in payloads:
+            sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+    s3 = S3Blobstore("s3://bucket/prefix", "id", b"secret", host="127.0.0.1", port=s3_server, use_ssl=False,
+                     multipart_threshold=1000, part_size=300, part_workers=3, codec="gzip")
+    with s3.session() as s3sess, local.session() as sess:
+        for payload in payloads:
+            blob = build_checksum(payload)
+            assert s3sess.import_via_fd(lambda: sess.read_handle(blob), blob) is False
+            assert s3sess.import_via_fd(lambda: sess.read_handle(blob), blob) is True
+    for payload in [_TEXT, large]:
+        key = "/prefix/" + build_checksum(payload)
+        assert gzip.decompress(_S3Handler.objects[key]) == payload
+        assert _S3Handler.metadata[key] == {S3_CODEC_HEADER: "gzip"}
+        assert s3.blob_codec(build_checksum(payload)) == "gzip"
+    assert _S3Handler.objects["/prefix/" + build_checksum(noise)] == noise
+    assert s3.blob_codec(build_checksum(noise)) is None
+    other = _local_store(tmp, "other")
+    with s3.session() as s3sess, other.session() as sess:
+        for payload in payloads:
+            blob = build_checksum(payload)
+            with s3sess.read_handle(blob) as fd:
+                assert b"".join(iter(lambda: fd.read(1000), b"")) == payload
+            assert s3sess.export_to(sess, blob) is False
+            assert other.blob_path(blob).content("rb") == payload
+
+
+def test_s3_chunked_round_trip(tmp, s3_server):
+    local = _local_store(tmp, "local")
+    payload = os.urandom(20000)
+    blob = build_checksum(payload)
+    with local.session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+    local.chunk_size = 1024
+    manifest = local.chunk(blob)
+    s3 = _parts_store(s3_server)
+    with s3.session() as s3sess, local.session() as sess:
+        for chunk, _ in manifest:
+            s3sess.import_via_fd(lambda c=chunk: sess.read_handle(c), chunk)
+        assert s3sess.import_manifest(blob, manifest) is False
+        assert s3sess.import_manifest(blob, manifest) is True
+    assert _S3Handler.metadata["/prefix/" + blob] == {S3_CODEC_HEADER: CHUNKED}
+    assert s3.blob_codec(blob) == CHUNKED
+    other = _local_store(tmp, "other")
+    with s3.session() as s3sess, other.session() as sess:
+        with s3sess.read_handle(blob) as fd:
+            assert b"".join(iter(lambda: fd.read(1000), b"")) == payload
+        # The chunks come down, and the blob stays chunked.
+        assert s3sess.export_to(sess, blob) is False
+        assert s3sess.export_to(sess, blob) is True
+    assert other.manifest(blob) == manifest
+    with other.read_handle(blob) as fd:
+        assert fd.read() == payload
+
+
+def test_s3_ranged_download_corrupt(tmp, s3_server):
+    payload = b"x" * 2000
+    blob = build_checksum(payload)
+    _S3Handler.objects["/prefix/" + blob] = b"y" * 2000
+    local = _local_store(tmp, "local")
+    with _parts_store(s3_server).session() as s3sess, local.session() as sess:
+        with pytest.raises(ValueError):
+            s3sess.export_to(sess, blob)
+    assert not local.exists(blob)
+    assert local.tmp_dir.dir_list() == []
+
+
+def test_s3_exists_many(s3_server, monkeypatch):
+    monkeypatch.setattr("farmfs.blobstore.EXISTS_BATCH", 10)
+    blobs = sorted(build_checksum(str(i).encode()) for i in range(40))
+    for blob in blobs[:30]:
+        _S3Handler.objects["/prefix/" + blob] = b""
+    s3 = _parts_store(s3_server)
+    assert s3.exists_many([]) == set()
+    # A dense run is answered a page at a time.
+    assert s3.exists_many(blobs[:25] + blobs[35:]) == set(blobs[:25])
+    assert len(_S3Handler.lists) == 4
+    # A sparse set skips ahead between the blobs.
+    _S3Handler.lists = []
+    wanted = [blobs[0], blobs[15], blobs[29], build_checksum(b"absent")]
+    assert s3.exists_many(wanted) == {blobs[0], blobs[15], blobs[29]}
+    assert len(_S3Handler.lists) <= 4
+
+
+def test_exists_many(tmp, monkeypatch):
+    monkeypatch.setattr("farmfs.blobstore.EXISTS_BATCH", 2)
+    server_root = tmp.join("api_server")
+    server_root.mkdir()
+    mkfs(server_root, server_root.join(".farmfs").join("userdata"))
+    app = get_app({"<root>": str(server_root)})
+    local = _local_store(tmp, "local")
+    payloads = [b"a", b"b", b"c"]
+    with _MockServerThread(app, _BS_PORT):
+        remote = HttpBlobstore(f"http://127.0.0.1:{_BS_PORT}", conn_timeout=5)
+        for bs in [local, remote]:
+            with bs.session() as sess:
+                for payload in payloads[:2]:
+                    sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+        wanted = [build_checksum(p) for p in payloads]
+        for bs in [local, remote]:
+            assert bs.exists_many(iter(wanted)) == set(wanted[:2])
+
+
+def test_http_read_many_import_many(tmp):
+    server_root = tmp.join("api_server")
+    server_root.mkdir()
+    mkfs(server_root, server_root.join(".farmfs").join("userdata"))
+    app = get_app({"<root>": str(server_root)})
+    payloads = [b"", b"a", b"bb" * 50000, b"c"]
+    blobs = [build_checksum(p) for p in payloads]
+    missing = build_checksum(b"missing")
+    with _MockServerThread(app, _BS_PORT):
+        bs = HttpBlobstore(f"http://127.0.0.1:{_BS_PORT}", conn_timeout=5)
+        with bs.session() as sess:
+            items = [(blob, len(p), lambda p=p: io.BytesIO(p)) for blob, p in zip(blobs[:3], payloads[:3])]
+            assert sess.import_many(items) == {blob: False for blob in blobs[:3]}
+            items = [(blob, len(p), lambda p=p: io.BytesIO(p)) for blob, p in zip(blobs[2:], payloads[2:])]
+            assert sess.import_many(items) == {blobs[2]: True, blobs[3]: False}
+        with bs.session() as sess:
+            got = []
+            for blob, frame in sess.read_many([blobs[2], missing] + blobs):
+                # Frames only partly read are skipped over.
+                got.append((blob, None if frame is None else frame.read(10)))
+            assert got == [(blobs[2], b"bb" * 5), (missing, None)] + [(blob, p[:10]) for blob, p in zip(blobs, payloads)]
+            with pytest.raises(LifecycleError):
+                for _ in sess.read_many(blobs):
+                    sess.read_handle(blobs[0])
+        assert bs.pool.stats()["discarded"] == 1
+        with bs.session() as sess:
+            with pytest.raises(ValueError):
+                sess.import_many([(blobs[1], 5, lambda: io.BytesIO(b"a"))])
+
+
+class _DroppingHandler(BaseHTTPRequestHandler):
+    """Serves one blob, hanging up half way through any response without a Range."""
+    protocol_version = "HTTP/1.1"
+    payload = bytes(range(256)) * 40
+    requests: List[Dict[str, str]] = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        etag = '"%s"' % md5(self.payload).hexdigest()
+        byte_range = self.headers.get("Range")
+        if byte_range is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.payload)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(self.payload[:len(self.payload) // 2])
+            self.close_connection = True
+            return
+        start = int(byte_range[len("bytes="):-1])
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(self.payload) - start))
+        self.send_header("Content-Range", f"bytes {start}-{len(self.payload) - 1}/{len(self.payload)}")
+        self.end_headers()
+        self.wfile.write(self.payload[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("read_size", [-1, 1000])
+def test_http_read_handle_resumes(read_size):
+    _DroppingHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _DroppingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        bs = HttpBlobstore(f"http://127.0.0.1:{server.server_address[1]}", conn_timeout=5)
+        blob = md5(_DroppingHandler.payload).hexdigest()
+        with bs.session() as sess:
+            with sess.read_handle(blob) as fd:
+                data = b"".join(iter(lambda: fd.read(read_size), b""))
+        assert data == _DroppingHandler.payload
+        half = len(_DroppingHandler.payload) // 2
+        resumed = _DroppingHandler.requests[1]
+        assert (resumed["Range"], resumed["If-Range"]) == (f"bytes={half}-", f'"{blob}"')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,57 @@
+import io
+import random
+
+import pytest
+
+from farmfs.chunking import ChunkedReader, chunk_bounds, chunks
+
+_SIZE = 4096
+
+
+def _data(seed, size):
+    return random.Random(seed).randbytes(size)
+
+
+def test_chunks_round_trip():
+    data = _data(0, 200 * 1024)
+    pieces = list(chunks(io.BytesIO(data), _SIZE))
+    assert b"".join(pieces) == data
+    _, min_size, max_size = chunk_bounds(_SIZE)
+    assert all(min_size <= len(p) <= max_size for p in pieces[:-1])
+    assert 10 < len(pieces) < 200
+    assert list(chunks(io.BytesIO(b""), _SIZE)) == []
+
+
+def test_chunks_survive_an_insert():
+    data = _data(1, 200 * 1024)
+    edited = data[:100000] + b"an insert" + data[100000:]
+    before = list(chunks(io.BytesIO(data), _SIZE))
+    after = list(chunks(io.BytesIO(edited), _SIZE))
+    # Only the chunks around the insert change; the boundaries after it line back up.
+    assert len(set(after) - set(before)) <= 2
+    assert len(set(before) - set(after)) <= 2
+    assert after[-10:] == before[-10:]
+
+
+def test_chunks_of_zeros_are_cut_at_max_size():
+    _, _, max_size = chunk_bounds(_SIZE)
+    pieces = list(chunks(io.BytesIO(bytes(max_size * 3 + 5)), _SIZE))
+    assert [len(p) for p in pieces] == [max_size] * 3 + [5]
+
+
+def test_chunk_bounds_too_small():
+    with pytest.raises(ValueError):
+        chunk_bounds(10)
+
+
+def test_chunked_reader():
+    store = {"a": b"first", "b": b"second"}
+    with ChunkedReader([("a", 5), ("b", 6)], lambda chunk: io.BytesIO(store[chunk])) as reader:
+        assert reader.read(3) == b"fir"
+        assert reader.read() == b"stsecond"
+        assert reader.read() == b""
+    assert reader.closed
+    with pytest.raises(ValueError, match="short"):
+        ChunkedReader([("a", 6)], lambda chunk: io.BytesIO(store[chunk])).read()
+    with pytest.raises(ValueError, match="longer"):
+        ChunkedReader([("b", 5)], lambda chunk: io.BytesIO(store[chunk])).read()
@@ -0,0 +1,53 @@
+import gzip
+import io
+import os
+
+import pytest
+
+from farmfs.codec import (
+    CompressingReader,
+    DecompressingReader,
+    PeekReader,
+    check_codec,
+    gzip_size,
+    worth_compressing,
+)
+
+_TEXT = b"".join(b"line %d of a compressible blob\n" % i for i in range(5000))
+
+
+def test_codec_round_trip():
+    compressed = CompressingReader(io.BytesIO(_TEXT), size=len(_TEXT)).read()
+    assert len(compressed) < len(_TEXT) // 4
+    # The output is plain gzip, and records its size up front.
+    assert gzip.decompress(compressed) == _TEXT
+    assert gzip_size(compressed) == len(_TEXT)
+    assert gzip_size(gzip.compress(_TEXT)) is None
+    reader = DecompressingReader(io.BytesIO(compressed))
+    assert b"".join(iter(lambda: reader.read(1000), b"")) == _TEXT
+    assert DecompressingReader(io.BytesIO(compressed)).read() == _TEXT
+
+
+def test_codec_truncated():
+    compressed = CompressingReader(io.BytesIO(_TEXT)).read()
+    with pytest.raises(ValueError):
+        DecompressingReader(io.BytesIO(compressed[:len(compressed) // 2])).read()
+
+
+@pytest.mark.parametrize("head,worth", [
+    (_TEXT, True),
+    (b"", False),
+    (os.urandom(10000), False),
+    (b"\xff\xd8\xff\xe0" + _TEXT, False),  # JPEG
+    (b"\x00\x00\x00\x18ftypisom" + _TEXT, False),  # mp4
+])
+def test_codec_worth_compressing(head, worth):
+    assert worth_compressing(head) is worth
+
+
+def test_codec_peek():
+    peeked = PeekReader(io.BytesIO(_TEXT), 100)
+    assert peeked.head == _TEXT[:100]
+    assert peeked.read(50) + peeked.read() == _TEXT
+    with pytest.raises(ValueError):
+        check_codec("lzma")
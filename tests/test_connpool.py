@@ -0,0 +1,113 @@
+import threading
+
+import pytest
+
+from farmfs.connpool import ConnectionPool
+
+
+class FakeConn:
+    def __init__(self, n):
+        self.n = n
+        self.healthy = True
+        self.closed = False
+
+
+def build_pool(max_size=2, max_idle=60.0, wait_timeout=0.0):
+    clock = [0.0]
+    made = []
+
+    def connect():
+        made.append(FakeConn(len(made)))
+        return made[-1]
+
+    def close(conn):
+        conn.closed = True
+    pool = ConnectionPool(connect, close, lambda conn: conn.healthy, max_size, max_idle, wait_timeout, lambda: clock[0])
+    return pool, made, clock
+
+
+def test_pool_reuses_most_recent():
+    pool, made, clock = build_pool()
+    with pool.lease() as a, pool.lease() as b:
+        assert (a.n, b.n) == (0, 1)
+    # a went back last, so it is leased first.
+    with pool.lease() as c:
+        assert c is a
+    stats = pool.stats()
+    assert (stats["total"], stats["available"], stats["in_use"]) == (2, 2, 0)
+    assert (stats["created"], stats["reused"]) == (2, 1)
+
+
+def test_pool_max_size_waits():
+    made = []
+    pool = ConnectionPool(lambda: made.append(FakeConn(len(made))) or made[-1], lambda conn: None, lambda conn: True,
+                          max_size=1, wait_timeout=5.0)
+    conn = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    pool.release(conn)
+    waiter.join()
+    assert got == [conn]
+    assert len(made) == 1
+
+
+def test_pool_full_times_out():
+    pool, made, clock = build_pool(max_size=1)
+    with pool.lease():
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+
+
+def test_pool_reserved():
+    pool, made, clock = build_pool(max_size=1)
+    with pool.reserved(2):
+        a, b, c = pool.acquire(), pool.acquire(), pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+        pool.release(a)
+    assert pool.max_size == 1
+    # Connections beyond max_size are closed as they come back.
+    pool.release(b)
+    pool.release(c)
+    assert (a.closed, b.closed, c.closed) == (False, True, True)
+    assert (pool.stats()["total"], pool.stats()["discarded"]) == (1, 0)
+
+
+def test_pool_evicts_idle():
+    pool, made, clock = build_pool(max_idle=10.0)
+    with pool.lease() as a:
+        pass
+    clock[0] = 11.0
+    with pool.lease() as b:
+        assert b is not a
+    assert a.closed
+    assert pool.stats()["evicted"] == 1
+
+
+def test_pool_replaces_unhealthy_and_failed():
+    pool, made, clock = build_pool()
+    with pool.lease() as a:
+        pass
+    a.healthy = False
+    with pool.lease() as b:
+        assert b is not a
+    with pytest.raises(ValueError):
+        with pool.lease() as c:
+            raise ValueError("broken")
+    assert c is b and b.closed
+    stats = pool.stats()
+    assert (stats["total"], stats["discarded"]) == (0, 2)
+
+
+def test_pool_close():
+    pool, made, clock = build_pool()
+    conn = pool.acquire()
+    with pool.lease() as idle:
+        pass
+    pool.close()
+    assert idle.closed and not conn.closed
+    pool.release(conn)
+    assert conn.closed
+    with pytest.raises(RuntimeError):
+        pool.acquire()
@@ -12,6 +12,7 @@ from farmfs.farmd import (
     JobRunner,
     JobState,
     VolumeConfig,
+    build_farmfs_argv,
     run_job,
 )
 from farmfs.farmd_ui import (
@@ -160,6 +161,18 @@ def test_job_add_fsck(farmd_vol: Path) -> None:
     assert vc.jobs[0].schedule == ALWAYS_SCHEDULE_NAME
 
 
+def test_job_add_fsck_scrub(farmd_vol: Path) -> None:
+    farmd_ui(["volume", "add", "media", "/Volumes/Media"], farmd_vol)
+    rc = farmd_ui(
+        ["job", "add", "fsck", "media", "--every=1d", "--checksums", "--scrub", "--rate=50M"],
+        farmd_vol,
+    )
+    assert rc == 0
+    job = _jr(farmd_vol).volumedb.read("media").jobs[0]
+    assert job.flags == ["--checksums", "--scrub", "--rate=50M"]
+    assert build_farmfs_argv(job) == ["fsck", "--checksums", "--scrub", "--rate=50M"]
+
+
 def test_job_add_fsck_multi_flags(farmd_vol: Path) -> None:
     farmd_ui(["volume", "add", "media", "/Volumes/Media"], farmd_vol)
     rc = farmd_ui(
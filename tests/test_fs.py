@@ -10,6 +10,8 @@ from farmfs.fs import (
     IsADirectory,
     NotPermitted,
     Path,
+    COPY_METHODS,
+    fastcopy,
     ensure_absent,
     ensure_copy,
     ensure_dir,
@@ -19,6 +21,10 @@ from farmfs.fs import (
     ensure_rename,
     walk,
     walk_from,
+    WALK_ENGINES,
+    get_walk_engine,
+    set_walk_engine,
+    ignored_path_checker,
 )
 from farmfs.fs import XSym
 import pytest
@@ -787,6 +793,45 @@ def test_copy_file(tmp_path) -> None:
     assert not pdne.exists()
 
 
+@pytest.mark.parametrize("method", COPY_METHODS)
+def test_fastcopy(tmp_path, method) -> None:
+    tmp = Path(str(tmp_path))
+    s = tmp.join("s")
+    data = bytes(range(256)) * 1000
+    with s.open("wb") as fd:
+        fd.write(data)
+    # Whichever method is asked for, the copy either succeeds with it or falls back to buffers.
+    for offset in [0, 1000]:
+        with s.open("rb") as src, tmp.join("d").open("wb") as dst:
+            src.seek(offset)
+            used = fastcopy(src, dst, [method])
+            assert used in (method, "buffered")
+            assert src.tell() == len(data) and dst.tell() == len(data) - offset
+        with tmp.join("d").open("rb") as fd:
+            assert fd.read() == data[offset:]
+
+
+def test_fastcopy_falls_back(tmp_path) -> None:
+    import io
+    tmp = Path(str(tmp_path))
+    d = tmp.join("d")
+    with d.open("wb") as dst:
+        assert fastcopy(io.BytesIO(b"abc"), dst) == "buffered"
+    with d.open("rb") as fd:
+        assert fd.read() == b"abc"
+    # A source with data read ahead of its descriptor is copied through buffers, from where it is.
+    s = tmp.join("s")
+    with s.open("wb") as fd:
+        fd.write(b"0123456789")
+    with s.open("rb") as src, d.open("wb") as dst:
+        assert src.read(1) == b"0"
+        assert fastcopy(src, dst) == "buffered"
+    with d.open("rb") as fd:
+        assert fd.read() == b"123456789"
+    with pytest.raises(ValueError):
+        fastcopy(io.BytesIO(b""), io.BytesIO(), ["teleport"])
+
+
 def test_ensure_copy(tmp_path) -> None:
     tmp = Path(str(tmp_path))
     s = tmp.join("s")
@@ -1021,3 +1066,55 @@ def test_walk_from_oracle(vol):
             f"  expected: {[str(p) for p, _ in expected]}\n"
             f"  got:      {[str(p) for p, _ in result]}"
         )
+
+
+@pytest.mark.parametrize("engine", sorted(WALK_ENGINES))
+def test_walk_from_oracle_engines(vol, engine):
+    """Every engine's walk_from must be a suffix of the listdir walk."""
+    from tests.conftest import build_blob
+    from farmfs import getvol
+
+    for data in [b"alpha", b"beta", b"gamma", b"delta", b"epsilon"]:
+        build_blob(vol, data)
+    root = getvol(vol).bs.root
+    oracle = list(walk(root, engine="listdir"))
+    assert list(walk(root, engine=engine)) == oracle
+    for i, (start_path, _) in enumerate(oracle):
+        assert list(walk_from(root, start_path, engine=engine)) == oracle[i:]
+
+
+def test_walk_engines_agree(tmp_path) -> None:
+    root = Path(str(tmp_path))
+    for d in ["a", "a/b", "a/b/c", "ab", "z", "skipme", "skipme/inner"]:
+        root.join(d).mkdir()
+    for f in ["a/1", "a/b/2", "a/b/c/3", "ab/4", "a.txt", "skipme/inner/5"]:
+        with root.join(f).open("w") as fd:
+            fd.write(f)
+    root.join("a/link").symlink(root.join("a.txt"))
+    root.join("dirlink").symlink(root.join("a"))
+    root.join("broken").symlink(root.join("nowhere"))
+    skip = ignored_path_checker([str(root.join("skipme"))])
+    listed = list(walk(root, skip=skip, engine="listdir"))
+    scanned = list(walk(root, skip=skip, engine="scandir"))
+    assert scanned == listed
+    types = dict((p.relative_to(root), t) for p, t in scanned)
+    assert types["dirlink"] == "link"
+    assert types["broken"] == "link"
+    assert types["a/b/c"] == "dir"
+    assert types["a/b/c/3"] == "file"
+    assert "skipme" not in types
+    assert "skipme/inner/5" not in types
+
+
+def test_set_walk_engine() -> None:
+    original = get_walk_engine()
+    try:
+        set_walk_engine("listdir")
+        assert get_walk_engine() == "listdir"
+        with pytest.raises(ValueError):
+            set_walk_engine("bogus")
+        assert get_walk_engine() == "listdir"
+    finally:
+        set_walk_engine(original)
+    with pytest.raises(ValueError):
+        list(walk(ROOT, engine="bogus"))
@@ -0,0 +1,94 @@
+import os
+import threading
+from farmfs.hashcache import HashCache, RACY_NS
+from .conftest import build_file, build_checksum
+
+
+def age(path, ns=10 * RACY_NS):
+    """Push path's mtime into the past, so its cache entry isn't racy."""
+    st = path.stat()
+    os.utime(path._path, ns=(st.st_atime_ns, st.st_mtime_ns - ns))
+
+
+def test_checksum_hit(tmp):
+    a = build_file(tmp, "a", "a")
+    age(a)
+    with HashCache(tmp.join("cache.db")) as cache:
+        assert cache.checksum(a) == build_checksum(b"a")
+        assert (cache.hits, cache.misses) == (0, 1)
+        assert cache.checksum(a) == build_checksum(b"a")
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_checksum_persists(tmp):
+    a = build_file(tmp, "a", "a")
+    age(a)
+    with HashCache(tmp.join("cache.db")) as cache:
+        cache.checksum(a)
+    with HashCache(tmp.join("cache.db")) as cache:
+        assert cache.checksum(a) == build_checksum(b"a")
+        assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_checksum_modified(tmp):
+    a = build_file(tmp, "a", "a")
+    age(a)
+    with HashCache(tmp.join("cache.db")) as cache:
+        cache.checksum(a)
+        # Same size, and mtime put back: only ctime gives the write away.
+        st = a.stat()
+        build_file(tmp, "a", "b")
+        os.utime(a._path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert cache.checksum(a) == build_checksum(b"b")
+        assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_checksum_racy(tmp):
+    a = build_file(tmp, "a", "a")
+    with HashCache(tmp.join("cache.db")) as cache:
+        cache.checksum(a)
+        assert cache.checksum(a) == build_checksum(b"a")
+        assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_clear(tmp):
+    a = build_file(tmp, "a", "a")
+    age(a)
+    with HashCache(tmp.join("cache.db")) as cache:
+        cache.checksum(a)
+        cache.clear()
+        assert cache.lookup(a.stat()) is None
+
+
+def test_checksum_threads(tmp):
+    files = [build_file(tmp, str(i), str(i)) for i in range(50)]
+    for f in files:
+        age(f)
+    errors = []
+    with HashCache(tmp.join("cache.db")) as cache:
+        def hash_all():
+            try:
+                for i, f in enumerate(files):
+                    assert cache.checksum(f) == build_checksum(str(i).encode())
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=hash_all) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert cache.hits + cache.misses == 4 * len(files)
+
+
+def test_dir_digest(tmp):
+    d = tmp.join("d")
+    d.mkdir()
+    age(d)
+    with HashCache(tmp.join("cache.db")) as cache:
+        assert cache.lookup_dir(d.stat(), "scope") is None
+        cache.record_dir(d.stat(), "scope", "0" * 32, ["x", "y"])
+        assert cache.lookup_dir(d.stat(), "scope") == ("0" * 32, ["x", "y"])
+        assert cache.lookup_dir(d.stat(), "other scope") is None
+        build_file(d, "f", "f")
+        assert cache.lookup_dir(d.stat(), "scope") is None
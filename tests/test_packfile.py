@@ -0,0 +1,66 @@
+import pytest
+
+from farmfs.packfile import PackIndex, Packs
+from .conftest import build_checksum
+
+
+def _packs(tmp):
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    return Packs(tmp.join("packs"), scratch)
+
+
+def test_pack_index():
+    entries = [(build_checksum(str(i).encode()), i * 10, 10) for i in range(100)]
+    index = PackIndex(PackIndex.encode(reversed(entries)))
+    assert len(index) == 100
+    assert list(index.entries()) == sorted(entries)
+    for blob, offset, length in entries:
+        assert index.find(blob) == (offset, length)
+    assert index.find(build_checksum(b"missing")) is None
+    middle = sorted(entries)[50][0]
+    assert [blob for blob, _, _ in index.entries(middle)] == [blob for blob, _, _ in sorted(entries)[51:]]
+    with pytest.raises(ValueError):
+        PackIndex(b"FARMPIDX")
+    with pytest.raises(ValueError):
+        PackIndex(PackIndex.encode(entries)[:-1])
+
+
+def test_packs_read_and_delete(tmp):
+    packs = _packs(tmp)
+    assert packs.find(build_checksum(b"a")) is None
+    assert list(packs.blobs()) == []
+    payloads = [b"a" * 100, b"b" * 100, b"c" * 100]
+    blobs = [build_checksum(p) for p in payloads]
+    packs.write(zip(blobs[:2], payloads[:2]))
+    packs.write(zip(blobs[1:], payloads[1:]))
+    assert list(packs.blobs()) == sorted(blobs)
+    assert list(packs.blobs(sorted(blobs)[0])) == sorted(blobs)[1:]
+    for blob, payload in zip(blobs, payloads):
+        with packs.open(blob) as fd:
+            assert fd.read(10) + fd.read() == payload
+            assert fd.read() == b""
+    # Deleting from a pack which stays mostly live only rewrites its index.
+    assert packs.delete(blobs[0]) is True
+    assert packs.delete(blobs[0]) is False
+    assert packs.find(blobs[0]) is None
+    # b is in both packs, and removing it leaves each with too little to keep.
+    assert packs.delete(blobs[1]) is True
+    assert [blob for blob in packs.blobs()] == [blobs[2]]
+    assert len(packs.pack_dir.dir_list()) == 2
+    with packs.open(blobs[2]) as fd:
+        assert fd.read() == payloads[2]
+    with pytest.raises(FileNotFoundError):
+        packs.open(blobs[0])
+
+
+def test_packs_repack(tmp):
+    packs = _packs(tmp)
+    payloads = [bytes([i]) * 100 for i in range(4)]
+    blobs = [build_checksum(p) for p in payloads]
+    packs.write(zip(blobs, payloads))
+    packs.delete(blobs[0])
+    assert packs.repack() == 100
+    assert packs.repack() == 0
+    assert list(packs.blobs()) == sorted(blobs[1:])
+    assert sum(p.stat().st_size for p in packs.pack_dir.dir_list() if p.name().endswith(".pack")) == 300
@@ -262,3 +262,29 @@ def test_pull_path_dest_not_in_volume(tmp_path_factory):
     dst_path = str(bare.join("dest"))
     with pytest.raises(ValueError, match="Volume not found"):
         farmfs_ui(["pull-path", src_path, dst_path], remote_path)
+
+
+# ---------------------------------------------------------------------------
+# Group P9: blobs are fetched ahead of the tree ops, a batch at a time
+# ---------------------------------------------------------------------------
+
+def test_pull_prefetch_batches(tmp_path_factory, monkeypatch):
+    import farmfs.volume
+    monkeypatch.setattr(farmfs.volume, "FETCH_BATCH", 3)
+    remote_path = _make_vol(tmp_path_factory, "remote")
+    local_path = _make_vol(tmp_path_factory, "local")
+
+    build_dir(remote_path, "d")
+    for i in range(10):
+        # Pairs of links share a blob, so some batches ask for a blob twice.
+        build_link(remote_path, "d/%02d" % i, build_blob(remote_path, b"blob %d" % (i // 2)))
+    _write_snap(remote_path, "v1")
+
+    r = farmfs_ui(["remote", "add", "origin", str(remote_path)], local_path)
+    assert r == 0
+    r = farmfs_ui(["pull", "--workers=3", "origin", "v1"], local_path)
+    assert r == 0
+
+    assert list(getvol(local_path).tree()) == _snap_items(remote_path, "v1")
+    local_vol = getvol(local_path)
+    assert all(local_vol.bs.exists(item.csum()) for item in local_vol.tree() if item.is_link())
@@ -0,0 +1,42 @@
+from farmfs.refindex import RefIndex, MAX_MISMATCHES
+
+
+def test_adjust(tmp):
+    refs = RefIndex(tmp.join("refs.db"))
+    refs.adjust(["a", "b", "a"], 1)
+    assert (refs.count("a"), refs.count("b"), refs.count("c")) == (2, 1, 0)
+    refs.adjust(["a", "b"], -1)
+    assert refs.unused() == ["b"]
+    refs.forget(["b"])
+    assert refs.unused() == []
+    refs.close()
+    # Counts are committed as they are made.
+    refs = RefIndex(tmp.join("refs.db"))
+    assert refs.count("a") == 1
+
+
+def test_reconcile(tmp):
+    refs = RefIndex(tmp.join("refs.db"))
+    assert not refs.built()
+    refs.adjust(["a", "gone"], 1)
+    assert refs.reconcile(["a", "a", "b"], ["a", "b", "c"], fix=False) == [
+        "a: counted 1, referenced 2",
+        "b: counted 0, referenced 1",
+        "gone: counted 1, but the blob is gone",
+    ]
+    assert not refs.built()
+    assert refs.count("a") == 1
+    assert len(refs.reconcile(["a", "a", "b"], ["a", "b", "c"], fix=True)) == 3
+    assert refs.built()
+    assert (refs.count("a"), refs.count("b"), refs.count("gone")) == (2, 1, 0)
+    # Unreferenced blobs are counted as unused.
+    assert refs.unused() == ["c"]
+    assert refs.reconcile(["a", "a", "b"], ["a", "b", "c"], fix=False) == []
+
+
+def test_reconcile_many(tmp):
+    refs = RefIndex(tmp.join("refs.db"))
+    blobs = ["%04d" % i for i in range(100)]
+    mismatches = refs.reconcile(blobs, blobs, fix=False)
+    assert len(mismatches) == MAX_MISMATCHES + 1
+    assert mismatches[-1] == "... (100 wrong counts total)"
@@ -0,0 +1,48 @@
+import pytest
+from s3lib import Connection
+
+from farmfs import s3request
+from farmfs.blobstore import is_s3_exception
+from farmfs.s3request import UnsupportedS3Lib, check_s3lib, s3_call, s3_head
+
+
+@pytest.fixture(autouse=True)
+def fresh_check():
+    check_s3lib.cache_clear()
+    yield
+    check_s3lib.cache_clear()
+
+
+def test_installed_s3lib_supported():
+    check_s3lib()
+
+
+@pytest.mark.parametrize("installed", ["2.2.9", "3.0.0", "unknown"])
+def test_unsupported_s3lib_version(monkeypatch, installed):
+    monkeypatch.setattr(s3request, "version", lambda name: installed)
+    with pytest.raises(UnsupportedS3Lib, match=f"need s3lib >=2.3,<3.0, found {installed}") as e:
+        s3_call(None, "HEAD", "key", "bucket", {}, {})  # type: ignore[arg-type]
+    assert not is_s3_exception(e.value)
+
+
+def test_s3lib_without_request_path(monkeypatch):
+    monkeypatch.delattr(Connection, "_s3_request")
+    with pytest.raises(UnsupportedS3Lib):
+        check_s3lib()
+
+
+class HeadConn:
+    def __init__(self, status):
+        self.status = status
+
+    def head_object(self, bucket, key):
+        if self.status != 200:
+            raise ValueError("S3 request failed with:\n%s Reason\n\n" % self.status)
+        return [("X-Amz-Meta-Farmfs-Codec", "gzip")]
+
+
+def test_s3_head():
+    assert s3_head(HeadConn(200), "bucket", "key") == {"x-amz-meta-farmfs-codec": "gzip"}  # type: ignore[arg-type]
+    assert s3_head(HeadConn(404), "bucket", "key") is None  # type: ignore[arg-type]
+    with pytest.raises(ValueError, match="403"):
+        s3_head(HeadConn(403), "bucket", "key")  # type: ignore[arg-type]
@@ -0,0 +1,97 @@
+import io
+from itertools import islice
+
+from farmfs.blobstore import FileBlobstore
+from farmfs.scrub import DAY_NS, ScrubIndex, scrub
+from farmfs.fs import ensure_readonly
+from .conftest import build_checksum
+
+
+def build_store(tmp, count):
+    ud = tmp.join("userdata")
+    ud.mkdir()
+    scratch = tmp.join("tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(ud, scratch)
+    with bs.session() as sess:
+        for i in range(count):
+            payload = str(i).encode()
+            sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+    return bs
+
+
+def serial_checksums(bs):
+    def blob_checksums(blobs):
+        return ((blob, bs.blob_checksum(blob)) for blob in blobs)
+    return blob_checksums
+
+
+def test_scrub_resumes(tmp):
+    bs = build_store(tmp, 30)
+    blobs = list(bs.blobs())
+    with ScrubIndex(tmp.join("scrub.db")) as index:
+        first = [blob for blob, _ in islice(scrub(bs, index, serial_checksums(bs), DAY_NS), 10)]
+        assert first == blobs[:10]
+        assert index.cursor() == blobs[9]
+    # The next run carries on from the cursor, and wraps it once the listing is done.
+    with ScrubIndex(tmp.join("scrub.db")) as index:
+        second = [blob for blob, _ in scrub(bs, index, serial_checksums(bs), DAY_NS)]
+        assert second == blobs[10:]
+        assert index.cursor() is None
+        assert list(scrub(bs, index, serial_checksums(bs), DAY_NS)) == []
+
+
+def test_scrub_cursor_waits_for_slow_blobs(tmp):
+    bs = build_store(tmp, 10)
+    blobs = list(bs.blobs())
+
+    def out_of_order(pairs):
+        """Finish the first blob last."""
+        held = None
+        for blob in pairs:
+            if held is None:
+                held = blob
+            else:
+                yield blob, bs.blob_checksum(blob)
+        yield held, bs.blob_checksum(held)
+
+    with ScrubIndex(tmp.join("scrub.db")) as index:
+        run = scrub(bs, index, out_of_order, DAY_NS)
+        assert [blob for blob, _ in islice(run, 9)] == blobs[1:]
+        assert index.cursor() is None or index.cursor() < blobs[0]
+        assert next(run) == (blobs[0], blobs[0])
+        assert index.cursor() is None
+
+
+def test_scrub_overdue_first(tmp):
+    bs = build_store(tmp, 5)
+    blobs = list(bs.blobs())
+    clock = [10 * DAY_NS]
+    with ScrubIndex(tmp.join("scrub.db")) as index:
+        for age, blob in enumerate(blobs):
+            index.record(blob, clock[0] - age * DAY_NS)
+        # Nothing is overdue yet.
+        assert list(scrub(bs, index, serial_checksums(bs), 30 * DAY_NS, now_ns=lambda: clock[0])) == []
+        # The longest overdue come first, and once verified are not overdue any more.
+        verified = [blob for blob, _ in scrub(bs, index, serial_checksums(bs), 2 * DAY_NS, now_ns=lambda: clock[0])]
+        assert verified == [blobs[4], blobs[3]]
+        assert index.verified_at(blobs[4]) == clock[0]
+
+
+def test_scrub_corrupt_and_missing(tmp):
+    bs = build_store(tmp, 4)
+    blobs = list(bs.blobs())
+    with ScrubIndex(tmp.join("scrub.db")) as index:
+        assert len(list(scrub(bs, index, serial_checksums(bs), DAY_NS))) == 4
+        corrupt = bs.blob_path(blobs[0])
+        corrupt.unlink()
+        with corrupt.open("w") as fd:
+            fd.write("corrupt")
+        ensure_readonly(corrupt)
+        bs.delete_blob(blobs[1])
+        # Re-verify everything: the corrupt blob is reported, the missing one forgotten.
+        results = list(scrub(bs, index, serial_checksums(bs), 0))
+        assert (blobs[0], build_checksum(b"corrupt")) in results
+        assert blobs[1] not in [blob for blob, _ in results]
+        assert index.verified_at(blobs[1]) is None
+        assert index.verified_at(blobs[0]) < index.verified_at(blobs[2])
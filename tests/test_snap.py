@@ -6,14 +6,20 @@ Group B: snapdb.write + snapdb.read is lossless.
 Group C: patch(T1, diff(T1, T2)) produces a volume equal to T2.
 Group D: same as C but diff uses live trees; assertion compares snapshots.
          Isolates tree_diff+tree_patch from snap serialisation bugs.
+Group E: diffs of trees with cached directory digests match full diffs.
+         Directory digests are only stored in binary snapshots.
 """
 
+import os
 from typing import cast
 
+import pytest
+
 from farmfs import getvol
+from farmfs.hashcache import RACY_NS
 from farmfs.volume import mkfs, tree_diff, tree_patch
 from farmfs.snapshot import KeySnapshot
-from farmfs.fs import Path, DIR, LINK
+from farmfs.fs import Path, DIR, LINK, walk
 from tests.conftest import build_blob, build_link, build_dir
 from tests.trees2 import csum_bytes
 
@@ -163,3 +169,83 @@ def test_live_diff_snap_equal(tmp_path_factory, tree2_pair):
     vol2.snapdb.write("s2", cast(KeySnapshot, vol2.tree()), overwrite=True)
 
     assert list(vol1.snapdb.read("s1")) == list(vol2.snapdb.read("s2"))
+
+
+# ---------------------------------------------------------------------------
+# Group E: diffs of a tree with cached directory digests match full diffs
+# ---------------------------------------------------------------------------
+
+def _age_dirs(root: Path) -> None:
+    """Push every directory's mtime into the past, so cached digests aren't racy."""
+    for path, type_ in walk(root):
+        if type_ == DIR:
+            st = path.stat()
+            os.utime(path._path, ns=(st.st_atime_ns, st.st_mtime_ns - 10 * RACY_NS))
+
+
+@pytest.fixture
+def binary_snaps(monkeypatch):
+    monkeypatch.setattr("farmfs.snapformat.DEFAULT_SNAP_FORMAT", "binary-zlib")
+
+
+def test_cached_digest_diff(tmp_path_factory, tree2_pair, binary_snaps):
+    tree1, tree2 = tree2_pair
+
+    vol1_path = _make_vol(tmp_path_factory, "vol1")
+    vol2_path = _make_vol(tmp_path_factory, "vol2")
+
+    _build_tree(vol1_path, tree1)
+    _build_tree(vol2_path, tree2)
+    _age_dirs(vol1_path)
+
+    vol1 = getvol(vol1_path)
+    vol2 = getvol(vol2_path)
+    vol2.snapdb.write("s2", cast(KeySnapshot, vol2.tree()), overwrite=True)
+    with vol1.hash_cache() as cache:
+        # The first walk records digests, the second uses them.
+        vol1.snapdb.write("s1", cast(KeySnapshot, vol1.tree(cache)), overwrite=True)
+        cached = tree_diff(vol1.tree(cache), vol2.snapdb.read("s2"))
+        assert tree_diff(vol1.tree(cache), vol1.snapdb.read("s1")) == []
+    full = tree_diff(vol1.tree(), vol2.snapdb.read("s2"))
+    assert [str(d) for d in cached] == [str(d) for d in full]
+
+
+def test_cached_digest_prunes(tmp_path_factory, binary_snaps):
+    vol_path = _make_vol(tmp_path_factory, "vol")
+    for d in ["a", "a/b", "c"]:
+        build_dir(vol_path, d)
+    build_link(vol_path, "a/b/x", build_blob(vol_path, b"x"))
+    build_link(vol_path, "c/y", build_blob(vol_path, b"y"))
+    _age_dirs(vol_path)
+    vol = getvol(vol_path)
+    with vol.hash_cache() as cache:
+        vol.snapdb.write("s", cast(KeySnapshot, vol.tree(cache)), overwrite=True)
+        digests = {i.pathStr(): i.digest() for i in vol.tree(cache) if i.is_dir()}
+        stored = {i.pathStr(): i.digest() for i in vol.snapdb.read("s") if i.is_dir()}
+        assert digests == stored
+        # An unchanged tree is diffed from the root's digest alone.
+        tree = iter(vol.tree(cache))
+        root = next(tree)
+        assert root.digest() == stored["."]
+        tree.prune()
+        assert next(tree, None) is None
+        # Only the directories above a change lose their digests.
+        build_link(vol_path, "a/b/z", build_blob(vol_path, b"z"))
+        digests = {i.pathStr(): i.digest() for i in vol.tree(cache) if i.is_dir()}
+        assert digests == {".": None, "a": None, "a/b": None, "c": stored["c"]}
+        assert [str(d) for d in tree_diff(vol.tree(cache), vol.snapdb.read("s"))] == ['("a/b/z", removed, None)']
+
+
+def test_json_snapshot_has_no_digests(tmp_path_factory, monkeypatch):
+    """Older farmfs releases reject snapshot dicts with keys they don't know."""
+    monkeypatch.setattr("farmfs.snapformat.DEFAULT_SNAP_FORMAT", "json")
+    vol_path = _make_vol(tmp_path_factory, "vol")
+    build_dir(vol_path, "a")
+    build_link(vol_path, "a/x", build_blob(vol_path, b"x"))
+    _age_dirs(vol_path)
+    vol = getvol(vol_path)
+    with vol.hash_cache() as cache:
+        vol.snapdb.write("s", cast(KeySnapshot, vol.tree(cache)), overwrite=True)
+        assert [set(item) for item in vol.keydb.read("snaps/s")] == [{"path", "type"}] * 2 + [{"path", "type", "csum"}]
+        assert all(i.digest() is None for i in vol.snapdb.read("s"))
+        assert tree_diff(vol.tree(cache), vol.snapdb.read("s")) == []
@@ -0,0 +1,158 @@
+import pytest
+from io import BytesIO
+from farmfs import snapformat
+from farmfs.snapformat import SnapshotKeyDB, decode, decode_items, encode
+from farmfs.keydb import BlobKeyDB, keydb_encoder
+from farmfs.snapshot import add_dir_digests
+from farmfs.ui import farmfs_ui
+from farmfs import getvol
+from farmfs.util import egest
+from .conftest import build_checksum, build_dir, build_file
+
+codecs = [snapformat.CODEC_NONE, snapformat.CODEC_ZLIB, snapformat.CODEC_ZSTD]
+
+
+def codec_available(codec):
+    if codec == snapformat.CODEC_ZSTD and snapformat.zstandard is None:
+        pytest.skip("zstandard is not installed")
+
+
+def snap_dicts(count):
+    items = [{"path": ".", "type": "dir"}]
+    for d in range(10):
+        items.append({"path": "Photos/été %d" % d, "type": "dir"})
+        for i in range(d, count, 10):
+            items.append({"path": "Photos/été %d/IMG_%06d.jpg" % (d, i),
+                          "type": "link",
+                          "csum": build_checksum(str(i).encode())})
+    return items
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_round_trip(codec):
+    codec_available(codec)
+    items = snap_dicts(500)
+    data = encode(items, codec)
+    assert snapformat.is_binary(data)
+    assert [i.get_dict() for i in decode(data)] == items
+
+
+def test_empty_round_trip():
+    assert decode(encode([])) == []
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_streams(codec):
+    """Items come out before the whole snapshot has been read."""
+    codec_available(codec)
+    fd = BytesIO(encode(snap_dicts(100000), codec))
+    items = decode_items(fd)
+    first = next(items)
+    assert first.pathStr() == "."
+    assert fd.tell() < len(fd.getvalue())
+
+
+def test_smaller_than_json():
+    items = snap_dicts(20000)
+    json_size = len(egest(keydb_encoder.encode(items)))
+    assert len(encode(items, snapformat.CODEC_NONE)) * 2 < json_size
+    assert len(encode(items, snapformat.CODEC_ZLIB)) * 5 < json_size
+
+
+@pytest.mark.parametrize("mangle", [
+    lambda data: data[:-3],
+    lambda data: data[:12] + b"\xff" * 8 + data[20:],
+    lambda data: data + b"\x01",
+    lambda data: data[:8] + b"\x09" + data[9:],
+])
+def test_corrupt(mangle):
+    data = encode(snap_dicts(100), snapformat.CODEC_NONE)
+    with pytest.raises(ValueError):
+        decode(mangle(data))
+
+
+@pytest.mark.parametrize("snap_format", ["json", "binary-none", "binary-zlib"])
+def test_keydb_reads_both(vol, snap_format):
+    fsvol = getvol(vol)
+    db = SnapshotKeyDB(fsvol.blob_db, snap_format)
+    items = snap_dicts(50)
+    db.write("snaps/a", items, overwrite=False)
+    assert snapformat.is_binary(fsvol.blob_db.read("snaps/a")) == snap_format.startswith("binary")
+    assert [i if isinstance(i, dict) else i.get_dict() for i in db.read("snaps/a")] == items
+    assert db.verify("snaps/a")
+    # Whatever we write, the other format's snapshots still read.
+    other = SnapshotKeyDB(fsvol.blob_db, "json" if snap_format != "json" else "binary-zlib")
+    assert [i if isinstance(i, dict) else i.get_dict() for i in other.read("snaps/a")] == items
+
+
+def test_unknown_format(tmp):
+    with pytest.raises(ValueError):
+        SnapshotKeyDB(BlobKeyDB(tmp, tmp), "yaml")
+
+
+def test_binary_snap_ui(vol, monkeypatch, capsys):
+    monkeypatch.setattr(snapformat, "DEFAULT_SNAP_FORMAT", "binary-zlib")
+    a = build_dir(vol, "a")
+    build_file(a, "b", "b")
+    build_file(vol, "c", "c")
+    assert farmfs_ui(["freeze"], vol) == 0
+    assert farmfs_ui(["snap", "make", "mysnap"], vol) == 0
+    fsvol = getvol(vol)
+    assert snapformat.is_binary(fsvol.blob_db.read("snaps/mysnap"))
+    capsys.readouterr()
+    assert farmfs_ui(["snap", "read", "mysnap"], vol) == 0
+    captured = capsys.readouterr()
+    assert captured.out == (
+        "<dir . None>\n<dir a None>\n"
+        f"<link a/b {build_checksum(b'b')}>\n<link c {build_checksum(b'c')}>\n"
+    )
+    vol.join("c").unlink()
+    assert farmfs_ui(["snap", "restore", "mysnap"], vol) == 0
+    assert vol.join("c").islink()
+    assert farmfs_ui(["fsck", "--quiet", "--keydb"], vol) == 0
+    # Corrupt the snapshot's records, but store it as a well formed blob.
+    raw = fsvol.blob_db.read("snaps/mysnap")
+    fsvol.blob_db.write("snaps/mysnap", raw[:-4], overwrite=True)
+    capsys.readouterr()
+    assert farmfs_ui(["fsck", "--quiet", "--keydb"], vol) == 16
+    captured = capsys.readouterr()
+    assert "CORRUPT keydb key: snaps/mysnap (invalid binary snapshot" in captured.out
+
+
+def test_json_snap_readable_in_binary_mode(vol, monkeypatch, capsys):
+    build_file(vol, "c", "c")
+    assert farmfs_ui(["freeze"], vol) == 0
+    assert farmfs_ui(["snap", "make", "old"], vol) == 0
+    monkeypatch.setattr(snapformat, "DEFAULT_SNAP_FORMAT", "binary-zlib")
+    assert farmfs_ui(["snap", "make", "new"], vol) == 0
+    fsvol = getvol(vol)
+    assert not snapformat.is_binary(fsvol.blob_db.read("snaps/old"))
+    assert snapformat.is_binary(fsvol.blob_db.read("snaps/new"))
+    capsys.readouterr()
+    assert farmfs_ui(["snap", "diff", "old"], vol) == 0
+    assert farmfs_ui(["snap", "diff", "new"], vol) == 0
+    assert capsys.readouterr().out == ""
+
+
+def test_dir_digest_round_trip():
+    items = add_dir_digests(snap_dicts(100))
+    data = encode(items, snapformat.CODEC_NONE)
+    assert [dict(i.get_dict(), digest=i.digest()) if i.is_dir() else i.get_dict() for i in decode(data)] == items
+    # Directory digests cost 16 bytes each.
+    assert len(data) == len(encode(snap_dicts(100), snapformat.CODEC_NONE)) + 11 * snapformat.DIGEST_LEN
+
+
+def test_keydb_digests_binary_only(vol):
+    fsvol = getvol(vol)
+    items = snap_dicts(20)
+    SnapshotKeyDB(fsvol.blob_db, "json").write("snaps/j", add_dir_digests(snap_dicts(20)), overwrite=False)
+    assert fsvol.keydb.read("snaps/j") == items
+    db = SnapshotKeyDB(fsvol.blob_db, "binary-zlib")
+    db.write("snaps/b", items, overwrite=False)
+    stored = decode(fsvol.blob_db.read("snaps/b"))
+    assert [i.digest() for i in stored if i.is_dir()] == [i["digest"] for i in add_dir_digests(snap_dicts(20)) if "digest" in i]
+    assert snapformat.stale_digests(stored) == []
+    stale = add_dir_digests(snap_dicts(20))
+    stale[0]["digest"] = "0" * 32
+    fsvol.blob_db.write("snaps/b", encode(stale), overwrite=True)
+    assert db.diagnose("snaps/b") == ["directory digest of . doesn't match its contents"]
@@ -0,0 +1,235 @@
+import io
+import random
+import threading
+
+import pytest
+
+import farmfs.util
+from farmfs import getvol
+from farmfs.api import get_app
+from farmfs.apiserver import ApiServer
+from farmfs.blobstore import BlobRejected, FileBlobstore, FileBlobstoreSession, HttpBlobstore, HttpBlobstoreSession
+from farmfs.transfer import SessionPool, Transfer, fetch_blobs, missing_blobs
+from .conftest import build_checksum
+
+
+def build_store(tmp, name, payloads=()):
+    ud = tmp.join(name)
+    ud.mkdir()
+    scratch = tmp.join(name + "_tmp")
+    scratch.mkdir()
+    bs = FileBlobstore(ud, scratch)
+    with bs.session() as sess:
+        for payload in payloads:
+            sess.import_via_fd(lambda p=payload: io.BytesIO(p), build_checksum(payload))
+    return bs
+
+
+def test_transfer_copies_all(tmp):
+    payloads = [str(i).encode() * (i + 1) for i in range(20)]
+    src = build_store(tmp, "src", payloads)
+    dst = build_store(tmp, "dst")
+    with Transfer(src, dst, workers=4) as xfer:
+        copied = list(xfer.copy(src.blobs()))
+    assert sorted(copied) == list(src.blobs())
+    assert list(dst.blobs()) == list(src.blobs())
+    assert xfer.stats.blobs == 20
+    assert xfer.stats.bytes == sum(len(p) for p in payloads)
+    assert xfer.src_pool.opened <= 4
+    assert "20 blobs" in xfer.stats.summary()
+
+
+def test_transfer_retries_on_fresh_sessions(tmp, monkeypatch):
+    src = build_store(tmp, "src", [b"a", b"b", b"c"])
+    dst = build_store(tmp, "dst")
+    monkeypatch.setattr(farmfs.util.time, "sleep", lambda seconds: None)
+    real_import = FileBlobstoreSession.import_via_fd
+    failures = {build_checksum(b"b")}
+
+    def flaky_import(self, getSrcHandle, blob, force=False):
+        if blob in failures:
+            failures.remove(blob)
+            raise ConnectionResetError("connection reset")
+        return real_import(self, getSrcHandle, blob, force)
+    monkeypatch.setattr(FileBlobstoreSession, "import_via_fd", flaky_import)
+    with Transfer(src, dst, workers=2) as xfer:
+        assert sorted(xfer.copy(src.blobs())) == list(src.blobs())
+    assert list(dst.blobs()) == list(src.blobs())
+    assert xfer.src_pool.discarded == 1
+    assert xfer.dst_pool.discarded == 1
+
+
+def test_transfer_bounds_bytes_in_flight(tmp, monkeypatch):
+    payloads = [bytes([i]) * 100 for i in range(12)]
+    src = build_store(tmp, "src", payloads)
+    dst = build_store(tmp, "dst")
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, most seen
+    real_import = FileBlobstoreSession.import_via_fd
+
+    def counted_import(self, getSrcHandle, blob, force=False):
+        with lock:
+            in_flight[0] += 100
+            in_flight[1] = max(in_flight)
+        try:
+            return real_import(self, getSrcHandle, blob, force)
+        finally:
+            with lock:
+                in_flight[0] -= 100
+    monkeypatch.setattr(FileBlobstoreSession, "import_via_fd", counted_import)
+    with Transfer(src, dst, workers=8, max_in_flight=250) as xfer:
+        assert len(list(xfer.copy(src.blobs()))) == 12
+    assert 0 < in_flight[1] <= 200
+
+
+def test_session_pool_bad_size(tmp):
+    with pytest.raises(ValueError):
+        SessionPool(build_store(tmp, "src"), 0)
+
+
+def test_fetch_blobs_skips_present_and_duplicates(tmp):
+    src = build_store(tmp, "src", [b"a", b"b", b"c"])
+    dst = build_store(tmp, "dst", [b"b"])
+    a, b, c = (build_checksum(p) for p in [b"a", b"b", b"c"])
+    assert list(missing_blobs(dst, [c, a, b, c, a])) == [c, a]
+    assert sorted(fetch_blobs(dst, src, [c, a, b, c, a], workers=2)) == sorted([a, c])
+    assert list(dst.blobs()) == list(src.blobs())
+    assert list(fetch_blobs(dst, src, [a, b, c])) == []
+
+
+def test_fetch_blobs_missing_source_is_not_retried(tmp, monkeypatch):
+    src = build_store(tmp, "src")
+    dst = build_store(tmp, "dst")
+    monkeypatch.setattr(farmfs.util.time, "sleep", lambda seconds: pytest.fail("retried a missing blob"))
+    with pytest.raises(FileNotFoundError):
+        list(fetch_blobs(dst, src, [build_checksum(b"gone")]))
+
+
+@pytest.fixture
+def remote(vol):
+    server = ApiServer("127.0.0.1", 0, get_app({"<root>": vol}), threads=4)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield HttpBlobstore(f"http://127.0.0.1:{server.server_port}", conn_timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_transfer_bulk_over_http(tmp, remote, monkeypatch):
+    monkeypatch.setattr("farmfs.transfer.DEFAULT_BULK_MAX_BLOB_SIZE", 100)
+    calls = []
+    real_import_many = HttpBlobstoreSession.import_many
+    real_read_many = HttpBlobstoreSession.read_many
+
+    def import_many(self, items):
+        calls.append(("import", len(items)))
+        return real_import_many(self, items)
+
+    def read_many(self, blobs):
+        calls.append(("read", len(blobs)))
+        return real_read_many(self, blobs)
+    monkeypatch.setattr(HttpBlobstoreSession, "import_many", import_many)
+    monkeypatch.setattr(HttpBlobstoreSession, "read_many", read_many)
+    monkeypatch.setattr(HttpBlobstoreSession, "import_via_fd", lambda *args: pytest.fail("copied a blob on its own"))
+    monkeypatch.setattr(HttpBlobstoreSession, "read_handle", lambda *args: pytest.fail("copied a blob on its own"))
+    payloads = [str(i).encode() * (i + 1) for i in range(10)] + [b"large" * 100]
+    blobs = [build_checksum(p) for p in payloads]
+    src = build_store(tmp, "src", payloads)
+    with Transfer(src, remote, workers=2, bulk_batch=4) as xfer:
+        assert sorted(xfer.copy(blobs)) == sorted(blobs)
+    assert sorted(calls) == [("import", 1), ("import", 2), ("import", 4), ("import", 4)]
+    assert xfer.stats.bytes == sum(len(p) for p in payloads)
+    calls.clear()
+    dst = build_store(tmp, "dst", payloads[:1])
+    assert sorted(fetch_blobs(dst, remote, blobs, workers=2)) == sorted(blobs[1:])
+    assert set(dst.blobs()) == set(blobs)
+    assert sum(n for _, n in calls) == 10
+    with pytest.raises(FileNotFoundError):
+        list(fetch_blobs(dst, remote, [build_checksum(b"gone")]))
+
+
+def test_transfer_bulk_fetch_retries_what_is_left(tmp, remote, monkeypatch):
+    payloads = [bytes([i]) * 10 for i in range(6)]
+    blobs = [build_checksum(p) for p in payloads]
+    with remote.session() as sess:
+        sess.import_many([(blob, len(p), lambda p=p: io.BytesIO(p)) for blob, p in zip(blobs, payloads)])
+    monkeypatch.setattr(farmfs.util.time, "sleep", lambda seconds: None)
+    asked = []
+    real_read_many = HttpBlobstoreSession.read_many
+
+    def flaky_read_many(self, wanted):
+        asked.append(list(wanted))
+        for n, (blob, frame) in enumerate(real_read_many(self, wanted)):
+            if len(asked) == 1 and n == 3:
+                raise ConnectionResetError("connection reset")
+            yield blob, frame
+    monkeypatch.setattr(HttpBlobstoreSession, "read_many", flaky_read_many)
+    dst = build_store(tmp, "dst")
+    with Transfer(remote, dst, workers=1) as xfer:
+        assert sorted(xfer.copy(blobs)) == sorted(blobs)
+    assert asked == [blobs, blobs[3:]]
+    assert (xfer.stats.blobs, xfer.stats.bytes) == (6, 60)
+    assert set(dst.blobs()) == set(blobs)
+    assert xfer.src_pool.discarded == 1
+
+
+def test_transfer_rejected_blob_is_not_retried(tmp, remote, monkeypatch):
+    monkeypatch.setattr(farmfs.util.time, "sleep", lambda seconds: pytest.fail("retried a rejected blob"))
+    good, bad = build_checksum(b"good"), build_checksum(b"bad")
+    with remote.session() as sess:
+        with pytest.raises(BlobRejected) as e:
+            sess.import_via_fd(lambda: io.BytesIO(b"not bad"), bad)
+    assert e.value.blob == bad
+    # A corrupt source blob is refused by the bulk upload too, which names it.
+    src = build_store(tmp, "src", [b"good"])
+    with src.session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(b"not bad"), bad)
+    with Transfer(src, remote, workers=1) as xfer:
+        with pytest.raises(BlobRejected) as e:
+            list(xfer.copy([good, bad]))
+    assert e.value.blob == bad
+    assert remote.exists_many([good, bad]) == {good}
+
+
+def test_transfer_chunked_sends_missing_chunks(tmp, vol, remote):
+    data = random.Random(0).randbytes(50000)
+    edited = data[:25000] + b"an edit" + data[25000:]
+    src = build_store(tmp, "src", [data, edited])
+    src.chunk_size = 1024
+    blobs = [build_checksum(data), build_checksum(edited)]
+    manifests = [src.chunk(blob) for blob in blobs]
+    for blob in blobs:
+        src.evict(blob)
+    with Transfer(src, remote, workers=2) as xfer:
+        assert list(xfer.copy(blobs[:1])) == blobs[:1]
+    assert xfer.stats.bytes == len(data)
+    # The edited copy only sends the chunks the edit changed.
+    with Transfer(src, remote, workers=2) as xfer:
+        assert list(xfer.copy(blobs[1:])) == blobs[1:]
+    assert xfer.stats.bytes < len(edited) // 4
+    remote_bs = getvol(vol).bs
+    assert [remote_bs.manifest(blob) for blob in blobs] == manifests
+    dst = build_store(tmp, "dst")
+    assert sorted(fetch_blobs(dst, remote, blobs)) == sorted(blobs)
+    assert dst.blob_path(blobs[1]).content("rb") == edited
+
+
+def test_transfer_more_workers_than_pool(tmp, remote, monkeypatch):
+    """Pooled sessions don't leave workers, or the checks for missing chunks, waiting on a connection."""
+    monkeypatch.setattr(farmfs.util.time, "sleep", lambda seconds: pytest.fail("waited for a connection"))
+    remote.pool.max_size = 2
+    remote.pool.wait_timeout = 1.0
+    payloads = [bytes([i]) * 10 for i in range(20)]
+    data = random.Random(0).randbytes(50000)
+    src = build_store(tmp, "src", payloads + [data])
+    src.chunk_size = 1024
+    src.chunk(build_checksum(data))
+    src.evict(build_checksum(data))
+    blobs = [build_checksum(p) for p in payloads + [data]]
+    with Transfer(src, remote, workers=4, bulk_batch=1) as xfer:
+        assert sorted(xfer.copy(blobs)) == sorted(blobs)
+    assert remote.pool.max_size == 2
+    dst = build_store(tmp, "dst")
+    assert sorted(fetch_blobs(dst, remote, blobs, workers=4)) == sorted(blobs)
@@ -1,4 +1,6 @@
 from io import BytesIO
+import os
+import random
 
 import pytest
 from farmfs.fs import Path, ensure_copy, ensure_readonly
@@ -6,6 +8,7 @@ from farmfs.ui import farmfs_ui, dbg_ui
 from farmfs.util import egest
 from farmfs.volume import mkfs
 from farmfs.api import get_app
+from farmfs.hashcache import RACY_NS
 from farmfs import getvol
 import uuid
 from delnone import delnone
@@ -173,6 +176,53 @@ def test_farmfs_freeze_snap_thaw(
     child_path.islink()
 
 
+@pytest.mark.parametrize("workers", ["1", "4"])
+def test_farmfs_freeze_workers(vol, workers, capsys):
+    # Duplicated content makes the workers race to import the same blobs.
+    for d in ["a", "b", "c"]:
+        parent = build_dir(vol, d)
+        for f in range(10):
+            build_file(parent, str(f), str(f % 3))
+    r = farmfs_ui(["freeze", "--workers", workers], vol)
+    captured = capsys.readouterr()
+    assert r == 0
+    lines = captured.out.splitlines()
+    assert [line.split()[1] for line in lines] == sorted(f"{d}/{f}" for d in "abc" for f in range(10))
+    assert sum(1 for line in lines if not line.endswith("was a duplicate")) == 3
+    r = farmfs_ui(["thaw", "--workers", workers], vol)
+    captured = capsys.readouterr()
+    assert r == 0
+    assert [line.split()[1] for line in captured.out.splitlines()] == sorted(f"{d}/{f}" for d in "abc" for f in range(10))
+    assert vol.join("c/5").content("r") == "2"
+
+
+@pytest.mark.parametrize("flags,hashed", [([], 0), (["--no-cache"], 1)])
+def test_farmfs_thaw_freeze_cache(vol, flags, hashed, monkeypatch, capsys):
+    a = build_file(vol, "a", "a")
+    a_csum = build_checksum(b"a")
+    r = farmfs_ui(["freeze"], vol)
+    assert r == 0
+    # Thaw copies the blob's mtime, which must be old enough not to be racy.
+    blob = a.readlinkat()
+    os.utime(blob._path, ns=(0, blob.stat().st_mtime_ns - 10 * RACY_NS))
+    r = farmfs_ui(["thaw", "a"], vol)
+    assert r == 0
+    assert a.isfile()
+    checksums = []
+    real_checksum = Path.checksum
+    def counted_checksum(path):
+        checksums.append(path)
+        return real_checksum(path)
+    monkeypatch.setattr(Path, "checksum", counted_checksum)
+    capsys.readouterr()
+    r = farmfs_ui(["freeze"] + flags + ["a"], vol)
+    captured = capsys.readouterr()
+    assert r == 0
+    assert captured.out == f"Imported a with checksum {a_csum} was a duplicate\n"
+    assert len(checksums) == hashed
+    assert vol.join(".farmfs/hashcache.db").exists()
+
+
 def test_farmfs_blob_broken(vol1, vol2, capsys):
     r = farmfs_ui(["remote", "add", "backup", "../vol2"], vol1)
     captured = capsys.readouterr()
@@ -329,6 +379,61 @@ def test_farmfs_blob_unreadable(vol, capsys):
     assert r == 0
 
 
+@pytest.mark.parametrize("hasher", [
+    ["--hasher=threads", "--workers=1"],
+    ["--hasher=processes", "--workers=2"],
+    ["--hasher=processes", "--read-size=1M", "--mmap"],
+    ["--read-size=3", "--mmap"],
+])
+def test_farmfs_blob_corruption_hashers(vol, capsys, hasher):
+    for name in ["a", "b", "c"]:
+        build_file(vol, name, name * 1000)
+    build_file(vol, "empty", "")
+    assert farmfs_ui(["freeze"], vol) == 0
+    a_blob = vol.join("a").readlinkat()
+    a_blob.unlink()
+    with a_blob.open("w") as a_fd:
+        a_fd.write("b" * 1000)
+    capsys.readouterr()
+    r = farmfs_ui(["fsck", "--quiet", "--checksums"] + hasher, vol)
+    captured = capsys.readouterr()
+    assert captured.out == "CORRUPTION checksum mismatch in blob %s got %s\n" % (
+        build_checksum(b"a" * 1000),
+        build_checksum(b"b" * 1000),
+    )
+    assert r == 2
+
+
+def test_farmfs_fsck_scrub(vol, capsys):
+    for name in ["a", "b", "c"]:
+        build_file(vol, name, name)
+    assert farmfs_ui(["freeze"], vol) == 0
+    capsys.readouterr()
+    assert farmfs_ui(["fsck", "--quiet", "--checksums", "--scrub", "--rate=1M"], vol) == 0
+    assert capsys.readouterr().out == ""
+    with getvol(vol).scrub_index() as index:
+        assert all(index.verified_at(build_checksum(name.encode())) for name in "abc")
+    a_blob = vol.join("a").readlinkat()
+    a_blob.unlink()
+    with a_blob.open("w") as a_fd:
+        a_fd.write("b")
+    ensure_readonly(a_blob)
+    # a was verified recently, so a scrub doesn't reread it until it is overdue.
+    assert farmfs_ui(["fsck", "--quiet", "--checksums", "--scrub"], vol) == 0
+    expected = "CORRUPTION checksum mismatch in blob %s got %s\n" % (build_checksum(b"a"), build_checksum(b"b"))
+    for _ in range(2):
+        assert farmfs_ui(["fsck", "--quiet", "--checksums", "--scrub", "--max-age=0"], vol) == 2
+        assert capsys.readouterr().out == expected
+
+
+@pytest.mark.parametrize("bad", [["--read-size=0"], ["--read-size=4T"], ["--hasher=gpu"], ["--workers=0"], ["--scrub", "--rate=fast"]])
+def test_farmfs_fsck_bad_hasher_options(vol, bad):
+    build_file(vol, "a", "a")
+    assert farmfs_ui(["freeze"], vol) == 0
+    with pytest.raises(ValueError):
+        farmfs_ui(["fsck", "--quiet", "--checksums"] + bad, vol)
+
+
 def test_farmfs_ignore_corruption(vol, capsys):
     build_file(vol, "a", "a")
     r = farmfs_ui(["freeze"], vol)
@@ -399,6 +504,61 @@ def test_farmfs_keydb_paren_ordering(vol, capsys):
     assert "CORRUPT" not in captured.out
 
 
+def test_farmfs_keydb_unsorted_snap(vol, capsys):
+    """A snapshot stored out of order is refused by diff, reported by fsck, and sorted by --fix."""
+    from posixpath import sep
+    for name in ["a", "b"]:
+        build_file(vol, name, name)
+    r = farmfs_ui(["freeze"], vol)
+    assert r == 0
+    fsvol = getvol(vol)
+    snap_key = "snaps" + sep + "mysnap"
+    items = [{"path": "b", "type": "link", "csum": build_checksum(b"b")},
+             {"path": "a", "type": "link", "csum": build_checksum(b"a")},
+             {"path": ".", "type": "dir"}]
+    fsvol.keydb.write(snap_key, items, overwrite=False)
+    with pytest.raises(ValueError, match="out of order"):
+        farmfs_ui(["snap", "diff", "mysnap"], vol)
+    r = farmfs_ui(["fsck", "--quiet", "--keydb"], vol)
+    captured = capsys.readouterr()
+    assert "CORRUPT keydb key: snaps/mysnap" in captured.out
+    assert r == 16
+    r = farmfs_ui(["fsck", "--quiet", "--keydb", "--fix"], vol)
+    captured = capsys.readouterr()
+    assert "FIXED keydb key: snaps/mysnap" in captured.out
+    assert r == 0
+    r = farmfs_ui(["snap", "diff", "mysnap"], vol)
+    captured = capsys.readouterr()
+    assert r == 0
+    assert captured.out == ""
+
+
+def test_farmfs_keydb_stale_digest(vol, capsys, monkeypatch):
+    """A directory digest which doesn't match the snapshot's contents is reported by fsck and fixed by --fix."""
+    from posixpath import sep
+    from farmfs import snapformat
+    monkeypatch.setattr("farmfs.snapformat.DEFAULT_SNAP_FORMAT", "binary-zlib")
+    a = build_dir(vol, "a")
+    build_file(a, "b", "b")
+    assert farmfs_ui(["freeze"], vol) == 0
+    assert farmfs_ui(["snap", "make", "mysnap"], vol) == 0
+    fsvol = getvol(vol)
+    snap_key = "snaps" + sep + "mysnap"
+    items = snapformat.decode(fsvol.blob_db.read(snap_key))
+    assert [item.pathStr() for item in items if item.digest() is not None] == [".", "a"]
+    dicts = [item.get_dict() for item in items]
+    dicts[0]["digest"] = items[0].digest()
+    dicts[1]["digest"] = "0" * 32
+    fsvol.blob_db.write(snap_key, snapformat.encode(dicts), overwrite=True)
+    capsys.readouterr()
+    assert farmfs_ui(["fsck", "--quiet", "--keydb"], vol) == 16
+    assert "CORRUPT keydb key: snaps/mysnap (stale directory digests: a)" in capsys.readouterr().out
+    assert farmfs_ui(["fsck", "--quiet", "--keydb", "--fix"], vol) == 0
+    assert "FIXED keydb key: snaps/mysnap" in capsys.readouterr().out
+    assert snapformat.decode(fsvol.blob_db.read(snap_key))[1].digest() == items[1].digest() != "0" * 32
+    assert farmfs_ui(["fsck", "--quiet", "--keydb"], vol) == 0
+
+
 def test_farmfs_keydb_corruption(vol, capsys):
     from farmfs import getvol
     r = farmfs_ui(["snap", "make", "mysnap"], vol)
@@ -726,6 +886,9 @@ def test_gc(vol, capsys):
     captured = capsys.readouterr()
     assert f"Removing {sd_csum}" in captured.out.splitlines()
     assert f"Removing {td_csum}" in captured.out.splitlines()
+    # The deleted snapshot's blob goes too.
+    noop_summary = captured.out.splitlines()[-1]
+    assert noop_summary.startswith("3 unused blobs, ") and noop_summary.endswith(" bytes reclaimable")
     assert captured.err == ""
     assert r == 0
     assert sk_blob.exists()
@@ -737,6 +900,7 @@ def test_gc(vol, capsys):
     captured = capsys.readouterr()
     assert f"Removing {sd_csum}" in captured.out.splitlines()
     assert f"Removing {td_csum}" in captured.out.splitlines()
+    assert captured.out.splitlines()[-1] == "Removed 3 unused blobs, reclaimed %s bytes" % noop_summary.split()[3]
     assert captured.err == ""
     assert r == 0
     assert sk_blob.exists()
@@ -745,6 +909,196 @@ def test_gc(vol, capsys):
     assert not td_blob.exists()
 
 
+def test_gc_small_runs_keeps_duplicates(vol, capsys, monkeypatch):
+    # Runs of two references, so the duplicates below fall within and across runs.
+    monkeypatch.setattr("farmfs.volume.SPILL_RUN_SIZE", 2)
+    for i in range(4):
+        build_file(vol, "same%d" % i, "same")
+    build_file(vol, "zz", "other")
+    build_file(vol, "gone", "gone")
+    assert farmfs_ui(["freeze"], vol) == 0
+    assert farmfs_ui(["snap", "make", "s1"], vol) == 0
+    vol.join("gone").unlink()
+    assert farmfs_ui(["snap", "delete", "s1"], vol) == 0
+    capsys.readouterr()
+    assert farmfs_ui(["gc"], vol) == 0
+    removed = [line.removeprefix("Removing ") for line in capsys.readouterr().out.splitlines() if line.startswith("Removing ")]
+    assert build_checksum(b"gone") in removed
+    assert build_checksum(b"same") not in removed and build_checksum(b"other") not in removed
+    assert farmfs_ui(["fsck", "--quiet", "--missing"], vol) == 0
+    assert all(vol.join("same%d" % i).content("rb") == b"same" for i in range(4))
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_gc_chunked(vol, capsys, monkeypatch, incremental):
+    monkeypatch.setattr("farmfs.blobstore.DEFAULT_CHUNK_THRESHOLD", 1024 * 1024)
+    gc = ["gc", "--incremental"] if incremental else ["gc"]
+    # Seeded, since now and then random data has no chunk boundary and isn't chunked.
+    payload = random.Random(0).randbytes(3 * 1024 * 1024)
+    big = Path("big", vol)
+    with big.open("wb") as fd:
+        fd.write(payload)
+    build_file(vol, "small", "small")
+    assert farmfs_ui(["freeze"], vol) == 0
+    bs = getvol(vol).bs
+    blob = build_checksum(payload)
+    manifest = bs.manifest(blob)
+    assert manifest is not None
+    assert farmfs_ui(["snap", "make", "s1"], vol) == 0
+    capsys.readouterr()
+    # The plain copy is linked from the tree, so it stays.
+    assert farmfs_ui(gc, vol) == 0
+    assert capsys.readouterr().out == "Removed 0 unused blobs, reclaimed 0 bytes\n"
+    assert farmfs_ui(["thaw", "big"], vol) == 0
+    big.unlink()
+    capsys.readouterr()
+    assert farmfs_ui(gc + ["--noop"], vol) == 0
+    assert capsys.readouterr().out == (
+        "0 unused blobs, 0 bytes reclaimable\n"
+        f"1 chunked blobs with plain copies, {len(payload)} bytes evictable\n"
+    )
+    # Only in s1 now, so the plain copy goes, and the chunks stay.
+    assert farmfs_ui(gc, vol) == 0
+    assert capsys.readouterr().out == (
+        "Removed 0 unused blobs, reclaimed 0 bytes\n"
+        f"Evicted 1 plain copies of chunked blobs, reclaimed {len(payload)} bytes\n"
+    )
+    assert not bs.blob_path(blob).exists()
+    assert all(bs.exists(chunk) for chunk, _ in manifest)
+    # Restoring links it again, from the chunks.
+    assert farmfs_ui(["snap", "restore", "s1"], vol) == 0
+    assert big.content("rb") == payload
+    assert farmfs_ui(["thaw", "big"], vol) == 0
+    big.unlink()
+    assert farmfs_ui(["snap", "delete", "s1"], vol) == 0
+    capsys.readouterr()
+    assert farmfs_ui(gc, vol) == 0
+    assert f"Removing {blob}\n" in capsys.readouterr().out
+    assert not any(bs.exists(b) for b in [blob] + [chunk for chunk, _ in manifest])
+    assert bs.exists(build_checksum(b"small"))
+
+
+def test_blob_pack(vol, capsys):
+    build_file(vol, "kept", "kept")
+    build_file(vol, "snapped", "snapped")
+    build_file(vol, "big", "big" * 2000)
+    assert farmfs_ui(["freeze"], vol) == 0
+    assert farmfs_ui(["snap", "make", "s1"], vol) == 0
+    assert farmfs_ui(["thaw", "snapped", "big"], vol) == 0
+    vol.join("snapped").unlink()
+    vol.join("big").unlink()
+    capsys.readouterr()
+    # Only the small blob no link or key holds is packed.
+    assert dbg_ui(["blob", "pack"], vol) == 0
+    assert capsys.readouterr().out == "Packed 1 blobs\n"
+    bs = getvol(vol).bs
+    snapped = build_checksum(b"snapped")
+    assert not bs.blob_path(snapped).exists()
+    assert bs.blob_path(build_checksum(b"kept")).exists()
+    assert farmfs_ui(["fsck", "--quiet", "--missing", "--checksums", "--blob-permissions"], vol) == 0
+    assert dbg_ui(["blob", "read", snapped], vol) == 0
+    assert capsys.readouterr().out == "snapped"
+    # Restoring links it again, out of its pack.
+    assert farmfs_ui(["snap", "restore", "s1"], vol) == 0
+    assert vol.join("snapped").content("rb") == b"snapped"
+    assert farmfs_ui(["thaw", "snapped"], vol) == 0
+    vol.join("snapped").unlink()
+    assert farmfs_ui(["snap", "delete", "s1"], vol) == 0
+    capsys.readouterr()
+    assert farmfs_ui(["gc"], vol) == 0
+    assert f"Removing {snapped}\n" in capsys.readouterr().out
+    assert not bs.exists(snapped)
+    assert dbg_ui(["blob", "repack"], vol) == 0
+    assert capsys.readouterr().out == "Repacked, reclaimed 0 bytes\n"
+
+
+def test_blob_index(vol, capsys):
+    build_file(vol, "a", "a")
+    build_file(vol, "b", "b")
+    assert farmfs_ui(["freeze"], vol) == 0
+    capsys.readouterr()
+    # The keydb's blobs are counted too.
+    assert dbg_ui(["blob", "count"], vol) == 0
+    blobs = int(capsys.readouterr().out)
+    assert blobs >= 2
+    assert dbg_ui(["blob", "index"], vol) == 0
+    assert capsys.readouterr().out == "Indexed %d blobs\n" % blobs
+    # Freezing, gc and fsck keep to the index from here on.
+    build_file(vol, "c", "c")
+    assert farmfs_ui(["freeze"], vol) == 0
+    vol.join("a").unlink()
+    assert farmfs_ui(["gc"], vol) == 0
+    assert farmfs_ui(["fsck", "--quiet", "--missing"], vol) == 0
+    capsys.readouterr()
+    bs = getvol(vol).bs
+    assert dbg_ui(["blob", "count"], vol) == 0
+    assert capsys.readouterr().out == "%d\n" % len(list(bs._listed_blobs()))
+    assert list(bs.blobs()) == list(bs._listed_blobs())
+    assert build_checksum(b"c") in bs.blobs() and build_checksum(b"a") not in bs.blobs()
+    assert dbg_ui(["blob", "index", "--drop"], vol) == 0
+    assert capsys.readouterr().out == "Dropped the blob index\n"
+    assert getvol(vol).bs.index.count() is None
+
+
+def test_gc_incremental(vol1, vol2, capsys):
+    def refcounts_ok(vol):
+        r = farmfs_ui(["fsck", "--quiet", "--refcounts"], vol)
+        out = capsys.readouterr().out
+        return r == 0 and "wrong reference count" not in out
+    a = build_dir(vol1, "a")
+    build_file(a, "b", "b")
+    build_file(vol1, "c", "c")
+    assert farmfs_ui(["freeze"], vol1) == 0
+    assert farmfs_ui(["snap", "make", "s1"], vol1) == 0
+    assert refcounts_ok(vol1)
+    # Thaw and restore move references between the tree and snapshot.
+    assert farmfs_ui(["thaw", "c"], vol1) == 0
+    vol1.join("c").unlink()
+    assert refcounts_ok(vol1)
+    assert farmfs_ui(["snap", "restore", "s1"], vol1) == 0
+    assert refcounts_ok(vol1)
+    # Pull counts the links it makes.
+    build_file(vol2, "d", "d")
+    assert farmfs_ui(["freeze"], vol2) == 0
+    assert farmfs_ui(["remote", "add", "other", "../vol2"], vol1) == 0
+    assert farmfs_ui(["pull", "other"], vol1) == 0
+    assert vol1.join("d").islink() and not vol1.join("c").exists()
+    assert refcounts_ok(vol1)
+    capsys.readouterr()
+    # c is still in s1, and b in the tree.
+    assert farmfs_ui(["gc", "--incremental"], vol1) == 0
+    assert capsys.readouterr().out == "Removed 0 unused blobs, reclaimed 0 bytes\n"
+    assert farmfs_ui(["snap", "delete", "s1"], vol1) == 0
+    # A link copied behind farmfs's back isn't counted, but still keeps its blob.
+    os.symlink(os.readlink(vol1.join("d")._path), vol1.join("copy")._path)
+    assert farmfs_ui(["thaw", "d"], vol1) == 0
+    assert refcounts_ok(vol1) is False
+    capsys.readouterr()
+    assert farmfs_ui(["gc", "--incremental"], vol1) == 0
+    assert capsys.readouterr().out == (
+        f"Removing {build_checksum(b'c')}\nRemoving {build_checksum(b'b')}\n"
+        "Removed 2 unused blobs, reclaimed 2 bytes\n"
+    )
+    assert vol1.join("copy").exists()
+    assert farmfs_ui(["fsck", "--quiet", "--refcounts", "--fix"], vol1) == 32
+    assert "rebuilt reference index" in capsys.readouterr().out
+    assert refcounts_ok(vol1)
+
+
+def test_gc_incremental_unbuilt(vol, capsys):
+    build_file(vol, "a", "a")
+    assert farmfs_ui(["freeze"], vol) == 0
+    vol.join(".farmfs/refs.db").unlink()
+    with pytest.raises(ValueError, match="reference index has not been built"):
+        farmfs_ui(["gc", "--incremental"], vol)
+    assert farmfs_ui(["fsck", "--quiet", "--refcounts"], vol) == 32
+    assert farmfs_ui(["fsck", "--quiet", "--refcounts", "--fix"], vol) == 32
+    capsys.readouterr()
+    assert farmfs_ui(["fsck", "--quiet", "--refcounts"], vol) == 0
+    assert farmfs_ui(["gc", "--incremental"], vol) == 0
+    assert capsys.readouterr().out == "Removed 0 unused blobs, reclaimed 0 bytes\n"
+
+
 def test_missing(vol, capsys):
     a = Path("a", vol)
     b = Path("b", vol)
@@ -1081,6 +1435,7 @@ def test_remote_upload_download(
     vol1,
     vol2,
     capsys,
+    monkeypatch,
     source_type,
     snap_name,
     uploaded,
@@ -1154,19 +1509,24 @@ def test_remote_upload_download(
         server_root2 = tmp.join("server2")
         with run_server(server_root2, 5002):
             url2 = get_endpoint(5002) if get_endpoint else str(server_root2)
-            r = dbg_ui(
-                delnone(
-                    [remote_type, "upload", source_type, snap_name, "--quiet", url2]
-                ),
-                vol1,
-            )
-            captured = capsys.readouterr()
-            assert r == 0
-            r = dbg_ui([remote_type, "check", "--quiet", url2], vol1)
-            captured = capsys.readouterr()
-            assert r == 2
-            assert captured.out == blob_a + " " + b_csum + "\n"
-            assert captured.err == ""
+            upload2 = delnone([remote_type, "upload", source_type, snap_name, "--quiet", url2])
+            if remote_type == "api":
+                # farmapi hashes what it is sent, so it refuses the corrupt blob, once.
+                monkeypatch.setattr("farmfs.util.time.sleep", lambda seconds: pytest.fail("retried a rejected blob"))
+                r = dbg_ui(upload2, vol1)
+                captured = capsys.readouterr()
+                assert r == 8
+                assert captured.out.startswith(f"Upload failed, {blob_a} rejected: status code 400: ")
+                assert "Successfully uploaded" not in captured.out
+            else:
+                r = dbg_ui(upload2, vol1)
+                captured = capsys.readouterr()
+                assert r == 0
+                r = dbg_ui([remote_type, "check", "--quiet", url2], vol1)
+                captured = capsys.readouterr()
+                assert r == 2
+                assert captured.out == blob_a + " " + b_csum + "\n"
+                assert captured.err == ""
             # Read the files from remote:
             r = dbg_ui([remote_type, "read", url, blob_a, blob_a], vol1)
             captured = capsys.readouterr()
@@ -1193,7 +1553,7 @@ def test_remote_upload_download(
                 pass
             # setup attempt to download blobs.
             r = dbg_ui(
-                delnone([remote_type, "download", "userdata", "--quiet", url]), vol2
+                delnone([remote_type, "download", "userdata", "--quiet", "--workers=3", url]), vol2
             )
             captured = capsys.readouterr()
             assert r == 0
@@ -30,7 +30,9 @@ from farmfs.util import (
     nth,
     pfmap,
     pfmaplazy,
+    pfmaplazyordered,
     pipeline,
+    RateLimit,
     retry,
     RetriesExhausted,
     retryFdIo2,
@@ -40,6 +42,8 @@ from farmfs.util import (
     take,
     uncurry,
     uniq,
+    uniq_sorted,
+    spill_sorted,
     withHandles2,
     withHandles2Thunk,
     file_thunk,
@@ -159,6 +163,42 @@ def test_uniq() -> None:
     assert list(uniq([1, 2, 3, 2])) == [1, 2, 3]
 
 
+def test_uniq_sorted() -> None:
+    assert list(uniq_sorted([1, 2, 2, 4, 4, 4])) == [1, 2, 4]
+    assert list(uniq_sorted([])) == []
+
+
+@pytest.mark.parametrize("run_size", [1, 3, 1000])
+def test_spill_sorted(tmp_path, run_size: int) -> None:
+    items = ["%04d" % ((i * 37) % 100) for i in range(300)]
+    out = list(spill_sorted(items, run_size, str(tmp_path)))
+    assert out == sorted(set(items))
+    # Runs are cleaned up once the stream is done.
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("run_size", [1, 2, 3, 4])
+def test_spill_sorted_duplicates(tmp_path, run_size: int) -> None:
+    # Duplicates within the first run don't make it look like the input ran out.
+    assert list(spill_sorted(["a", "a", "b", "c", "d"], run_size, str(tmp_path))) == ["a", "b", "c", "d"]
+    # Nor do duplicates across runs, or runs made only of duplicates.
+    items = ["d", "a", "a", "a", "c", "b", "a", "d", "e", "e"]
+    assert list(spill_sorted(items, run_size, str(tmp_path))) == ["a", "b", "c", "d", "e"]
+    assert list(spill_sorted(["a", "a"], run_size, str(tmp_path))) == ["a"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spill_sorted_reads_everything_first() -> None:
+    seen = []
+    def source() -> Iterable[str]:
+        for item in ["c", "a", "b"]:
+            seen.append(item)
+            yield item
+    out = spill_sorted(source(), run_size=2)
+    assert next(out) == "a"
+    assert seen == ["c", "a", "b"]
+
+
 def test_irange() -> None:
     assert list(take(3)(irange(0, 1))) == [0, 1, 2]
     assert list(take(3)(irange(0, -1))) == [0, -1, -2]
@@ -282,7 +322,7 @@ def test_every() -> None:
     assert every(even, [])
 
 
-@pytest.mark.parametrize("pfmap_func", [pfmap, pfmaplazy])
+@pytest.mark.parametrize("pfmap_func", [pfmap, pfmaplazy, pfmaplazyordered])
 def test_pfmap(pfmap_func) -> None:
     increment = lambda x: x + 1
     p_increment = pfmap_func(increment, workers=4)
@@ -290,6 +330,18 @@ def test_pfmap(pfmap_func) -> None:
     assert sorted(p_increment(range(1, limit))) == sorted(range(2, limit + 1))
 
 
+def test_pfmaplazyordered_keeps_order() -> None:
+    import time
+    def slow_first(x: int) -> int:
+        if x % 5 == 0:
+            time.sleep(0.01)
+        return x * 2
+    p_double = pfmaplazyordered(slow_first, workers=4, buffer_size=2)
+    assert list(p_double(range(50))) == [x * 2 for x in range(50)]
+    with pytest.raises(ValueError):
+        pfmaplazyordered(slow_first, workers=0)
+
+
 def test_jaccard_similarity() -> None:
     a = set([1, 2, 3])
     b = set([1, 2, 4, 5])
@@ -494,3 +546,27 @@ def test_is_past_false() -> None:
 def test_is_past_equal() -> None:
     t = datetime(2026, 2, 28, 0, 0, 0, tzinfo=timezone.utc)
     assert is_past(t, t) is True
+
+
+def test_rate_limit() -> None:
+    now = [0.0]
+    slept: List[float] = []
+
+    def sleep(seconds: float) -> None:
+        slept.append(seconds)
+        now[0] += seconds
+    limit = RateLimit(100, clock=lambda: now[0], sleep=sleep)
+    # A second's worth of burst goes straight through.
+    limit.acquire(100)
+    assert slept == []
+    # Then work is paced to the rate, even when one item exceeds it.
+    limit.acquire(50)
+    limit.acquire(250)
+    assert slept == [0.5, 2.5]
+    # Idle time only banks a second's worth of budget.
+    now[0] += 60
+    limit.acquire(100)
+    limit.acquire(10)
+    assert slept == [0.5, 2.5, 0.1]
+    with pytest.raises(ValueError):
+        RateLimit(0)
@@ -1,3 +1,9 @@
+import io
+from errno import EXDEV
+
+import pytest
+from farmfs.blobstore import FileBlobstore
+from farmfs.snapshot import add_dir_digests, path_key
 from farmfs.volume import KeySnapshot, tree_diff
 from itertools import permutations, combinations
 from re import search
@@ -5,6 +11,8 @@ from farmfs.fs import sep, ROOT, Path
 from tests.trees import makeLink
 from functools import reduce
 from farmfs.util import uncurry
+from farmfs import getvol
+from .conftest import build_blob, build_checksum, build_link
 
 
 def produce_mismatches(segments):
@@ -49,3 +57,135 @@ def test_tree_diff_order():
     diff = tree_diff(left, right)
     paths = list(map(lambda change: change.path(ROOT), diff))
     assert paths == [path_a, path_b]
+
+
+def test_path_key_order_matches_path():
+    paths = ["/"] + list(filter(lambda p: search("//", p) is None,
+                                map(lambda s: sep + "".join(s), permutations("abc/+", 4))))
+    by_path = sorted(paths, key=Path)
+    by_key = sorted(paths, key=path_key)
+    assert by_key == by_path
+    assert path_key(".") == path_key("/") == ()
+    assert path_key("a/./b") == path_key("/a/b") == ("a", "b")
+
+
+def test_presorted_snapshot_streams():
+    links = [makeLink(Path(p), "00000000000000000000000000000000") for p in ["/a", "/a/b", "/a+"]]
+    assert [i.pathStr() for i in KeySnapshot(links, "ok", None, presorted=True)] == ["a", "a/b", "a+"]
+    out_of_order = KeySnapshot(list(reversed(links)), "bad", None, presorted=True)
+    with pytest.raises(ValueError, match="Snapshot bad is out of order"):
+        list(out_of_order)
+    unsorted = KeySnapshot(list(reversed(links)), "bad", None)
+    assert [i.pathStr() for i in unsorted] == ["a", "a/b", "a+"]
+
+
+def test_dir_digests():
+    def snap(prefix, csum):
+        return add_dir_digests([
+            {"path": ".", "type": "dir"},
+            {"path": prefix, "type": "dir"},
+            {"path": prefix + "/a", "type": "link", "csum": csum},
+            {"path": prefix + "/b", "type": "dir"},
+            {"path": "z", "type": "dir"},
+        ])
+    x = snap("x", "0" * 32)
+    moved = snap("y", "0" * 32)
+    changed = snap("x", "1" * 32)
+    # A directory's digest covers its contents, not its name.
+    assert x[1]["digest"] == moved[1]["digest"]
+    assert x[0]["digest"] != moved[0]["digest"]
+    # A change moves the digests of every directory above it, and no others.
+    assert x[1]["digest"] != changed[1]["digest"]
+    assert x[0]["digest"] != changed[0]["digest"]
+    assert x[3]["digest"] == changed[3]["digest"]
+    assert x[4]["digest"] == changed[4]["digest"]
+
+
+def test_tree_diff_skips_matching_digests():
+    left = KeySnapshot(add_dir_digests([
+        {"path": ".", "type": "dir"},
+        {"path": "a", "type": "dir"},
+        {"path": "a/b", "type": "link", "csum": "0" * 32},
+        {"path": "c", "type": "link", "csum": "0" * 32},
+    ]), "left", None, presorted=True)
+    right_items = add_dir_digests([
+        {"path": ".", "type": "dir"},
+        {"path": "a", "type": "dir"},
+        {"path": "a/b", "type": "link", "csum": "0" * 32},
+        {"path": "c", "type": "link", "csum": "1" * 32},
+    ])
+    # Lie about a/b. Only a diff which skips a, on the strength of its digest, misses it.
+    right_items[2]["csum"] = "2" * 32
+    right = KeySnapshot(right_items, "right", None, presorted=True)
+    assert [str(d) for d in tree_diff(left, right)] == ['("c", link, ' + "1" * 32 + ")"]
+
+
+@pytest.mark.parametrize("run_size", [1, 2, 1000])
+def test_unused_blobs_spilled(vol, run_size):
+    blobs = [build_blob(vol, str(i).encode()) for i in range(10)]
+    for i in range(0, 10, 3):
+        build_link(vol, "l%d" % i, blobs[i])
+    fsvol = getvol(vol)
+    fsvol.snapdb.write("snap", fsvol.tree(), overwrite=False)
+    vol.join("l0").unlink()
+    unused = list(fsvol.unused_blobs(fsvol.items(), run_size))
+    assert unused == sorted(b for i, b in enumerate(blobs) if i % 3 != 0)
+
+
+@pytest.mark.parametrize("run_size", [1, 2, 4])
+def test_unused_blobs_duplicate_references(vol, run_size):
+    blobs = [build_blob(vol, str(i).encode()) for i in range(6)]
+    # Files with the same content, kept in a snapshot too, reference blobs many times over.
+    for i in range(4):
+        build_link(vol, "a%d" % i, blobs[0])
+        build_link(vol, "b%d" % i, blobs[1])
+    build_link(vol, "c", blobs[2])
+    fsvol = getvol(vol)
+    fsvol.snapdb.write("snap", fsvol.tree(), overwrite=False)
+    build_link(vol, "d", blobs[3])
+    unused = list(fsvol.unused_blobs(fsvol.items(), run_size))
+    assert unused == sorted(blobs[4:])
+
+
+def test_unused_blobs_missing(vol):
+    keep = build_blob(vol, b"keep")
+    build_blob(vol, b"orphan")
+    build_link(vol, "keep", keep)
+    fsvol = getvol(vol)
+    fsvol.bs.delete_blob(keep)
+    orphans = fsvol.unused_blobs(fsvol.items(), run_size=1)
+    # Nothing comes out, so nothing is deleted, if a referenced blob is missing.
+    with pytest.raises(AssertionError, match="Missing " + keep):
+        next(orphans)
+
+
+def test_link_compressed_blob(vol):
+    fsvol = getvol(vol)
+    payload = b"a compressible blob\n" * 1000
+    blob = build_checksum(payload)
+    with FileBlobstore(fsvol.bs.root, fsvol.bs.tmp_dir, codec="gzip").session() as sess:
+        sess.import_via_fd(lambda: io.BytesIO(payload), blob)
+    assert fsvol.bs.stored_blob(blob)[1] == "gzip"
+    # Linking decompresses the blob, so the link can be followed.
+    fsvol.link(vol.join("a"), blob)
+    assert vol.join("a").content("rb") == payload
+    assert fsvol.bs.stored_blob(blob) == (fsvol.bs.blob_path(blob), None)
+
+
+def test_freeze_across_mounts(vol, monkeypatch):
+    fsvol = getvol(vol)
+    cache = fsvol.hash_cache()
+
+    def cross_device(tree_path, blob):
+        raise OSError(EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(fsvol.bs, "import_via_link", cross_device)
+    with vol.join("a").open("wb") as fd:
+        fd.write(b"a")
+    result = fsvol.freeze(vol.join("a"), cache)
+    assert (result["csum"], result["was_dup"]) == (build_checksum(b"a"), False)
+    assert vol.join("a").islink() and vol.join("a").content("rb") == b"a"
+    # The blob is a copy, not the tree's file.
+    assert fsvol.bs.blob_path(result["csum"]).stat().st_nlink == 1
+    with vol.join("b").open("wb") as fd:
+        fd.write(b"a")
+    assert fsvol.freeze(vol.join("b"))["was_dup"] is True